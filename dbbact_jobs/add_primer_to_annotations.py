@@ -4,7 +4,7 @@
 
 import argparse
 from dbbact_server.utils import debug, SetDebugLevel
-from dbbact_server import db_access
+from dbbact_server import db_access, dbannotations
 import sys
 
 __version__ = "1.0"
@@ -47,6 +47,7 @@ def add_primer_to_annotations(con, cur, update_all=False, commit=True):
 		debug(2, 'annotation %d primer region %d' % (cid, cprimerid))
 		cur.execute('UPDATE AnnotationsTable SET primerID=%s WHERE id=%s', [cprimerid, cid])
 	debug(3, 'found %d annotations' % idx)
+	dbannotations.invalidate_annotation_cache(con, cur)
 	if commit:
 		debug(3, 'committing changes to database')
 		con.commit()
@@ -4,7 +4,7 @@
 
 import argparse
 from dbbact_server.utils import debug, SetDebugLevel
-from dbbact_server import db_access
+from dbbact_server import db_access, dbchanges
 
 import sys
 
@@ -16,6 +16,11 @@ def delete_unused_seqs(con, cur, delete=False):
 	if delete:
 		cur.execute('DELETE FROM SequencesTable WHERE NOT EXISTS(SELECT SequencesAnnotationTable.seqid FROM SequencesAnnotationTable WHERE SequencesAnnotationTable.seqid = SequencesTable.id)')
 		debug(3, 'deleted')
+		err = dbchanges.add_change(con, cur, 'sequence')
+		if err:
+			debug(7, 'failed to record the change (%s). rolling back' % err)
+			con.rollback()
+			return err
 		con.commit()
 	else:
 		cur.execute('SELECT * FROM SequencesTable WHERE NOT EXISTS(SELECT SequencesAnnotationTable.seqid FROM SequencesAnnotationTable WHERE SequencesAnnotationTable.seqid = SequencesTable.id)')
@@ -22,7 +22,10 @@ commands = {'update_seq_taxonomy': './update_seq_taxonomy.py',
 			# 'update_gg': './update_whole_seq_db.py -w greengenes',
 			# 'update_seq_translator': './update_whole_seq_db.py --server-type develop --wholeseqdb silva --wholeseq-file ~/whole_seqs/SILVA_132_SSURef_tax_silva.fasta',
 			'update_seq_translator': './update_whole_seq_db.py --wholeseqdb silva',
-			'update_seq_counts': './update_seq_counts.py'}
+			'update_seq_counts': './update_seq_counts.py',
+			# rebuild the sequence index snapshots after the sequence updates. the output file names should match the server DBBACT_SEQUENCE_INDEX/DBBACT_PREFIX_INDEX/DBBACT_CLOSE_INDEX
+			# (i.e. -p update_sequence_index:output:/path/sequence_index.npy -p update_sequence_index:close-output:/path/close_index.npy)
+			'update_sequence_index': './update_sequence_index.py'}
 
 
 def get_time_to_tomorrow(hour, minute=0):
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# Rebuild the ontology closure table (OntologyClosureTable) from the ontology tree
+
+'''Rebuild the ontology transitive closure table (OntologyClosureTable, created by database/ontology_closure.psql) from OntologyTreeStructureTable.
+The server updates the table when adding terms, so need to run only once after creating the table,
+and after changing the ontology tree not through the server / utils/ontology_manager.py (i.e. loading a new ontology version).
+'''
+
+import sys
+from io import StringIO
+
+import argparse
+import setproctitle
+
+from dbbact_server import db_access, ontology_closure
+from dbbact_server.utils import debug, SetDebugLevel
+
+__version__ = "0.9"
+
+
+def update_ontology_closure(con, cur, chunk_size=1000000):
+	debug(3, 'update_ontology_closure started')
+	if ontology_closure.np is None:
+		debug(7, 'numpy not installed. cannot build the ontology closure')
+		return 'numpy not installed'
+	cur.execute('SELECT ontologyId, ontologyParentId, ontologyNameId FROM OntologyTreeStructureTable')
+	edges = cur.fetchall()
+	debug(3, 'building the closure for %d edges' % len(edges))
+	if len(edges) == 0:
+		children, parents, ontologies = [], [], []
+	else:
+		children, parents, ontologies = zip(*[(cres[0], cres[1], cres[2]) for cres in edges])
+	termids, ancestorids, depths, ontologyids = ontology_closure.build_closure(children, parents, ontologies)
+	debug(3, 'found %d closure rows. writing' % len(termids))
+	cur.execute('TRUNCATE OntologyClosureTable')
+	for cpos in range(0, len(termids), chunk_size):
+		data = StringIO()
+		for crow in zip(termids[cpos:cpos + chunk_size].tolist(), ancestorids[cpos:cpos + chunk_size].tolist(), depths[cpos:cpos + chunk_size].tolist(), ontologyids[cpos:cpos + chunk_size].tolist()):
+			data.write('%d\t%d\t%d\t%s\n' % (crow[0], crow[1], crow[2], '\\N' if crow[3] < 0 else crow[3]))
+		data.seek(0)
+		cur.copy_from(data, 'ontologyclosuretable', columns=('termid', 'ancestorid', 'depth', 'ontologynameid'))
+		debug(2, 'wrote %d rows' % min(cpos + chunk_size, len(termids)))
+	con.commit()
+	debug(3, 'done')
+	return ''
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Rebuild the dbbact ontology closure table. version ' + __version__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--port', help='postgres port', default=5432, type=int)
+	parser.add_argument('--host', help='postgres host', default=None)
+	parser.add_argument('--database', help='postgres database', default='dbbact')
+	parser.add_argument('--user', help='postgres user', default='dbbact')
+	parser.add_argument('--password', help='postgres password', default='magNiv')
+	parser.add_argument('--proc-title', help='name of the process (to view in ps aux)')
+	parser.add_argument('--debug-level', help='debug level (1 for debug ... 9 for critical)', default=2, type=int)
+	args = parser.parse_args(argv)
+
+	SetDebugLevel(args.debug_level)
+	# set the process name for ps aux
+	if args.proc_title:
+		setproctitle.setproctitle(args.proc_title)
+
+	con, cur = db_access.connect_db(database=args.database, user=args.user, password=args.password, port=args.port, host=args.host)
+	update_ontology_closure(con, cur)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -11,7 +11,7 @@ from collections import defaultdict
 
 import psycopg2
 
-from dbbact_server import db_access, dbannotations, dbontology
+from dbbact_server import db_access, dbannotations, dbontology, dbchanges
 from dbbact_server.utils import debug, SetDebugLevel
 
 __version__ = "1.0"
@@ -78,13 +78,17 @@ def update_ontology_parents_overwrite(con, cur):
             else:
                 parentsdict[cdetailtype].extend(parents)
 
+        all_parents = set()
+        for parents in parentsdict.values():
+            all_parents.update(parents)
+        parents_info = dbontology.get_terms_info(con, cur, list(all_parents))
         for cdetailtype, parents in parentsdict.items():
             parents = list(set(parents))
             for cpar in parents:
-                err, cparent_description, cparent_term_id = dbontology.get_name_from_id(con, cur, cpar)
-                if err:
-                    debug(7, err)
+                if cpar not in parents_info:
+                    debug(7, 'termid %d not in OntologyTable' % cpar)
                     continue
+                cparent_description, cparent_term_id = parents_info[cpar]
                 cdetailtype = cdetailtype.lower()
                 debug(1, 'adding parent %s' % cpar)
                 cur.execute('INSERT INTO AnnotationParentsTable (idAnnotation,annotationDetail,ontology, term_id) VALUES (%s,%s,%s,%s)', [cid, cdetailtype, cparent_description, cparent_term_id])
@@ -165,6 +169,15 @@ def update_ontology_parents_overwrite(con, cur):
     cur.execute('ALTER TABLE ontologytreestructuretable ADD CONSTRAINT ontologytreestructuretable_ontologyid_fkey FOREIGN KEY (ontologyid) REFERENCES ontologytable(id)')
     cur.execute('ALTER TABLE ontologytreestructuretable ADD CONSTRAINT ontologytreestructuretable_ontologyparentid_fkey FOREIGN KEY (ontologyparentid) REFERENCES ontologytable(id)')
 
+    # clear the annotation parents cached by the server workers
+    err = dbannotations.invalidate_annotation_cache(con, cur)
+    if not err:
+        # the term sequence/annotation counts changed
+        err = dbchanges.add_change(con, cur, 'term')
+    if err:
+        debug(7, 'failed to record the change (%s). rolling back' % err)
+        con.rollback()
+        return err
     debug(4, 'committing')
     con.commit()
     debug(4, 'added %d, skipped %d' % (added, skipped))
@@ -239,6 +252,15 @@ def update_ontology_parents(con, cur, overwrite=True, ontology=None):
         debug(4, 'adding indexes')
         cur.execute('CREATE INDEX annotationparentstable_idannotation_idx ON annotationparentstable(idannotation int4_ops)')
         cur.execute('CREATE INDEX annotationparentstable_ontology_idx ON annotationparentstable(ontology text_ops)')
+    # clear the annotation parents cached by the server workers
+    err = dbannotations.invalidate_annotation_cache(con, cur)
+    if not err:
+        # the term sequence/annotation counts changed
+        err = dbchanges.add_change(con, cur, 'term')
+    if err:
+        debug(7, 'failed to record the change (%s). rolling back' % err)
+        con.rollback()
+        return err
     debug(4, 'committing')
     con.commit()
     debug(4, 'added %d, skipped %d' % (added, skipped))
@@ -13,7 +13,7 @@ import psycopg2
 import psycopg2.extras
 import setproctitle
 
-from dbbact_server import db_access
+from dbbact_server import db_access, dbchanges
 from dbbact_server.utils import debug, SetDebugLevel
 
 __version__ = "0.9"
@@ -46,6 +46,11 @@ def add_seq_counts(con, cur):
 	debug(2, 'adding total_annotations, total_experiments to SequencesTable')
 	for cseq_id in seq_annotations.keys():
 		cur.execute('UPDATE SequencesTable SET total_annotations=%s, total_experiments=%s WHERE id=%s', [len(seq_annotations[cseq_id]), len(seq_exps[cseq_id]), cseq_id])
+	err = dbchanges.add_change(con, cur, 'sequence_info')
+	if err:
+		debug(7, 'failed to record the change (%s). rolling back' % err)
+		con.rollback()
+		return err
 	con.commit()
 	debug(3, 'done')
 
@@ -9,6 +9,7 @@ import setproctitle
 from dbbact_server.utils import debug, SetDebugLevel
 from dbbact_server import db_access
 from dbbact_server import dbsequences
+from dbbact_server import dbchanges
 
 
 __version__ = '0.9'
@@ -66,6 +67,13 @@ def update_seq_hash(con, cur):
         else:
             count_success = count_success + 1
         count += 1
+    if count_seq_success > 0:
+        err = dbchanges.add_change(con, cur, 'sequence_info')
+        if err:
+            debug(7, 'failed to record the change (%s). rolling back' % err)
+            con.rollback()
+            return err
+        con.commit()
     debug(2, 'added sequence hashes for %d sequences. %d failures' % (count, count_failure))
 
 
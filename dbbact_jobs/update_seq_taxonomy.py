@@ -7,7 +7,7 @@ import os
 import setproctitle
 
 from dbbact_server.utils import debug, SetDebugLevel
-from dbbact_server import db_access
+from dbbact_server import db_access, dbchanges
 
 
 __version__ = '0.9'
@@ -77,6 +77,11 @@ def update_seq_taxonomy(con, cur, rdp='rdp_classifier_2.12/'):
 			cur.execute('UPDATE SequencesTable SET taxonomy=%s WHERE sequence=%s', [taxstr, cseq])
 			num_updated += 1
 	debug(2, 'finished updating database. committing')
+	err = dbchanges.add_change(con, cur, 'sequence_info')
+	if err:
+		debug(7, 'failed to record the change (%s). rolling back' % err)
+		con.rollback()
+		return err
 	con.commit()
 	debug(3, 'done. updated taxonomy for %d sequences' % num_updated)
 
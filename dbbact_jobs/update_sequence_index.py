@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Build the sequence index snapshot files used by the dbbact server workers
+
+'''Build the sequence index snapshot files used by the dbbact server workers:
+the exact sequence index (sequence md5 -> sequence id, primer id), the prefix index (all the sequences sorted, for the shorter/longer sequence matches)
+and the close sequences index (2 bit packed sequences and block tables, for get_close_sequences).
+The server loads (memory maps) the snapshots when DBBACT_SEQUENCE_INDEX / DBBACT_PREFIX_INDEX / DBBACT_CLOSE_INDEX are set to the snapshot file names, and reloads them when the files are replaced.
+'''
+
+import sys
+
+import argparse
+import setproctitle
+
+from dbbact_server import db_access, seqindex
+from dbbact_server.utils import debug, SetDebugLevel
+
+__version__ = "0.9"
+
+
+def update_sequence_index(con, cur, output, index_type='exact'):
+	debug(3, 'update_sequence_index started for %s index' % index_type)
+	if seqindex.np is None:
+		debug(7, 'numpy not installed. cannot build the sequence index')
+		return 'numpy not installed'
+	index = seqindex.INDEX_TYPES[index_type]()
+	err = index.build(con, cur)
+	if err:
+		debug(7, 'failed building the sequence index: %s' % err)
+		return err
+	index.save(output)
+	debug(3, 'done')
+	return ''
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Build the dbbact exact sequence index snapshot file. version ' + __version__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--port', help='postgres port', default=5432, type=int)
+	parser.add_argument('--host', help='postgres host', default=None)
+	parser.add_argument('--database', help='postgres database', default='dbbact')
+	parser.add_argument('--user', help='postgres user', default='dbbact')
+	parser.add_argument('--password', help='postgres password', default='magNiv')
+	parser.add_argument('-o', '--output', help='the exact sequence index snapshot file name (same as DBBACT_SEQUENCE_INDEX of the server)', default='sequence_index.npy')
+	parser.add_argument('--prefix-output', help='if set, also build the prefix index snapshot file (same as DBBACT_PREFIX_INDEX of the server)')
+	parser.add_argument('--close-output', help='if set, also build the close sequences index snapshot file (same as DBBACT_CLOSE_INDEX of the server)')
+	parser.add_argument('--proc-title', help='name of the process (to view in ps aux)')
+	parser.add_argument('--debug-level', help='debug level (1 for debug ... 9 for critical)', default=2, type=int)
+	args = parser.parse_args(argv)
+
+	SetDebugLevel(args.debug_level)
+	# set the process name for ps aux
+	if args.proc_title:
+		setproctitle.setproctitle(args.proc_title)
+
+	con, cur = db_access.connect_db(database=args.database, user=args.user, password=args.password, port=args.port, host=args.host)
+	update_sequence_index(con, cur, args.output)
+	if args.prefix_output is not None:
+		update_sequence_index(con, cur, args.prefix_output, index_type='prefix')
+	if args.close_output is not None:
+		update_sequence_index(con, cur, args.close_output, index_type='close')
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
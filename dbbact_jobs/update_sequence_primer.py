@@ -4,7 +4,7 @@
 
 import argparse
 from dbbact_server.utils import debug, SetDebugLevel
-from dbbact_server import db_access
+from dbbact_server import db_access, dbchanges
 from dbbact_server.dbsequences import GetSequenceId
 from dbbact_server.dbprimers import GetIdFromName
 import sys
@@ -82,6 +82,9 @@ def update_sequence_primer(con, cur, sequence, primer, commit=True):
 		debug(4, 'moving seqid %d to ok sequence %d and deleting' % (cseqid, okid))
 		cur.execute('UPDATE SequencesAnnotationTable SET seqid=%s WHERE seqid=%s', [okid, cseqid])
 		cur.execute('DELETE FROM SequencesTable WHERE id=%s', [cseqid])
+	err = dbchanges.add_change(con, cur, 'sequence', seqids)
+	if err:
+		return err
 	if commit:
 		debug(3, 'committing')
 		con.commit()
@@ -13,7 +13,7 @@ import psycopg2.extras
 import setproctitle
 from collections import defaultdict
 
-from dbbact_server import db_access
+from dbbact_server import db_access, dbchanges
 from dbbact_server.utils import debug, SetDebugLevel
 
 __version__ = "0.9"
@@ -88,6 +88,11 @@ def update_term_info(con, cur):
 				cur2.execute('DELETE FROM TermInfoTable WHERE term=%s', ['-' + cterm])
 			cur2.execute('INSERT INTO TermInfoTable (term, TotalExperiments, TotalAnnotations,TermType) VALUES (%s, %s, %s, %s)', ['-' + cterm, tot_exps_neg, tot_anno_neg, 'single'])
 
+	err = dbchanges.add_change(con, cur, 'term')
+	if err:
+		debug(7, 'failed to record the change (%s). rolling back' % err)
+		con.rollback()
+		return err
 	debug(2, 'committing')
 	con.commit()
 	debug(3, 'done')
@@ -135,6 +140,11 @@ def update_term_info_old(con, cur):
 		if cterm == 'small village':
 			debug(2, 'processed term %d: %s. pos exps %d, pos anno %d, neg exps %d, neg anno %d' % (idx, cterm, len(term_exps_pos), len(term_annotations_pos), len(term_exps_neg), len(term_annotations_neg)))
 
+	err = dbchanges.add_change(con, cur, 'term')
+	if err:
+		debug(7, 'failed to record the change (%s). rolling back' % err)
+		con.rollback()
+		return err
 	debug(2, 'committing')
 	con.commit()
 	debug(3, 'done')
@@ -10,6 +10,7 @@ import psycopg2
 from dbbact_sequence_translator.utils import debug, SetDebugLevel
 from dbbact_sequence_translator import db_access
 from dbbact_sequence_translator import db_translate
+from dbbact_server import seqpack
 
 
 '''Process all sequences in the NewSequencesTable queue, so we will have fast wholeseq<->dbBact sequence lookup
@@ -20,6 +21,9 @@ If a natch is found, updates the SequenceIDsTable and SequenceToSequenceTable.
 
 __version__ = 0.9
 
+# the length of the k-mer (start of each dbbact sequence) used to find the candidate positions in the whole sequences
+KMER_LEN = 32
+
 
 def iter_fasta_seqs(filename, replace_u_t=True):
 	"""
@@ -127,6 +131,69 @@ def hash_sequences(con, cur, dbidVal, whole_seq_db_version=None, short_len=100,
 	return all_ids, seq_hash, seq_lens, short_hash
 
 
+def get_kmer_keys(short_hash, k=KMER_LEN):
+	'''Get the packed k-mers of the start of the dbbact sequences (see seqpack.kmer_keys()), for finding the candidate positions in the whole sequences
+
+	Parameters
+	----------
+	short_hash: dict of {short_seq: seq_hash dict}
+		from hash_sequences()
+	k: int, optional
+		the k-mer length (<= 32)
+
+	Returns
+	-------
+	keys: numpy array of uint64 or None
+		the sorted unique k-mer keys. None if numpy is not installed (all positions are tested)
+	has_escaped: bool
+		True if some dbbact sequences contain non ACGT characters in the k-mer (so positions with non ACGT characters are also tested)
+	'''
+	if seqpack.np is None:
+		return None, True
+	keys = []
+	has_escaped = False
+	for cshort in short_hash:
+		codes = seqpack.encode(cshort[:k])
+		if not seqpack.is_acgt(codes):
+			has_escaped = True
+			continue
+		keys.append(seqpack.kmer_keys(codes, k)[0][0])
+	return seqpack.np.unique(seqpack.np.array(keys, dtype=seqpack.np.uint64)), has_escaped
+
+
+def get_candidate_positions(cseq, short_len, kmer_keys, has_escaped, k=KMER_LEN):
+	'''Get the positions in a whole sequence where a dbbact sequence can start (the k-mer at the position matches the start of a dbbact sequence)
+
+	Parameters
+	----------
+	cseq: str
+		the whole sequence
+	short_len: int
+		the length of the short sequences in short_hash
+	kmer_keys, has_escaped:
+		from get_kmer_keys()
+	k: int, optional
+		the k-mer length (same as in get_kmer_keys())
+
+	Returns
+	-------
+	iterable of int
+		the candidate positions (out of range(len(cseq) - short_len))
+	'''
+	num_pos = len(cseq) - short_len
+	if kmer_keys is None or num_pos <= 0 or len(kmer_keys) == 0 and has_escaped:
+		return range(max(num_pos, 0))
+	np = seqpack.np
+	keys, valid = seqpack.kmer_keys(seqpack.encode(cseq), k)
+	keys = keys[:num_pos]
+	valid = valid[:num_pos]
+	pos = np.minimum(np.searchsorted(kmer_keys, keys), len(kmer_keys) - 1)
+	found = (kmer_keys[pos] == keys) & valid if len(kmer_keys) > 0 else np.zeros(len(keys), dtype=bool)
+	if has_escaped:
+		found |= ~valid
+	return np.nonzero(found)[0]
+
+
 def update_sequencestosequences_table(con, cur, whole_seq_id, whole_seq_db_id, dbbact_id):
 	'''Update the SequenceToSequences table, that contains for each whole_seq region sequence the list of matching dbBact ids
 	The table is used for fast sequence lookup when searching for matching dbBact sequences from other regions
@@ -216,6 +283,8 @@ def update_whole_seq_db(con, cur, whole_seq_fasta_name, seqdbname, check_exists=
 		return
 
 	debug(2, 'Getting whole seq db IDs for %d dbbact sequences' % len(all_ids))
+	# test only the positions where the start of a dbbact sequence appears (instead of hashing all the positions)
+	kmer_keys, has_escaped = get_kmer_keys(short_hash)
 	# iterate over the silva database file and look for matches to any dbbact sequence
 	idx = 0
 	for cseq, chead in iter_fasta_seqs(whole_seq_fasta_name):
@@ -224,7 +293,7 @@ def update_whole_seq_db(con, cur, whole_seq_fasta_name, seqdbname, check_exists=
 		if idx % 1000 == 1:
 			debug(2, "count: %d" % idx)
 
-		for cpos in range(len(cseq) - short_len):
+		for cpos in get_candidate_positions(cseq, short_len, kmer_keys, has_escaped):
 			ccseq = cseq[cpos:cpos + short_len]
 			if ccseq in short_hash:
 				for k, v in short_hash[ccseq].items():
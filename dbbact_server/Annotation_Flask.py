@@ -79,7 +79,7 @@ def add_annotations():
             Add all annotation details to AnnotationsTable (automatically adding userId and addedDate)
             Add all pairs to AnnotationListTable
     """
-    debug(3, 'add_annotations', request)
+    debug(3, 'add_annotations', request=request)
     cfunc = add_annotations
     if request.method == 'GET':
         return(getdoc(cfunc), 400)
@@ -167,7 +167,7 @@ def update_annotations():
         Action:
             Update all the non-None (supplied) fields in the existing annotation.
     """
-    debug(3, 'update_annotations', request)
+    debug(3, 'update_annotations', request=request)
     cfunc = add_annotations
     if request.method == 'GET':
         return(getdoc(cfunc), 400)
@@ -219,7 +219,7 @@ def get_annotation_sequences():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_annotation_sequences', request)
+    debug(3, 'get_annotation_sequences', request=request)
     cfunc = get_annotation_sequences
     alldat = request.get_json()
     if alldat is None:
@@ -261,7 +261,7 @@ def get_annotation_list_sequences():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_annotation_list_sequences', request)
+    debug(3, 'get_annotation_list_sequences', request=request)
     cfunc = get_annotation_sequences
     alldat = request.get_json()
     if alldat is None:
@@ -312,7 +312,7 @@ def get_annotation_full_sequences():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_annotation_full_sequences', request)
+    debug(3, 'get_annotation_full_sequences', request=request)
     cfunc = get_annotation_full_sequences
     alldat = request.get_json()
     if alldat is None:
@@ -354,7 +354,7 @@ def delete_annotation():
             If user is not logged in, cannot delete
             Can only delete annotations created by the user
     """
-    debug(3, 'delete_annotation', request)
+    debug(3, 'delete_annotation', request=request)
     cfunc = delete_annotation
     if request.method == 'GET':
         return(getdoc(cfunc), 400)
@@ -400,7 +400,7 @@ def delete_sequences_from_annotation():
             If user is not logged in, cannot delete non-annonymous
             Can only delete annotations created by the user
     """
-    debug(3, 'delete_sequences_from_annotation', request)
+    debug(3, 'delete_sequences_from_annotation', request=request)
     cfunc = delete_sequences_from_annotation
     if request.method == 'GET':
         return(getdoc(cfunc), 400)
@@ -491,7 +491,7 @@ def get_annotation():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_annotation', request)
+    debug(3, 'get_annotation', request=request)
     cfunc = get_annotation
     annotationid = request.args.get('annotationid')
     if annotationid is None:
@@ -538,7 +538,7 @@ def get_annotation_ontology_parents():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_annotation_ontology_parents', request)
+    debug(3, 'get_annotation_ontology_parents', request=request)
     cfunc = get_annotation_ontology_parents
     alldat = request.get_json()
     if alldat is None:
@@ -580,7 +580,7 @@ def get_all_annotations():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_all_annotations', request)
+    debug(3, 'get_all_annotations', request=request)
     err, annotations = dbannotations.GetAllAnnotations(g.con, g.cur, userid=current_user.user_id)
     if err:
         debug(6, err)
@@ -617,7 +617,7 @@ def add_annotation_flag():
             Once an annotation is flagged, the flag status is "suggested". The flag will be reviewed by the dbbact team and then the status
             changed to "accepted" or "rejected"
     """
-    debug(3, 'add_annotation_flag', request)
+    debug(3, 'add_annotation_flag', request=request)
     cfunc = add_annotation_flag
     alldat = request.get_json()
     if alldat is None:
@@ -661,7 +661,7 @@ def get_annotation_flags():
     Details :
         Validation:
     """
-    debug(3, 'get_annotation_flags', request)
+    debug(3, 'get_annotation_flags', request=request)
     cfunc = get_annotation_flags
     alldat = request.get_json()
     if alldat is None:
@@ -699,7 +699,7 @@ def delete_annotation_flag():
         Validation:
         Can only delete if the user that created the flag is the user requesting delete
     """
-    debug(3, 'delete_annotation_flag', request)
+    debug(3, 'delete_annotation_flag', request=request)
     cfunc = delete_annotation_flag
     alldat = request.get_json()
     if alldat is None:
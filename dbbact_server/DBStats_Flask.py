@@ -1,8 +1,16 @@
+import os
 import json
 from flask import Blueprint, g, request
-from .utils import debug
+from flask_login import current_user
+from .utils import debug, get_recent_debug
 from .autodoc import auto
 from . import dbstats
+from . import db_access
+from . import dbchanges
+from .cache import get_cache_stats
+from .seqindex import get_index_stats
+from .ontology_graph import get_graph_stats
+from .term_dict import get_term_dict_stats
 
 
 DBStats_Flask_Obj = Blueprint('DBStats_Flask_Obj', __name__, template_folder='templates')
@@ -37,7 +45,7 @@ def dbdstats():
         }
     Details:
     """
-    debug(3, 'dbstats', request)
+    debug(3, 'dbstats', request=request)
     err, stats = dbstats.GetStats(g.con, g.cur)
     if not err:
         debug(2, 'Got statistics')
@@ -47,6 +55,229 @@ def dbdstats():
     return (errmsg, 400)
 
 
+@DBStats_Flask_Obj.route('/stats/pool', methods=['GET'])
+@auto.doc()
+def pool_stats():
+    """
+    Title: Get the database connection pool statistics
+    URL: /stats/pool
+    Method: GET
+    URL Params:
+    Data Params:
+     Success Response:
+        Code : 201
+        Content :
+        pool : dict or None (if connection pooling is disabled)
+        {
+            "pid" : int
+                process id of the worker that served the request (each worker has its own pool)
+            "min_size", "max_size" : int
+                the pool size limits
+            "in_use" : int
+                number of connections currently in use
+            "idle" : int
+                number of open connections waiting in the pool
+            "requests" : int
+                number of connections borrowed from the pool
+            "waits" : int
+                number of requests that waited for a free connection
+            "wait_time", "max_wait_time" : float
+                the total and the longest time (seconds) waited for a free connection
+            "created", "discarded" : int
+                number of database connections opened / closed by the pool
+            "failed_checks" : int
+                number of idle connections that failed the health check
+        }
+    Details:
+        Used to size the number of gunicorn workers and the pool size against the postgres max_connections.
+    """
+    debug(3, 'pool_stats', request=request)
+    return json.dumps({'pool': db_access.get_pool_stats()})
+
+
+@DBStats_Flask_Obj.route('/stats/cache', methods=['GET'])
+@auto.doc()
+def cache_stats():
+    """
+    Title: Get the worker caches statistics
+    URL: /stats/cache
+    Method: GET
+    URL Params:
+    Data Params:
+     Success Response:
+        Code : 201
+        Content :
+        {
+            "pid" : int
+                process id of the worker that served the request (each worker has its own caches)
+            "caches" : dict of {name(str): stats(dict)}
+            {
+                "size", "max_size" : int
+                    the current and maximal number of entries in the cache
+                "hits", "misses" : int
+                    number of cache lookups that found / did not find the entry
+                "hit_rate" : float
+                    hits / (hits + misses)
+                "evictions" : int
+                    number of entries removed since the cache was full
+                "invalidations" : int
+                    number of entries removed since the data changed
+                "bytes", "max_bytes" : int (only for caches limited by size, i.e. "responses")
+                    the current and maximal total size of the entries in the cache
+            }
+            "sequence_index" : dict or null (if no sequence index is enabled)
+            {
+            "exact", "prefix", "close" : dict or null (if the index is not enabled)
+                "size" : int
+                    number of sequences in the index (when built/loaded)
+                "changed" : int
+                    number of sequences added/changed since the index was built
+                "valid" : bool
+                    False if the index is not used (i.e. sequences changed in bulk since it was built)
+                "version" : int
+                    the data version the index is up to date with
+                "hits", "misses" : int
+                    number of sequences found / not found in the index
+                "filename" : str or null
+                    the snapshot file the index is loaded from
+                "candidates", "query_time" : int, float
+                    (only for the close index) total number of candidate sequences compared, and total lookup time (seconds)
+            }
+            "ontology_graph" : dict or null (if the ontology graph was not used yet)
+            {
+                "edges" : int
+                    number of parent-child edges loaded
+                "changed" : int
+                    number of terms with parents changed since the graph was loaded
+                "valid" : bool
+                    False if the graph is not used (i.e. could not be loaded)
+                "version" : int
+                    the data version the graph is up to date with
+                "load_time" : float
+                    the time (seconds) it took to load the graph
+                "lookups" : int
+                    number of ancestors/descendants/paths lookups
+            }
+            "term_dict" : dict or null (if the term dictionary was not used yet)
+            {
+                "terms", "synonyms" : int
+                    number of terms and synonyms loaded
+                "changed" : int
+                    number of terms changed since the dictionary was loaded
+                "invalid_keys" : int
+                    number of term descriptions/term_ids/synonyms changed by this worker and not yet read (looked up in the database)
+                "valid" : bool
+                    False if the dictionary is not used (i.e. could not be loaded)
+                "version" : int
+                    the data version the dictionary is up to date with
+                "load_time" : float
+                    the time (seconds) it took to load the dictionary
+                "lookups", "misses" : int
+                    number of terms/ids/synonyms looked up, and number not found in the dictionary (looked up in the database)
+            }
+        }
+    Details:
+        The annotation cache is used only if the worker receives the change notifications from the database.
+    """
+    debug(3, 'cache_stats', request=request)
+    return json.dumps({'pid': os.getpid(), 'caches': get_cache_stats(), 'sequence_index': get_index_stats(), 'ontology_graph': get_graph_stats(),
+                       'term_dict': get_term_dict_stats()})
+
+
+@DBStats_Flask_Obj.route('/stats/version', methods=['GET', 'POST'])
+@auto.doc()
+def data_version():
+    """
+    Title: Get the database data version and the changes since a previous version
+    URL: /stats/version
+    Method: GET, POST
+    URL Params:
+    Data Params: JSON
+        {
+            "since" : int (optional)
+                if supplied, return also the changes after this data version
+            "entity" : str (optional)
+                return only the changes to this entity type ('annotation', 'sequence', 'sequence_info', 'term' or 'experiment')
+            "max_versions" : int (optional)
+                the maximal number of data versions to return the changes for (default 1000)
+        }
+     Success Response:
+        Code : 201
+        Content :
+        {
+            "version" : int
+                the current data version (increased on every change to the annotations, sequences, ontology terms or experiments)
+            "changes" : list of dict (only if "since" was supplied)
+            {
+                "version" : int
+                    the data version of the change
+                "entity" : str
+                    the changed entity type ('annotation', 'sequence', 'sequence_info', 'term' or 'experiment')
+                "id" : int or null
+                    the id of the changed entity (annotationid, sequence id, ontology term id or expid). null for bulk changes (any entity of this type may have changed)
+                "date" : str
+                    the date and time of the change
+            }
+        }
+    Details:
+        Used by clients to check if cached/mirrored data is still valid.
+        Continue fetching changes from the last returned version until no changes are returned.
+    """
+    debug(3, 'data_version', request=request)
+    alldat = request.get_json(silent=True)
+    if alldat is None:
+        alldat = {}
+    err, version = dbchanges.get_data_version(g.con, g.cur)
+    if err:
+        debug(6, err)
+        return (err, 400)
+    res = {'version': version}
+    since = alldat.get('since')
+    if since is not None:
+        err, changes = dbchanges.get_changes(g.con, g.cur, since, entity=alldat.get('entity'), max_versions=alldat.get('max_versions', 1000))
+        if err:
+            debug(6, err)
+            return (err, 400)
+        res['changes'] = changes
+    return json.dumps(res)
+
+
+@DBStats_Flask_Obj.route('/stats/recent_debug', methods=['GET', 'POST'])
+@auto.doc()
+def recent_debug():
+    """
+    Title: Get the recent debug messages of the worker
+    URL: /stats/recent_debug
+    Method: GET, POST
+    URL Params:
+    Data Params: JSON
+        {
+            "num" : int (optional)
+                maximal number of messages to return (default 100)
+            "min_level" : int (optional)
+                return only messages with level >= min_level
+        }
+     Success Response:
+        Code : 201
+        Content :
+        {
+            "records" : list of str
+                the recent debug messages of the worker that served the request (oldest first)
+        }
+    Details:
+        Available only for admin users.
+        Messages below the printed debug level are kept only if the DBBACT_DEBUG_RING_LEVEL env. variable is set.
+    """
+    debug(3, 'recent_debug', request=request)
+    if current_user.is_admin != 1:
+        return ('only admin users can view the debug messages', 400)
+    alldat = request.get_json(silent=True)
+    if alldat is None:
+        alldat = {}
+    records = get_recent_debug(num=alldat.get('num', 100), min_level=alldat.get('min_level'))
+    return json.dumps({'records': records})
+
+
 @DBStats_Flask_Obj.route('/stats/get_supported_version', methods=['GET'])
 @auto.doc()
 def get_supported_version():
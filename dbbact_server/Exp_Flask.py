@@ -6,6 +6,7 @@ from .utils import getdoc, debug
 from .autodoc import auto
 from . import dbexperiments
 from . import dbannotations
+from .response_cache import cached_json_response
 
 
 Exp_Flask_Obj = Blueprint('Exp_Flask_Obj', __name__)
@@ -57,7 +58,7 @@ def add_details():
             Return the new expId for these details
             for each "type"/"value" in the "details" list, if "type" exists in ExperimentTypesTable, get the id and add it to "type" field in ExperimentsIdentifiers table. Otherwise, create it there and get the id and add it to "type" field in ExperimentsIdentifiers.
     """
-    debug(3, 'experiments/add_details', request)
+    debug(3, 'experiments/add_details', request=request)
     cfunc = add_details
     if request.method == 'GET':
         return(getdoc(cfunc))
@@ -162,7 +163,7 @@ def get_id():
             If study is private, return only if user is authenticated and created the study. If user not authenticated, do not return it in the list
             If study is not private, return it (no need for authentication)
     """
-    debug(3, 'experiments/get_id', request)
+    debug(3, 'experiments/get_id', request=request)
     alldat = request.get_json()
     details = alldat.get('details')
     if details is None:
@@ -206,7 +207,7 @@ def get_details():
             If study is not private, return details (no need for authentication)
             if study not found - return error
     """
-    debug(3, 'experiments/get_details', request)
+    debug(3, 'experiments/get_details', request=request)
     alldat = request.get_json()
     if alldat is None:
         return('no expId supplied', 400)
@@ -253,7 +254,7 @@ def get_annotations():
             if annotation is private, return only if created by the same user as the querying
             if study not found - return error
     """
-    debug(3, 'experiments/get_annotations', request)
+    debug(3, 'experiments/get_annotations', request=request)
     alldat = request.get_json()
     if alldat is None:
         return('no expId supplied', 400)
@@ -290,10 +291,15 @@ def get_experiments_list():
     Details :
         Validation:
             If experiment is private, return only if user is authenticated and created the study.
+        The response is cached until the data changes, and has an ETag (send If-None-Match to get a 304 if unchanged). Compressed if the client accepts gzip/br/zstd encoding.
     """
-    debug(3, 'experiments/get_experiments_list', request)
-    err, expdat = dbexperiments.GetExperimentsList(g.con, g.cur, userid=current_user.user_id)
-    if err:
-        return(err, 400)
-    debug(1, 'found %d experiments for get_experiments_list' % len(expdat))
-    return json.dumps({'explist': expdat})
+    debug(3, 'experiments/get_experiments_list', request=request)
+
+    def _get_experiments_list():
+        err, expdat = dbexperiments.GetExperimentsList(g.con, g.cur, userid=current_user.user_id)
+        if err:
+            return err, None
+        debug(1, 'found %d experiments for get_experiments_list', len(expdat))
+        return '', {'explist': expdat}
+    # the list includes the private experiments of the user
+    return cached_json_response('get_experiments_list', [current_user.user_id], _get_experiments_list)
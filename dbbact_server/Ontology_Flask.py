@@ -4,6 +4,7 @@ from flask_login import login_required
 from . import dbontology
 from .utils import getdoc, debug
 from .autodoc import auto
+from .response_cache import cached_json_response, streamed_json_response
 
 Ontology_Flask_Obj = Blueprint('Ontology_Flask_Obj', __name__, template_folder='templates')
 
@@ -56,7 +57,7 @@ def ontology_add_term():
             Get the ontologynameid from the OntologyNamesTable. Add (ontologyId = termid, ontologyParentId = parentif, ontologyNameId = ontologynameid)
             for each sysnonym, if not in OntologyTable add it, get the synonymid, add to OntologySynymTable (idOntology = termid, idSynonym = synonymid)
     """
-    debug(3, 'ontology_add_term', request)
+    debug(3, 'ontology_add_term', request=request)
     cfunc = ontology_add_term
     if request.method == 'GET':
         return(getdoc(cfunc))
@@ -111,7 +112,7 @@ def ontology_get_parents():
         If it is a synonym for a term, get the original term first.
         Note that if the term is in more than one ontology, will return all parents
     """
-    debug(3, 'ontology_get_parents', request)
+    debug(3, 'ontology_get_parents', request=request)
     term = request.args.get('term')
     if term is None:
         # # TODO: retrun error
@@ -138,6 +139,8 @@ def ontology_get_family_graph():
                 "both" to get parents and children
                 "parent" to get only parents
                 "child" to get only children
+            "max_depth": int, optional
+                if set, get only max_depth levels of parents/children
         }
     Data Params:
     Success Response:
@@ -155,16 +158,19 @@ def ontology_get_family_graph():
         If it is a synonym for a term, get the original term first.
         Note that if the term is in more than one ontology, will return all parents/children
     """
-    debug(3, 'ontology_get_parents', request)
+    debug(3, 'ontology_get_parents', request=request)
     terms = request.json.get('terms')
     if terms is None:
         # # TODO: retrun error
         return('missing argument term', 400)
     relation = request.json.get('relation', 'both')
-    err, res = dbontology.get_family_graph(g.con, g.cur, terms=terms, relation=relation, force_unique=False)
+    max_depth = request.json.get('max_depth')
+    if max_depth is not None and (not isinstance(max_depth, int) or isinstance(max_depth, bool) or max_depth < 0):
+        return('max_depth must be a non-negative int', 400)
+    err, res = dbontology.get_family_graph(g.con, g.cur, terms=terms, relation=relation, force_unique=False, max_depth=max_depth)
     if err:
         return(err, 400)
-    return(json.dumps({'family': res}))
+    return streamed_json_response({'family': res})
 
 
 @Ontology_Flask_Obj.route('/ontology/get_synonym', methods=['GET'])
@@ -195,7 +201,7 @@ def ontology_get_synonym():
             }
         }
     """
-    debug(3, 'ontology_get_synonym', request)
+    debug(3, 'ontology_get_synonym', request=request)
     cid = request.args.get('startid')
     if cid is None:
         return(getdoc(ontology_get_synonym))
@@ -270,7 +276,7 @@ def get_ontology_annotations():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_ontology_annotations', request)
+    debug(3, 'get_ontology_annotations', request=request)
     cfunc = get_ontology_annotations
     ontology_term = request.args.get('term')
     get_children = request.args.get('get_children')
@@ -322,8 +328,10 @@ def get_all_terms():
                     the ontology term id (i.e. "ENVO:00004")
             }
         }
+    Details:
+        The response is cached until the data changes, and has an ETag (send If-None-Match to get a 304 if unchanged). Compressed if the client accepts gzip/br/zstd encoding.
     """
-    debug(1, 'get_all_descriptions', request)
+    debug(1, 'get_all_descriptions', request=request)
     alldat = request.get_json()
     if alldat is None:
         min_term_id = None
@@ -331,8 +339,11 @@ def get_all_terms():
     else:
         min_term_id = alldat.get('min_term_id')
         ontologyid = alldat.get('ontologyid')
-    ontology, ontology_ids = dbontology.get_ontology_terms_list(g.con, g.cur, min_term_id=min_term_id, ontologyid=ontologyid)
-    return json.dumps({'ontology': ontology, 'ontology_term_ids': ontology_ids}, ensure_ascii=False)
+
+    def _get_all_terms():
+        ontology, ontology_ids = dbontology.get_ontology_terms_list(g.con, g.cur, min_term_id=min_term_id, ontologyid=ontologyid)
+        return '', {'ontology': ontology, 'ontology_term_ids': ontology_ids}
+    return cached_json_response('get_all_terms', [min_term_id, ontologyid], _get_all_terms, ensure_ascii=False)
 
 
 @Ontology_Flask_Obj.route('/ontology/get_all_synonyms', methods=['GET'])
@@ -351,10 +362,11 @@ def get_all_synonyms():
                     the synonym terms
             }
         }
+    Details:
+        The response is cached until the data changes, and has an ETag (send If-None-Match to get a 304 if unchanged). Compressed if the client accepts gzip/br/zstd encoding.
     """
-    debug(3, 'get_all_synonyms', request)
-    jsonRetData = dbontology.GetListOfSynonym(g.con, g.cur)
-    return json.dumps(jsonRetData, ensure_ascii=False)
+    debug(3, 'get_all_synonyms', request=request)
+    return cached_json_response('get_all_synonyms', [], lambda: ('', dbontology.GetListOfSynonym(g.con, g.cur)), ensure_ascii=False)
 
 
 @Ontology_Flask_Obj.route('/ontology/get', methods=['POST'])
@@ -382,7 +394,7 @@ def get_ontology():
         Action:
         Get ids for list of ontologies
     """
-    debug(3, 'ontology/get', request)
+    debug(3, 'ontology/get', request=request)
     cfunc = get_ontology
     if request.method == 'GET':
         return(getdoc(cfunc))
@@ -429,7 +441,7 @@ def get_ontology_term_stats():
     Details :
         Validation:
     """
-    debug(3, 'get_ontology_term_stats', request)
+    debug(3, 'get_ontology_term_stats', request=request)
     cfunc = get_ontology_term_stats
     alldat = request.get_json()
     ontology_terms = alldat.get('terms')
@@ -467,7 +479,7 @@ def get_term_pair_count():
     Details :
         Validation:
     """
-    debug(3, 'get_term_pair_count', request)
+    debug(3, 'get_term_pair_count', request=request)
     cfunc = get_term_pair_count
     alldat = request.get_json()
     term_pairs = alldat.get('term_pairs')
@@ -509,7 +521,7 @@ def get_term_children():
     Details :
         Validation:
     """
-    debug(3, 'get_term_children', request)
+    debug(3, 'get_term_children', request=request)
     cfunc = get_term_children
     alldat = request.get_json()
     term = alldat.get('term', None)
@@ -547,7 +559,7 @@ def get_term_parent_tree_flask():
     Details :
         Validation:
     """
-    debug(3, 'get_term_parent_tree_flask', request)
+    debug(3, 'get_term_parent_tree_flask', request=request)
     cfunc = get_term_parent_tree_flask
     alldat = request.get_json()
     if alldat is None:
@@ -589,7 +601,7 @@ def get_term_sequences():
     Details :
         Validation:
     """
-    debug(3, 'get_term_seqs', request)
+    debug(3, 'get_term_seqs', request=request)
     cfunc = get_term_sequences
     alldat = request.get_json()
     if alldat is None:
@@ -599,7 +611,7 @@ def get_term_sequences():
         return(getdoc(cfunc))
     get_children = (alldat.get('get_children', 'true').lower() == 'true')
     err, pos_seqs, neg_seqs = dbontology.get_term_sequences(g.con, g.cur, term, get_children=get_children)
-    return json.dumps({'pos_seqs': pos_seqs, 'neg_seqs': neg_seqs})
+    return streamed_json_response({'pos_seqs': pos_seqs, 'neg_seqs': neg_seqs})
 
 
 @Ontology_Flask_Obj.route('/ontology/get_used_terms', methods=['GET'])
@@ -621,13 +633,15 @@ def get_used_terms():
             num_used: int
                 the number of times this term is used in the database
         }
+    The response is cached until the data changes, and has an ETag (send If-None-Match to get a 304 if unchanged). Compressed if the client accepts gzip/br/zstd encoding.
     """
-    debug(3, 'get_used_terms', request)
+    debug(3, 'get_used_terms', request=request)
     cfunc = get_used_terms
     if request.method != 'GET':
         return(getdoc(cfunc))
-    err, terms = dbontology.get_used_terms(g.con, g.cur)
-    if err:
-        return(err, 400)
-    return json.dumps({'terms': terms})
+
+    def _get_used_terms():
+        err, terms = dbontology.get_used_terms(g.con, g.cur)
+        return err, {'terms': terms}
+    return cached_json_response('get_used_terms', [], _get_used_terms)
     
\ No newline at end of file
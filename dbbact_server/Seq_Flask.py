@@ -13,6 +13,9 @@ from .autodoc import auto
 Seq_Flask_Obj = Blueprint('Seq_Flask_Obj', __name__, template_folder='templates')
 # CORS(Seq_Flask_Obj)
 
+# the maximal number of sequences in one get_close_sequences_list request (if the close sequences index is enabled, see also dbsequences.MAX_CLOSE_DB_QUERIES)
+MAX_CLOSE_SEQUENCES_LIST = 50000
+
 
 @Seq_Flask_Obj.route('/sequences/add', methods=['POST', 'GET'])
 @auto.doc()
@@ -45,7 +48,7 @@ def add_sequences():
         Action:
         Add all sequences that don't already exist in SequencesTable
     """
-    debug(3, 'add_sequences', request)
+    debug(3, 'add_sequences', request=request)
     cfunc = add_sequences
     if request.method == 'GET':
         return(getdoc(cfunc))
@@ -102,7 +105,7 @@ def get_sequenceid():
         Validation:
         Action:
     """
-    debug(3, 'get_sequenceid', request)
+    debug(3, 'get_sequenceid', request=request)
     cfunc = get_sequenceid
     alldat = request.get_json()
     sequence = alldat.get('sequence')
@@ -152,6 +155,9 @@ def get_sequenceid_list():
                 False (default) to get just annotations for dbbact sequences that match exactly the query sequences
             "dbname": str, optional
                 If supplied (i.e. 'silva'), assume sequence is the identifier in dbname (i.e.  'FJ978486' for 'silva' instead of acgt sequence)
+            "sequence_hashes": list of str (optional)
+                Instead of sequences - the md5 hash of each sequence (hex string of the md5 of the upper case sequence, i.e. hashlib.md5(seq.upper().encode()).hexdigest())
+                Only exact matches are returned (no_shorter, no_longer, use_sequence_translator and dbname are ignored)
         }
     Success Response:
         Code : 201
@@ -173,6 +179,14 @@ def get_sequenceid_list():
     no_longer = alldat.get('no_longer', False)
     use_sequence_translator = alldat.get('use_sequence_translator', False)
     dbname = alldat.get('dbname', None)
+    sequence_hashes = alldat.get('sequence_hashes')
+    if sequence_hashes is not None:
+        err, out_list = dbsequences.GetSequencesIdsFromHashes(g.con, g.cur, sequence_hashes)
+        if err:
+            debug(4, 'get_sequenceid_list failed. error encountered: %s' % err)
+            return err, 400
+        debug(3, 'found ids for %d sequence hashes' % len(out_list))
+        return json.dumps({"seqIds": out_list})
     if sequences is None:
         return(getdoc(cfunc))
     if dbname is not None:
@@ -221,7 +235,7 @@ def get_taxonomy_str():
             "taxonomy" : str
         }
     """
-    debug(3, 'get_taxonomy_str', request)
+    debug(3, 'get_taxonomy_str', request=request)
     cfunc = get_taxonomy_str
     alldat = request.get_json()
     if alldat is None:
@@ -324,7 +338,7 @@ def get_sequence_annotations():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_sequence_annotations', request)
+    debug(3, 'get_sequence_annotations', request=request)
     cfunc = get_sequence_annotations
     alldat = request.get_json()
     if alldat is None:
@@ -438,7 +452,7 @@ def get_sequence_list_annotations():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_list_annotations', request)
+    debug(3, 'get_list_annotations', request=request)
     cfunc = get_sequence_list_annotations
     alldat = request.get_json()
     if alldat is None:
@@ -514,6 +528,9 @@ def get_fast_annotations():
                 False to get just annotations for dbbact sequences that match exactly the queryy sequences
             "dbname": str, optional
                 If supplied (i.e. 'silva'), assume sequence is the identifier in dbname (i.e.  'FJ978486' for 'silva' instead of acgt sequence)
+            "sequence_hashes": list of str (optional)
+                Instead of sequences - the md5 hash of each sequence (hex string of the md5 of the upper case sequence, i.e. hashlib.md5(seq.upper().encode()).hexdigest())
+                Only exact matches are used (use_sequence_translator and dbname are ignored)
     Success Response:
         Code : 200
         Content :
@@ -589,14 +606,18 @@ def get_fast_annotations():
         If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
         If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_fast_annotations', request)
+    debug(3, 'get_fast_annotations', request=request)
     cfunc = get_fast_annotations
     alldat = request.get_json()
     if alldat is None:
         return(getdoc(cfunc))
     sequences = alldat.get('sequences')
+    hashes = False
     if sequences is None:
-        return('sequences parameter missing', 400)
+        sequences = alldat.get('sequence_hashes')
+        if sequences is None:
+            return('sequences parameter missing', 400)
+        hashes = True
     region = alldat.get('region')
     get_term_info = alldat.get('get_term_info', True)
     get_taxonomy = alldat.get('get_taxonomy', True)
@@ -610,7 +631,7 @@ def get_fast_annotations():
         seq_translate_api = g.seq_translate_api
     else:
         seq_translate_api = None
-    err, annotations, seqannotations, term_info, taxonomy = dbannotations.GetFastAnnotations(g.con, g.cur, sequences, region=region, userid=current_user.user_id, get_term_info=get_term_info, get_taxonomy=get_taxonomy, get_parents=get_parents, get_all_exp_annotations=get_all_exp_annotations, seq_translate_api=seq_translate_api, dbname=dbname)
+    err, annotations, seqannotations, term_info, taxonomy = dbannotations.GetFastAnnotations(g.con, g.cur, sequences, region=region, userid=current_user.user_id, get_term_info=get_term_info, get_taxonomy=get_taxonomy, get_parents=get_parents, get_all_exp_annotations=get_all_exp_annotations, seq_translate_api=seq_translate_api, dbname=dbname, hashes=hashes)
     if err:
         errmsg = 'error encountered while getting the fast annotations: %s' % err
         debug(6, errmsg)
@@ -650,7 +671,7 @@ def get_taxonomy_annotation_ids():
         If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
         If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_taxonomy_annotation_ids', request)
+    debug(3, 'get_taxonomy_annotation_ids', request=request)
     cfunc = get_taxonomy_annotation_ids
     alldat = request.get_json()
     if alldat is None:
@@ -694,7 +715,7 @@ def get_taxonomy_annotations():
         If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
         If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_taxonomy_annotations', request)
+    debug(3, 'get_taxonomy_annotations', request=request)
     cfunc = get_taxonomy_annotations
     alldat = request.get_json()
     if alldat is None:
@@ -738,7 +759,7 @@ def get_hash_annotations():
         If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
         If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_hash_annotations', request)
+    debug(3, 'get_hash_annotations', request=request)
     cfunc = get_hash_annotations
     alldat = request.get_json()
     if alldat is None:
@@ -782,7 +803,7 @@ def get_hash_annotations():
 #         If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
 #         If annotation is not private, return it (no need for authentication)
 #     """
-#     debug(3, 'get_gg_annotations', request)
+#     debug(3, 'get_gg_annotations', request=request)
 #     cfunc = get_gg_annotations
 #     alldat = request.get_json()
 #     if alldat is None:
@@ -828,7 +849,7 @@ def get_hash_annotations():
 #         If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
 #         If annotation is not private, return it (no need for authentication)
 #     """
-#     debug(3, 'get_silva_annotations', request)
+#     debug(3, 'get_silva_annotations', request=request)
 #     cfunc = get_silva_annotations
 #     alldat = request.get_json()
 #     if alldat is None:
@@ -879,7 +900,7 @@ def get_taxonomy_sequences():
         }
     Validation:
     """
-    debug(3, 'get_taxonomy_sequences', request)
+    debug(3, 'get_taxonomy_sequences', request=request)
     cfunc = get_taxonomy_sequences
     alldat = request.get_json()
     if alldat is None:
@@ -888,7 +909,7 @@ def get_taxonomy_sequences():
     if taxonomy is None:
         return('taxonomy parameter missing', 400)
     seqids = dbsequences.get_taxonomy_seqids(g.con, g.cur, taxonomy, userid=None)
-    err, sequences = dbsequences.SeqFromID(g.con, g.cur, seqids)
+    err, sequences = dbsequences.SeqFromIDs(g.con, g.cur, seqids)
     if err:
         return err, err
 
@@ -925,7 +946,7 @@ def get_sequence_info():
         }
     Validation:
     """
-    debug(3, 'get_sequence_info', request)
+    debug(3, 'get_sequence_info', request=request)
     cfunc = get_sequence_info
     alldat = request.get_json()
     if alldat is None:
@@ -933,7 +954,7 @@ def get_sequence_info():
     seqids = alldat.get('seqids')
     if seqids is None:
         return('seqids parameter missing', 400)
-    err, sequences = dbsequences.SeqFromID(g.con, g.cur, seqids)
+    err, sequences = dbsequences.SeqFromIDs(g.con, g.cur, seqids)
     if err:
         errmsg = 'error encountered searching for sequence information: %s' % err
         debug(6, errmsg)
@@ -975,7 +996,7 @@ def get_sequence_string_annotations():
             If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
             If annotation is not private, return it (no need for authentication)
     """
-    debug(3, 'get_sequence_string_annotations', request)
+    debug(3, 'get_sequence_string_annotations', request=request)
     cfunc = get_sequence_string_annotations
     alldat = request.get_json()
     if alldat is None:
@@ -1014,7 +1035,7 @@ def get_sequence_string_annotations():
 #         {
 #             "dbbact_seqs_per_id": dict of {seq_id(str): tuple of (list of dbbact ids(int), list of dbbact sequences (str))}
 #     '''
-#     debug(3, 'api_seqs_from_external_db_id', request)
+#     debug(3, 'api_seqs_from_external_db_id', request=request)
 #     cfunc = api_get_seqs_from_db_id
 #     alldat = request.get_json()
 #     if alldat is None:
@@ -1132,7 +1153,7 @@ def get_sequence_string_annotations():
 #         If an annotation is private, return it only if user is authenticated and created the curation. If user not authenticated, do not return it in the list
 #         If annotation is not private, return it (no need for authentication)
 #     """
-#     debug(3, 'get_fast_annotations_external_db_id', request)
+#     debug(3, 'get_fast_annotations_external_db_id', request=request)
 #     cfunc = get_fast_annotations_external_db_id
 #     alldat = request.get_json()
 #     if alldat is None:
@@ -1181,7 +1202,7 @@ def get_primers():
             }
         }
     '''
-    debug(3, 'get_primers', request)
+    debug(3, 'get_primers', request=request)
     err, primers = dbprimers.get_primers(g.con, g.cur)
     if err:
         debug(6, err)
@@ -1222,7 +1243,7 @@ def add_primer_region():
             }
         }
     '''
-    debug(3, 'get_primers', request)
+    debug(3, 'get_primers', request=request)
     try:
         alldat = request.get_json()
         regionname = alldat.get('name')
@@ -1265,7 +1286,7 @@ def guess_region():
                 id of the primer region
         }
     '''
-    debug(3, 'guess_region', request)
+    debug(3, 'guess_region', request=request)
     cfunc = add_sequences
     alldat = request.get_json()
     sequences = alldat.get('sequences')
@@ -1306,7 +1327,7 @@ def get_whole_seq_taxonomy_f():
                 the whole sequence database id of each match (i.e. 'agyq01000038')
         }
     """
-    debug(3, 'get_whole_seq_taxonomy', request)
+    debug(3, 'get_whole_seq_taxonomy', request=request)
     cfunc = get_whole_seq_taxonomy_f
     alldat = request.get_json()
     if alldat is None:
@@ -1345,7 +1366,7 @@ def get_species_seqs_f():
                 the actual sequences matching the species
         }
     """
-    debug(3, 'get_species_seqs', request)
+    debug(3, 'get_species_seqs', request=request)
     cfunc = get_species_seqs_f
     alldat = request.get_json()
     if alldat is None:
@@ -1395,7 +1416,7 @@ def get_close_sequences_f():
                     the number of mismatches
         }
     '''
-    debug(3, 'get close sequences', request)
+    debug(3, 'get close sequences', request=request)
     cfunc = get_close_sequences_f
     alldat = request.get_json()
     if alldat is None:
@@ -1409,3 +1430,63 @@ def get_close_sequences_f():
     if err:
         return('problem getting close sequences. error=%s' % err, 400)
     return json.dumps({'similar_seqs': similar_seqs})
+
+
+@Seq_Flask_Obj.route('/sequences/get_close_sequences_list', methods=['GET', 'POST'])
+@auto.doc()
+def get_close_sequences_list():
+    '''
+    Title: get_close_sequences_list
+    Description: Get the dbBact sequences that are close (i.e. <= max_mismatches) to each sequence in a list (i.e. all the ASVs of a feature table)
+    URL: /sequences/get_close_sequences_list
+    Method: GET, POST
+    URL Params:
+    Data Params: JSON
+        {
+            "sequences": list of str
+                the sequences to get close sequences for (up to 50000 sequences if the close sequences index is enabled (DBBACT_CLOSE_INDEX), otherwise up to 100 sequences)
+            "max_mismatches": int (optional)
+                the maximum number of mismatches to allow (default=1, maximum 5)
+            "test_left_trim": bool (optional)
+                True (default) to test if the sequence can be left trimmed to get a match (such as sometimes in the result of DADA2)
+                False to not test left trimming
+            "best_only": bool (optional)
+                False (default) to return all the close sequences for each sequence
+                True to return only the closest dbBact sequence (lowest num_mismatches) for each sequence
+        }
+    Success Response:
+        Code : 200
+        Content :
+        {
+            "similar_seqs": list (one entry per query sequence, in the order of sequences) of list (one entry per close sequence, ordered by num_mismatches) of dict containing:
+                "sequence": str
+                    the sequence
+                "seq_id": int
+                    the dbBact sequence id
+                "num_mismatches": int
+                    the number of mismatches
+        }
+    Details:
+        Uses the close sequences index if enabled (DBBACT_CLOSE_INDEX), so large tables are processed in one pass (split between DBBACT_CLOSE_POOL_SIZE processes)
+    '''
+    debug(3, 'get close sequences list', request=request)
+    cfunc = get_close_sequences_list
+    alldat = request.get_json()
+    if alldat is None:
+        return(getdoc(cfunc))
+    sequences = alldat.get('sequences')
+    if sequences is None:
+        return('sequences parameter missing', 400)
+    if not isinstance(sequences, list) or not all(isinstance(cseq, str) for cseq in sequences):
+        return('sequences must be a list of str', 400)
+    if len(sequences) > MAX_CLOSE_SEQUENCES_LIST:
+        return('too many sequences (%d). maximum is %d' % (len(sequences), MAX_CLOSE_SEQUENCES_LIST), 400)
+    test_left_trim = alldat.get('test_left_trim', True)
+    max_mismatches = alldat.get('max_mismatches', 1)
+    if not isinstance(max_mismatches, int) or isinstance(max_mismatches, bool) or max_mismatches < 0 or max_mismatches > 5:
+        return('max_mismatches must be an int between 0 and 5', 400)
+    best_only = alldat.get('best_only', False)
+    err, similar_seqs = dbsequences.get_close_sequences_list(g.con, g.cur, sequences, max_mismatches=max_mismatches, test_left_trim=test_left_trim, best_only=best_only)
+    if err:
+        return('problem getting close sequences. error=%s' % err, 400)
+    return json.dumps({'similar_seqs': similar_seqs})
@@ -11,16 +11,24 @@ from .Docs_Flask import Docs_Flask_Obj
 from .DBStats_Flask import DBStats_Flask_Obj
 from .Annotation_Flask import Annotation_Flask_Obj
 from .Ontology_Flask import Ontology_Flask_Obj
-from .utils import debug, SetDebugLevel
+from .utils import debug, SetDebugLevel, SetDebugRingLevel, get_token_secret, verify_token
 from . import db_access
 from . import dbuser
+from . import dbannotations
+from . import seqindex
+from . import ontology_graph
+from . import term_dict
 
 
 # global variables
 dbDefaultUser = "na"  # anonymos user in case the field is empty
 dbDefaultPwd = ""
 
-recentLoginUsers = []
+# the userid of the default user (set on first use by _get_default_user_id())
+defaultUserId = None
+
+# the default number of annotations in the worker annotation cache (DBBACT_ANNOTATION_CACHE_SIZE)
+DEFAULT_ANNOTATION_CACHE_SIZE = 20000
 
 app = Flask(__name__)
 app.register_blueprint(Seq_Flask_Obj)
@@ -61,16 +69,30 @@ def before_request():
         debug(6, 'got request for page %s' % request.url, request=request)
         g.local_request = False
     else:
-        debug(2, 'got local request for page %s' % request.url, request=request)
+        debug(2, 'got local request for page %s', request.url, request=request)
         g.local_request = True
-    con, cur = db_access.connect_db(server_type=app.config.get('DBBACT_SERVER_TYPE'),
-                                    host=app.config.get('DBBACT_POSTGRES_HOST'),
-                                    port=app.config.get('DBBACT_POSTGRES_PORT'),
-                                    database=app.config.get('DBBACT_POSTGRES_DATABASE'),
-                                    user=app.config.get('DBBACT_POSTGRES_USER'),
-                                    password=app.config.get('DBBACT_POSTGRES_PASSWORD'))
+    db_params = {'server_type': app.config.get('DBBACT_SERVER_TYPE'),
+                 'host': app.config.get('DBBACT_POSTGRES_HOST'),
+                 'port': app.config.get('DBBACT_POSTGRES_PORT'),
+                 'database': app.config.get('DBBACT_POSTGRES_DATABASE'),
+                 'user': app.config.get('DBBACT_POSTGRES_USER'),
+                 'password': app.config.get('DBBACT_POSTGRES_PASSWORD')}
+    if _use_pool():
+        # borrow a connection from the worker connection pool (returned in teardown_request)
+        pool = db_access.get_pool(min_size=app.config.get('DBBACT_POOL_MIN_SIZE') or 1,
+                                  max_size=app.config.get('DBBACT_POOL_MAX_SIZE') or 10,
+                                  max_age=app.config.get('DBBACT_POOL_MAX_AGE') or 3600,
+                                  timeout=app.config.get('DBBACT_POOL_TIMEOUT') or 30,
+                                  **db_params)
+        con, cur = pool.getconn()
+        g.pool = pool
+    else:
+        con, cur = db_access.connect_db(**db_params)
+        g.pool = None
     g.con = con
     g.cur = cur
+    # process the cache invalidation notifications from the other workers
+    db_access.poll_notifications(**db_params)
     # address of the sequence translator rest api
     g.seq_translate_api = app.config.get('DBBACT_SEQUENCE_TRANSLATOR_ADDR')
 
@@ -82,10 +104,24 @@ def before_request():
         return res
 
 
-# and when the request is over, disconnect
+# and when the request is over, return the connection to the pool (or disconnect if not using the pool)
 @app.teardown_request
 def teardown_request(exception):
-    g.con.close()
+    con = g.get('con')
+    if con is None:
+        return
+    if g.get('pool') is not None:
+        g.pool.putconn(con)
+    else:
+        con.close()
+
+
+def _use_pool():
+    '''test if the database connection pool is enabled (DBBACT_POOL_MAX_SIZE=0 disables it)'''
+    max_size = app.config.get('DBBACT_POOL_MAX_SIZE')
+    if max_size is None:
+        return True
+    return int(max_size) > 0
 
 
 # handle the cross-site scripting requests (CORS)
@@ -96,7 +132,8 @@ def after_request(response):
     # check for the API general message if an error occured
     # the message is located at 'dbbact-api-error-message.txt'
     # append the message to the end of the error message
-    if response.status_code != 200:
+    # (not for 304 not modified responses, which have no body)
+    if response.status_code != 200 and response.status_code != 304:
         api_error_filename = 'dbbact-api-error-message.txt'
         try:
             with open(api_error_filename) as fl:
@@ -106,12 +143,12 @@ def after_request(response):
                     response.data = response.data + b'\n' + alert_text.encode()
         except:
             with open(api_error_filename, 'w') as fl:
-                debug(5, 'empty alert file created: %s' % api_error_filename)
+                debug(5, 'empty alert file created: %s', api_error_filename)
 
     header = response.headers
     header['Access-Control-Allow-Origin'] = '*'
     # this part from: https://stackoverflow.com/questions/25727306/request-header-field-access-control-allow-headers-is-not-allowed-by-access-contr
-    header["Access-Control-Allow-Headers"] = "Origin, X-Requested-With, Content-Type, Accept"
+    header["Access-Control-Allow-Headers"] = "Origin, X-Requested-With, Content-Type, Accept, Authorization"
     if g.local_request:
         debug(2, 'request processing finished')
     else:
@@ -125,66 +162,63 @@ def load_user(request):
     try:
         debug(1, '>>>>>>>>>>>load_user login attempt')
         user = None
+        # login using a token (from /users/login) if supplied - no need to check the password
+        auth_header = request.headers.get('Authorization')
+        if auth_header is not None and auth_header.startswith('Bearer '):
+            err, token_data = verify_token(app.config.get('DBBACT_TOKEN_SECRET'), auth_header[len('Bearer '):].strip())
+            if not err:
+                debug(1, 'load_user token login succeeded userid=%d', token_data['uid'])
+                return User(token_data['user'], None, token_data['uid'], token_data['admin'])
+            debug(2, 'token login failed: %s', err)
         alldat = request.get_json()
         if (alldat is not None):
-            debug(1, 'login request json: %s' % alldat)
             userName = alldat.get('user')
             password = alldat.get('pwd')
         else:
             userName = None
             password = None
-        debug(1, 'username is %s' % userName)
+        debug(1, 'username is %s', userName)
 
         # use default user name when it was not sent
         if(userName is None and password is None):
             userName = dbDefaultUser  # anonymos user in case the field is empty
             password = dbDefaultPwd
 
-        # check if exist in the recent array first & password didnt change
-        # for tempUser in recentLoginUsers:
-        #   if( tempUser.name == userName ):
-        #       if( tempUser.password == password):
-        #           user found, return
-        #           debug(1,'user %s already found' % (tempUser.name))
-        #           return tempUser
-        #       else:
-        #           debug(1,'remove user %s since it might that the password was changed' % (tempUser.id))
-        #           # user exist but with different password, remove the user and continue login
-        #           recentLoginUsers.remove(tempUser)
-
-        # user was not found in the cache memory
-        errorMes, userId = dbuser.getUserId(g.con, g.cur, userName, password)
+        # anonymous user - no need to authenticate
+        if userName == dbDefaultUser and password == dbDefaultPwd:
+            return User(dbDefaultUser, dbDefaultPwd, _get_default_user_id(), 0)
+
+        # authenticate (using the cache of recently verified logins)
+        errorMes, userId, isadmin = dbuser.get_user_login(g.con, g.cur, userName, password)
         if userId >= 0:
-            debug(1, 'load_user login succeeded userid=%d' % userId)
-            errorMes, isadmin = dbuser.isAdmin(g.con, g.cur, userName)
-            if isadmin != 1:
-                isadmin = 0
+            debug(1, 'load_user login succeeded userid=%d', userId)
             user = User(userName, password, userId, isadmin)
-            # add the user to the recent users list
-            # for tempUser int recentLoginUsers:
-            #   if( tempUser.name == user.name ):
-            #       debug(1,'user %s already found' % (user.id))
-            # add the user to the list
-            # recentLoginUsers.append(user)
         else:
-            debug(2, 'user login for user %s failed %s' % (userName, errorMes))
-            # make sure we are not admin
-            isadmin = 0
-            # login failed, so fallback to default user
-            errorMes, userId = dbuser.getUserId(g.con, g.cur, dbDefaultUser, dbDefaultPwd)
-            if userId >= 0:
-                debug(1, 'logged in as default user userid=%d' % userId)
-            else:
-                debug(3, 'Failed to get userID. using default. error %s' % errorMes)
-                userId = 0
-            user = User(dbDefaultUser, dbDefaultPwd, userId, isadmin)
+            debug(2, 'user login for user %s failed %s', userName, errorMes)
+            # login failed, so fallback to default user (and make sure we are not admin)
+            user = User(dbDefaultUser, dbDefaultPwd, _get_default_user_id(), 0)
         return user
     # we need this except for flask-autodoc (it does not have flask.g ?!?!)
     except Exception as e:
-        debug(3, 'exception occured when logging in user. login failed. error: %s' % e)
+        debug(3, 'exception occured when logging in user. login failed. error: %s', e)
         return user
 
 
+def _get_default_user_id():
+    '''get the userid of the default (anonymous) user.
+    the id is looked up once per worker'''
+    global defaultUserId
+
+    if defaultUserId is None:
+        errorMes, userId = dbuser.getUserId(g.con, g.cur, dbDefaultUser, dbDefaultPwd)
+        if userId < 0:
+            debug(3, 'Failed to get userID. using default. error %s', errorMes)
+            return 0
+        debug(1, 'default user userid=%d', userId)
+        defaultUserId = userId
+    return defaultUserId
+
+
 def gunicorn(server_type=None, pg_host=None, pg_port=None, pg_db=None, pg_user=None, pg_pwd=None, seq_trans_api=True, debug_level=6):
     '''The entry point for running the api server through gunicorn (http://gunicorn.org/)
     to run dbbact rest server using gunicorn, use:
@@ -217,6 +251,9 @@ def gunicorn(server_type=None, pg_host=None, pg_port=None, pg_db=None, pg_user=N
     app.debug = True
     debug(6, 'starting dbbact rest-api server using gunicorn, debug_level=%d' % debug_level)
     set_env_params()
+    # keep also lower level debug records (without printing them) in the recent records buffer (see /stats/recent_debug)
+    if app.config.get('DBBACT_DEBUG_RING_LEVEL') is not None:
+        SetDebugRingLevel(int(app.config.get('DBBACT_DEBUG_RING_LEVEL')))
     if server_type is not None:
         app.config['DBBACT_SERVER_TYPE'] = server_type
     if pg_host is not None:
@@ -256,12 +293,47 @@ def gunicorn(server_type=None, pg_host=None, pg_port=None, pg_db=None, pg_user=N
 
 def set_env_params():
     # set the database access parameters
-    env_params = ['DBBACT_SERVER_TYPE', 'DBBACT_POSTGRES_HOST', 'DBBACT_POSTGRES_PORT', 'DBBACT_POSTGRES_DATABASE', 'DBBACT_POSTGRES_USER', 'DBBACT_POSTGRES_PASSWORD', 'DBBACT_SEQUENCE_TRANSLATOR_ADDR']
+    env_params = ['DBBACT_SERVER_TYPE', 'DBBACT_POSTGRES_HOST', 'DBBACT_POSTGRES_PORT', 'DBBACT_POSTGRES_DATABASE', 'DBBACT_POSTGRES_USER', 'DBBACT_POSTGRES_PASSWORD', 'DBBACT_SEQUENCE_TRANSLATOR_ADDR',
+                  'DBBACT_POOL_MIN_SIZE', 'DBBACT_POOL_MAX_SIZE', 'DBBACT_POOL_MAX_AGE', 'DBBACT_POOL_TIMEOUT',
+                  'DBBACT_TOKEN_SECRET', 'DBBACT_TOKEN_TTL', 'DBBACT_DEBUG_RING_LEVEL', 'DBBACT_ANNOTATION_CACHE_SIZE',
+                  'DBBACT_SEQUENCE_INDEX', 'DBBACT_PREFIX_INDEX', 'DBBACT_CLOSE_INDEX', 'DBBACT_CLOSE_POOL_SIZE', 'DBBACT_ONTOLOGY_GRAPH',
+                  'DBBACT_TERM_DICT']
+    # the parameters whose values should not be written to the log
+    secret_params = ('DBBACT_POSTGRES_PASSWORD', 'DBBACT_TOKEN_SECRET')
     for cparam in env_params:
             cval = os.environ.get(cparam)
             if cval is not None:
-                debug(5, 'using value %s for env. parameter %s' % (cval, cparam))
+                if cparam in secret_params:
+                    debug(5, 'using value *** for env. parameter %s', cparam)
+                else:
+                    debug(5, 'using value %s for env. parameter %s', cval, cparam)
             app.config[cparam] = cval
+    # the key for signing the login tokens. if not supplied, use (or create) the key file so all workers share the same key
+    if app.config['DBBACT_TOKEN_SECRET'] is None:
+        app.config['DBBACT_TOKEN_SECRET'] = get_token_secret()
+    else:
+        app.config['DBBACT_TOKEN_SECRET'] = app.config['DBBACT_TOKEN_SECRET'].encode('utf8')
+    # number of annotations cached by each worker (0 to disable the cache)
+    if app.config['DBBACT_ANNOTATION_CACHE_SIZE'] is None:
+        dbannotations.set_annotation_cache_size(DEFAULT_ANNOTATION_CACHE_SIZE)
+    else:
+        dbannotations.set_annotation_cache_size(int(app.config['DBBACT_ANNOTATION_CACHE_SIZE']))
+    # the exact sequence index, the prefix index and the close sequences index: 'memory' to build it in each worker, or the snapshot file name (created by dbbact_jobs/update_sequence_index.py)
+    for cparam, cindex_type in (('DBBACT_SEQUENCE_INDEX', 'exact'), ('DBBACT_PREFIX_INDEX', 'prefix'), ('DBBACT_CLOSE_INDEX', 'close')):
+        if app.config[cparam] is not None:
+            if app.config[cparam] == 'memory':
+                seqindex.init_sequence_index(index_type=cindex_type)
+            else:
+                seqindex.init_sequence_index(filename=app.config[cparam], index_type=cindex_type)
+    # number of processes for large close sequences lookups (requires the close index snapshot file)
+    if app.config['DBBACT_CLOSE_POOL_SIZE'] is not None:
+        seqindex.set_close_pool_size(int(app.config['DBBACT_CLOSE_POOL_SIZE']))
+    # the in-memory ontology graph (used by default). set to 0 to always query the database for the term parents/children
+    if app.config['DBBACT_ONTOLOGY_GRAPH'] is not None:
+        ontology_graph.set_ontology_graph_enabled(app.config['DBBACT_ONTOLOGY_GRAPH'].lower() not in ('0', 'false', 'no'))
+    # the in-memory term dictionary (used by default). set to 0 to always query the database for the term names/ids/synonyms
+    if app.config['DBBACT_TERM_DICT'] is not None:
+        term_dict.set_term_dict_enabled(app.config['DBBACT_TERM_DICT'].lower() not in ('0', 'false', 'no'))
     # Bypass the proxy for local requests (so can talk to sequence_translator_dbbact)
     os.environ['NO_PROXY']='127.0.0.1'
 
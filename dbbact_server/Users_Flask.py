@@ -1,15 +1,17 @@
 import json
-from flask import Blueprint, request, g
+from flask import Blueprint, request, g, current_app
 from flask_login import login_required, current_user
 from . import dbannotations
 from . import dbuser
-from .utils import debug, getdoc, send_email, random_str
+from .utils import debug, getdoc, send_email, random_str, create_token
 from .autodoc import auto
 
 
 Users_Flask_Obj = Blueprint('Users_Flask_Obj', __name__, template_folder='templates')
 
 MAX_RECOVERY_ATTEMPTS = 10
+# default validity time (seconds) of the tokens created by /users/login
+DEFAULT_TOKEN_TTL = 24 * 60 * 60
 
 
 @Users_Flask_Obj.route('/users/get_user_id', methods=['POST', 'GET'])
@@ -50,6 +52,56 @@ def get_user_id():
     return json.dumps({"user": userid})
 
 
+@Users_Flask_Obj.route('/users/login', methods=['POST', 'GET'])
+@auto.doc()
+def login():
+    """
+    Title: Get a login token
+    URL: users/login
+    Method: POST
+    URL Params:
+    Data Params: JSON
+        {
+            user : str
+                user name
+            pwd : str
+                password
+        }
+    Success Response:
+        Code : 200
+        Content :
+        {
+            token : str
+                the login token. send it in the "Authorization: Bearer <token>" header of the following requests
+                instead of the user/pwd fields
+            expires : int
+                the token expiration time (seconds since epoch)
+            user : int
+                the userid
+        }
+    Details:
+        The token is signed by the server and is valid until it expires (default 24 hours, set by the DBBACT_TOKEN_TTL env. variable).
+        Note a password change does not revoke tokens that were already issued.
+    """
+    cfunc = login
+    if request.method == 'GET':
+        return(getdoc(cfunc))
+    alldat = request.get_json()
+    if alldat is None:
+        return('user and pwd must be supplied', 400)
+    user = alldat.get('user')
+    pwd = alldat.get('pwd')
+
+    err, userid, isadmin = dbuser.get_user_login(g.con, g.cur, user, pwd)
+    if userid < 0:
+        debug(3, 'login for user %s failed: %s' % (user, err))
+        return(err, 400)
+    ttl = int(current_app.config.get('DBBACT_TOKEN_TTL') or DEFAULT_TOKEN_TTL)
+    token, expires = create_token(current_app.config['DBBACT_TOKEN_SECRET'], {'uid': userid, 'user': user, 'admin': isadmin}, ttl)
+    debug(3, 'created login token for user %s' % user)
+    return json.dumps({'token': token, 'expires': expires, 'user': userid})
+
+
 @Users_Flask_Obj.route('/users/get_user_public_information', methods=['POST', 'GET'])
 @auto.doc()
 def get_user_public_information():
@@ -201,7 +253,7 @@ def forgot_password():
 
     # generate and update new password
     newpassword = random_str()
-    debug(6, 'reset password for email %s. token is %s' % (email, newpassword))
+    debug(6, 'reset password for email %s' % email)
     debug(3, 'calling updateNewTempcode')
     err, retval = dbuser.updateNewTempcode(g.con, g.cur, username, newpassword)
     if retval <= 0:
@@ -0,0 +1,207 @@
+import threading
+from collections import OrderedDict
+
+from .utils import debug
+
+# all the caches created in this process (name -> LRUCache), for the statistics
+_caches = OrderedDict()
+
+
+class LRUCache:
+    '''A thread safe least-recently-used dict cache with a maximal number of entries (and optionally a maximal total size in bytes)
+
+    Each worker process keeps its own caches, so invalidation across workers is done using
+    postgres notifications (see db_access.listen())
+    '''
+    def __init__(self, name, max_size=10000, max_bytes=None):
+        '''
+        Parameters
+        ----------
+        name: str
+            name of the cache (for the statistics)
+        max_size: int, optional
+            maximal number of entries in the cache (the least recently used are removed first).
+            0 to disable the cache
+        max_bytes: int or None, optional
+            maximal total size (as given in set()) of the entries in the cache (the least recently used are removed first).
+            None for no size limit
+        '''
+        self.name = name
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        # the size of each entry (only if max_bytes is not None) and the total size of the entries
+        self._sizes = {}
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # incremented on each invalidation (so values read from the database before the invalidation are not stored)
+        self.generation = 0
+        _caches[name] = self
+
+    def get(self, key, default=None):
+        '''Get the value of key from the cache (and mark it as recently used)
+
+        Parameters
+        ----------
+        key:
+            the key to get
+        default: optional
+            the value to return if the key is not in the cache
+
+        Returns
+        -------
+        the cached value or default if not in the cache
+        '''
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_many(self, keys):
+        '''Get the values of multiple keys from the cache
+
+        Parameters
+        ----------
+        keys: iterable
+            the keys to get
+
+        Returns
+        -------
+        dict of {key: value}
+            only for the keys found in the cache
+        '''
+        found = {}
+        with self._lock:
+            for ckey in keys:
+                try:
+                    found[ckey] = self._data[ckey]
+                except KeyError:
+                    self.misses += 1
+                    continue
+                self._data.move_to_end(ckey)
+                self.hits += 1
+        return found
+
+    def set(self, key, value, generation=None, nbytes=0):
+        '''Store the value of key in the cache (removing the least recently used entries if the cache is full)
+
+        Parameters
+        ----------
+        key:
+            the key to store
+        value:
+            the value to store
+        generation: int or None, optional
+            the cache generation when the value was read from the database.
+            if not None and the cache was invalidated since, the value is not stored (since it may be stale)
+        nbytes: int, optional
+            the size of the value (used only if the cache has max_bytes).
+            calling set() again for the same key updates the size (i.e. if the value grew)
+        '''
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(key)
+            self._data[key] = value
+            if self.max_bytes is not None:
+                self._sizes[key] = nbytes
+                self.total_bytes += nbytes
+            self._evict(self.max_size)
+
+    def _remove(self, key):
+        '''Remove the key from the cache (if present). Should be called with the lock held
+
+        Returns
+        -------
+        bool: True if the key was in the cache
+        '''
+        if key not in self._data:
+            return False
+        del self._data[key]
+        self.total_bytes -= self._sizes.pop(key, 0)
+        return True
+
+    def _evict(self, max_size):
+        '''Remove the least recently used entries until the cache is within max_size entries and max_bytes. Should be called with the lock held'''
+        while len(self._data) > max(max_size, 0) or (self.max_bytes is not None and self.total_bytes > self.max_bytes and self._data):
+            ckey, _ = self._data.popitem(last=False)
+            self.total_bytes -= self._sizes.pop(ckey, 0)
+            self.evictions += 1
+
+    def invalidate(self, keys=None):
+        '''Remove entries from the cache
+
+        Parameters
+        ----------
+        keys: iterable or None, optional
+            the keys to remove. None to clear the whole cache
+        '''
+        with self._lock:
+            self.generation += 1
+            if keys is None:
+                self.invalidations += len(self._data)
+                self._data.clear()
+                self._sizes.clear()
+                self.total_bytes = 0
+                return
+            for ckey in keys:
+                if self._remove(ckey):
+                    self.invalidations += 1
+
+    def resize(self, max_size):
+        '''Set the maximal number of entries in the cache
+
+        Parameters
+        ----------
+        max_size: int
+            the new maximal size (0 to disable the cache)
+        '''
+        with self._lock:
+            self.max_size = max_size
+            self._evict(max_size)
+        debug(2, 'cache %s resized to %d', self.name, max_size)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_stats(self):
+        '''Get the cache usage statistics
+
+        Returns
+        -------
+        dict with the keys:
+            'size', 'max_size', 'hits', 'misses', 'evictions', 'invalidations' : int
+            'hit_rate' : float
+            'bytes', 'max_bytes' : int (only if the cache has max_bytes)
+        '''
+        with self._lock:
+            total = self.hits + self.misses
+            stats = {'size': len(self._data), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                     'hit_rate': self.hits / total if total > 0 else 0.0,
+                     'evictions': self.evictions, 'invalidations': self.invalidations}
+            if self.max_bytes is not None:
+                stats['bytes'] = self.total_bytes
+                stats['max_bytes'] = self.max_bytes
+            return stats
+
+
+def get_cache_stats():
+    '''Get the statistics of all the caches of the current process
+
+    Returns
+    -------
+    dict of {name(str): stats(dict)}
+        the stats returned by LRUCache.get_stats() for each cache
+    '''
+    return {cname: ccache.get_stats() for cname, ccache in _caches.items()}
@@ -1,30 +1,39 @@
+import os
+import time
+import threading
+import weakref
+
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
 
 from .utils import debug
 
+# the per-worker connection pool (created on first use by get_pool())
+_pool = None
+# the pid of the process that created _pool (so a forked worker does not reuse the parent connections)
+_pool_pid = None
+# pools inherited from a parent process. we keep a reference so the connections are not closed (and terminated on the server) by the garbage collector
+_inherited_pools = []
 
-def connect_db(server_type=None, database=None, user=None, password=None, port=None, host=None):
+# the registered prepared statements (name -> PREPARE command). added using register_statement()
+_statements = {}
+# for each connection, dict of the statements already prepared on it (name -> PREPARE command)
+# weak so closed/discarded connections are removed automatically
+_prepared = weakref.WeakKeyDictionary()
+
+
+def _get_connect_params(server_type=None, database=None, user=None, password=None, port=None, host=None):
     """
-    connect to the postgres database and return the connection and cursor
+    get the postgres connection parameters for the server type, overridden by the function parameters
 
     Parameters
     ----------
-    server_type: str
-        type of server to connect to. overrides the other default parameters
-        options are:
-            'main', 'develop', 'test', 'local'
-    database: str, optional
-        name of the database to connect to (usually 'dbbact'/'dbbact_develop'/'dbbact_test')
-    host: str or False or None
-        False to not pass host parameter
-        None to use server_type defaults
-        str to connect to given host
+    see connect_db()
 
     Returns
     -------
-    con : the psycopg database connection
-    cur : the psycopg database cursor (DictCursor)
+    dict of parameters to pass to psycopg2.connect()
     """
     # set the default values
     chost = False
@@ -68,12 +77,38 @@ def connect_db(server_type=None, database=None, user=None, password=None, port=N
         chost = host
     # convert port to number since env. parameter can be str
     cport = int(cport)
+    params = {'database': cdatabase, 'user': cuser, 'password': cpassword, 'port': cport}
+    if chost is not False:
+        params['host'] = chost
+    return params
+
+
+def connect_db(server_type=None, database=None, user=None, password=None, port=None, host=None):
+    """
+    connect to the postgres database and return the connection and cursor
+
+    Parameters
+    ----------
+    server_type: str
+        type of server to connect to. overrides the other default parameters
+        options are:
+            'main', 'develop', 'test', 'local'
+    database: str, optional
+        name of the database to connect to (usually 'dbbact'/'dbbact_develop'/'dbbact_test')
+    host: str or False or None
+        False to not pass host parameter
+        None to use server_type defaults
+        str to connect to given host
+
+    Returns
+    -------
+    con : the psycopg database connection
+    cur : the psycopg database cursor (DictCursor)
+    """
+    params = _get_connect_params(server_type=server_type, database=database, user=user, password=password, port=port, host=host)
     try:
-        debug(1, 'connecting host=%s, database=%s, user=%s, port=%d' % (chost, cdatabase, cuser, cport))
-        if chost is False:
-            con = psycopg2.connect(database=cdatabase, user=cuser, password=cpassword, port=cport)
-        else:
-            con = psycopg2.connect(host=chost, database=cdatabase, user=cuser, password=cpassword, port=cport)
+        debug(1, 'connecting host=%s, database=%s, user=%s, port=%d' % (params.get('host', False), params['database'], params['user'], params['port']))
+        con = psycopg2.connect(**params)
         cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
         debug(1, 'connected to database')
         return (con, cur)
@@ -82,3 +117,424 @@ def connect_db(server_type=None, database=None, user=None, password=None, port=N
         debug(3, msg)
         raise SystemError(msg)
         return None
+
+
+class ConnectionPool:
+    """
+    A per-process pool of postgres connections.
+    Connections are borrowed using getconn() and returned using putconn(). Returned connections are rolled back,
+    connections older than max_age seconds are replaced, and connections idle for more than check_interval seconds
+    are tested (using "SELECT 1") before they are handed out again.
+    """
+    def __init__(self, min_size=1, max_size=10, max_age=3600, timeout=30, check_interval=30, **connect_params):
+        """
+        Parameters
+        ----------
+        min_size: int, optional
+            the number of connections to open when the pool is created
+        max_size: int, optional
+            the maximal number of open connections (idle + in use)
+        max_age: float, optional
+            replace connections which are older than max_age seconds (0 to never replace)
+        timeout: float, optional
+            maximal time (seconds) to wait for a free connection when all max_size connections are in use
+        check_interval: float, optional
+            test connections that were idle for more than check_interval seconds before using them
+        connect_params:
+            passed to _get_connect_params() (server_type, database, user, password, port, host)
+        """
+        self.min_size = int(min_size)
+        self.max_size = max(int(max_size), 1)
+        self.max_age = float(max_age)
+        self.timeout = float(timeout)
+        self.check_interval = float(check_interval)
+        self._params = _get_connect_params(**connect_params)
+        self._lock = threading.Condition()
+        # list of (con, creation time, last used time) of the idle connections
+        self._idle = []
+        # dict of id(con) -> creation time for the connections currently in use
+        self._in_use = {}
+        self._stats = {'requests': 0, 'waits': 0, 'wait_time': 0.0, 'max_wait_time': 0.0, 'created': 0, 'discarded': 0, 'failed_checks': 0}
+        for idx in range(min(self.min_size, self.max_size)):
+            try:
+                con = self._connect()
+            except SystemError:
+                break
+            self._idle.append((con, time.time(), time.time()))
+
+    def _connect(self):
+        try:
+            con = psycopg2.connect(**self._params)
+        except psycopg2.DatabaseError as e:
+            msg = 'Cannot connect to database %s. Error %s' % (self._params['database'], e)
+            debug(3, msg)
+            raise SystemError(msg)
+        self._stats['created'] += 1
+        debug(1, 'pool opened new connection to database %s' % self._params['database'])
+        return con
+
+    def _discard(self, con):
+        self._stats['discarded'] += 1
+        try:
+            con.close()
+        except Exception as e:
+            debug(2, 'failed to close discarded connection: %s' % e)
+
+    def _is_healthy(self, con, created, last_used):
+        '''test if an idle connection can be reused'''
+        if con.closed:
+            return False
+        now = time.time()
+        if self.max_age > 0 and now - created > self.max_age:
+            debug(1, 'pool connection passed max age')
+            return False
+        if now - last_used > self.check_interval:
+            try:
+                cur = con.cursor()
+                cur.execute('SELECT 1')
+                cur.close()
+                con.rollback()
+            except psycopg2.Error as e:
+                debug(3, 'pool connection failed health check: %s' % e)
+                self._stats['failed_checks'] += 1
+                return False
+        return True
+
+    def getconn(self):
+        """
+        borrow a connection from the pool. waits up to timeout seconds if all connections are in use
+
+        Returns
+        -------
+        con : the psycopg database connection
+        cur : the psycopg database cursor (DictCursor)
+        """
+        start_time = time.time()
+        waited = False
+        with self._lock:
+            self._stats['requests'] += 1
+            while True:
+                con = None
+                while len(self._idle) > 0:
+                    ccon, created, last_used = self._idle.pop()
+                    if self._is_healthy(ccon, created, last_used):
+                        con = ccon
+                        break
+                    self._discard(ccon)
+                if con is not None:
+                    break
+                if len(self._in_use) < self.max_size:
+                    con = self._connect()
+                    created = time.time()
+                    break
+                remaining = self.timeout - (time.time() - start_time)
+                if remaining <= 0:
+                    msg = 'timeout waiting for a free database connection (pool max_size=%d)' % self.max_size
+                    debug(7, msg)
+                    raise SystemError(msg)
+                waited = True
+                self._lock.wait(remaining)
+            self._in_use[id(con)] = created
+            if waited:
+                wait_time = time.time() - start_time
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += wait_time
+                self._stats['max_wait_time'] = max(self._stats['max_wait_time'], wait_time)
+        cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        return con, cur
+
+    def putconn(self, con):
+        """
+        return a connection to the pool. an open transaction is rolled back
+
+        Parameters
+        ----------
+        con : the psycopg database connection (obtained from getconn())
+        """
+        with self._lock:
+            created = self._in_use.pop(id(con), None)
+            if created is None:
+                debug(5, 'trying to return a connection that is not from the pool')
+                return
+            keep = not con.closed
+            if keep and con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    con.rollback()
+                except psycopg2.Error as e:
+                    debug(3, 'rollback of returned connection failed: %s' % e)
+                    keep = False
+            if keep and self.max_age > 0 and time.time() - created > self.max_age:
+                keep = False
+            if keep:
+                self._idle.append((con, created, time.time()))
+            else:
+                self._discard(con)
+            self._lock.notify()
+
+    def closeall(self):
+        '''close all the idle connections in the pool'''
+        with self._lock:
+            for con, created, last_used in self._idle:
+                self._discard(con)
+            self._idle = []
+
+    def get_stats(self):
+        """
+        get the pool usage statistics
+
+        Returns
+        -------
+        dict with the following keys:
+            'pid': the process id of the worker owning the pool
+            'min_size', 'max_size': the pool size limits
+            'in_use': number of connections currently borrowed
+            'idle': number of open connections waiting in the pool
+            'requests': total number of getconn() calls
+            'waits': number of getconn() calls that had to wait for a free connection
+            'wait_time': total wait time (seconds)
+            'max_wait_time': the longest wait (seconds)
+            'created', 'discarded': number of physical connections opened / closed
+            'failed_checks': number of idle connections that failed the health check
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pid'] = os.getpid()
+            stats['min_size'] = self.min_size
+            stats['max_size'] = self.max_size
+            stats['in_use'] = len(self._in_use)
+            stats['idle'] = len(self._idle)
+        return stats
+
+
+def get_pool(**kwargs):
+    """
+    get the connection pool of the current process. create it if needed (i.e. on the first request in each gunicorn worker)
+
+    Parameters
+    ----------
+    kwargs:
+        passed to ConnectionPool() when the pool is created
+
+    Returns
+    -------
+    ConnectionPool
+    """
+    global _pool, _pool_pid
+
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    if _pool is not None:
+        # we were forked from the process that created the pool - don't touch the parent connections
+        debug(2, 'process forked, creating a new connection pool')
+        _inherited_pools.append(_pool)
+    _pool = ConnectionPool(**kwargs)
+    _pool_pid = os.getpid()
+    debug(2, 'created connection pool (min_size=%d, max_size=%d) for pid %d' % (_pool.min_size, _pool.max_size, _pool_pid))
+    return _pool
+
+
+def get_pool_stats():
+    """
+    get the statistics of the current process connection pool
+
+    Returns
+    -------
+    dict (see ConnectionPool.get_stats()) or None if no pool was created in this process
+    """
+    if _pool is None or _pool_pid != os.getpid():
+        return None
+    return _pool.get_stats()
+
+
+def register_statement(name, argtypes, query):
+    """
+    register a frequently used query as a prepared statement.
+    the statement is prepared once on each connection by prepare_statements(), and then used via cur.execute('EXECUTE name(%s,...)', [...])
+
+    Parameters
+    ----------
+    name: str
+        name of the prepared statement
+    argtypes: list of str
+        the postgres types of the statement parameters (i.e. ['int', 'text'])
+    query: str
+        the query. parameters are $1, $2, ...
+    """
+    if len(argtypes) > 0:
+        command = 'PREPARE %s(%s) AS %s' % (name, ','.join(argtypes), query)
+    else:
+        command = 'PREPARE %s AS %s' % (name, query)
+    if name in _statements and _statements[name] != command:
+        debug(5, 'prepared statement %s re-registered with a different query' % name)
+    _statements[name] = command
+
+
+def prepare_statements(con, cur):
+    '''Prepare all the registered statements which are not yet prepared on the connection.
+    Since postgres prepared statements persist for the whole session, each statement is prepared only once per connection
+    (pooled connections keep their prepared statements between requests).
+
+    Parameters
+    ----------
+    con, cur:
+
+    Returns
+    -------
+    err: str
+        empty ('') if ok. otherwise the error encountered
+    '''
+    con_prepared = _prepared.get(con)
+    if con_prepared is None:
+        # first time we see this connection - get the statements already prepared (i.e. if the connection was used outside the registry)
+        con_prepared = {}
+        try:
+            cur.execute('SELECT name FROM pg_prepared_statements')
+            for cres in cur.fetchall():
+                con_prepared[cres[0]] = None
+        except psycopg2.DatabaseError as e:
+            debug(7, 'error %s encountered when getting prepared statements' % e)
+            return str(e)
+        _prepared[con] = con_prepared
+    try:
+        for cname, ccommand in _statements.items():
+            if cname in con_prepared:
+                if con_prepared[cname] == ccommand:
+                    continue
+                # prepared outside the registry or with a different query - prepare again
+                cur.execute('DEALLOCATE %s' % cname)
+                del con_prepared[cname]
+            cur.execute(ccommand)
+            con_prepared[cname] = ccommand
+            debug(1, 'prepared statement %s' % cname)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'error %s encountered in prepare_statements' % e)
+        return str(e)
+    return ''
+
+
+# the postgres notification channels we listen on (channel -> list of callback functions)
+_listen_callbacks = {}
+# the connection used for receiving the notifications (per process)
+_listen_con = None
+_listen_pid = None
+
+
+def listen(channel, callback):
+    """
+    register a callback for postgres notifications (NOTIFY) on the channel.
+    the notifications are received by poll_notifications() (called at the beginning of each request)
+
+    Parameters
+    ----------
+    channel: str
+        the notification channel name
+    callback: function(payload)
+        called with the notification payload (str) for each notification received on the channel.
+        called with None if notifications may have been lost (i.e. the listening connection failed),
+        so any state depending on the notifications should be reset
+    """
+    if channel not in _listen_callbacks:
+        _listen_callbacks[channel] = []
+        # reconnect on the next poll to listen also on the new channel
+        _close_listener()
+    _listen_callbacks[channel].append(callback)
+
+
+def notify(cur, channel, payload=''):
+    """
+    send a postgres notification on the channel to all the listening processes (including the current one).
+    the notification is sent when the transaction is committed
+
+    Parameters
+    ----------
+    cur: the database cursor
+    channel: str
+        the notification channel name
+    payload: str, optional
+        the notification payload
+    """
+    cur.execute('SELECT pg_notify(%s, %s)', [channel, payload])
+
+
+def _close_listener():
+    global _listen_con, _listen_pid
+
+    if _listen_con is not None and _listen_pid == os.getpid():
+        try:
+            _listen_con.close()
+        except Exception:
+            pass
+    _listen_con = None
+    _listen_pid = None
+
+
+def _notify_all(payload):
+    for ccallbacks in _listen_callbacks.values():
+        for ccallback in ccallbacks:
+            ccallback(payload)
+
+
+def poll_notifications(**connect_params):
+    """
+    process the postgres notifications received since the last call (calling the callbacks registered using listen()).
+    opens the listening connection if needed (once per process)
+
+    Parameters
+    ----------
+    connect_params:
+        passed to _get_connect_params() (server_type, database, user, password, port, host) when opening the listening connection
+
+    Returns
+    -------
+    int
+        the number of notifications processed
+    """
+    global _listen_con, _listen_pid
+
+    if len(_listen_callbacks) == 0:
+        return 0
+    if _listen_con is None or _listen_pid != os.getpid() or _listen_con.closed:
+        if _listen_pid == os.getpid():
+            # listening connection was lost, so we may have missed notifications
+            debug(5, 'listening connection closed')
+        _listen_con = None
+        try:
+            con = psycopg2.connect(**_get_connect_params(**connect_params))
+            con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = con.cursor()
+            for cchannel in _listen_callbacks.keys():
+                cur.execute('LISTEN %s' % cchannel)
+            cur.close()
+        except psycopg2.DatabaseError as e:
+            debug(7, 'failed to open listening connection: %s', e)
+            _notify_all(None)
+            return 0
+        _listen_con = con
+        _listen_pid = os.getpid()
+        debug(2, 'listening for notifications on channels %s', list(_listen_callbacks.keys()))
+        # we did not listen until now, so anything could have changed
+        _notify_all(None)
+    try:
+        _listen_con.poll()
+    except psycopg2.Error as e:
+        debug(7, 'polling the listening connection failed: %s', e)
+        _close_listener()
+        _notify_all(None)
+        return 0
+    num_notifications = len(_listen_con.notifies)
+    while len(_listen_con.notifies) > 0:
+        cnotify = _listen_con.notifies.pop(0)
+        for ccallback in _listen_callbacks.get(cnotify.channel, []):
+            ccallback(cnotify.payload)
+    return num_notifications
+
+
+def is_listening():
+    """
+    test if the current process receives postgres notifications (i.e. poll_notifications() was called and the connection is open)
+
+    Returns
+    -------
+    bool
+    """
+    return _listen_con is not None and _listen_pid == os.getpid() and not _listen_con.closed
@@ -7,8 +7,110 @@ from . import dbexperiments
 from . import dbidval
 from . import dbontology
 from . import dbprimers
-from .dbontology import get_parents, get_name_from_id
+from .dbontology import get_parents
 from .utils import debug
+from . import db_access
+from . import dbchanges
+from .cache import LRUCache
+
+
+# the prepared statements used in GetAnnotationDetails()
+db_access.register_statement('get_annotation_details', ['int'],
+                             'SELECT annotationlisttable.idontology, annotationlisttable.idAnnotationDetail, ontologytable.description AS ontology, ontologytable.term_id AS term_id, AnnotationDetailsTypesTable.description AS detailtype FROM annotationlisttable '
+                             'LEFT JOIN ontologytable ON annotationlisttable.idontology=ontologytable.id '
+                             'LEFT JOIN AnnotationDetailsTypesTable on annotationlisttable.idAnnotationDetail=AnnotationDetailsTypesTable.id '
+                             'WHERE annotationlisttable.idannotation=$1')
+# for GetAnnotationsFromID()
+db_access.register_statement('get_annotation', ['int'],
+                             'SELECT AnnotationsTable.*,userstable.username, MethodTypesTable.description as method, AgentTypesTable.description as agent, AnnotationTypesTable.description as annotationtype, PrimersTable.regionname as primer FROM AnnotationsTable '
+                             'JOIN usersTable ON AnnotationsTable.iduser = userstable.id '
+                             'JOIN MethodTypesTable ON AnnotationsTable.idmethod = MethodTypesTable.id '
+                             'JOIN AgentTypesTable ON AnnotationsTable.idagenttype = AgentTypesTable.id '
+                             'JOIN AnnotationTypesTable ON AnnotationsTable.idannotationtype = AnnotationTypesTable.id '
+                             'JOIN PrimersTable ON AnnotationsTable.primerid = PrimersTable.id '
+                             'WHERE AnnotationsTable.id=$1')
+# for get_annotation_flags() (called from GetAnnotationsFromID())
+db_access.register_statement('get_annotation_flags', ['int'],
+                             'SELECT status, userid, id, reason FROM AnnotationFlagsTable WHERE annotationID=$1')
+# for GetFastAnnotations()
+db_access.register_statement('get_sequences_annotations', ['integer[]'],
+                             'SELECT annotationid FROM SequencesAnnotationTable WHERE seqid = ANY($1)')
+
+# the notification channel used to invalidate the annotation caches of all the workers (payload is comma separated annotationids or '*' for all)
+ANNOTATION_CACHE_CHANNEL = 'dbbact_annotations'
+# per worker cache of {annotationid: {'data': annotation data dict (see GetAnnotationsFromID()), 'parents': dict or None, 'parents_ids': dict or None}}
+# the entries include also private annotations (visibility is tested on each access). disabled (max_size=0) until set_annotation_cache_size() is called
+_annotation_cache = LRUCache('annotations', max_size=0)
+
+
+def set_annotation_cache_size(max_size):
+    '''Set the maximal number of annotations in the worker annotation cache
+
+    Parameters
+    ----------
+    max_size: int
+        the maximal number of cached annotations. 0 to disable the cache
+    '''
+    _annotation_cache.resize(max_size)
+
+
+def _use_annotation_cache():
+    '''The annotation cache is used only if we get the invalidation notifications from the other workers'''
+    return _annotation_cache.max_size > 0 and db_access.is_listening()
+
+
+def _annotation_cache_notification(payload):
+    '''Called by db_access.poll_notifications() for each notification on the ANNOTATION_CACHE_CHANNEL (or with None if notifications were lost)'''
+    if payload is None or payload == '*' or payload == '':
+        _annotation_cache.invalidate()
+        return
+    _annotation_cache.invalidate([int(cid) for cid in payload.split(',')])
+
+
+db_access.listen(ANNOTATION_CACHE_CHANNEL, _annotation_cache_notification)
+
+
+def invalidate_annotation_cache(con, cur, annotationids=None):
+    '''Remove annotations from the annotation cache of all the workers, and record the change in the data version (see dbchanges.add_change()).
+    Should be called by every function changing the annotation data, details, flags or parents
+    (the other workers are notified when the transaction is committed)
+
+    Parameters
+    ----------
+    con, cur
+    annotationids: list of int or int or None, optional
+        the annotations to invalidate. None to clear the whole cache (i.e. when the ontology changes)
+
+    Returns
+    -------
+    err: str
+        empty ('') if ok, otherwise the error encountered
+    '''
+    if annotationids is None:
+        _annotation_cache.invalidate()
+        payload = '*'
+    else:
+        if isinstance(annotationids, int):
+            annotationids = [annotationids]
+        annotationids = list(set(annotationids))
+        if len(annotationids) == 0:
+            return ''
+        _annotation_cache.invalidate(annotationids)
+        payload = ','.join(str(cid) for cid in annotationids)
+    # notification payload is limited to 8000 bytes
+    if len(payload) > 7000:
+        payload = '*'
+    try:
+        db_access.notify(cur, ANNOTATION_CACHE_CHANNEL, payload)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'error %s encountered in invalidate_annotation_cache', e)
+        return 'error %s encountered in invalidate_annotation_cache' % e
+    return dbchanges.add_change(con, cur, 'annotation', annotationids)
+
+
+def _is_visible(data, userid):
+    '''test if the annotation data (see GetAnnotationsFromID()) is visible to the user (not private or created by the user)'''
+    return data['private'] != 'y' or data['userid'] == userid
 
 
 def AddSequenceAnnotations(con, cur, sequences, primer, expid, annotationtype, annotationdetails, method='',
@@ -58,17 +160,22 @@ def AddSequenceAnnotations(con, cur, sequences, primer, expid, annotationtype, a
     err, seqids = dbsequences.AddSequences(con, cur, sequences, primer=primer, commit=False, seq_translate_api=seq_translate_api)
     if err:
         return err, -1
-    err, annotationid = AddAnnotation(con, cur, expid, annotationtype, annotationdetails, method, description, agenttype, private, userid, commit=False, numseqs=len(set(seqids)), primer=primer)
+    seqids = list(set(seqids))
+    err, annotationid = AddAnnotation(con, cur, expid, annotationtype, annotationdetails, method, description, agenttype, private, userid, commit=False, numseqs=len(seqids), primer=primer)
     if err:
         return err, -1
-    # link sequences to annotation
-    for cseqid in seqids:
-        cur.execute('SELECT * from SequencesAnnotationTable WHERE seqId=%s AND annotationID=%s LIMIT 1', [cseqid, annotationid])
-        if cur.rowcount == 0:
-            cur.execute('INSERT INTO SequencesAnnotationTable (seqId,annotationId) VALUES (%s,%s)', [cseqid, annotationid])
-        else:
-            debug(3, "trying to re-add sequenceannotation seqid=%s annotationid=%s. skipping" % (cseqid, annotationid))
-    debug(2, "Added %d sequence annotations" % len(seqids))
+    # link sequences to annotation (using one query, skipping existing links)
+    try:
+        cur.execute('INSERT INTO SequencesAnnotationTable (seqId,annotationId) SELECT q.seqid, %s FROM unnest(%s::integer[]) AS q(seqid) '
+                    'WHERE NOT EXISTS (SELECT 1 FROM SequencesAnnotationTable WHERE seqId=q.seqid AND annotationId=%s)', [annotationid, seqids, annotationid])
+        num_added = cur.rowcount
+        if num_added != len(seqids):
+            debug(3, "%d sequences already linked to annotationid %s. skipping", len(seqids) - num_added, annotationid)
+            cur.execute('UPDATE AnnotationsTable SET seqCount=%s WHERE id=%s', [num_added, annotationid])
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s encountered when linking sequences to annotation %s', e, annotationid)
+        return 'database error %s' % e, -1
+    debug(2, "Added %d sequence annotations", num_added)
     if commit:
         con.commit()
     return '', annotationid
@@ -113,7 +220,7 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
     cid : int
         the annotationid or <0 if failed
     '''
-    debug(1, 'UpdateAnnotation for annotationID %d' % annotationid)
+    debug(1, 'UpdateAnnotation for annotationID %d', annotationid)
 
     # verify the user can update the annotation
     err, origuser = GetAnnotationUser(con, cur, annotationid)
@@ -133,7 +240,7 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
         if annotationtypeid < 0:
             return 'annotation type %s unknown' % annotationtype, -1
         cur.execute('UPDATE AnnotationsTable SET idAnnotationType = %s WHERE id = %s', [annotationtypeid, annotationid])
-        debug(1, 'updated annotation type to %d' % annotationtypeid)
+        debug(1, 'updated annotation type to %d', annotationtypeid)
 
     # update methodid
     if method is not None:
@@ -141,7 +248,7 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
         if methodid < 0:
             return 'method %s unknown' % method, -1
         cur.execute('UPDATE AnnotationsTable SET idMethod = %s WHERE id = %s', [methodid, annotationid])
-        debug(1, 'updated method to %d' % methodid)
+        debug(1, 'updated method to %d', methodid)
 
     # update agenttypeid
     if agenttype is not None:
@@ -149,25 +256,25 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
         if agenttypeid < 0:
             return 'agenttype %s unknown' % agenttype, -1
         cur.execute('UPDATE AnnotationsTable SET idAgentType = %s WHERE id = %s', [agenttypeid, annotationid])
-        debug(1, 'updated agenttypeid to %d' % agenttypeid)
+        debug(1, 'updated agenttypeid to %d', agenttypeid)
 
     # update private
     if private is not None:
         private = private.lower()
         cur.execute('UPDATE AnnotationsTable SET isPrivate = %s WHERE id = %s', [private, annotationid])
-        debug(1, 'updated private to %s' % private)
+        debug(1, 'updated private to %s', private)
 
     # update description
     if description is not None:
         cur.execute('UPDATE AnnotationsTable SET description = %s WHERE id = %s', [description, annotationid])
-        debug(1, 'updated description to %s' % description)
+        debug(1, 'updated description to %s', description)
 
-    debug(2, "updated annotation id %d." % (annotationid))
+    debug(2, "updated annotation id %d.", annotationid)
 
     if numseqs is None:
         cur.execute('SELECT seqCount FROM AnnotationsTable WHERE id = %s LIMIT 1', [annotationid])
         if cur.rowcount == 0:
-            debug(3, 'seqCount for annotationid %d not found' % annotationid)
+            debug(3, 'seqCount for annotationid %d not found', annotationid)
             numseqs = 0
         else:
             res = cur.fetchone()
@@ -175,7 +282,7 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
 
     # update the annotation details if needed
     if annotationdetails is not None:
-        debug(1, 'Updating %d annotation details' % len(annotationdetails))
+        debug(1, 'Updating %d annotation details', len(annotationdetails))
 
         # first update the counts (removing the old annotaiton details)
         err = update_counts_for_annotation_delete(con, cur, annotationid, commit=False)
@@ -192,7 +299,7 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
         if err:
             debug(3, "failed to add annotation details. aborting")
             return err, -1
-        debug(2, "%d annotationdetails added" % numadded)
+        debug(2, "%d annotationdetails added", numadded)
         # and update the annotationParentsTable (ontology terms per annotation)
         # delete the old entry
         cur.execute('DELETE FROM AnnotationParentsTable WHERE idAnnotation=%s', [annotationid])
@@ -202,8 +309,11 @@ def UpdateAnnotation(con, cur, annotationid, annotationtype=None, annotationdeta
         if err:
             debug(3, "failed to add annotation parents. aborting")
             return err, -1
-        debug(2, "%d annotation parents added" % numadded)
+        debug(2, "%d annotation parents added", numadded)
 
+    err = invalidate_annotation_cache(con, cur, annotationid)
+    if err:
+        return err, -1
     if commit:
         con.commit()
     return '', annotationid
@@ -242,7 +352,7 @@ def AddAnnotation(con, cur, expid, annotationtype, annotationdetails, method='',
     """
     # test if experiment exists
     if not dbexperiments.TestExpIdExists(con, cur, expid, userid):
-        debug(4, 'expid %d does not exists' % expid)
+        debug(4, 'expid %d does not exists', expid)
         return 'expid %d does not exist' % expid, -1
     # handle userid
     if userid is None:
@@ -283,7 +393,7 @@ def AddAnnotation(con, cur, expid, annotationtype, annotationdetails, method='',
         cur.execute('INSERT INTO AnnotationsTable (idExp,idUser,idAnnotationType,idMethod,description,idAgentType,isPrivate,addedDate,seqCount, primerID) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id',
                     [expid, userid, annotationtypeid, methodid, description, agenttypeid, private, cdate, numseqs, primerid])
         cid = cur.fetchone()[0]
-        debug(2, "added annotation id is %d. adding %d annotationdetails" % (cid, len(annotationdetails)))
+        debug(2, "added annotation id is %d. adding %d annotationdetails", cid, len(annotationdetails))
     except psycopg2.DatabaseError as e:
         msg = "database error %s enountered when adding annotation" % e
         debug(7, msg)
@@ -294,15 +404,18 @@ def AddAnnotation(con, cur, expid, annotationtype, annotationdetails, method='',
     if err:
         debug(3, "failed to add annotation details. aborting")
         return err, -1
-    debug(2, "%d annotationdetails added" % numadded)
+    debug(2, "%d annotationdetails added", numadded)
 
     # add the parents of each ontology term to the annotationparentstable
     err, numadded = AddAnnotationParents(con, cur, cid, annotationdetails, commit=False, numseqs=numseqs)
     if err:
         debug(3, "failed to add annotation parents. aborting")
         return err, -1
-    debug(2, "%d annotation parents added" % numadded)
+    debug(2, "%d annotation parents added", numadded)
 
+    err = invalidate_annotation_cache(con, cur, cid)
+    if err:
+        return err, -1
     if commit:
         con.commit()
     return '', cid
@@ -330,34 +443,37 @@ def AddAnnotationDetails(con, cur, annotationid, annotationdetails, commit=True)
     """
     try:
         numadded = 0
+        # get the ontology term ids - either term_id field or the description field
+        err, terms_ids = dbontology.get_terms_ids(con, cur, [cdet[1] for cdet in annotationdetails], allow_ontology_id=True)
+        if err:
+            return err, -1
         for cdet in annotationdetails:
             cdetailtype = cdet[0]
             contologyterm = cdet[1]
             cdetailtypeid = dbidval.GetIdFromDescription(con, cur, "AnnotationDetailsTypesTable", cdetailtype)
             if cdetailtypeid < 0:
-                debug(3, "detailtype %s not found" % cdetailtype)
+                debug(3, "detailtype %s not found", cdetailtype)
                 return "detailtype %s not found" % cdetailtype, -1
 
-            # get the ontology term id - either term_id field or the description field
-            err, contologytermid = dbontology.get_term_ids(con, cur, contologyterm, allow_ontology_id=True)
-            if err:
-                return err, -1
+            contologytermid = terms_ids[contologyterm.lower()]
             if len(contologytermid) > 0:
                 if len(contologytermid) > 1:
-                    debug(3, 'ontology term %s has %d matches' % (contologyterm, len(contologytermid)))
+                    debug(3, 'ontology term %s has %d matches', contologyterm, len(contologytermid))
                 contologytermid = contologytermid[0]
             else:
                 # contologytermid = dbidval.GetIdFromDescription(con, cur, "OntologyTable", contologyterm)
                 # if contologytermid < 0:
-                debug(3, "ontology term %s not found" % contologyterm)
+                debug(3, "ontology term %s not found", contologyterm)
                 err, contologytermid = dbontology.AddTerm(con, cur, contologyterm, commit=False)
                 if err:
                     debug(7, 'error enountered when adding ontology term %s' % contologyterm)
                     return 'ontology term %s not found or added' % contologyterm, -1
-                debug(3, 'ontology term %s added' % contologyterm)
+                debug(3, 'ontology term %s added', contologyterm)
+                # so if the term appears again in the annotation details we will not add it again
+                terms_ids[contologyterm.lower()] = [contologytermid]
             cur.execute('INSERT INTO AnnotationListTable (idAnnotation,idAnnotationDetail,idOntology) VALUES (%s,%s,%s)', [annotationid, cdetailtypeid, contologytermid])
             numadded += 1
-        debug(1, "Added %d annotationlist items" % numadded)
+        debug(1, "Added %d annotationlist items", numadded)
         if commit:
             con.commit()
         return '', numadded
@@ -411,21 +527,26 @@ def AddAnnotationParents(con, cur, annotationid, annotationdetails, commit=True,
                 if all_parents_dict is not None:
                     all_parents_dict[contologyterm] = parents
 
-            debug(2, 'term %s parents %s' % (contologyterm, parents))
+            debug(2, 'term %s parents %s', contologyterm, parents)
             if cdetailtype not in parentsdict:
                 parentsdict[cdetailtype] = parents.copy()
             else:
                 parentsdict[cdetailtype].extend(parents)
 
+        all_parents = set()
+        for parents in parentsdict.values():
+            all_parents.update(parents)
+        parents_info = dbontology.get_terms_info(con, cur, list(all_parents))
         for cdetailtype, parents in parentsdict.items():
             parents = list(set(parents))
             for cpar in parents:
-                err, cpar_description, cpar_term_id = get_name_from_id(con, cur, cpar)
-                if err:
+                if cpar not in parents_info:
+                    err = 'termid %d not in OntologyTable' % cpar
                     debug(7, err)
                     return err, -2
+                cpar_description, cpar_term_id = parents_info[cpar]
                 cdetailtype = cdetailtype.lower()
-                debug(1, 'adding parent %s (%s, %s)' % (cpar, cpar_description, cpar_term_id))
+                debug(1, 'adding parent %s (%s, %s)', cpar, cpar_description, cpar_term_id)
                 cur.execute('INSERT INTO AnnotationParentsTable (idAnnotation,annotationDetail,ontology,term_id) VALUES (%s,%s,%s,%s)', [annotationid, cdetailtype, cpar_description, cpar_term_id])
                 numadded += 1
                 # add the number of sequences and one more annotation to all the terms in this annotation
@@ -435,7 +556,7 @@ def AddAnnotationParents(con, cur, annotationid, annotationdetails, commit=True,
                 # otherwise, add 1 to the annotationCount
                 else:
                     cur.execute('UPDATE OntologyTable SET seqCount = seqCount+%s, annotationCount=annotationCount+1 WHERE id = %s', [numseqs, cpar])
-        debug(1, "Added %d annotationparents items" % numadded)
+        debug(1, "Added %d annotationparents items", numadded)
         if commit:
             con.commit()
         return '', numadded
@@ -461,7 +582,7 @@ def GetAnnotationParents(con, cur, annotationid, get_term_id=True):
         error encountered or '' if ok
     parents : dict of {str:list of str} {detail type (i.e. 'all'/'low'/'high'): list of ontology terms_ids (if get_term_id is True) or list of ontology terms (if get_term_id is False)}
     '''
-    debug(1, 'GetAnnotationParents for id %d' % annotationid)
+    debug(1, 'GetAnnotationParents for id %d', annotationid)
     # cur.execute('SELECT annotationdetail,ontology FROM AnnotationParentsTable WHERE idannotation=%s', [annotationid])
     if get_term_id:
         cur.execute('SELECT annotationdetail,term_id FROM AnnotationParentsTable WHERE idannotation=%s', [annotationid])
@@ -480,7 +601,66 @@ def GetAnnotationParents(con, cur, annotationid, get_term_id=True):
             parents[cdetail].append(conto)
         else:
             parents[cdetail] = [conto]
-    debug(1, 'found %d detail types' % len(parents))
+    debug(1, 'found %d detail types', len(parents))
+    return '', parents
+
+
+def GetAnnotationsParents(con, cur, annotationids, get_term_id=True):
+    '''
+    Get the ontology parents for a list of annotations (bulk version of GetAnnotationParents())
+
+    input:
+    con,cur
+    annotationids : list of int
+        the annotation ids to get the parents for
+    get_term_id: bool, optional
+        True (default) to get the term_id (i.e. 'gaz:000001')
+        False to get the term name (i.e. 'feces')
+
+    output:
+    err: str
+        error encountered or '' if ok
+    parents : dict of {annotationid(int): dict of {str:list of str}}
+        for each annotation, {detail type (i.e. 'all'/'low'/'high'): list of ontology terms_ids (if get_term_id is True) or list of ontology terms (if get_term_id is False)}
+        annotations without parents have an empty dict
+    '''
+    annotationids = list(set(annotationids))
+    debug(1, 'GetAnnotationsParents for %d annotations', len(annotationids))
+    parents = {cid: {} for cid in annotationids}
+    if len(annotationids) == 0:
+        return '', parents
+    # the parents are cached together with the annotation data (if the annotation is in the cache)
+    cache_key = 'parents_ids' if get_term_id else 'parents'
+    use_cache = _use_annotation_cache()
+    if use_cache:
+        generation = _annotation_cache.generation
+        cached = _annotation_cache.get_many(annotationids)
+        for cid, centry in cached.items():
+            if centry[cache_key] is not None:
+                parents[cid] = centry[cache_key]
+        annotationids = [cid for cid in annotationids if cid not in cached or cached[cid][cache_key] is None]
+        if len(annotationids) == 0:
+            return '', parents
+    try:
+        if get_term_id:
+            cur.execute('SELECT idannotation,annotationdetail,term_id FROM AnnotationParentsTable WHERE idannotation = ANY(%s)', [annotationids])
+        else:
+            cur.execute('SELECT idannotation,annotationdetail,ontology FROM AnnotationParentsTable WHERE idannotation = ANY(%s)', [annotationids])
+        for cres in cur:
+            cparents = parents[cres[0]]
+            if cres[1] in cparents:
+                cparents[cres[1]].append(cres[2])
+            else:
+                cparents[cres[1]] = [cres[2]]
+    except psycopg2.DatabaseError as e:
+        debug(7, 'error %s encountered in GetAnnotationsParents', e)
+        return 'error %s encountered in GetAnnotationsParents' % e, {}
+    if use_cache:
+        for cid in annotationids:
+            if cid in cached:
+                centry = dict(cached[cid])
+                centry[cache_key] = parents[cid]
+                _annotation_cache.set(cid, centry, generation=generation)
     return '', parents
 
 
@@ -499,7 +679,7 @@ def GetAnnotationDetails(con, cur, annotationid):
     details : list of (str,str, str) (detail type (i.e. 'higher in'), ontology term (i.e. 'homo sapiens'), ontology term_id (i.e. 'GAZ:0004'))
     """
     details = []
-    debug(1, 'get annotationdetails from id %d' % annotationid)
+    debug(1, 'get annotationdetails from id %d', annotationid)
     # cur.execute('SELECT * FROM AnnotationListTable WHERE idAnnotation=%s', [annotationid])
     cur.execute('EXECUTE get_annotation_details(%s)', [annotationid])
     allres = cur.fetchall()
@@ -515,7 +695,7 @@ def GetAnnotationDetails(con, cur, annotationid):
         #     return err, []
         # details.append([detailtype, ontology])
         details.append([res['detailtype'], res['ontology'], res['term_id']])
-    debug(1, 'found %d annotation details' % len(details))
+    debug(1, 'found %d annotation details', len(details))
     return '', details
 
 
@@ -534,7 +714,7 @@ def get_annotation_details_termids(con, cur, annotationid):
     details : list of (str, str) (detail type (i.e. 'higher in'), ontology id (i.e. 'envo:000001'). if ontology id is empty, returns the term (i.e. 'feces') instead)
     """
     details = []
-    debug(1, 'get annotationdetails from id %d' % annotationid)
+    debug(1, 'get annotationdetails from id %d', annotationid)
     cur.execute('SELECT * FROM AnnotationListTable WHERE idAnnotation=%s', [annotationid])
     allres = cur.fetchall()
     for res in allres:
@@ -544,20 +724,20 @@ def get_annotation_details_termids(con, cur, annotationid):
         if err:
             return err, []
         err, term, ontology_id = dbontology.get_name_from_id(con, cur, term_dbbact_id)
-        debug(1, 'ontologyid %d term %s ontologyid %s' % (term_dbbact_id, term, ontology_id))
+        debug(1, 'ontologyid %d term %s ontologyid %s', term_dbbact_id, term, ontology_id)
         if err:
             return err, []
         if ontology_id[0] == '':
             ontology_id[0] = term[0]
         details.append([detailtype, ontology_id])
-    debug(1, 'found %d annotation details' % len(details))
+    debug(1, 'found %d annotation details', len(details))
     return '', details
 
 
 def GetAnnotationsFromID_prep(con, cur, annotationid, userid=0):
     '''Similar to GetAnnotationsFromID but with the additional prepare query step
     '''
-    _prepare_queries(con, cur)
+    db_access.prepare_statements(con, cur)
     return GetAnnotationsFromID(con, cur, annotationid, userid)
 
 
@@ -599,62 +779,173 @@ def GetAnnotationsFromID(con, cur, annotationid, userid=0):
         "review_status" : int
                 The annotation review status: 0 - not reviewed yet, 1 - reviewed and accepted (by the dbbact team)
     """
-    debug(1, 'get annotation from id %d' % annotationid)
+    debug(1, 'get annotation from id %d', annotationid)
+    use_cache = _use_annotation_cache()
+    if use_cache:
+        centry = _annotation_cache.get(annotationid)
+        if centry is not None:
+            if not _is_visible(centry['data'], userid):
+                debug(3, 'Trying to view private annotation id %d from different user (orig user %d, current user %d)', annotationid, centry['data']['userid'], userid)
+                return 'Annotationid %d is private. Cannot view' % annotationid, None
+            return '', dict(centry['data'])
+        generation = _annotation_cache.generation
     # cur.execute('SELECT AnnotationsTable.*,userstable.username FROM AnnotationsTable,userstable WHERE AnnotationsTable.iduser = userstable.id and AnnotationsTable.id=%s', [annotationid])
     cur.execute('EXECUTE get_annotation(%s)', [annotationid])
     if cur.rowcount == 0:
-        debug(3, 'annotationid %d not found' % annotationid)
+        debug(3, 'annotationid %d not found', annotationid)
         return 'Annotationid %d not found' % annotationid, None
     res = cur.fetchone()
     debug(1, res)
 
+    data = _annotation_data_from_row(res)
+
+    if res['isprivate'] == 'y':
+        if userid != data['userid']:
+            debug(3, 'Trying to view private annotation id %d from different user (orig user %d, current user %d)', annotationid, data['userid'], userid)
+            return 'Annotationid %d is private. Cannot view' % annotationid, None
+
+    details = []
+    err, details = GetAnnotationDetails(con, cur, annotationid)
+    if err:
+        return err, None
+    data['details'] = details
+    err, flags = get_annotation_flags(con, cur, annotationid)
+    data['flags'] = flags
+    data['review_status'] = res['review_status']
+
+    if use_cache and not err:
+        _annotation_cache.set(annotationid, {'data': dict(data), 'parents': None, 'parents_ids': None}, generation=generation)
+    return '', data
+
+
+def _annotation_data_from_row(res):
+    '''Create the annotation data dict (see GetAnnotationsFromID()) from the AnnotationsTable row (without the details, flags and review_status)
+
+    Parameters
+    ----------
+    res: DictRow
+        the row from the get_annotation query (AnnotationsTable joined with the users/method/agent/annotationtype/primer names)
+
+    Returns
+    -------
+    data: dict
+    '''
     data = {}
-    data['id'] = annotationid
+    data['id'] = res['id']
     data['description'] = res['description']
     data['private'] = res['isprivate']
-
-    # err, method = dbidval.GetDescriptionFromId(con, cur, 'MethodTypesTable', res['idmethod'])
-    # if err:
-    #     return err, None
-    # data['method'] = method
-    # err, agent = dbidval.GetDescriptionFromId(con, cur, 'AgentTypesTable', res['idagenttype'])
-    # if err:
-    #     return err, None
-    # data['agent'] = agent
-    # err, annotationtype = dbidval.GetDescriptionFromId(con, cur, 'AnnotationTypesTable', res['idannotationtype'])
-    # if err:
-    #     return err, None
-    # data['annotationtype'] = annotationtype
-    # err, data['primer'] = dbprimers.GetNameFromID(con, cur, res['primerid'])
-    # if err:
-    #     return err, None
     data['method'] = res['method']
     data['agent'] = res['agent']
     data['annotationtype'] = res['annotationtype']
     data['primer'] = res['primer']
-
     data['expid'] = res['idexp']
     data['userid'] = res['iduser']
     data['username'] = res['username']
     data['date'] = res['addeddate'].isoformat()
-    data['annotationid'] = annotationid
+    data['annotationid'] = res['id']
     data['num_sequences'] = res['seqcount']
     data['primerid'] = res['primerid']
+    return data
 
-    if res['isprivate'] == 'y':
-        if userid != data['userid']:
-            debug(3, 'Trying to view private annotation id %d from different user (orig user %d, current user %d)' % (annotationid, data['userid'], userid))
-            return 'Annotationid %d is private. Cannot view' % annotationid, None
 
-    details = []
-    err, details = GetAnnotationDetails(con, cur, annotationid)
-    if err:
-        return err, None
-    data['details'] = details
-    err, flags = get_annotation_flags(con, cur, annotationid)
-    data['flags'] = flags
-    data['review_status'] = res['review_status']
+def GetAnnotationsFromIDs(con, cur, annotationids, userid=0):
+    '''Get the annotation details for a list of annotation ids.
+    Same as GetAnnotationsFromID() but uses 3 queries for all the annotations (not found in the worker annotation cache).
+    Private annotations of other users (and ids not in the database) are skipped.
+
+    Parameters
+    ----------
+    con, cur
+    annotationids: list of int
+        the annotation ids to get
+    userid: int, optional
+        the user requesting the annotations (to get also private annotations of this user)
+
+    Returns
+    -------
+    err: str
+        the error encountered or '' if ok
+    annotations: list of dict
+        the annotation data (see GetAnnotationsFromID()) for the visible annotations, in the order of annotationids
+    '''
+    annotationids = list(annotationids)
+    debug(1, 'GetAnnotationsFromIDs for %d annotations', len(annotationids))
+    if len(annotationids) == 0:
+        return '', []
+    unique_ids = list(set(annotationids))
+    data = {}
+    use_cache = _use_annotation_cache()
+    if use_cache:
+        generation = _annotation_cache.generation
+        cached = _annotation_cache.get_many(unique_ids)
+        for cid, centry in cached.items():
+            if _is_visible(centry['data'], userid):
+                data[cid] = centry['data']
+        unique_ids = [cid for cid in unique_ids if cid not in cached]
+        debug(1, '%d annotations found in cache', len(cached))
+    if len(unique_ids) > 0:
+        err, fetched = _get_annotations_data(con, cur, unique_ids, userid)
+        if err:
+            return err, []
+        if use_cache:
+            for cid, cdata in fetched.items():
+                _annotation_cache.set(cid, {'data': cdata, 'parents': None, 'parents_ids': None}, generation=generation)
+        data.update(fetched)
+    # return a copy of each annotation dict since the callers may modify it (and it may be cached)
+    annotations = [dict(data[cid]) for cid in annotationids if cid in data]
+    debug(1, 'found %d visible annotations', len(annotations))
+    return '', annotations
+
+
+def _get_annotations_data(con, cur, annotationids, userid=0):
+    '''Get the annotation data dicts for the annotation ids from the database (used by GetAnnotationsFromIDs())
+
+    Parameters
+    ----------
+    con, cur
+    annotationids: list of int
+        the (unique) annotation ids to get
+    userid: int, optional
+        the user requesting the annotations (to get also private annotations of this user)
 
+    Returns
+    -------
+    err: str
+        the error encountered or '' if ok
+    data: dict of {annotationid(int): annotation data(dict)}
+        the annotation data (see GetAnnotationsFromID()) for the visible annotations
+    '''
+    try:
+        cur.execute('SELECT AnnotationsTable.*,userstable.username, MethodTypesTable.description as method, AgentTypesTable.description as agent, AnnotationTypesTable.description as annotationtype, PrimersTable.regionname as primer FROM AnnotationsTable '
+                    'JOIN usersTable ON AnnotationsTable.iduser = userstable.id '
+                    'JOIN MethodTypesTable ON AnnotationsTable.idmethod = MethodTypesTable.id '
+                    'JOIN AgentTypesTable ON AnnotationsTable.idagenttype = AgentTypesTable.id '
+                    'JOIN AnnotationTypesTable ON AnnotationsTable.idannotationtype = AnnotationTypesTable.id '
+                    'JOIN PrimersTable ON AnnotationsTable.primerid = PrimersTable.id '
+                    "WHERE AnnotationsTable.id = ANY(%s) AND (AnnotationsTable.isprivate IS DISTINCT FROM 'y' OR AnnotationsTable.iduser = %s)", [annotationids, userid])
+        data = {}
+        for cres in cur:
+            cdata = _annotation_data_from_row(cres)
+            cdata['details'] = []
+            cdata['flags'] = []
+            cdata['review_status'] = cres['review_status']
+            data[cdata['id']] = cdata
+        if len(data) == 0:
+            debug(1, 'no visible annotations found')
+            return '', {}
+        visible_ids = list(data.keys())
+        cur.execute('SELECT annotationlisttable.idannotation, ontologytable.description AS ontology, ontologytable.term_id AS term_id, AnnotationDetailsTypesTable.description AS detailtype FROM annotationlisttable '
+                    'LEFT JOIN ontologytable ON annotationlisttable.idontology=ontologytable.id '
+                    'LEFT JOIN AnnotationDetailsTypesTable on annotationlisttable.idAnnotationDetail=AnnotationDetailsTypesTable.id '
+                    'WHERE annotationlisttable.idannotation = ANY(%s)', [visible_ids])
+        for cres in cur:
+            data[cres['idannotation']]['details'].append([cres['detailtype'], cres['ontology'], cres['term_id']])
+        cur.execute('SELECT annotationid, status, userid, id, reason FROM AnnotationFlagsTable WHERE annotationID = ANY(%s)', [visible_ids])
+        for cres in cur:
+            data[cres['annotationid']]['flags'].append({'status': cres['status'], 'userid': cres['userid'], 'flagid': cres['id'], 'reason': cres['reason']})
+    except psycopg2.DatabaseError as e:
+        debug(7, 'error %s encountered in GetAnnotationsFromIDs', e)
+        return 'error %s encountered in GetAnnotationsFromIDs' % e, {}
     return '', data
 
 
@@ -675,10 +966,10 @@ def IsAnnotationVisible(con, cur, annotationid, userid=0):
     isvisible: bool
         True if user is allowed to see the annotation, False if not
     """
-    debug(1, 'IsAnnotationVisible, annotationid %d, userid %d' % (annotationid, userid))
+    debug(1, 'IsAnnotationVisible, annotationid %d, userid %d', annotationid, userid)
     cur.execute('SELECT (isPrivate,idUser) FROM AnnotationsTable WHERE id=%s LIMIT 1', [annotationid])
     if cur.rowcount == 0:
-        debug(3, 'annotationid %d not found' % annotationid)
+        debug(3, 'annotationid %d not found', annotationid)
         return 'Annotationid %d not found', False
     res = cur.fetchone()
     if res[0] == 'y':
@@ -706,77 +997,24 @@ def GetUserAnnotations(con, cur, foruserid, userid=0):
         a list of all the info about each annotation (see GetAnnotationsFromID())
     '''
     details = []
-    debug(1, 'GetUserAnnotations userid %d' % userid)
+    debug(1, 'GetUserAnnotations userid %d', userid)
 
     # prepapre the queries for faster running times
-    _prepare_queries(con, cur)
+    db_access.prepare_statements(con, cur)
 
     cur.execute('SELECT id FROM AnnotationsTable WHERE iduser=%s', [foruserid])
     if cur.rowcount == 0:
-        debug(3, 'no annotations for userid %d' % foruserid)
+        debug(3, 'no annotations for userid %d', foruserid)
         return '', []
     res = cur.fetchall()
-    for cres in res:
-        err, cdetails = GetAnnotationsFromID(con, cur, cres[0], userid=userid)
-        if err:
-            debug(6, err)
-            return err, None
-        details.append(cdetails)
-    debug(3, 'found %d annotations' % len(details))
+    err, details = GetAnnotationsFromIDs(con, cur, [cres[0] for cres in res], userid=userid)
+    if err:
+        debug(6, err)
+        return err, None
+    debug(3, 'found %d annotations', len(details))
     return '', details
 
 
-def _prepare_queries(con, cur):
-    '''Prepare the postgres queries used frequently in a single request (for speed optimization).
-
-    Note that since postgresql prepare doesn't persist between sessions, need to redefine each new connection
-
-    Parameters
-    ----------
-    con, cur:
-
-    Returns
-    -------
-    err: str
-        empty ('') if ok. otherwise the error encountered
-    '''
-    try:
-        cur.execute('deallocate all')
-        # for GetAnnotationDetails()
-        cur.execute('prepare get_annotation_details(int) AS '
-                    'SELECT annotationlisttable.idontology, annotationlisttable.idAnnotationDetail, ontologytable.description AS ontology, ontologytable.term_id AS term_id, AnnotationDetailsTypesTable.description AS detailtype FROM annotationlisttable '
-                    'LEFT JOIN ontologytable ON annotationlisttable.idontology=ontologytable.id '
-                    'LEFT JOIN AnnotationDetailsTypesTable on annotationlisttable.idAnnotationDetail=AnnotationDetailsTypesTable.id '
-                    'WHERE annotationlisttable.idannotation=$1')
-        # for GetSequenceAnnotations()
-        cur.execute('PREPARE get_annotation(int) AS '
-                    'SELECT AnnotationsTable.*,userstable.username, MethodTypesTable.description as method, AgentTypesTable.description as agent, AnnotationTypesTable.description as annotationtype, PrimersTable.regionname as primer FROM AnnotationsTable '
-                    'JOIN usersTable ON AnnotationsTable.iduser = userstable.id '
-                    'JOIN MethodTypesTable ON AnnotationsTable.idmethod = MethodTypesTable.id '
-                    'JOIN AgentTypesTable ON AnnotationsTable.idagenttype = AgentTypesTable.id '
-                    'JOIN AnnotationTypesTable ON AnnotationsTable.idannotationtype = AnnotationTypesTable.id '
-                    'JOIN PrimersTable ON AnnotationsTable.primerid = PrimersTable.id '
-                    'WHERE AnnotationsTable.id=$1')
-        # for GetAnnotationFlags() (called from GetAnnotations())
-        cur.execute('PREPARE get_annotation_flags(int) AS '
-                    'SELECT status, userid, id, reason FROM AnnotationFlagsTable WHERE annotationID=$1')
-        # for GetSequenceId()
-        cur.execute('PREPARE get_sequence_id_exact(text) AS '
-                    'SELECT id, idprimer FROM SequencesTable WHERE sequence=$1 LIMIT 1')
-        cur.execute('PREPARE get_sequence_id_seed(text) AS '
-                    'SELECT id,sequence FROM SequencesTable WHERE seedsequence=$1')
-        cur.execute('PREPARE get_sequence_primer(int) AS '
-                    'SELECT idPrimer FROM SequencesTable WHERE id=$1 LIMIT 1')
-        # for GetFastAnnotations()
-        cur.execute('PREPARE get_sequences_annotations(integer[]) AS '
-                    'SELECT annotationid FROM SequencesAnnotationTable WHERE seqid = ANY($1)')
-        return ''
-
-    except psycopg2.DatabaseError as e:
-        debug(7, "error %s enountered in _prepare_queries" % e)
-        return e
-
-
 def GetSequenceAnnotations(con, cur, sequence, region=None, userid=0, seq_translate_api=None, dbname=None):
     """
     Get all annotations for a sequence. Returns a list of annotations (empty list if sequence is not found)
@@ -802,30 +1040,28 @@ def GetSequenceAnnotations(con, cur, sequence, region=None, userid=0, seq_transl
         a list of all the info about each annotation (see GetAnnotationsFromID())
     """
     details = []
-    debug(1, 'GetSequenceAnnotations sequence %s' % sequence)
+    debug(1, 'GetSequenceAnnotations sequence %s', sequence)
     # prepare the queries that run multiple times (to speed up)
-    err = _prepare_queries(con, cur)
+    err = db_access.prepare_statements(con, cur)
 
     err, sid = dbsequences.GetSequenceId(con, cur, sequence, region, seq_translate_api=seq_translate_api, dbname=dbname)
     if len(sid) == 0:
-        debug(2, 'Sequence %s not found for GetSequenceAnnotations.' % sequence)
+        debug(2, 'Sequence %s not found for GetSequenceAnnotations.', sequence)
         return '', []
     if err:
         debug(6, 'Sequence %s not found for GetSequenceAnnotations. error : %s' % (sequence, err))
         return err, None
-    debug(1, 'sequenceid=%s' % sid)
+    debug(1, 'sequenceid=%s', sid)
     cur.execute('SELECT annotationId FROM SequencesAnnotationTable WHERE seqId IN %s', [tuple(sid)])
     if cur.rowcount == 0:
-        debug(3, 'no annotations for sequenceid %s' % sid)
+        debug(3, 'no annotations for sequenceid %s', sid)
         return '', []
     res = cur.fetchall()
-    for cres in res:
-        err, cdetails = GetAnnotationsFromID(con, cur, cres[0])
-        if err:
-            debug(6, err)
-            return err, None
-        details.append(cdetails)
-    debug(3, 'found %d annotations' % len(details))
+    err, details = GetAnnotationsFromIDs(con, cur, [cres[0] for cres in res])
+    if err:
+        debug(6, err)
+        return err, None
+    debug(3, 'found %d annotations', len(details))
     return '', details
 
 
@@ -840,7 +1076,7 @@ def GetAnnotationsFromExpId(con, cur, expid, userid=0, prepared=False):
     userid : int
         the user requesting the info (for private studies/annotations)
     prepared: bool, optional
-        True to indicate the _prepare_queries() has already been called in this connection. use it when doing multiple queries (i.e from GetFastAnnotations() )
+        True to indicate db_access.prepare_statements() has already been called in this connection. use it when doing multiple queries (i.e from GetFastAnnotations() )
 
     output:
     err : str
@@ -848,32 +1084,23 @@ def GetAnnotationsFromExpId(con, cur, expid, userid=0, prepared=False):
     annotations: list of dict
         a list of all the annotations associated with the experiment
     """
-    debug(1, 'GetAnnotationsFromExpId expid=%d' % expid)
+    debug(1, 'GetAnnotationsFromExpId expid=%d', expid)
     # prepare the queries for fast runtime
     if not prepared:
-        err = _prepare_queries(con, cur)
+        err = db_access.prepare_statements(con, cur)
 
     # test if experiment exists and not private
     if not dbexperiments.TestExpIdExists(con, cur, expid, userid):
-        debug(3, 'experiment %d does not exist' % expid)
+        debug(3, 'experiment %d does not exist', expid)
         return '', []
     cur.execute('SELECT id from AnnotationsTable WHERE idExp=%s', [expid])
     res = cur.fetchall()
-    debug(1, 'found %d annotations for expid %d' % (len(res), expid))
-    annotations = []
-    for cres in res:
-        # test if annotation is private - don't show it
-        err, canview = IsAnnotationVisible(con, cur, cres[0], userid)
-        if err:
-            return err, None
-        if not canview:
-            continue
-
-        err, cannotation = GetAnnotationsFromID(con, cur, cres[0], userid)
-        if err:
-            debug(3, 'error encountered for annotationid %d : %s' % (cres[0], err))
-            return err, None
-        annotations.append(cannotation)
+    debug(1, 'found %d annotations for expid %d', len(res), expid)
+    # private annotations (of other users) are not returned
+    err, annotations = GetAnnotationsFromIDs(con, cur, [cres[0] for cres in res], userid=userid)
+    if err:
+        debug(3, 'error encountered for expid %d : %s', expid, err)
+        return err, None
     return '', annotations
 
 
@@ -894,7 +1121,7 @@ def GetSequencesFromAnnotationID(con, cur, annotationid, userid=0):
     seqids : list of int
         the sequence ids associated with the annotationid
     """
-    debug(1, "GetSequencesFromAnnotationID for annotationid %d" % annotationid)
+    debug(1, "GetSequencesFromAnnotationID for annotationid %d", annotationid)
     err, canview = IsAnnotationVisible(con, cur, annotationid, userid)
     if err:
         debug(6, 'error encountered:%s' % err)
@@ -907,7 +1134,7 @@ def GetSequencesFromAnnotationID(con, cur, annotationid, userid=0):
     res = cur.fetchall()
     for cres in res:
         seqids.append(cres[0])
-    debug(1, "Found %d sequences associated" % len(seqids))
+    debug(1, "Found %d sequences associated", len(seqids))
     return '', seqids
 
 
@@ -933,12 +1160,12 @@ def GetFullSequencesFromAnnotationID(con, cur, annotationid, userid=0):
         'taxonomy' : str
             the taxonomy of the sequence or '' if unknown
     '''
-    debug(1, "GetSequencesFromAnnotationID for annotationid %d" % annotationid)
+    debug(1, "GetSequencesFromAnnotationID for annotationid %d", annotationid)
     err, seqids = GetSequencesFromAnnotationID(con, cur, annotationid, userid)
     if err:
         return err, []
-    debug(1, 'Found %s sequences' % len(seqids))
-    err, sequences = dbsequences.SeqFromID(con, cur, seqids)
+    debug(1, 'Found %s sequences', len(seqids))
+    err, sequences = dbsequences.SeqFromIDs(con, cur, seqids)
     if err:
         return err, []
     return '', sequences
@@ -959,10 +1186,10 @@ def GetAnnotationUser(con, cur, annotationid):
     userid: int
         the userid which generated the annotation
     """
-    debug(1, 'GetAnnotationUser, annotationid %d' % annotationid)
+    debug(1, 'GetAnnotationUser, annotationid %d', annotationid)
     cur.execute('SELECT (idUser) FROM AnnotationsTable WHERE id=%s LIMIT 1', [annotationid])
     if cur.rowcount == 0:
-        debug(3, 'annotationid %d not found' % annotationid)
+        debug(3, 'annotationid %d not found', annotationid)
         return 'Annotationid %d not found', False
     res = cur.fetchone()
     return '', res[0]
@@ -987,7 +1214,7 @@ def DeleteAnnotation(con, cur, annotationid, userid=0, commit=True):
     err : str
         The error encountered or '' if ok
     """
-    debug(1, 'DeleteAnnotation for annotationid %d userid %d' % (annotationid, userid))
+    debug(1, 'DeleteAnnotation for annotationid %d userid %d', annotationid, userid)
     err, origuser = GetAnnotationUser(con, cur, annotationid)
     if err:
         return err
@@ -1013,6 +1240,9 @@ def DeleteAnnotation(con, cur, annotationid, userid=0, commit=True):
     cur.execute('DELETE FROM AnnotationParentsTable WHERE idAnnotation=%s', [annotationid])
     debug(1, 'deleted from annotationParentsTable')
 
+    err = invalidate_annotation_cache(con, cur, annotationid)
+    if err:
+        return err
     if commit:
         con.commit()
     return('')
@@ -1034,7 +1264,7 @@ def update_counts_for_annotation_delete(con, cur, annotationid, commit=False):
     err: str
         '' if ok, otherwise the error encountered
     '''
-    debug(1, 'update_counts_for_annotation_delete for id %s' % annotationid)
+    debug(1, 'update_counts_for_annotation_delete for id %s', annotationid)
 
     # find how many sequences are in the annotations
     cur.execute('SELECT seqCount FROM AnnotationsTable WHERE id=%s', [annotationid])
@@ -1079,7 +1309,7 @@ def DeleteSequenceFromAnnotation(con, cur, sequences, annotationid, userid=0, co
     err: str
         the error string or '' if no error encountered
     '''
-    debug(1, 'DeleteSequenceFromAnnotation for %d sequences, annotationid %d, userid %d' % (len(sequences), annotationid, userid))
+    debug(1, 'DeleteSequenceFromAnnotation for %d sequences, annotationid %d, userid %d', len(sequences), annotationid, userid)
     err, origuser = GetAnnotationUser(con, cur, annotationid)
     if origuser != 0:
         if userid == 0:
@@ -1095,12 +1325,12 @@ def DeleteSequenceFromAnnotation(con, cur, sequences, annotationid, userid=0, co
     err, seqids = dbsequences.GetSequencesIds(con, cur, sequences, no_shorter=True, no_longer=True)
     for cseqids in seqids:
         cur.execute('DELETE FROM SequencesAnnotationTable WHERE annotationid=%s AND seqId=%s', (annotationid, cseqids[0]))
-    debug(3, 'deleted %d sequences from from sequencesannotationtable annotationid=%d' % (len(sequences), annotationid))
+    debug(3, 'deleted %d sequences from from sequencesannotationtable annotationid=%d', len(sequences), annotationid)
 
     # remove the count of these sequences for the annotation
     numseqs = len(sequences)
     cur.execute('UPDATE AnnotationsTable SET seqCount = seqCount-%s WHERE id=%s', [numseqs, annotationid])
-    debug(3, 'removed %d from the annotationstable seq count' % numseqs)
+    debug(3, 'removed %d from the annotationstable seq count', numseqs)
 
     # update the ontology term sequence counts
     err, parents = GetAnnotationParents(con, cur, annotationid, get_term_id=True)
@@ -1113,12 +1343,15 @@ def DeleteSequenceFromAnnotation(con, cur, sequences, annotationid, userid=0, co
             cur.execute('UPDATE OntologyTable SET seqCount = seqCount-%s WHERE term_id = %s', [numseqs, ccterm])
     debug(3, 'fixed ontologytable counts')
 
+    err = invalidate_annotation_cache(con, cur, annotationid)
+    if err:
+        return err
     if commit:
         con.commit()
     return('')
 
 
-def GetFastAnnotations(con, cur, sequences, region=None, userid=0, get_term_info=True, get_all_exp_annotations=True, get_taxonomy=True, get_parents=True, seq_translate_api=None, dbname=None):
+def GetFastAnnotations(con, cur, sequences, region=None, userid=0, get_term_info=True, get_all_exp_annotations=True, get_taxonomy=True, get_parents=True, seq_translate_api=None, dbname=None, hashes=False):
     """
     Get annotations for a list of sequences in a compact form
 
@@ -1145,6 +1378,9 @@ def GetFastAnnotations(con, cur, sequences, region=None, userid=0, get_term_info
     dbname: str or None, optional
         if None, assume sequences are acgt sequences
         if str, assume sequences are database ids and this is the database name (i.e. 'FJ978486' for 'silva', etc.)
+    hashes: bool, optional
+        True to indicate sequences are the sequence hashes (md5 hex string of the upper case sequence, see dbsequences.GetSequencesIdsFromHashes()).
+        only exact matches are returned (seq_translate_api and dbname are ignored)
 
     output:
     err : str
@@ -1164,105 +1400,130 @@ def GetFastAnnotations(con, cur, sequences, region=None, userid=0, get_term_info
             'total_sequences' : int
                 total number of sequences in annotations where this term appears (as a parent)
     taxonomy : list of str
-        the dbbact taxonomy string for each supplied sequence (order similar to query sequences)
+        the dbbact taxonomy string for each supplied sequence (order similar to query sequences). 'NA' if the sequence is not found
     """
-    debug(2, 'GetFastAnnotations for %d sequences' % len(sequences))
-
-    # prepare the queries for faster running times
-    err = _prepare_queries(con, cur)
+    debug(2, 'GetFastAnnotations for %d sequences', len(sequences))
 
     annotations = {}
     seqannotations = []
     all_terms = set()
     term_info = {}
 
-    # set of experients we already processed (so no need to re-look at the annotations from the experiment
-    # in case get_all_exp_annotations=True)
-    experiments_added = set()
-
-    err, seqids = dbsequences.GetSequencesIds(con, cur, sequences, region, seq_translate_api=seq_translate_api, dbname=dbname)
+    # stage 1: get the sequence ids for all sequences
+    if hashes:
+        err, seqids = dbsequences.GetSequencesIdsFromHashes(con, cur, sequences, region)
+    else:
+        err, seqids = dbsequences.GetSequencesIds(con, cur, sequences, region, seq_translate_api=seq_translate_api, dbname=dbname)
     if err:
-        return err, []
-    for cseqpos, cseq in enumerate(sequences):
-        cseqannotationids = []
-        # get the sequenceid
-        sid = seqids[cseqpos]
+        return err, {}, [], {}, []
+
+    # stage 2: get the annotations of all the sequence ids in one query
+    all_seqids = set()
+    for sid in seqids:
+        all_seqids.update(sid)
+    seq_annotation_ids = defaultdict(list)
+    if len(all_seqids) > 0:
+        cur.execute('SELECT seqid, annotationid FROM SequencesAnnotationTable WHERE seqid = ANY(%s)', [list(all_seqids)])
+        for cres in cur:
+            seq_annotation_ids[cres[0]].append(cres[1])
+    # the annotation ids in order of appearance
+    found_annotation_ids = {}
+    for cseqpos, sid in enumerate(seqids):
         # if not in database - no annotations
         if len(sid) == 0:
             continue
-        # get annotations for the sequence
-        # cur.execute('EXECUTE get_sequences_annotations(%s)', ['{' + str(sid)[1:-1] + '}'])
-        cur.execute('SELECT annotationid FROM SequencesAnnotationTable WHERE seqid IN %s', [tuple(sid)])
-        res = cur.fetchall()
-        # go over all annotations
-        for cres in res:
-            current_annotation = cres[0]
-            # add the sequence annotation link
-            cseqannotationids.append(current_annotation)
+        cseqannotationids = []
+        for csid in sid:
+            cseqannotationids.extend(seq_annotation_ids[csid])
+        for cannotationid in cseqannotationids:
+            found_annotation_ids[cannotationid] = True
+        seqannotations.append((cseqpos, cseqannotationids))
 
-            # if annotation is already in list - move to next
-            if current_annotation in annotations:
+    # stage 3: get the details of the annotations (private annotations of other users are skipped)
+    err, found_annotations = GetAnnotationsFromIDs(con, cur, list(found_annotation_ids.keys()), userid=userid)
+    if err:
+        return err, {}, [], {}, []
+    if get_all_exp_annotations:
+        # add all the annotations from the experiments of the annotations found (only for experiments visible to the user)
+        debug(1, 'getting all exp annotations')
+        visible_expids = dbexperiments.get_visible_expids(con, cur, [cdetails['expid'] for cdetails in found_annotations], userid=userid)
+        exp_annotation_ids = defaultdict(list)
+        if len(visible_expids) > 0:
+            cur.execute('SELECT id, idExp FROM AnnotationsTable WHERE idExp = ANY(%s)', [list(visible_expids)])
+            for cres in cur:
+                exp_annotation_ids[cres[1]].append(cres[0])
+        all_exp_annotation_ids = [cid for cids in exp_annotation_ids.values() for cid in cids]
+        err, exp_annotations = GetAnnotationsFromIDs(con, cur, all_exp_annotation_ids, userid=userid)
+        if err:
+            return err, {}, [], {}, []
+        exp_annotations = {cdetails['annotationid']: cdetails for cdetails in exp_annotations}
+        # keep the order - all the annotations of each experiment following the first annotation found from the experiment
+        annotations_to_process = []
+        experiments_added = set()
+        for cdetails in found_annotations:
+            expid = cdetails['expid']
+            if expid in experiments_added:
                 continue
-
-            # we don't need the term info since we do it once for all terms
-            err, cdetails = GetAnnotationsFromID(con, cur, current_annotation, userid=userid)
-            # if we didn't get annotation details, probably they are private - just ignore
-            if cdetails is None:
+            cexp_annotations = [exp_annotations[cid] for cid in exp_annotation_ids[expid] if cid in exp_annotations]
+            if len(cexp_annotations) == 0:
+                # the experiment is missing from ExperimentsTable or not visible to the user, so keep just the annotation found
+                debug(4, 'experiment %s of annotation %s not found. not adding the experiment annotations', expid, cdetails['annotationid'])
+                annotations_to_process.append(cdetails)
                 continue
-            annotations_to_process = [cdetails]
-            if get_all_exp_annotations:
-                debug(1, 'getting all exp annotations')
-                if 'expid' in cdetails:
-                    expid = cdetails['expid']
-                    # if we already added this experiment - finished
-                    if expid in experiments_added:
-                        continue
-                    err, annotations_to_process = GetAnnotationsFromExpId(con, cur, expid, userid=userid, prepared=True)
-                    experiments_added.add(expid)
-
-            for cdetails in annotations_to_process:
-                cannotationid = cdetails['annotationid']
-                # if annotation not in annotations list - add it
-                if cannotationid not in annotations:
-                    # if we didn't get annotation details, probably they are private - just ignore
-                    if cdetails is None:
-                        continue
-                    # if we need to get the parents, add all the parent terms
-                    if get_parents:
-                        err, parents = GetAnnotationParents(con, cur, cannotationid, get_term_id=False)
-                    else:
-                        # otherwise, just keep the annotation terms
-                        parents = defaultdict(list)
-                        for cdet in cdetails['details']:
-                            cdetailtype = cdet[0]
-                            cterm = cdet[1]
-                            parents[cdetailtype].append(cterm)
-                    cdetails['parents'] = parents
-                    # add to the set of all terms to get the info for
-                    # note we add a "-" for terms that have a "low" annotation type
-                    for ctype, cterms in parents.items():
-                        for cterm in cterms:
-                            if ctype == 'low':
-                                cterm = '-' + cterm
-                            all_terms.add(cterm)
-                    # and add the annotation
-                    annotations[cannotationid] = cdetails
+            experiments_added.add(expid)
+            annotations_to_process.extend(cexp_annotations)
+    else:
+        annotations_to_process = found_annotations
 
-        seqannotations.append((cseqpos, cseqannotationids))
-    debug(2, 'got annotations. found %d unique terms' % len(all_terms))
+    # stage 4: get the parents for all annotations
+    if get_parents:
+        err, all_parents = GetAnnotationsParents(con, cur, [cdetails['annotationid'] for cdetails in annotations_to_process], get_term_id=False)
+        if err:
+            return err, {}, [], {}, []
+    for cdetails in annotations_to_process:
+        cannotationid = cdetails['annotationid']
+        if cannotationid in annotations:
+            continue
+        if get_parents:
+            parents = all_parents[cannotationid]
+        else:
+            # otherwise, just keep the annotation terms
+            parents = defaultdict(list)
+            for cdet in cdetails['details']:
+                cdetailtype = cdet[0]
+                cterm = cdet[1]
+                parents[cdetailtype].append(cterm)
+        cdetails['parents'] = parents
+        # add to the set of all terms to get the info for
+        # note we add a "-" for terms that have a "low" annotation type
+        for ctype, cterms in parents.items():
+            for cterm in cterms:
+                if ctype == 'low':
+                    cterm = '-' + cterm
+                all_terms.add(cterm)
+        # and add the annotation
+        annotations[cannotationid] = cdetails
+
+    # stage 5: get the term info for all terms
+    debug(2, 'got annotations. found %d unique terms', len(all_terms))
     if get_term_info:
         term_info = dbontology.get_term_counts(con, cur, all_terms)
     else:
         term_info = {}
-    debug(2, 'found %d annotations, %d annotated sequences. %d term_info' % (len(annotations), len(seqannotations), len(term_info)))
+    debug(2, 'found %d annotations, %d annotated sequences. %d term_info', len(annotations), len(seqannotations), len(term_info))
+
+    # stage 6: get the taxonomies (using the sequence ids we already found)
     taxonomy = []
     if get_taxonomy:
-        for cseq in sequences:
-            cerr, ctax = dbsequences.GetSequenceTaxonomy(con, cur, cseq)
-            if cerr == '':
-                taxonomy.append(ctax)
-            else:
-                taxonomy.append('na')
+        if hashes:
+            # the hashes are exact matches, so we use the taxonomy of the matching sequence id
+            err, taxonomies = dbsequences.get_taxonomies_by_ids(con, cur, [cids[0] for cids in seqids if len(cids) > 0])
+            taxonomy = [taxonomies.get(cids[0], 'NA') if len(cids) > 0 else 'NA' for cids in seqids]
+        else:
+            err, taxonomy = dbsequences.GetSequencesTaxonomy(con, cur, sequences, seqids=seqids)
+        if err:
+            # same as the taxonomy of sequences not found
+            taxonomy = ['NA'] * len(sequences)
         debug(2, 'got taxonomies')
     return '', annotations, seqannotations, term_info, taxonomy
 
@@ -1283,23 +1544,18 @@ def GetAllAnnotations(con, cur, userid=0):
     annotations : list of dict
         list of all annotations (see GetAnnotationsFromID)
     '''
-    debug(1, 'GetAllAnnotations for user %d' % userid)
+    debug(1, 'GetAllAnnotations for user %d', userid)
 
     # prepare the queries for faster running times
-    err = _prepare_queries(con, cur)
+    err = db_access.prepare_statements(con, cur)
 
-    annotations = []
     cur.execute('SELECT id from AnnotationsTable')
     res = cur.fetchall()
-    debug(1, 'Found %d annotations in dbBact' % len(res))
-    for cres in res:
-        cannotationid = cres[0]
-        err, cannotation = GetAnnotationsFromID(con, cur, cannotationid, userid=userid)
-        if err:
-            debug(2, 'error for annotationid %d: %s' % (cannotationid, err))
-            continue
-        annotations.append(cannotation)
-    debug(1, 'Got details for %d annotations' % len(annotations))
+    debug(1, 'Found %d annotations in dbBact', len(res))
+    err, annotations = GetAnnotationsFromIDs(con, cur, [cres[0] for cres in res], userid=userid)
+    if err:
+        return err, []
+    debug(1, 'Got details for %d annotations', len(annotations))
     return '', annotations
 
 
@@ -1329,11 +1585,11 @@ def GetSequenceStringAnnotations(con, cur, sequence, region=None, userid=0):
                 string summarizing the annotation (i.e. 'higher in ibd compared to control in human, feces')
     """
     res = []
-    debug(1, 'GetSequenceStringAnnotations for sequence %s' % sequence)
+    debug(1, 'GetSequenceStringAnnotations for sequence %s', sequence)
     err, annotations = GetSequenceAnnotations(con, cur, sequence, region=region, userid=userid)
     if err:
         return err, res
-    debug(1, 'Got %s annotations' % len(annotations))
+    debug(1, 'Got %s annotations', len(annotations))
     for cannotation in annotations:
         cres = {}
         cres['annotationid'] = cannotation['annotationid']
@@ -1585,7 +1841,10 @@ def add_annotation_flag(con, cur, annotationid, userid, reason, commit=True):
     '''
     try:
         cur.execute('INSERT INTO AnnotationFlagsTable (annotationID, userID, reason, status) VALUES (%s, %s, %s, %s)', [annotationid, userid, reason, 'suggested'])
-        debug(3, 'Annotation %s flagged by user %s' % (annotationid, userid))
+        debug(3, 'Annotation %s flagged by user %s', annotationid, userid)
+        err = invalidate_annotation_cache(con, cur, annotationid)
+        if err:
+            return err
         if commit:
             con.commit()
         return ''
@@ -1618,7 +1877,10 @@ def update_annotation_flag_status(con, cur, flagid, status, response='', commit=
         debug(7, err)
         return err
     try:
-        cur.execute('UPDATE AnnotationFlagsTable SET status=%s, response=%s WHERE id=%s', [status, response, flagid])
+        cur.execute('UPDATE AnnotationFlagsTable SET status=%s, response=%s WHERE id=%s RETURNING annotationID', [status, response, flagid])
+        err = invalidate_annotation_cache(con, cur, [cres[0] for cres in cur.fetchall()])
+        if err:
+            return err
         if commit:
             con.commit()
         return ''
@@ -1644,7 +1906,7 @@ def get_annotation_flags(con, cur, annotaitonid, status=None):
     err: str (empty '' if ok)
     flags: list of dict {'flagid': int, status:str, userid: int}
     '''
-    debug(1, 'get_annotation_flags for annotationid %d' % annotaitonid)
+    debug(1, 'get_annotation_flags for annotationid %d', annotaitonid)
     flags = []
     if isinstance(status, str):
         status = [status]
@@ -1658,7 +1920,7 @@ def get_annotation_flags(con, cur, annotaitonid, status=None):
                     continue
             cflag = {'status': cres['status'], 'userid': cres['userid'], 'flagid': cres['id'], 'reason': cres['reason']}
             flags.append(cflag)
-        debug(1, 'found %d flags for annotationid %d' % (len(flags), annotaitonid))
+        debug(1, 'found %d flags for annotationid %d', len(flags), annotaitonid)
         return '', flags
     except psycopg2.DatabaseError as e:
         debug(7, "error %s enountered in get_annotation_flags" % e)
@@ -1683,7 +1945,7 @@ def delete_annotation_flag(con, cur, flagid, userid, commit=True):
         empty ('') if ok, otherwise the error encountered
     '''
     try:
-        cur.execute('SELECT userid FROM AnnotationFlagsTable WHERE id=%s', [flagid])
+        cur.execute('SELECT userid, annotationid FROM AnnotationFlagsTable WHERE id=%s', [flagid])
         if cur.rowcount == 0:
             err = 'no flags matching id %d found' % flagid
             debug(2, err)
@@ -1694,6 +1956,9 @@ def delete_annotation_flag(con, cur, flagid, userid, commit=True):
             debug(2, err)
             return err
         cur.execute('DELETE FROM AnnotationFlagsTable WHERE id=%s', [flagid])
+        err = invalidate_annotation_cache(con, cur, res['annotationid'])
+        if err:
+            return err
         if commit:
             con.commit()
         return ''
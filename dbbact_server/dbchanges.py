@@ -0,0 +1,183 @@
+import psycopg2
+
+from .utils import debug
+from . import db_access
+
+# the entity types recorded in the ChangeLogTable
+# 'sequence_info' is for changes of the sequence information only (counts, taxonomy, hashes), not of the sequences themselves (so the sequence indexes are not rebuilt)
+ENTITY_TYPES = ('annotation', 'sequence', 'sequence_info', 'term', 'experiment')
+
+# the notification channel on which the new data version is sent when a change is committed
+# NOTE: the notification is sent by the changelog_set_version() trigger function (database/data_version.psql), so change it there too
+DATA_VERSION_CHANNEL = 'dbbact_data_version'
+
+# the latest data version received in the notifications (None if unknown)
+_known_version = None
+
+# True/False if the DataVersionTable, ChangeLogTable and the version trigger exist (tested on first use), None if not tested yet
+_has_version_table = None
+
+
+def _data_version_notification(payload):
+    '''Called by db_access.poll_notifications() for each committed change (or with None if notifications were lost)'''
+    global _known_version
+
+    if payload is None:
+        _known_version = None
+        return
+    try:
+        version = int(payload)
+    except ValueError:
+        debug(5, 'bad data version notification payload %s', payload)
+        _known_version = None
+        return
+    if _known_version is None or version > _known_version:
+        _known_version = version
+
+
+db_access.listen(DATA_VERSION_CHANNEL, _data_version_notification)
+
+
+def _test_version_table(con, cur):
+    '''Test (once per process) if the data version tables and the version trigger exist in the database (created by database/data_version.psql)'''
+    global _has_version_table
+
+    if _has_version_table is None:
+        cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name IN ('dataversiontable', 'changelogtable')")
+        _has_version_table = cur.fetchone()[0] == 2
+        if _has_version_table:
+            cur.execute("SELECT COUNT(*) FROM information_schema.triggers WHERE trigger_name = 'changelogtable_version_trigger'")
+            _has_version_table = cur.fetchone()[0] > 0
+        if not _has_version_table:
+            debug(7, 'DataVersionTable/ChangeLogTable/changelogtable_version_trigger not found. Data version is not updated. Please run database/data_version.psql')
+    return _has_version_table
+
+
+def add_change(con, cur, entity, entityids=None):
+    '''Record a change in the database: increase the data version and add the changed entities to the ChangeLogTable.
+    Should be called in every function changing annotations, sequences, ontology terms or experiments (before the commit).
+    The changes are added with version 0, and the data version is increased (and the workers notified) only when the transaction is committed
+    (by the changelog_set_version() deferred trigger, see database/data_version.psql), so the DataVersionTable row is not locked during the transaction.
+    All the changes of a transaction get the same data version.
+
+    Parameters
+    ----------
+    con, cur
+    entity: str
+        the type of the changed entities. one of ENTITY_TYPES ('annotation', 'sequence', 'sequence_info', 'term', 'experiment')
+    entityids: int or list of int or None, optional
+        the ids of the changed entities (annotationid/sequence id/ontology term id/expid)
+        None to record a change of an unknown set of entities (i.e. a bulk update of many entities)
+
+    Returns
+    -------
+    err: str
+        empty ('') if ok, otherwise the error encountered
+    '''
+    if entity not in ENTITY_TYPES:
+        err = 'unknown entity type %s for add_change' % entity
+        debug(7, err)
+        return err
+    if isinstance(entityids, int):
+        entityids = [entityids]
+    if entityids is not None and len(entityids) == 0:
+        return ''
+    try:
+        if not _test_version_table(con, cur):
+            return ''
+        # the version is set on commit
+        if entityids is None:
+            cur.execute('INSERT INTO ChangeLogTable (version, entity, entityid) VALUES (0, %s, NULL)', [entity])
+        else:
+            cur.execute('INSERT INTO ChangeLogTable (version, entity, entityid) SELECT 0, %s, unnest(%s::integer[])', [entity, list(set(entityids))])
+        debug(1, 'recorded change of %s %s', entity, entityids)
+        return ''
+    except psycopg2.DatabaseError as e:
+        err = 'error %s encountered in add_change' % e
+        debug(7, err)
+        return err
+
+
+def get_data_version(con, cur, use_cached=True):
+    '''Get the current data version (increased on every committed change to the data)
+
+    Parameters
+    ----------
+    con, cur
+    use_cached: bool, optional
+        True (default) to use the version received in the change notifications (no database query) if available.
+        False to always query the database
+
+    Returns
+    -------
+    err: str
+        empty ('') if ok, otherwise the error encountered
+    version: int or None
+        the data version (0 if the DataVersionTable does not exist), None if error encountered
+    '''
+    global _known_version
+
+    if use_cached and _known_version is not None and db_access.is_listening():
+        return '', _known_version
+    try:
+        if not _test_version_table(con, cur):
+            return '', 0
+        cur.execute('SELECT version FROM DataVersionTable')
+        if cur.rowcount == 0:
+            return '', 0
+        version = cur.fetchone()[0]
+    except psycopg2.DatabaseError as e:
+        err = 'error %s encountered in get_data_version' % e
+        debug(7, err)
+        return err, None
+    if db_access.is_listening() and (_known_version is None or version > _known_version):
+        _known_version = version
+    return '', version
+
+
+def get_changes(con, cur, since_version, entity=None, max_versions=1000, until_version=None):
+    '''Get the changes to the data after a given data version
+
+    Parameters
+    ----------
+    con, cur
+    since_version: int
+        get the changes with data version > since_version
+    entity: str or None, optional
+        if not None, get only changes of this entity type (one of ENTITY_TYPES)
+    max_versions: int, optional
+        the maximal number of data versions to return the changes for (the oldest are returned first).
+        all the changes of each returned version are returned, so the next call can continue from the last returned version
+    until_version: int or None, optional
+        if not None, get only the changes with data version <= until_version (i.e. the committed data version the caller is updating to)
+
+    Returns
+    -------
+    err: str
+        empty ('') if ok, otherwise the error encountered
+    changes: list of dict {'version': int, 'entity': str, 'id': int or None, 'date': str}
+        the changes ordered by version. 'id' is None for changes of an unknown set of entities (i.e. bulk updates)
+    '''
+    try:
+        if not _test_version_table(con, cur):
+            return '', []
+        if until_version is None:
+            # bigint max
+            until_version = 2 ** 63 - 1
+        if entity is None:
+            cur.execute('SELECT version, entity, entityid, changedate FROM ChangeLogTable WHERE version IN '
+                        '(SELECT DISTINCT version FROM ChangeLogTable WHERE version > %s AND version <= %s ORDER BY version LIMIT %s) ORDER BY version',
+                        [since_version, until_version, max_versions])
+        else:
+            cur.execute('SELECT version, entity, entityid, changedate FROM ChangeLogTable WHERE entity = %s AND version IN '
+                        '(SELECT DISTINCT version FROM ChangeLogTable WHERE version > %s AND version <= %s AND entity = %s ORDER BY version LIMIT %s) ORDER BY version',
+                        [entity, since_version, until_version, entity, max_versions])
+        changes = []
+        for cres in cur:
+            changes.append({'version': cres['version'], 'entity': cres['entity'], 'id': cres['entityid'], 'date': cres['changedate'].isoformat()})
+    except psycopg2.DatabaseError as e:
+        err = 'error %s encountered in get_changes' % e
+        debug(7, err)
+        return err, []
+    debug(1, 'found %d changes since version %d', len(changes), since_version)
+    return '', changes
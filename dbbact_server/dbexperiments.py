@@ -3,6 +3,7 @@ import datetime
 import psycopg2
 
 from .utils import debug
+from . import dbchanges
 
 
 def GetExperimentIdByVals(con, cur, arrName, arrValue, userid=None, logic='any'):
@@ -156,6 +157,8 @@ def AddExperimentDetails(con, cur, expid, details, user_id, private='n', commit=
             ctype = ctype.lower()
             cval = cval.lower()
             cur.execute('INSERT INTO ExperimentsTable (expId,type,value,date,userid,private) VALUES(%s,%s,%s,%s,%s,%s)', [expid, ctype, cval, cdate, user_id, private])
+        if dbchanges.add_change(con, cur, 'experiment', expid):
+            return -2
         if commit:
             con.commit()
         return expid
@@ -198,6 +201,32 @@ def TestExpIdExists(con, cur, expid, userid=None):
     return False
 
 
+def get_visible_expids(con, cur, expids, userid=None):
+    """
+    get the experiments (out of expids) which exist and are visible to the user (bulk version of TestExpIdExists())
+
+    input:
+    expids : list of int
+    userid : int (optional)
+
+    output:
+    set of int
+        the expids which exist and are not private (or private and userid match)
+    """
+    expids = list(set(expids))
+    debug(1, "get_visible_expids for %d experiments userid %s", len(expids), userid)
+    if len(expids) == 0:
+        return set()
+    # like TestExpIdExists(), the private flag is taken from one of the experiment rows
+    cur.execute('SELECT DISTINCT ON (expId) expId, private, userId FROM ExperimentsTable WHERE expId = ANY(%s)', [expids])
+    visible = set()
+    for cres in cur:
+        if cres[1] == 'n' or cres[2] == userid:
+            visible.add(cres[0])
+    debug(1, "%d experiments visible", len(visible))
+    return visible
+
+
 def GetDetailsFromExpId(con, cur, expid, userid=None):
     """
     get the details of an experiment with id expid
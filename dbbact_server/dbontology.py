@@ -1,10 +1,14 @@
 import psycopg2
-from collections import defaultdict
+from collections import deque
 
 from .utils import debug, tolist
 from . import dbidval
 from . import dbannotations
-from . import dbsequences
+from . import db_access
+from . import dbchanges
+from . import ontology_graph
+from . import ontology_closure
+from . import term_dict
 
 
 def add_ontology_term(con, cur, term, term_id='', commit=True):
@@ -37,6 +41,10 @@ def add_ontology_term(con, cur, term, term_id='', commit=True):
                 return err, None
             term_id = 'dbbact:%d' % termid
             cur.execute('UPDATE OntologyTable SET term_id=%s WHERE id=%s', [term_id, termid])
+            term_dict.invalidate_terms([termid], [term, term_id])
+            err = dbchanges.add_change(con, cur, 'term', termid)
+            if err:
+                return err, None
         else:
             # term_id supplied
             cur.execute('SELECT id FROM OntologyTable WHERE description=%s AND term_id=%s', [term, term_id])
@@ -53,6 +61,10 @@ def add_ontology_term(con, cur, term, term_id='', commit=True):
                     # not in the table - create a new entry
                     cur.execute('INSERT INTO OntologyTable (description, term_id) VALUES (%s, %s) RETURNING id', [term, term_id])
                     termid = cur.fetchone()[0]
+                term_dict.invalidate_terms([termid], [term, term_id])
+                err = dbchanges.add_change(con, cur, 'term', termid)
+                if err:
+                    return err, None
         return '', termid
     except psycopg2.DatabaseError as e:
         msg = "error %s in add_ontology_term" % e
@@ -81,32 +93,105 @@ def get_term_ids(con, cur, term, allow_ontology_id=True):
         the dbbact term ids matching the term. NOTE: if term not found, will not error and instead return empty list.
     '''
     term = term.lower()
-    term_found = False
+    err, terms_ids = get_terms_ids(con, cur, [term], allow_ontology_id=allow_ontology_id)
+    if err:
+        return err, []
+    ids = terms_ids[term]
+    if len(ids) == 0:
+        debug(2, 'Term %s not found in OntologyTable' % term)
+        return '', []
+    debug(2, 'found %d matches for term %s', len(ids), term)
+    return '', ids
 
-    # try first the term_id field (i.e. gaz:0004)
-    if allow_ontology_id:
-            cur.execute('SELECT id FROM OntologyTable WHERE term_id=%s', [term])
-            if cur.rowcount > 0:
-                term_found = True
-    # if not found, try next the term description field (i.e. feces/homo sapiens)
-    if not term_found:
-        cur.execute('SELECT id FROM OntologyTable WHERE description=%s', [term])
-        if cur.rowcount > 0:
-            term_found = True
 
-    if not term_found:
-        msg = 'Term %s not found in OntologyTable' % term
-        debug(2, msg)
-        return '', []
+def get_terms_ids(con, cur, terms, allow_ontology_id=True):
+    '''Get the dbbact term ids matching each term (same as get_term_ids() for a list of terms)
 
-    ids = []
-    res = cur.fetchall()
-    for cres in res:
-        ids.append(cres['id'])
-    debug(2, 'found %d matches for term %s' % (len(ids), term))
+    Parameters
+    ----------
+    con, cur
+    terms: list of str
+        the terms to get the ids for
+    allow_ontology_id: bool, optional
+        if True, the terms can also be ontology ids (i.e. 'envo:000001')
+
+    Returns
+    -------
+    error (str):
+        empty string ('') if ok, otherwise the error encountered
+    ids (dict of {term(str): list of int})
+        the dbbact term ids matching each term (keys are the lower case terms). empty list for terms not found
+    '''
+    terms = set(cterm.lower() for cterm in terms)
+    ids = {}
+    tdict = term_dict.get_term_dict(con, cur)
+    if tdict is not None:
+        for cterm in terms:
+            if not tdict.is_valid_key(cterm):
+                # the term was changed in the current transaction
+                continue
+            cids = []
+            # try first the term_id field (i.e. gaz:0004)
+            if allow_ontology_id:
+                cids = tdict.ids_from_term_id(cterm)
+            # if not found, try next the term description field (i.e. feces/homo sapiens)
+            if len(cids) == 0:
+                cids = tdict.ids_from_description(cterm)
+            if len(cids) > 0:
+                ids[cterm] = cids
+        tdict.lookups += len(terms)
+        tdict.misses += len(terms) - len(ids)
+    missing = [cterm for cterm in terms if cterm not in ids]
+    try:
+        if allow_ontology_id and len(missing) > 0:
+            cur.execute('SELECT id, term_id FROM OntologyTable WHERE term_id = ANY(%s)', [missing])
+            for cres in cur:
+                ids.setdefault(cres[1], []).append(cres[0])
+            missing = [cterm for cterm in missing if cterm not in ids]
+        if len(missing) > 0:
+            cur.execute('SELECT id, description FROM OntologyTable WHERE description = ANY(%s)', [missing])
+            for cres in cur:
+                ids.setdefault(cres[1], []).append(cres[0])
+    except psycopg2.DatabaseError as e:
+        msg = 'error %s encountered in get_terms_ids' % e
+        debug(7, msg)
+        return msg, {}
+    for cterm in terms:
+        ids.setdefault(cterm, [])
     return '', ids
 
 
+def get_terms_info(con, cur, term_ids):
+    '''Get the description and term_id of the dbbact term ids (same as get_name_from_id() for a list of ids)
+
+    Parameters
+    ----------
+    con, cur
+    term_ids: list of int
+        the dbbact ids of the terms
+
+    Returns
+    -------
+    dict of {id(int): (description(str), term_id(str))}
+        only for the ids found in OntologyTable
+    '''
+    info = {}
+    tdict = term_dict.get_term_dict(con, cur)
+    if tdict is not None:
+        for cid in term_ids:
+            cinfo = tdict.get(cid)
+            if cinfo is not None:
+                info[cid] = cinfo
+        tdict.lookups += len(term_ids)
+        tdict.misses += len(term_ids) - len(info)
+    missing = list(set(cid for cid in term_ids if cid not in info))
+    if len(missing) > 0:
+        cur.execute('SELECT id, description, term_id FROM OntologyTable WHERE id = ANY(%s)', [missing])
+        for cres in cur:
+            info[cres[0]] = (cres[1], cres[2])
+    return info
+
+
 def get_name_from_id(con, cur, term_dbbact_id):
     '''Get term name and term_id from the term dbbact id (OntologyTable)
 
@@ -126,13 +211,12 @@ def get_name_from_id(con, cur, term_dbbact_id):
         the matching term_id (i.e. 'envo:00001' etc.)
     '''
     try:
-        cur.execute('SELECT description, term_id FROM OntologyTable WHERE id=%s LIMIT 1', [term_dbbact_id])
-        if cur.rowcount == 0:
+        info = get_terms_info(con, cur, [term_dbbact_id])
+        if term_dbbact_id not in info:
             msg = 'termid %d not in OntologyTable' % term_dbbact_id
             debug(5, msg)
             return msg, None, None
-        res = cur.fetchone()
-        return '', res['description'], res['term_id']
+        return '', info[term_dbbact_id][0], info[term_dbbact_id][1]
     except psycopg2.DatabaseError as e:
         msg = "error %s enountered in ontology.get_name_from_id" % e
         debug(7, msg)
@@ -160,13 +244,14 @@ def get_names_from_ids(con, cur, term_ids):
     terms = []
     ontology_ids = []
     try:
+        info = get_terms_info(con, cur, term_ids)
         for cid in term_ids:
-            err, cterm, cterm_id = get_name_from_id(con, cur, cid)
-            if err:
-                debug(5, err)
-                return err, [], []
-            terms.append(cterm)
-            ontology_ids.append(cterm_id)
+            if cid not in info:
+                msg = 'termid %d not in OntologyTable' % cid
+                debug(5, msg)
+                return msg, [], []
+            terms.append(info[cid][0])
+            ontology_ids.append(info[cid][1])
         return '', terms, ontology_ids
     except psycopg2.DatabaseError as e:
         msg = "error %s enountered in ontology.get_names_from_ids" % e
@@ -216,7 +301,7 @@ def AddTerm(con, cur, term, parent='dbbact:1811274', ontologyname='dbbact', syno
         parent = parent.lower()
         term_id = term_id.lower()
         if parent_id is None:
-            debug(4, 'parent id for term %s is None. Changed to empty' % term)
+            debug(4, 'parent id for term %s is None. Changed to empty', term)
             parent_id = ''
         parent_id = parent_id.lower()
         ontologyname = ontologyname.lower()
@@ -248,7 +333,7 @@ def AddTerm(con, cur, term, parent='dbbact:1811274', ontologyname='dbbact', syno
         if synonyms:
             for csyn in synonyms:
                 err, cid = AddSynonym(con, cur, termid, csyn, commit=False)
-        debug(2, 'added ontology term %s. id is %d' % (term, termid))
+        debug(2, 'added ontology term %s. id is %d', term, termid)
         if commit:
             con.commit()
         return '', termid
@@ -284,11 +369,17 @@ def AddTreeTerm(con, cur, termid, parentid, ontologynameid, commit=True):
         cur.execute('SELECT uniqueId FROM OntologyTreeStructureTable WHERE (ontologyId=%s AND ontologyParentId=%s AND ontologyNameId=%s) LIMIT 1', [termid, parentid, ontologynameid])
         if cur.rowcount > 0:
             sid = cur.fetchone()[0]
-            debug(2, 'Tree entry exists (%d). returning it' % sid)
+            debug(2, 'Tree entry exists (%d). returning it', sid)
             return '', sid
         # does not exist - lets add it
         cur.execute('INSERT INTO OntologyTreeStructureTable (ontologyId,ontologyParentId,ontologyNameId) VALUES (%s,%s,%s) RETURNING uniqueId', [termid, parentid, ontologynameid])
         sid = cur.fetchone()[0]
+        err = ontology_closure.update_closure(con, cur, [termid])
+        if err:
+            return err, -2
+        err = dbchanges.add_change(con, cur, 'term', termid)
+        if err:
+            return err, -2
         return '', sid
     except psycopg2.DatabaseError as e:
         debug(7, "error %s enountered in ontology.AddTreeTerm" % e)
@@ -319,6 +410,10 @@ def AddSynonym(con, cur, termid, synonym, commit=True):
         # TODO: maybe test idterm,synonym does not exist
         cur.execute('INSERT INTO OntologySynonymTable (idOntology,synonym) VALUES (%s,%s) RETURNING uniqueId', [termid, synonym])
         sid = cur.fetchone()[0]
+        term_dict.invalidate_terms([termid], [synonym])
+        err = dbchanges.add_change(con, cur, 'term', termid)
+        if err:
+            return err, -2
         if commit:
             con.commit()
         return '', sid
@@ -345,12 +440,12 @@ def GetTreeParentsById(con, cur, termid):
     try:
         cur.execute('SELECT ontologyParentId FROM OntologyTreeStructureTable WHERE ontologyId=%s', [termid])
         if cur.rowcount == 0:
-            debug(3, 'termid %d not found in ontologytree' % termid)
+            debug(3, 'termid %d not found in ontologytree', termid)
             return 'termid %d not found in ontologytree' % termid, []
         parentids = []
         for cres in cur:
             parentids.append(cres[0])
-        debug(2, 'found %d parentids for termid %d' % (len(parentids), termid))
+        debug(2, 'found %d parentids for termid %d', len(parentids), termid)
         return '', parentids
     except psycopg2.DatabaseError as e:
         debug(7, "error %s enountered in ontology.GetTreeParentById" % e)
@@ -375,18 +470,38 @@ def GetTreeChildrenById(con, cur, termid):
     try:
         cur.execute('SELECT ontologyId FROM OntologyTreeStructureTable WHERE ontologyParentId=%s', [termid])
         if cur.rowcount == 0:
-            debug(3, 'termid %d not found in ontologytree' % termid)
+            debug(3, 'termid %d not found in ontologytree', termid)
             return 'termid %d not found in ontologytree' % termid, []
         childids = []
         for cres in cur:
             childids.append(cres[0])
-        debug(2, 'found %d child ids for termid %d' % (len(childids), termid))
+        debug(2, 'found %d child ids for termid %d', len(childids), termid)
         return '', childids
     except psycopg2.DatabaseError as e:
         debug(7, "error %s enountered in ontology.GetTreeChildrenById" % e)
         return "error %s enountered in ontology.GetTreeChildrenById" % e, '', []
 
 
+def _get_tree_parents(con, cur, graph, termid):
+    '''Same as GetTreeParentsById(), but using the ontology graph if available (graph is not None)'''
+    if graph is None:
+        return GetTreeParentsById(con, cur, termid)
+    parentids = graph.parents(termid)
+    if len(parentids) == 0:
+        return 'termid %d not found in ontologytree' % termid, []
+    return '', parentids
+
+
+def _get_tree_children(con, cur, graph, termid):
+    '''Same as GetTreeChildrenById(), but using the ontology graph if available (graph is not None)'''
+    if graph is None:
+        return GetTreeChildrenById(con, cur, termid)
+    childids = graph.children(termid)
+    if len(childids) == 0:
+        return 'termid %d not found in ontologytree' % termid, []
+    return '', childids
+
+
 def GetParents_old(con, cur, term):
     """
     Get all the parents of the term in the ontology tree
@@ -411,7 +526,7 @@ def GetParents_old(con, cur, term):
     if len(termids) == 0:
         err, termid = GetSynonymTermId(con, cur, term)
         if err:
-            debug(3, 'ontology term not found for %s' % term)
+            debug(3, 'ontology term not found for %s', term)
             return 'ontolgy term %s not found' % term, []
         debug(2, 'converted synonym to termid')
         termids = [termid]
@@ -434,7 +549,7 @@ def GetParents_old(con, cur, term):
                 continue
             parents.append(cparent)
         parents_id_set.add(origid)
-    debug(2, 'found %d parents' % len(parents))
+    debug(2, 'found %d parents', len(parents))
     return '', parents
 
 
@@ -454,6 +569,15 @@ def get_parents_ids(con, cur, term_ids):
         the ids of the parents of term (in OntologyTable)
     """
     # termid = dbidval.GetIdFromDescription(con, cur, 'OntologyTable', term)
+    graph = ontology_graph.get_ontology_graph(con, cur)
+    if graph is not None:
+        parents_ids = set(graph.ancestors(term_ids))
+        debug(2, 'found %d parents', len(parents_ids))
+        return '', parents_ids
+    err, parents_ids = ontology_closure.get_ancestors(con, cur, term_ids)
+    if not err and parents_ids is not None:
+        debug(2, 'found %d parents', len(parents_ids))
+        return '', parents_ids
 
     plist = term_ids.copy()
     parents_ids = set(plist)
@@ -468,7 +592,7 @@ def get_parents_ids(con, cur, term_ids):
         plist.extend(cparentids)
         parents_ids = parents_ids.union(cparentids)
         processed_set.add(cid)
-    debug(2, 'found %d parents' % len(parents_ids))
+    debug(2, 'found %d parents', len(parents_ids))
     return '', parents_ids
 
 
@@ -560,7 +684,16 @@ def _has_annotations(con, cur, terms):
     return ok_terms
 
 
-def get_family_graph(con, cur, terms, relation='both', force_unique=False, max_children_num=500000):
+def _add_family_edge(succ, source, target):
+    '''Add an edge to the family graph adjacency (same node/edge order as networkx DiGraph.add_edge())'''
+    if source not in succ:
+        succ[source] = {}
+    if target not in succ:
+        succ[target] = {}
+    succ[source][target] = None
+
+
+def get_family_graph(con, cur, terms, relation='both', force_unique=False, max_children_num=500000, max_depth=None):
     """
     get a cytoscape graph json of the parents and/or children of a term
 
@@ -577,16 +710,22 @@ def get_family_graph(con, cur, terms, relation='both', force_unique=False, max_c
     max_children_num: int or None, optional
         if None, return all children
         if int, return maximum of max_children_num child results
+    max_depth: int or None, optional
+        if None, get all the levels of parents/children
+        if int, get only max_depth levels of parents/children of the terms
 
     Returns
     -------
     err : str
         Error message or empty string if ok
-    family : list of str
-        json (cytospace graph) of the term parents and/or children
+    family : dict
+        json (cytospace graph) of the term parents and/or children, in the networkx node_link_data() format:
+        {'directed': True, 'multigraph': False, 'graph': {}, 'nodes': list of {'name': str, 'id': int}, 'links': list of {'source': int, 'target': int}}
     """
-    import networkx as nx
-
+    if max_depth is not None and (not isinstance(max_depth, int) or isinstance(max_depth, bool) or max_depth < 0):
+        msg = 'max_depth must be a non-negative int (got %s)' % (max_depth, )
+        debug(4, msg)
+        return msg, []
     # get the term ontologyids
     term_ids = []
     for cterm in terms:
@@ -596,63 +735,67 @@ def get_family_graph(con, cur, terms, relation='both', force_unique=False, max_c
             debug(4, msg)
             return msg, []
         if len(cterm_ids) > 1:
-            debug(1, '*** more than one id (%d) found for term %s. Please supply ontology id instead (i.e. "envo:00001")' % (len(cterm_ids), cterm))
+            debug(1, '*** more than one id (%d) found for term %s. Please supply ontology id instead (i.e. "envo:00001")', len(cterm_ids), cterm)
             if force_unique:
                 msg = 'more than one id (%d) found for term %s. Please supply ontology id instead (i.e. "envo:00001")' % (len(cterm_ids), cterm)
                 debug(4, msg)
                 return msg, []
         term_ids.extend(cterm_ids)
 
-    tg = nx.DiGraph()
+    graph = ontology_graph.get_ontology_graph(con, cur)
+    # the successors of each node (dict keys keep the insertion order)
+    succ = {}
     processed_set = set()
     if relation == 'both' or relation == 'parent':
         debug(3, 'Getting parents')
-        plist = term_ids.copy()
-        parents_ids = set(plist)
-        processed_set = set()
+        plist = deque((cid, 0) for cid in term_ids)
         while len(plist) > 0:
-            cid = plist.pop(0)
+            cid, cdepth = plist.popleft()
             if cid in processed_set:
                 continue
-            err, cparentids = GetTreeParentsById(con, cur, cid)
+            if max_depth is not None and cdepth >= max_depth:
+                continue
+            err, cparentids = _get_tree_parents(con, cur, graph, cid)
             if err:
                 continue
             for ccparentid in cparentids:
-                tg.add_edge(ccparentid, cid)
-            plist.extend(cparentids)
+                _add_family_edge(succ, ccparentid, cid)
+                plist.append((ccparentid, cdepth + 1))
             processed_set.add(cid)
+        debug(2, 'found %d parents', len(succ))
 
     if relation == 'both' or relation == 'child':
         debug(3, 'Getting children')
-        plist = term_ids.copy()
-        parents_ids = set(plist)
+        plist = deque((cid, 0) for cid in term_ids)
         processed_set = processed_set.difference(term_ids)
         while len(plist) > 0:
-            cid = plist.pop(0)
+            cid, cdepth = plist.popleft()
             if cid in processed_set:
                 continue
             processed_set.add(cid)
             if max_children_num is not None:
                 if len(processed_set) > max_children_num:
-                    debug(3, 'max children num (%d) reached for terms: %s' % (max_children_num, terms))
+                    debug(3, 'max children num (%d) reached for terms: %s', max_children_num, terms)
                     break
-            err, cparentids = GetTreeChildrenById(con, cur, cid)
+            if max_depth is not None and cdepth >= max_depth:
+                continue
+            err, cchildids = _get_tree_children(con, cur, graph, cid)
             if err:
                 continue
-            for ccparentid in cparentids:
-                tg.add_edge(cid, ccparentid)
-            plist.extend(cparentids)
-
-    # now add node names
-    processed = list(processed_set)
-    err, terms, term_ids = get_names_from_ids(con, cur, processed)
-    # check what terms have annotations
-    # ok_terms = _has_annotations(con, cur, terms)
-    # print('%d have annotations out of %d' % (len(ok_terms), len(terms)))
-    for idx, cid in enumerate(processed):
-        tg.nodes[cid]['name'] = terms[idx]
-    debug(2, 'found %d parents' % len(parents_ids))
-    return '', nx.node_link_data(tg)
+            for cchildid in cchildids:
+                _add_family_edge(succ, cid, cchildid)
+                plist.append((cchildid, cdepth + 1))
+
+    # the terms are always in the graph (also if they have no parents/children)
+    for cid in term_ids:
+        succ.setdefault(cid, {})
+    # now add node names (only for the nodes in the graph, after the limits)
+    names = get_terms_from_ids(con, cur, succ.keys())
+    debug(2, 'family graph has %d nodes', len(succ))
+    family = {'directed': True, 'multigraph': False, 'graph': {},
+              'nodes': [{'name': names[cid], 'id': cid} for cid in succ],
+              'links': [{'source': cid, 'target': ctarget} for cid, ctargets in succ.items() for ctarget in ctargets]}
+    return '', family
 
 
 def GetSynonymTermId(con, cur, synonym):
@@ -671,17 +814,55 @@ def GetSynonymTermId(con, cur, synonym):
         the id of the term for the synonym is defined
     """
     synonym = synonym.lower()
+    err, termids = get_synonyms_term_ids(con, cur, [synonym])
+    if err:
+        return err, -2
+    if synonym not in termids:
+        debug(2, 'synonym %s not found', synonym)
+        return 'synonym %s not found' % synonym, -1
+    termid = termids[synonym]
+    debug(2, 'for synonym %s termid is %d', synonym, termid)
+    return '', termid
+
+
+def get_synonyms_term_ids(con, cur, synonyms):
+    """
+    Get the term ids for which the synonyms are (same as GetSynonymTermId() for a list of synonyms)
+
+    Parameters
+    ----------
+    con,cur
+    synonyms : list of str
+        the synonyms to search for
+
+    Returns
+    -------
+    err : str
+        Error message or empty string if ok
+    termids : dict of {synonym(str): termid(int)}
+        the id of the term for which each synonym is defined (keys are the lower case synonyms). only for the synonyms found
+    """
+    synonyms = set(csyn.lower() for csyn in synonyms)
+    termids = {}
+    tdict = term_dict.get_term_dict(con, cur)
+    if tdict is not None:
+        for csyn in synonyms:
+            cid = tdict.synonym_id(csyn)
+            if cid is not None:
+                termids[csyn] = cid
+        tdict.lookups += len(synonyms)
+        tdict.misses += len(synonyms) - len(termids)
+    missing = [csyn for csyn in synonyms if csyn not in termids]
+    if len(missing) == 0:
+        return '', termids
     try:
-        cur.execute('SELECT idOntology FROM OntologySynonymTable WHERE synonym=%s', [synonym])
-        if cur.rowcount == 0:
-            debug(2, 'synonym %s not found' % synonym)
-            return 'synonym %s not found' % synonym, -1
-        termid = cur.fetchone()[0]
-        debug(2, 'for synonym %s termid is %d' % (synonym, termid))
-        return '', termid
+        cur.execute('SELECT synonym, idOntology FROM OntologySynonymTable WHERE synonym = ANY(%s) ORDER BY uniqueId', [missing])
+        for cres in cur:
+            termids.setdefault(cres[0], cres[1])
+        return '', termids
     except psycopg2.DatabaseError as e:
-        debug(7, "error %s enountered in GetSynonymTermId" % e)
-        return "error %s enountered in GetSynonymTermId" % e, -2
+        debug(7, "error %s enountered in get_synonyms_term_ids" % e)
+        return "error %s enountered in get_synonyms_term_ids" % e, {}
 
 
 def GetSynonymTerm(con, cur, synonym):
@@ -701,15 +882,43 @@ def GetSynonymTerm(con, cur, synonym):
     """
     err, termid = GetSynonymTermId(con, cur, synonym)
     if err:
-        debug(2, 'ontology term %s is not a synonym' % synonym)
+        debug(2, 'ontology term %s is not a synonym', synonym)
         return err, str(termid)
-    err, term = dbidval.GetDescriptionFromId(con, cur, 'ontologyTable', termid)
+    err, term, term_id = get_name_from_id(con, cur, termid)
     if err:
-        debug(3, 'ontology term not found for termid %d (synonym %s)' % (termid, synonym))
+        debug(3, 'ontology term not found for termid %d (synonym %s)', termid, synonym)
         return err, term
     return '', term
 
 
+def get_synonyms_terms(con, cur, synonyms):
+    """
+    Get the terms for which the synonyms are (same as GetSynonymTerm() for a list of synonyms)
+
+    Parameters
+    ----------
+    con,cur
+    synonyms : list of str
+        the synonyms to search for
+
+    Returns
+    -------
+    err : str
+        Error message or empty string if ok
+    terms : dict of {synonym(str): term(str)}
+        the term (description) for which each synonym is defined (keys are the lower case synonyms). only for the synonyms found
+    """
+    err, termids = get_synonyms_term_ids(con, cur, synonyms)
+    if err:
+        return err, {}
+    try:
+        info = get_terms_info(con, cur, list(termids.values()))
+    except psycopg2.DatabaseError as e:
+        debug(7, "error %s enountered in get_synonyms_terms" % e)
+        return "error %s enountered in get_synonyms_terms" % e, {}
+    return '', {csyn: info[cid][0] for csyn, cid in termids.items() if cid in info}
+
+
 def GetTermAnnotations(con, cur, terms, use_synonyms=True, get_children=True):
     '''
     Get details for all annotations which contain the ontology term "term" as a parent of (or exact) annotation detail
@@ -731,8 +940,8 @@ def GetTermAnnotations(con, cur, terms, use_synonyms=True, get_children=True):
     annotations : list of dict
         list of annotation details per annotation which contains the term
     '''
-    debug(1, 'GetTermAnnotations for ontology terms %s, use_synonyms=%s, get_children=%s' % (terms, use_synonyms, get_children))
-    dbannotations._prepare_queries(con, cur)
+    debug(1, 'GetTermAnnotations for ontology terms %s, use_synonyms=%s, get_children=%s', terms, use_synonyms, get_children)
+    db_access.prepare_statements(con, cur)
     terms = tolist(terms)
     annotation_ids = None
     if len(terms) == 0:
@@ -750,25 +959,18 @@ def GetTermAnnotations(con, cur, terms, use_synonyms=True, get_children=True):
                     return err
                 if len(ctermids) > 0:
                     # found it so it is an id. get also all the children
-                    terms_from_id = set()
-                    for cctermid in ctermids:
-                        cur.execute('SELECT description FROM OntologyTable WHERE id=%s LIMIT 1', [cctermid])
-                        if cur.rowcount == 0:
-                            debug(6, 'description not found for termid %d' % cctermid)
-                            continue
-                        ccterm = cur.fetchone()[0]
-                        terms_from_id.add(ccterm)
+                    terms_from_id = set(cinfo[0] for cinfo in get_terms_info(con, cur, ctermids).values())
                     cur.execute('SELECT idannotation FROM AnnotationParentsTable WHERE ontology IN %s', [tuple(list(terms_from_id))])
                 else:
                     if use_synonyms:
                         err, cterm = GetSynonymTerm(con, cur, cterm)
                         if err:
-                            debug(3, 'no annotations or synonyms for term %s' % cterm)
+                            debug(3, 'no annotations or synonyms for term %s', cterm)
                             return '', []
-                        debug(1, 'found original ontology term %s' % cterm)
+                        debug(1, 'found original ontology term %s', cterm)
                         cur.execute('SELECT idannotation FROM AnnotationParentsTable WHERE ontology=%s', [cterm])
                     else:
-                        debug(3, 'no annotations for term %s' % cterm)
+                        debug(3, 'no annotations for term %s', cterm)
                         return '', []
         else:
             err, ctermids = get_term_ids(con, cur, cterm)
@@ -783,7 +985,7 @@ def GetTermAnnotations(con, cur, terms, use_synonyms=True, get_children=True):
                         msg = 'ontology term not found for %s' % cterm
                         debug(3, msg)
                         return msg, []
-                    debug(2, 'converted synonym %s to termid %s' % (cterm, ctermids))
+                    debug(2, 'converted synonym %s to termid %s', cterm, ctermids)
             cur.execute('SELECT idannotation FROM AnnotationListTable WHERE idontology IN %s', [tuple(ctermids)])
 
         res = cur.fetchall()
@@ -794,14 +996,11 @@ def GetTermAnnotations(con, cur, terms, use_synonyms=True, get_children=True):
             annotation_ids = cannotation_ids
         annotation_ids = annotation_ids.intersection(cannotation_ids)
 
-    annotations = []
-    for cannotation_id in annotation_ids:
-        err, cdetails = dbannotations.GetAnnotationsFromID(con, cur, cannotation_id)
-        if err:
-            debug(6, err)
-            continue
-        annotations.append(cdetails)
-    debug(3, 'found %d annotations' % len(annotations))
+    err, annotations = dbannotations.GetAnnotationsFromIDs(con, cur, annotation_ids)
+    if err:
+        debug(6, err)
+        return err, []
+    debug(3, 'found %d annotations', len(annotations))
     return '', annotations
 
 
@@ -826,42 +1025,33 @@ def get_term_counts(con, cur, terms, term_types=('single'), ignore_lower=False):
     -------
     dict of {term(str): {'total_annotations': int, 'total_experiments': int}}
     '''
-    debug(1, 'get_term_counts for %d terms' % len(terms))
-    terms = list(set(terms))
+    debug(1, 'get_term_counts for %d terms', len(terms))
+    terms = set(terms)
+    if term_types == ('single'):
+        if '' in terms:
+            debug(4, 'empty term encountered')
+            terms.discard('')
     term_info = {}
-    for cterm in terms:
-        if term_types == ('single'):
-            if cterm == '':
-                debug(4, 'empty term encountered')
-                continue
-            if cterm[0] == '-':
-                # cur.execute('SELECT exp_count, annotation_neg_count from OntologyTable WHERE description=%s', [cterm[1:]])
-                cur.execute('SELECT TotalExperiments, TotalAnnotations from TermInfoTable WHERE term=%s', [cterm])
-            else:
-                # cur.execute('SELECT exp_count, annotationCount from OntologyTable WHERE description=%s', [cterm])
-                cur.execute('SELECT TotalExperiments, TotalAnnotations from TermInfoTable WHERE term=%s', [cterm])
-        else:
-            cur.execute('SELECT TotalExperiments, TotalAnnotations from TermInfoTable WHERE term=%s', [cterm])
-        if cur.rowcount == 0:
-            debug(2, 'Term %s not found in ontology table' % cterm)
+    if len(terms) == 0:
+        return term_info
+    # note "low" terms (starting with '-') are also stored in the TermInfoTable with the '-'
+    cur.execute('SELECT term, TotalExperiments, TotalAnnotations from TermInfoTable WHERE term = ANY(%s)', [list(terms)])
+    for cres in cur:
+        cterm = cres[0]
+        if cterm not in term_info:
+            term_info[cterm] = {}
+            # term_info[cterm]['total_sequences'] = 0
+            term_info[cterm]['total_experiments'] = 0
+            term_info[cterm]['total_annotations'] = 0
+        if cres[1] is None:
+            debug(7, 'None value encountered for term %s total experiments', cterm)
             continue
-        res = cur.fetchall()
-        total_experiments = 0
-        total_annotations = 0
-        for cres in res:
-            if cres[0] is None:
-                debug(7, 'None value encountered for term %s total experiments' % cterm)
-                continue
-            if cres[0] is None:
-                debug(7, 'None value encountered for term %s total annotations' % cterm)
-                continue
-            total_experiments += cres[0]
-            total_annotations += cres[1]
-        term_info[cterm] = {}
-        # term_info[cterm]['total_sequences'] = 0
-        term_info[cterm]['total_experiments'] = total_experiments
-        term_info[cterm]['total_annotations'] = total_annotations
-    debug(1, 'found info for %d terms' % len(term_info))
+        if cres[2] is None:
+            debug(7, 'None value encountered for term %s total annotations', cterm)
+            continue
+        term_info[cterm]['total_experiments'] += cres[1]
+        term_info[cterm]['total_annotations'] += cres[2]
+    debug(1, 'found info for %d terms (out of %d)', len(term_info), len(terms))
     return term_info
 
 
@@ -885,7 +1075,7 @@ def get_annotations_term_counts(con, cur, annotations):
             'total_squences' : int
                 The total number of sequences in annotations where this ontology term is a predecessor
     '''
-    debug(1, 'get_annotations_term_counts for %d annotations' % len(annotations))
+    debug(1, 'get_annotations_term_counts for %d annotations', len(annotations))
     terms = []
     for cannotation in annotations:
         for cdet in cannotation['details']:
@@ -930,7 +1120,7 @@ def get_ontology_terms_list(con, cur, min_term_id=None, ontologyid=None):
     else:
         cur.execute('SELECT ontologytreestructuretable.ontologyid, ontologytable.description, ontologytable.term_id FROM ontologytreestructuretable INNER JOIN ontologytable ON ontologytable.id=ontologytreestructuretable.ontologyid WHERE OntologyNameID=%s', [ontologyid])
 
-    debug(3, 'found %d terms' % cur.rowcount)
+    debug(3, 'found %d terms', cur.rowcount)
 
     res = cur.fetchall()
     all_ontologies = {}
@@ -1001,7 +1191,7 @@ def GetIDs(con, cur, ontList):
             for cres in res:
                 ontids.append(res[0])
 
-        debug(3, "Number of ontology ids %d (out of %d)" % (len(ontids), len(ontList)))
+        debug(3, "Number of ontology ids %d (out of %d)", len(ontids), len(ontList))
         return "", ontids
 
     except psycopg2.DatabaseError as e:
@@ -1022,11 +1212,12 @@ def get_terms_from_ids(con, cur, ids):
     -------
     dict of {id(int): name(str)}
     '''
+    ids = list(ids)
+    info = get_terms_info(con, cur, ids)
     names = {}
     for cid in ids:
-        cur.execute('SELECT description FROM OntologyTable WHERE id=%s LIMIT 1', [cid])
-        if cur.rowcount > 0:
-            names[cid] = cur.fetchone()[0]
+        if cid in info:
+            names[cid] = info[cid][0]
         else:
             names[cid] = 'NOT FOUND'
     return names
@@ -1049,12 +1240,12 @@ def get_term_pairs_count(con, cur, term_pairs):
     for cterm in term_pairs:
         cur.execute("SELECT AnnotationCount from TermPairsTable WHERE TermPair=%s", [cterm])
         if cur.rowcount == 0:
-            debug(5, 'term pair %s not found' % cterm)
+            debug(5, 'term pair %s not found', cterm)
             term_count[cterm] = 0
             continue
         res = cur.fetchone()
         term_count[cterm] = res[0]
-    debug(2, 'Found term pairs for %d terms' % len(term_count))
+    debug(2, 'Found term pairs for %d terms', len(term_count))
     return term_count
 
 
@@ -1080,10 +1271,50 @@ def get_ontology_id_from_name(con, cur, ontology_name):
         msg = 'ontology name %s not found'
         debug(8, msg)
         return msg, -1
-    debug(1, 'found ontology id %d for ontology %s' % (oid, ontology_name))
+    debug(1, 'found ontology id %d for ontology %s', oid, ontology_name)
     return '', oid
 
 
+def _get_descendant_ids(con, cur, term_ids, ontology_id=None):
+    '''Get the ids of all the descendants of the terms in the ontology tree
+    Uses the in-memory ontology graph or the OntologyClosureTable if available, otherwise one recursive query
+
+    Parameters
+    ----------
+    con,cur : database connection and cursor
+    term_ids: list of int
+        the terms to get the descendants for
+    ontology_id: int or None, optional
+        if not None, follow only tree edges of this ontology (OntologyNamesTable id)
+
+    Returns
+    -------
+    error: empty ('') if ok, otherwise the error string
+    descendants: set of int
+        the descendant ids (including term_ids)
+    '''
+    graph = ontology_graph.get_ontology_graph(con, cur)
+    if graph is not None:
+        return '', set(graph.descendants(term_ids, ontology_id=ontology_id))
+    err, descendants = ontology_closure.get_descendants(con, cur, term_ids, ontology_id=ontology_id)
+    if err:
+        return err, set()
+    if descendants is not None:
+        return '', descendants
+    try:
+        # UNION (not UNION ALL) so we stop on circles in the tree
+        if ontology_id is None:
+            cur.execute('WITH RECURSIVE children(id) AS (SELECT unnest(%s::integer[]) UNION SELECT t.ontologyId FROM OntologyTreeStructureTable t JOIN children ON t.ontologyParentId = children.id) '
+                        'SELECT id FROM children', [list(term_ids)])
+        else:
+            cur.execute('WITH RECURSIVE children(id) AS (SELECT unnest(%s::integer[]) UNION SELECT t.ontologyId FROM OntologyTreeStructureTable t JOIN children ON t.ontologyParentId = children.id WHERE t.ontologyNameId = %s) '
+                        'SELECT id FROM children', [list(term_ids), ontology_id])
+        return '', set(cres[0] for cres in cur)
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return 'database error %s' % e, set()
+
+
 def get_term_children(con, cur, term, ontology_name=None, only_annotated=True):
     '''get a list of all terms that are a children of the given term. Optionally, limit to a given ontology.
 
@@ -1111,44 +1342,28 @@ def get_term_children(con, cur, term, ontology_name=None, only_annotated=True):
         debug(4, msg)
         return msg, {}
     termid = termid[0]
-    children_ids = set()
-    terms = set(termid)
     if ontology_name is None:
         ontology_id = None
     else:
         err, ontology_id = get_ontology_id_from_name(con, cur, ontology_name)
         if err:
             return err, {}
-    while len(terms) > 0:
-        ctermid = terms.pop()
-        if ctermid in children_ids:
-            debug(8, 'termid %d is in a circle?' % ctermid)
-            continue
-        children_ids.add(ctermid)
-        if ontology_name is None:
-            cur.execute('SELECT ontologyid FROM OntologyTreeStructureTable WHERE ontologyParentID=%s', [ctermid])
-        else:
-            cur.execute('SELECT ontologyid FROM OntologyTreeStructureTable WHERE ontologyParentID=%s AND ontologyNameID=%s', [ctermid, ontology_id])
-        res = cur.fetchall()
-        for cres in res:
-            terms.add(cres[0])
-    debug(5, 'found %d children for term %s' % (len(children_ids), term))
+    err, children_ids = _get_descendant_ids(con, cur, list(termid), ontology_id=ontology_id)
+    if err:
+        return err, {}
+    debug(5, 'found %d children for term %s', len(children_ids), term)
     children = get_terms_from_ids(con, cur, children_ids)
     if only_annotated:
+        # look if the term has any annotations, or any lower in annotations
+        term_names = set(children.values())
+        cur.execute('SELECT term FROM TermInfoTable WHERE term = ANY(%s) AND TotalAnnotations > 0', [list(term_names) + ['-' + cterm for cterm in term_names]])
         ok_terms = set()
-        for cterm in children.values():
-            # look if term has any annotations
-            cur.execute('SELECT TotalAnnotations from TermInfoTable WHERE term=%s LIMIT 1', [cterm])
-            if cur.rowcount > 0:
-                if cur.fetchone()[0] > 0:
-                    ok_terms.add(cterm)
-                    continue
-            # look also for lower in annotations
-            cur.execute('SELECT TotalAnnotations from TermInfoTable WHERE term=%s LIMIT 1', ['-' + cterm])
-            if cur.rowcount > 0:
-                if cur.fetchone()[0] > 0:
-                    ok_terms.add(cterm)
-        debug(3, 'found %d term children with annotations out of %d children' % (len(ok_terms), len(children)))
+        for cres in cur:
+            if cres[0] in term_names:
+                ok_terms.add(cres[0])
+            if cres[0].startswith('-') and cres[0][1:] in term_names:
+                ok_terms.add(cres[0][1:])
+        debug(3, 'found %d term children with annotations out of %d children', len(ok_terms), len(children))
         new_children = {}
         for cid, cterm in children.items():
             if cterm in ok_terms:
@@ -1186,33 +1401,37 @@ def get_parents_trees(con, cur, term, max_trees=20):
     all_trees = []
     open_trees = [[x] for x in termids]
     total_trees = 0
-    while len(open_trees) > 0:
-        total_trees += 1
-        if total_trees > max_trees:
-            break
-        res_tree = open_trees.pop()
-        res_tree_set = set(res_tree)
-        while True:
-            ctermid = res_tree[-1]
-            err, ids = GetTreeParentsById(con, cur, ctermid)
-            # if reached top of tree
-            if err != '':
-                break
-            # check for loops our tree
-            ids = [x for x in ids if x not in res_tree_set]
-            if len(ids) == 0:
+    graph = ontology_graph.get_ontology_graph(con, cur)
+    if graph is not None:
+        all_trees = graph.root_paths(termids, max_paths=max_trees)
+    else:
+        while len(open_trees) > 0:
+            total_trees += 1
+            if total_trees > max_trees:
                 break
-            # if we have more than 1 parent, process one and store the others
-            if len(ids) > 1:
-                for newterm in ids[1:]:
-                    ttree = res_tree.copy()
-                    ttree.append(newterm)
-                    open_trees.append(ttree)
-            ctermid = ids[0]
-            res_tree.append(ctermid)
-            res_tree_set.add(ctermid)
-        # finished building this tree, add it to the list of all trees
-        all_trees.append(res_tree)
+            res_tree = open_trees.pop()
+            res_tree_set = set(res_tree)
+            while True:
+                ctermid = res_tree[-1]
+                err, ids = GetTreeParentsById(con, cur, ctermid)
+                # if reached top of tree
+                if err != '':
+                    break
+                # check for loops our tree
+                ids = [x for x in ids if x not in res_tree_set]
+                if len(ids) == 0:
+                    break
+                # if we have more than 1 parent, process one and store the others
+                if len(ids) > 1:
+                    for newterm in ids[1:]:
+                        ttree = res_tree.copy()
+                        ttree.append(newterm)
+                        open_trees.append(ttree)
+                ctermid = ids[0]
+                res_tree.append(ctermid)
+                res_tree_set.add(ctermid)
+            # finished building this tree, add it to the list of all trees
+            all_trees.append(res_tree)
 
     # remove all subsets
     all_ids = set()
@@ -1262,52 +1481,40 @@ def get_term_sequences(con, cur, term, get_children=True):
         the negative associated sequences (i.e. lower in) (keys - sequence (ACGT)) and the number of annotations the sequence is associated with the term in (int)
     '''
     term = term.lower()
+    err, ids = get_term_ids(con, cur, term)
+    if err:
+        return err, {}, {}
+    if len(ids) == 0:
+        msg = 'term %s not found in OntologyTable' % term
+        debug(2, msg)
+        return msg, {}, {}
     if get_children:
         debug(3, 'getting term sequences with children')
-        err, ids_dict = get_term_children(con, cur, term)
+        err, ids = _get_descendant_ids(con, cur, ids)
         if err:
             return err, {}, {}
-        ids = list(ids_dict.keys())
     else:
         debug(3, 'getting term sequences without children')
-        err, ids = get_term_ids(con, cur, term)
-        if err:
-            return err, {}, {}
-    if len(ids) == 0:
-        msg = 'term %s not found in OntologyTable'
-        debug(2, msg)
-        return msg, {}, {}
-    pos_seqs = defaultdict(int)
-    neg_seqs = defaultdict(int)
-    for cid in ids:
-        cur.execute('SELECT idannotation, idannotationdetail FROM annotationlisttable WHERE idontology=%s', [cid])
-        res = cur.fetchall()
-        for cres in res:
-            cannotation_id = cres[0]
-            cidannotation_detail = cres[1]
-            cerr, cseqs = dbannotations.GetSequencesFromAnnotationID(con, cur, cannotation_id)
-            if cerr != '':
-                debug(3, 'error encountered when getting sequences for annotationid %s: %s' % (cannotation_id, cerr))
-                continue
-            for ccseq in cseqs:
-                if cidannotation_detail == 2:
-                    neg_seqs[ccseq] += 1
-                else:
-                    pos_seqs[ccseq] += 1
+    # count the (non private) annotations of each sequence, separately for the lower in (idannotationdetail 2) annotations
+    try:
+        cur.execute('SELECT SequencesTable.sequence, counts.negative, counts.num FROM '
+                    '(SELECT SequencesAnnotationTable.seqId, AnnotationListTable.idAnnotationDetail = 2 AS negative, COUNT(*) AS num FROM AnnotationListTable '
+                    'INNER JOIN AnnotationsTable ON AnnotationsTable.id = AnnotationListTable.idAnnotation '
+                    'INNER JOIN SequencesAnnotationTable ON SequencesAnnotationTable.annotationId = AnnotationListTable.idAnnotation '
+                    "WHERE AnnotationListTable.idOntology = ANY(%s) AND AnnotationsTable.isprivate IS DISTINCT FROM 'y' "
+                    'GROUP BY SequencesAnnotationTable.seqId, negative) AS counts '
+                    'INNER JOIN SequencesTable ON SequencesTable.id = counts.seqId', [list(ids)])
+    except psycopg2.DatabaseError as e:
+        debug(7, 'database error %s' % e)
+        return 'database error %s' % e, {}, {}
     pos_sequences = {}
-    for ck, cv in pos_seqs.items():
-        err, seq = dbsequences.GetSequenceStrByID(con, cur, ck)
-        if err:
-            debug(5, 'sequence from id failed for seqid %s' % ck)
-            seq = ck
-        pos_sequences[seq] = cv
     neg_sequences = {}
-    for ck, cv in neg_seqs.items():
-        err, seq = dbsequences.GetSequenceStrByID(con, cur, ck)
-        if err:
-            debug(5, 'sequence from id failed for seqid %s' % ck)
-            seq = ck
-        neg_sequences[seq] = cv
+    for cseq, cnegative, cnum in cur:
+        if cnegative:
+            neg_sequences[cseq] = cnum
+        else:
+            pos_sequences[cseq] = cnum
+    debug(3, 'found %d positive, %d negative sequences for %d terms', len(pos_sequences), len(neg_sequences), len(ids))
     return '', pos_sequences, neg_sequences
 
 
@@ -1327,7 +1534,7 @@ def get_term_synonyms(con, cur, term_id):
         the synonyms for the term (i.e. 'feces')
     '''
     cur.execute('SELECT synonym FROM ontologysynonymtable WHERE idontology=%s', [term_id])
-    debug(2,'found %d synonyms for term id %d' % (cur.rowcount, term_id))
+    debug(2,'found %d synonyms for term id %d', cur.rowcount, term_id)
     res = cur.fetchall()
     synonyms = []
     for cres in res:
@@ -1361,7 +1568,7 @@ def get_used_terms(con, cur):
     if cur.rowcount == 0:
         debug(2, 'no terms with any annotation found in ontology table')
         return 'no terms with any annotation found in ontology table', []
-    debug(3, 'found %d terms with annotations' % cur.rowcount)
+    debug(3, 'found %d terms with annotations', cur.rowcount)
     res = cur.fetchall()
     used_terms = []
     for cres in res:
@@ -1372,7 +1579,7 @@ def get_used_terms(con, cur):
         # get synonyms
         err, synonyms = get_term_synonyms(con, cur, id)
         if err:
-            debug(2, 'error getting synonyms for term %s: %s' % (term, err))
+            debug(2, 'error getting synonyms for term %s: %s', term, err)
             continue
         used_terms.append({'term': term, 'term_id': term_id, 'synonyms': synonyms, 'id': id, 'num_used': num_used})
     return '', used_terms
\ No newline at end of file
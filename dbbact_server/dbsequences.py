@@ -1,15 +1,65 @@
 from collections import defaultdict
+import time
+
 import psycopg2
 import requests
 
 from . import dbprimers
 from .utils import debug
 from . import dbannotations
+from . import db_access
+from . import dbchanges
+from . import seqindex
 
 # length for the seed sequence
 # used for fast searching of sub sequences
 SEED_SEQ_LEN = 100
 
+# the maximal number of query sequences searched in the database (a pg_trgm scan each) in one get_close_sequences_list() call
+# (i.e. all the queries if the close sequences index is not enabled, or the queries that cannot be searched in the index)
+MAX_CLOSE_DB_QUERIES = 100
+
+# the prepared statements used in GetSequenceId()
+db_access.register_statement('get_sequence_id_exact', ['text'],
+                             'SELECT id, idprimer FROM SequencesTable WHERE sequence=$1 LIMIT 1')
+db_access.register_statement('get_sequence_id_seed', ['text'],
+                             'SELECT id, sequence, idprimer FROM SequencesTable WHERE seedsequence=$1')
+
+# True/False if the seqdigest column exists in SequencesTable (tested on first use), None if not tested yet
+_has_digest_column = None
+
+
+def _test_digest_column(con, cur):
+    '''Test (once per process) if the seqdigest column exists in SequencesTable (created by database/seq_digest.psql)'''
+    global _has_digest_column
+
+    if _has_digest_column is None:
+        cur.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_name = 'sequencestable' AND column_name = 'seqdigest'")
+        _has_digest_column = cur.fetchone()[0] > 0
+        if not _has_digest_column:
+            debug(7, 'seqdigest column not found in SequencesTable. exact sequence lookups use the sequence field. Please run database/seq_digest.psql')
+    return _has_digest_column
+
+
+def hash_to_digest(seq_hash):
+    '''Convert a sequence hash (md5 hex string of the upper case sequence, as in the hashfull field) to the 16 byte digest (as in the seqdigest field)
+
+    Parameters
+    ----------
+    seq_hash: str
+        the sequence hash (32 hex characters)
+
+    Returns
+    -------
+    bytes (16 bytes) or None if not a valid sequence hash
+    '''
+    if not isinstance(seq_hash, str) or len(seq_hash) != 32:
+        return None
+    try:
+        return bytes.fromhex(seq_hash)
+    except ValueError:
+        return None
+
 
 def AddSequences(con, cur, sequences, taxonomies=None, ggids=None, primer='V4', commit=True, seq_translate_api=None):
     """
@@ -38,47 +88,75 @@ def AddSequences(con, cur, sequences, taxonomies=None, ggids=None, primer='V4',
     numadded = 0
     idprimer = dbprimers.GetIdFromName(con, cur, primer)
     if idprimer < 0:
-        debug(2, 'primer %s not found' % primer)
+        debug(2, 'primer %s not found', primer)
         return "primer %s not found" % primer, None
-    debug(1, 'primerid %s' % idprimer)
+    debug(1, 'primerid %s', idprimer)
 
-    # prepare the queries for fast performance
-    err = dbannotations._prepare_queries(con, cur)
+    # the position of the first appearance of each (lower case) sequence
+    seq_pos = {}
+    for idx, cseq in enumerate(sequences):
+        if len(cseq) < SEED_SEQ_LEN:
+            errmsg = 'sequence too short (<%d) for sequence %s' % (SEED_SEQ_LEN, cseq)
+            debug(4, errmsg)
+            return errmsg, None
+        cseq = cseq.lower()
+        if cseq not in seq_pos:
+            seq_pos[cseq] = idx
 
     try:
         seqs_to_add_to_translator = {}
-        for idx, cseq in enumerate(sequences):
-            if len(cseq) < SEED_SEQ_LEN:
-                errmsg = 'sequence too short (<%d) for sequence %s' % (SEED_SEQ_LEN, cseq)
-                debug(4, errmsg)
-                return errmsg, None
-            # test if already exists, skip it. NOTE: we do not want the sequence translator sequences as result (we look for our sequence)
-            err, cseqid = GetSequenceId(con, cur, sequence=cseq, idprimer=idprimer, no_shorter=True, no_longer=True, seq_translate_api=None)
-            # if we get primer mismatch error, it means the sequence is in the database but with different primers
-            if err == 'primer mismatch':
-                return 'primer mismatch: The sequence in dbBact has a different primer than the requested primer (%s)\nfor sequence %s\nPlease contact dbBact support.' % (primer, cseq), None
-
-            if len(cseqid) == 0:
-                # not found, so need to add this sequence
-                if taxonomies is None:
-                    ctax = 'na'
-                else:
-                    ctax = taxonomies[idx].lower()
-                if ggids is None:
-                    cggid = 0
-                else:
-                    cggid = ggids[idx]
-                cseq = cseq.lower()
-                cseedseq = cseq[:SEED_SEQ_LEN]
-                cur.execute('INSERT INTO SequencesTable (idPrimer,sequence,length,taxonomy,ggid,seedsequence) VALUES (%s,%s,%s,%s,%s,%s) RETURNING id', [idprimer, cseq, len(cseq), ctax, cggid, cseedseq])
-                cseqid = cur.fetchone()
-                numadded += 1
-                seqs_to_add_to_translator[cseqid[0]] = cseq
-            if len(cseqid) > 1:
+        # get the sequences already in the database (using one query). NOTE: we do not want the sequence translator sequences as result (we look for our sequence)
+        seq_ids = defaultdict(list)
+        if len(seq_pos) > 0:
+            if _test_digest_column(con, cur):
+                digest_seqs = {seqindex.sequence_digest(cseq): cseq for cseq in seq_pos}
+                cur.execute('SELECT seqdigest, id, idprimer FROM SequencesTable WHERE seqdigest = ANY(%s)', [[psycopg2.Binary(cdigest) for cdigest in digest_seqs]])
+                for cres in cur:
+                    seq_ids[digest_seqs[bytes(cres[0])]].append((cres[1], cres[2]))
+            else:
+                cur.execute('SELECT sequence, id, idprimer FROM SequencesTable WHERE sequence = ANY(%s)', [list(seq_pos.keys())])
+                for cres in cur:
+                    seq_ids[cres[0]].append((cres[1], cres[2]))
+        for cseq, cids in seq_ids.items():
+            if len(cids) > 1:
                 msg = 'AddSequences - Same sequence appears twice in database: %s' % cseq
                 debug(8, msg)
                 return msg, None
-            seqids.append(cseqid[0])
+            # if we get primer mismatch, it means the sequence is in the database but with different primers
+            if cids[0][1] != idprimer:
+                debug(8, 'Matching sequence %s but non-matching primer %s (query primer was %d)' % (cseq, cids[0][1], idprimer))
+                return 'primer mismatch: The sequence in dbBact has a different primer than the requested primer (%s)\nfor sequence %s\nPlease contact dbBact support.' % (primer, sequences[seq_pos[cseq]]), None
+
+        # add all the new sequences (using one query)
+        new_seqs = [cseq for cseq in seq_pos if cseq not in seq_ids]
+        if len(new_seqs) > 0:
+            if taxonomies is None:
+                new_taxonomies = ['na'] * len(new_seqs)
+            else:
+                new_taxonomies = [taxonomies[seq_pos[cseq]].lower() for cseq in new_seqs]
+            if ggids is None:
+                new_ggids = [0] * len(new_seqs)
+            else:
+                new_ggids = [ggids[seq_pos[cseq]] for cseq in new_seqs]
+            columns = 'idPrimer,sequence,length,taxonomy,ggid,seedsequence'
+            values = 'SELECT %s, unnest(%s), unnest(%s), unnest(%s), unnest(%s), unnest(%s)'
+            params = [idprimer, new_seqs, [len(cseq) for cseq in new_seqs], new_taxonomies, new_ggids, [cseq[:SEED_SEQ_LEN] for cseq in new_seqs]]
+            if _test_digest_column(con, cur):
+                columns += ',seqdigest'
+                values += ', unnest(%s)'
+                params.append([psycopg2.Binary(seqindex.sequence_digest(cseq)) for cseq in new_seqs])
+            cur.execute('INSERT INTO SequencesTable (' + columns + ') ' + values + ' RETURNING id, sequence', params)
+            for cres in cur:
+                seq_ids[cres[1]].append((cres[0], idprimer))
+                seqs_to_add_to_translator[cres[0]] = cres[1]
+            numadded = len(new_seqs)
+
+        # the ids in the order of the input sequences
+        seqids = [seq_ids[cseq.lower()][0][0] for cseq in sequences]
+
+        err = dbchanges.add_change(con, cur, 'sequence', list(seqs_to_add_to_translator.keys()))
+        if err:
+            return err, None
 
         if seq_translate_api is not None:
             debug(1, 'adding sequence to sequence translator queue')
@@ -92,7 +170,7 @@ def AddSequences(con, cur, sequences, taxonomies=None, ggids=None, primer='V4',
 
         if commit:
             con.commit()
-        debug(3, "Added %d sequences (out of %d)" % (numadded, len(sequences)))
+        debug(3, "Added %d sequences (out of %d)", numadded, len(sequences))
         return "", seqids
 
     except psycopg2.DatabaseError as e:
@@ -103,6 +181,7 @@ def AddSequences(con, cur, sequences, taxonomies=None, ggids=None, primer='V4',
 def SeqFromID(con, cur, seqids):
     '''Get the information about the sequence.
     Get the sequence (ACGT) and taxonomy from sequence id or list of sequence ids
+    NOTE: same as SeqFromIDs() (kept for backward compatibility)
 
     Parameters
     ----------
@@ -122,31 +201,89 @@ def SeqFromID(con, cur, seqids):
         'total_experiments': int
             the total number of experiments which this sequence is associated with
     '''
+    return SeqFromIDs(con, cur, seqids)
+
+
+def SeqFromIDs(con, cur, seqids):
+    '''Get the information about a list of sequence ids (using one query)
+    Get the sequence (ACGT) and taxonomy from sequence id or list of sequence ids
+
+    Parameters
+    ----------
+    con, cur
+    seqids : int or list of int
+        the ids to get the sequences for
+
+    Returns
+    -------
+    err : str
+        The error encountered or '' if ok
+    sequences : list of dict (one per sequence id, in the same order). contains:
+        'seq' : str (ACGT)
+            the sequence ('' if the id was not found. in this case this is the only field)
+        'taxonomy' : str
+            the taxonomy of the sequence or '' if unknown
+        'seqid' : int
+            the sequence id
+        'total_annotations': int
+            the number of annotations which this sequence is associated with
+        'total_experiments': int
+            the total number of experiments which this sequence is associated with
+    '''
     if isinstance(seqids, int):
         seqids = [seqids]
+    debug(1, 'SeqFromIDs for %d sequences', len(seqids))
+    seqs_info = {}
+    if len(seqids) > 0:
+        try:
+            cur.execute("SELECT id, sequence, " + _TAXONOMY_FIELDS + ", total_annotations, total_experiments FROM SequencesTable WHERE id = ANY(%s)", [list(set(seqids))])
+        except psycopg2.DatabaseError as e:
+            msg = 'error %s encountered in SeqFromIDs' % e
+            debug(7, msg)
+            return msg, []
+        for res in cur:
+            seqs_info[res['id']] = {'seq': res['sequence'], 'taxonomy': _taxonomy_str(res[2:8]), 'seqid': res['id'], 'total_annotations': res['total_annotations'], 'total_experiments': res['total_experiments']}
     sequences = []
     for cseqid in seqids:
-        cur.execute("SELECT sequence,coalesce(taxdomain,''),coalesce(taxphylum,''),  coalesce(taxclass,''),coalesce(taxorder,''),coalesce(taxfamily,''), coalesce(taxgenus,'') as taxonomy_str, total_annotations, total_experiments FROM SequencesTable WHERE id=%s", [cseqid])
-
-        if cur.rowcount == 0:
+        if cseqid in seqs_info:
+            # a copy so the same id appearing twice does not share the dict
+            sequences.append(dict(seqs_info[cseqid]))
+        else:
             sequences.append({'seq': ''})
-            continue
-        res = cur.fetchone()
-        firstTax = True
-        taxStr = ''
-        list_of_pre_str = ["d__", "p__", "c__", "o__", "f__", "g__"]
-        for idx, val in enumerate(list_of_pre_str):
-            if res[idx + 1]:
-                if firstTax is False:
-                    taxStr += ';'
-                taxStr += val + res[idx + 1]
-                firstTax = False
-
-        cseqinfo = {'seq': res[0], 'taxonomy': taxStr, 'seqid': cseqid, 'total_annotations': res['total_annotations'], 'total_experiments': res['total_experiments']}
-        sequences.append(cseqinfo)
     return '', sequences
 
 
+def get_taxonomies_by_ids(con, cur, seqids):
+    '''Get the taxonomy strings for a list of sequence ids (using one query)
+
+    Parameters
+    ----------
+    con, cur
+    seqids : list of int
+        the sequence ids to get the taxonomy for
+
+    Returns
+    -------
+    err : str
+        The error encountered or '' if ok
+    taxonomies : dict of {seqid (int): taxonomy (str)}
+        the taxonomy string (of format d__XXX;p__YYYY;...) of each sequence id found
+    '''
+    taxonomies = {}
+    if len(seqids) == 0:
+        return '', taxonomies
+    try:
+        cur.execute('SELECT id, ' + _TAXONOMY_FIELDS + ' FROM SequencesTable WHERE id = ANY(%s)', [list(set(seqids))])
+        for cres in cur:
+            taxonomies[cres[0]] = _taxonomy_str(cres[1:])
+    except psycopg2.DatabaseError as e:
+        msg = 'error %s encountered in get_taxonomies_by_ids' % e
+        debug(7, msg)
+        return msg, {}
+    debug(1, 'got taxonomies for %d sequence ids', len(taxonomies))
+    return '', taxonomies
+
+
 def OBSOLETE_GetSequencesIds(con, cur, sequences, no_shorter=False, no_longer=False, seq_translate_api=None, dbname=None):
     """
     Get sequence ids for a sequence or list of sequences
@@ -169,7 +306,7 @@ def OBSOLETE_GetSequencesIds(con, cur, sequences, no_shorter=False, no_longer=Fa
         the list of ids for each sequence (empty [] for sequences which were not found)
     """
     # prepare the queries for faster performance
-    err = dbannotations._prepare_queries(con, cur)
+    err = db_access.prepare_statements(con, cur)
     if isinstance(sequences, str):
         sequences = [sequences]
     ids = []
@@ -202,7 +339,7 @@ def GetSequenceIdFromGG(con, cur, ggid):
     '''
     sid = []
 
-    debug(1, 'get id for ggid %d' % ggid)
+    debug(1, 'get id for ggid %d', ggid)
     cur.execute('SELECT id FROM SequencesTable WHERE ggid=%s', [ggid])
     if cur.rowcount == 0:
         errmsg = 'ggid %s not found in database' % ggid
@@ -214,7 +351,7 @@ def GetSequenceIdFromGG(con, cur, ggid):
         resid = cres[0]
         sid.append(resid)
 
-    debug(1, 'found %d sequences for ggid %d' % (len(sid), ggid))
+    debug(1, 'found %d sequences for ggid %d', len(sid), ggid)
     return '', sid
 
 
@@ -247,38 +384,135 @@ def GetSequencesIds(con, cur, sequences, idprimer=None, no_shorter=False, no_lon
         the ids of the matching sequences (empty tuple if not found)
         Note: can be more than one as we also look for short subsequences / long supersequences
     """
-    err = dbannotations._prepare_queries(con, cur)
-
-    sids = []
-    # get the sequence ids without region translation
+    # get the sequence ids without region translation (using one query for all the sequences)
     # we do one call to sequence translator to make it faster
-    for cseq in sequences:
-        err, cids = GetSequenceId(con, cur, cseq, idprimer=idprimer, no_shorter=no_shorter, no_longer=no_longer, seq_translate_api=None, dbname=dbname)
-        sids.append(list(cids))
+    if dbname is None:
+        err, sids = _get_sequences_ids_batch(con, cur, sequences, idprimer=idprimer, no_shorter=no_shorter, no_longer=no_longer)
+        if err:
+            return err, []
+    else:
+        sids = [[] for cseq in sequences]
 
     # and now call the sequence translator for all sequences
     if seq_translate_api is not None:
         if dbname is None:
-            debug(2, 'translating %d sequences to other regions' % len(sequences))
+            debug(2, 'translating %d sequences to other regions', len(sequences))
             res = requests.post(seq_translate_api + '/get_ids_for_seqs', json={'sequences': sequences})
         else:
-            debug(2, 'getting dbids from wholeseq ids for %d sequences' % len(sequences))
+            debug(2, 'getting dbids from wholeseq ids for %d sequences', len(sequences))
             res = requests.post(seq_translate_api + '/get_dbbact_ids_from_wholeseq_ids', json={'whole_seq_ids': sequences, 'dbname': dbname})
         if res.ok:
             trans_ids = res.json()['dbbact_ids']
-            debug(2, 'got %d ids from sequence translator' % len(trans_ids))
+            debug(2, 'got %d ids from sequence translator', len(trans_ids))
         else:
-            debug(5, 'got error from sequence translator: %s' % res.content)
+            debug(5, 'got error from sequence translator: %s', res.content)
             trans_ids = []
         # and merge the ids
         for cidx in range(len(sequences)):
             sids[cidx].extend(trans_ids[cidx])
     else:
-        debug(2, 'not translating %d sequences' % len(sequences))
+        debug(2, 'not translating %d sequences', len(sequences))
+    return '', sids
+
+
+def _get_sequences_ids_batch(con, cur, sequences, idprimer=None, no_shorter=False, no_longer=False):
+    """
+    Get the dbbact sequence ids for a list of acgt sequences using one query (bulk version of GetSequenceId() without the sequence translator)
+    The prefix comparison (for shorter/longer matches) and the primer test are done in the query
+
+    input:
+    con,cur : database connection and cursor
+    sequences : list of str (ACGT sequences) or integers (greengenes ids)
+    idprimer : int (optional)
+        if supplied, return only sequences from this idPrimer
+    no_shorter : bool (optional)
+        False (default) to enable shorter db sequences matching sequence, True to require at least length of query sequence
+    no_longer : bool (optional)
+        False (default) to enable longer db sequences matching sequence, True to require at least length of database sequence
+
+    output:
+    errmsg : str
+        "" if ok, error msg if error encountered
+    sids : list of [list of int]
+        the ids of the matching sequences for each sequence (empty list if not found, too short or primer mismatch)
+    """
+    sids = [[] for cseq in sequences]
+    # the positions of each (lowercase) sequence in the list
+    seq_pos = defaultdict(list)
+    for idx, cseq in enumerate(sequences):
+        cseq = str(cseq)
+        # digits only - it is a greengenes id (rare, so no need for bulk)
+        if cseq.isdigit():
+            err, cids = GetSequenceIdFromGG(con, cur, int(cseq))
+            sids[idx] = cids
+            continue
+        if len(cseq) < SEED_SEQ_LEN:
+            debug(4, 'sequence too short (<%d) for sequence %s', SEED_SEQ_LEN, cseq)
+            continue
+        seq_pos[cseq.lower()].append(idx)
+    if len(seq_pos) == 0:
+        return '', sids
+    query_seqs = list(seq_pos.keys())
+    res = []
+    if no_shorter and no_longer:
+        # get the exact matches from the sequence index (if enabled), and query only the sequences not found in the index
+        found = seqindex.lookup_sequences(con, cur, query_seqs)
+        if found is not None:
+            res = [(cseq, cfound[0], cfound[1]) for cseq, cfound in zip(query_seqs, found) if cfound is not None]
+            query_seqs = [cseq for cseq, cfound in zip(query_seqs, found) if cfound is None]
+            debug(1, '%d sequences found in the sequence index', len(res))
+    else:
+        # the prefix index (if enabled) contains all the sequences, so no need to query the database
+        found = seqindex.lookup_prefix_sequences(con, cur, query_seqs, no_shorter=no_shorter, no_longer=no_longer, min_length=SEED_SEQ_LEN)
+        if found is not None:
+            res = [(cseq, cmatch[0], cmatch[1]) for cseq, cfound in zip(query_seqs, found) for cmatch in cfound]
+            query_seqs = []
+            debug(1, 'found %d prefix matches in the prefix index', len(res))
+    try:
+        if len(query_seqs) == 0:
+            pass
+        elif no_shorter and no_longer:
+            # exact match
+            if _test_digest_column(con, cur):
+                digest_seqs = {seqindex.sequence_digest(cseq): cseq for cseq in query_seqs}
+                cur.execute('SELECT seqdigest, id, idprimer FROM SequencesTable WHERE seqdigest = ANY(%s)', [[psycopg2.Binary(cdigest) for cdigest in digest_seqs]])
+                res.extend([(digest_seqs[bytes(cres[0])], cres[1], cres[2]) for cres in cur])
+            else:
+                cur.execute('SELECT sequence, id, idprimer FROM SequencesTable WHERE sequence = ANY(%s)', [query_seqs])
+                res.extend(cur.fetchall())
+        else:
+            # all the sequences sharing the seed, where the shorter of the two is a prefix of the other
+            conditions = ['left(SequencesTable.sequence, least(length(SequencesTable.sequence), length(q.seq))) = left(q.seq, least(length(SequencesTable.sequence), length(q.seq)))']
+            if no_shorter:
+                conditions.append('length(SequencesTable.sequence) >= length(q.seq)')
+            if no_longer:
+                conditions.append('length(SequencesTable.sequence) <= length(q.seq)')
+            cur.execute('SELECT q.seq, SequencesTable.id, SequencesTable.idprimer FROM unnest(%s::text[]) AS q(seq) '
+                        'JOIN SequencesTable ON SequencesTable.seedsequence = left(q.seq, %s) WHERE ' + ' AND '.join(conditions),
+                        [query_seqs, SEED_SEQ_LEN])
+            res.extend(cur.fetchall())
+    except psycopg2.DatabaseError as e:
+        debug(7, 'error %s encountered in _get_sequences_ids_batch', e)
+        return 'error %s encountered in _get_sequences_ids_batch' % e, []
+    found = defaultdict(set)
+    mismatch = set()
+    for cres in res:
+        cseq = cres[0]
+        if no_shorter and no_longer and cseq in found:
+            # like GetSequenceId(), use only one exact match
+            continue
+        if idprimer is not None and cres[2] != idprimer:
+            mismatch.add(cseq)
+            continue
+        found[cseq].add(cres[1])
+    for cseq, cids in found.items():
+        for idx in seq_pos[cseq]:
+            sids[idx] = list(cids)
+    debug(2, 'found ids for %d out of %d sequences (%d primer mismatches)', len(found), len(seq_pos), len(mismatch - set(found.keys())))
     return '', sids
 
 
-def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer=False, seq_translate_api=None, dbname=None):
+def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer=False, seq_translate_api=None, dbname=None, use_index=True):
     """
     Get sequence ids for a sequence
 
@@ -298,6 +532,9 @@ def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer
     dbname: str or None, optional
         if None, assume sequences are acgt sequences
         if str, assume sequences are database ids and this is the database name (i.e. 'FJ978486' for 'silva', etc.)
+    use_index: bool, optional
+        True (default) to look up the matches in the worker sequence indexes (if enabled, see seqindex.py) before querying the database.
+        False to always query the database (i.e. when adding sequences in the current transaction)
 
     output:
     errmsg : str
@@ -309,7 +546,7 @@ def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer
     """
     # check if the sequence is made only of digits assume it is a greengenes id
     if sequence.isdigit():
-        debug(1, 'getting id for ggid %s' % sequence)
+        debug(1, 'getting id for ggid %s', sequence)
         return GetSequenceIdFromGG(con, cur, int(sequence))
 
     sid = []
@@ -324,48 +561,63 @@ def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer
         # if looking for exact sequence, look up fast using exact match
         if no_shorter and no_longer:
             debug(2, 'noshortnolong')
-            err = dbannotations._prepare_queries(con, cur)
-            if err:
-                return err, []
-            # cur.execute('SELECT id, idprimer FROM SequencesTable WHERE sequence=%s LIMIT 1', [cseq])
-            cur.execute('EXECUTE get_sequence_id_exact(%s)', [cseq])
-            if cur.rowcount > 0:
-                res = cur.fetchone()
+            res = None
+            if use_index:
+                found = seqindex.lookup_sequences(con, cur, [cseq])
+                if found is not None and found[0] is not None:
+                    res = {'id': found[0][0], 'idprimer': found[0][1]}
+            if res is None:
+                if _test_digest_column(con, cur):
+                    cur.execute('SELECT id, idprimer FROM SequencesTable WHERE seqdigest=%s LIMIT 1', [psycopg2.Binary(seqindex.sequence_digest(cseq))])
+                else:
+                    err = db_access.prepare_statements(con, cur)
+                    if err:
+                        return err, []
+                    # cur.execute('SELECT id, idprimer FROM SequencesTable WHERE sequence=%s LIMIT 1', [cseq])
+                    cur.execute('EXECUTE get_sequence_id_exact(%s)', [cseq])
+                if cur.rowcount > 0:
+                    res = cur.fetchone()
+            if res is not None:
                 if idprimer is not None:
                     if res['idprimer'] != idprimer:
                         debug(8, 'Matching sequence %s but non-matching primer %d (query primer was %d)' % (sequence, res['idprimer'], idprimer))
                         return 'primer mismatch', []
                 sid = [res['id']]
         else:
-            # look for all sequences matching the seed
-            cseedseq = cseq[:SEED_SEQ_LEN]
-            # cur.execute('SELECT id,sequence FROM SequencesTable WHERE seedsequence=%s', [cseedseq])
-            cur.execute('EXECUTE get_sequence_id_seed(%s)', [cseedseq])
-            cseqlen = len(cseq)
-            res = cur.fetchall()
-            found_seq = False
-            for cres in res:
-                resid = cres[0]
-                resseq = cres[1]
-                if no_shorter:
-                    if len(resseq) < cseqlen:
-                        continue
-                    comparelen = cseqlen
-                else:
-                    comparelen = min(len(resseq), cseqlen)
-                if no_longer:
-                    if len(resseq) > cseqlen:
-                        continue
-                if cseq[:comparelen] == resseq[:comparelen]:
-                    found_seq = True
-                    if idprimer is None:
-                        sid.append(resid)
+            found = None
+            if use_index:
+                found = seqindex.lookup_prefix_sequences(con, cur, [cseq], no_shorter=no_shorter, no_longer=no_longer, min_length=SEED_SEQ_LEN)
+            if found is not None:
+                matches = found[0]
+            else:
+                # look for all sequences matching the seed
+                err = db_access.prepare_statements(con, cur)
+                if err:
+                    return err, []
+                cseedseq = cseq[:SEED_SEQ_LEN]
+                # cur.execute('SELECT id,sequence FROM SequencesTable WHERE seedsequence=%s', [cseedseq])
+                cur.execute('EXECUTE get_sequence_id_seed(%s)', [cseedseq])
+                cseqlen = len(cseq)
+                res = cur.fetchall()
+                matches = []
+                for cres in res:
+                    resid = cres[0]
+                    resseq = cres[1]
+                    if no_shorter:
+                        if len(resseq) < cseqlen:
+                            continue
+                        comparelen = cseqlen
                     else:
-                        cur.execute('EXECUTE get_sequence_primer(%s)', [resid])
-                        # cur.execute('SELECT idPrimer FROM SequencesTable WHERE id=%s LIMIT 1', [resid])
-                        res = cur.fetchone()
-                        if res[0] == idprimer:
-                            sid.append(resid)
+                        comparelen = min(len(resseq), cseqlen)
+                    if no_longer:
+                        if len(resseq) > cseqlen:
+                            continue
+                    if cseq[:comparelen] == resseq[:comparelen]:
+                        matches.append((resid, cres[2]))
+            found_seq = len(matches) > 0
+            for resid, resprimer in matches:
+                if idprimer is None or resprimer == idprimer:
+                    sid.append(resid)
             # if we found the sequence but not
             if found_seq and len(sid) == 0:
                 return 'primer mismatch', []
@@ -380,7 +632,7 @@ def GetSequenceId(con, cur, sequence, idprimer=None, no_shorter=False, no_longer
         if res.ok:
             trans_ids = res.json()['dbbact_ids'][0]
         else:
-            debug(5, 'got error from sequence translator: %s' % res.content)
+            debug(5, 'got error from sequence translator: %s', res.content)
             trans_ids = []
         sid.extend(trans_ids)
     else:
@@ -433,13 +685,13 @@ def get_taxonomy_seqids(con, cur, taxonomy, userid=None):
     '''
     taxonomy = taxonomy.lower()
     taxStr = taxonomy
-    debug(1, 'GetTaxonomyAnnotationIDS for taxonomy %s' % taxonomy)
+    debug(1, 'GetTaxonomyAnnotationIDS for taxonomy %s', taxonomy)
     cur.execute('SELECT id from SequencesTable where (taxrootrank ILIKE %s OR taxdomain ILIKE %s OR taxphylum ILIKE %s OR taxclass ILIKE %s OR taxfamily ILIKE %s OR taxgenus ILIKE %s OR taxorder ILIKE %s)', [taxStr, taxStr, taxStr, taxStr, taxStr, taxStr, taxStr])
     res = cur.fetchall()
     seqids = []
     for cres in res:
         seqids.append(cres[0])
-    debug(1, 'found %d matching sequences for the taxonomy' % len(seqids))
+    debug(1, 'found %d matching sequences for the taxonomy', len(seqids))
     return seqids
 
 
@@ -479,7 +731,7 @@ def GetTaxonomyAnnotationIDs(con, cur, taxonomy, userid=None):
         for cres in res:
             annotationids_dict[cres[0]] += 1
     # NOTE: need to add user validation for the ids!!!!!!
-    debug(1, 'found %d unique annotations for the taxonomy' % len(annotationids_dict))
+    debug(1, 'found %d unique annotations for the taxonomy', len(annotationids_dict))
     annotationids = []
     for k, v in annotationids_dict.items():
         annotationids.append((k, v))
@@ -507,8 +759,8 @@ def GetTaxonomyAnnotations(con, cur, taxonomy, userid=None):
     seqids : list of int
         list of the sequenceids which have this taxonomy
     '''
-    debug(1, 'GetTaxonomyAnnotations for taxonomy %s' % taxonomy)
-    dbannotations._prepare_queries(con, cur)
+    debug(1, 'GetTaxonomyAnnotations for taxonomy %s', taxonomy)
+    db_access.prepare_statements(con, cur)
     # get the annotation ids
     err, annotationids, seqids = GetTaxonomyAnnotationIDs(con, cur, taxonomy, userid)
     if err:
@@ -516,16 +768,13 @@ def GetTaxonomyAnnotations(con, cur, taxonomy, userid=None):
         debug(6, errmsg)
         return errmsg, None
     # and get the annotation details for each
-    annotations = []
-    for cres in annotationids:
-        cid = cres[0]
-        ccount = cres[1]
-        err, cdetails = dbannotations.GetAnnotationsFromID(con, cur, cid)
-        if err:
-            debug(6, err)
-            continue
-        annotations.append((cdetails, ccount))
-    debug(1, 'got %d details' % len(annotations))
+    counts = {cres[0]: cres[1] for cres in annotationids}
+    err, details = dbannotations.GetAnnotationsFromIDs(con, cur, [cres[0] for cres in annotationids])
+    if err:
+        debug(6, err)
+        return err, None
+    annotations = [(cdetails, counts[cdetails['annotationid']]) for cdetails in details]
+    debug(1, 'got %d details', len(annotations))
     return '', annotations, seqids
 
 
@@ -550,7 +799,7 @@ def GetHashAnnotationIDs(con, cur, hash_str, userid=None):
     '''
     hash_str = hash_str.lower()
     taxStr = hash_str
-    debug(1, 'GetHashAnnotationIDS for Hash %s' % hash_str)
+    debug(1, 'GetHashAnnotationIDS for Hash %s', hash_str)
     cur.execute('SELECT id,sequence from SequencesTable where (hashfull ILIKE %s or hash150 ILIKE %s or hash100 ILIKE %s)', [hash_str, hash_str, hash_str])
     res = cur.fetchall()
     seqids = []
@@ -558,7 +807,7 @@ def GetHashAnnotationIDs(con, cur, hash_str, userid=None):
     for cres in res:
         seqids.append(cres[0])
         seqnames.append(cres[1])
-    debug(1, 'found %d matching sequences for the Hash' % len(seqids))
+    debug(1, 'found %d matching sequences for the Hash', len(seqids))
     annotationids_dict = defaultdict(int)
     for cseq in seqids:
         cur.execute('SELECT annotationid from sequencesAnnotationTable where seqid=%s', [cseq])
@@ -566,7 +815,7 @@ def GetHashAnnotationIDs(con, cur, hash_str, userid=None):
         for cres in res:
             annotationids_dict[cres[0]] += 1
     # NOTE: need to add user validation for the ids!!!!!!
-    debug(1, 'found %d unique annotations for the Hash' % len(annotationids_dict))
+    debug(1, 'found %d unique annotations for the Hash', len(annotationids_dict))
     annotationids = []
     for k, v in annotationids_dict.items():
         annotationids.append((k, v))
@@ -719,7 +968,7 @@ def GetHashAnnotations(con, cur, hash_str, userid=None):
         list of the sequenceids which have this taxonomy
     seqnames : list of sequence strings
     '''
-    debug(1, 'GetHashAnnotations for hash %s' % hash_str)
+    debug(1, 'GetHashAnnotations for hash %s', hash_str)
     # get the annotation ids
     err, annotationids, seqids, seqnames = GetHashAnnotationIDs(con, cur, hash_str, userid)
     if err:
@@ -727,16 +976,13 @@ def GetHashAnnotations(con, cur, hash_str, userid=None):
         debug(6, errmsg)
         return errmsg, None
     # and get the annotation details for each
-    annotations = []
-    for cres in annotationids:
-        cid = cres[0]
-        ccount = cres[1]
-        err, cdetails = dbannotations.GetAnnotationsFromID(con, cur, cid)
-        if err:
-            debug(6, err)
-            continue
-        annotations.append((cdetails, ccount))
-    debug(1, 'got %d details' % len(annotations))
+    counts = {cres[0]: cres[1] for cres in annotationids}
+    err, details = dbannotations.GetAnnotationsFromIDs(con, cur, [cres[0] for cres in annotationids])
+    if err:
+        debug(6, err)
+        return err, None
+    annotations = [(cdetails, counts[cdetails['annotationid']]) for cdetails in details]
+    debug(1, 'got %d details', len(annotations))
     return '', annotations, seqids, seqnames
 
 
@@ -985,18 +1231,45 @@ def GetSequenceTaxonomy(con, cur, sequence, region=None, userid=0):
         The taxonomy string (of format d__XXX;p__YYYY;...)
     """
 
-    debug(1, 'GetSequenceTaxonomy sequence %s' % sequence)
+    debug(1, 'GetSequenceTaxonomy sequence %s', sequence)
 
     cseq = sequence.lower()
-    cur.execute("SELECT coalesce(taxdomain,''),coalesce(taxphylum,''),  coalesce(taxclass,''),coalesce(taxorder,''),coalesce(taxfamily,''), coalesce(taxgenus,'') as taxonomy_str FROM SequencesTable WHERE sequence=%s", [cseq])
+    tax_query = "SELECT coalesce(taxdomain,''),coalesce(taxphylum,''),  coalesce(taxclass,''),coalesce(taxorder,''),coalesce(taxfamily,''), coalesce(taxgenus,'') as taxonomy_str FROM SequencesTable WHERE "
+    if _test_digest_column(con, cur):
+        cur.execute(tax_query + 'seqdigest=%s', [psycopg2.Binary(seqindex.sequence_digest(cseq))])
+    else:
+        cur.execute(tax_query + 'sequence=%s', [cseq])
 
     if cur.rowcount == 0:
-        debug(1, 'taxonomy not found for sequence %s' % cseq)
+        debug(1, 'taxonomy not found for sequence %s', cseq)
         # ctaxinfo = {'taxonomy': 'NA'}
         # return '', ctaxinfo
         return '', 'NA'
 
     res = cur.fetchone()
+    taxStr = _taxonomy_str(res)
+
+    # ctaxinfo = {'taxonomy': taxStr}
+    # return '', ctaxinfo
+    return '', taxStr
+
+
+# the taxonomy fields of SequencesTable (in the order used by _taxonomy_str())
+_TAXONOMY_FIELDS = "coalesce(taxdomain,''), coalesce(taxphylum,''), coalesce(taxclass,''), coalesce(taxorder,''), coalesce(taxfamily,''), coalesce(taxgenus,'')"
+
+
+def _taxonomy_str(res):
+    '''Create the taxonomy string (d__XXX;p__YYYY;...) from the taxdomain, taxphylum, taxclass, taxorder, taxfamily, taxgenus values
+
+    Parameters
+    ----------
+    res: list of str
+        the taxonomy values ('' for missing levels)
+
+    Returns
+    -------
+    str
+    '''
     firstTax = True
     taxStr = ''
     list_of_pre_str = ["d__", "p__", "c__", "o__", "f__", "g__"]
@@ -1006,10 +1279,117 @@ def GetSequenceTaxonomy(con, cur, sequence, region=None, userid=0):
                 taxStr += ';'
             taxStr += val + res[idx]
             firstTax = False
+    return taxStr
+
+
+def GetSequencesTaxonomy(con, cur, sequences, seqids=None):
+    """
+    Get the taxonomy str for a list of sequences (bulk version of GetSequenceTaxonomy())
+
+    Parameters
+    ----------
+    con,cur :
+    sequences : list of str ('ACGT')
+        the sequences to get the taxonomy for (exact match)
+    seqids : list of list of int or None, optional
+        the ids already resolved for each sequence (i.e. from GetSequencesIds()). the exact sequence is first looked for in these ids
+
+    Returns
+    -------
+    err : str
+        The error encountered or '' if ok
+    taxonomy: list of str
+        The taxonomy string (of format d__XXX;p__YYYY;...) for each sequence ('NA' if sequence not found)
+    """
+    debug(1, 'GetSequencesTaxonomy for %d sequences', len(sequences))
+    cseqs = [cseq.lower() for cseq in sequences]
+    tax_query = 'SELECT sequence, ' + _TAXONOMY_FIELDS + ' FROM SequencesTable WHERE '
+    found = {}
+    try:
+        if seqids is not None:
+            all_ids = set()
+            for cids in seqids:
+                all_ids.update(cids)
+            if len(all_ids) > 0:
+                cur.execute(tax_query + 'id = ANY(%s)', [list(all_ids)])
+                for cres in cur:
+                    if cres[0] not in found:
+                        found[cres[0]] = _taxonomy_str(cres[1:])
+        missing = list(set([cseq for cseq in cseqs if cseq not in found]))
+        if len(missing) > 0:
+            if _test_digest_column(con, cur):
+                cur.execute(tax_query + 'seqdigest = ANY(%s)', [[psycopg2.Binary(seqindex.sequence_digest(cseq)) for cseq in missing]])
+            else:
+                cur.execute(tax_query + 'sequence = ANY(%s)', [missing])
+            for cres in cur:
+                if cres[0] not in found:
+                    found[cres[0]] = _taxonomy_str(cres[1:])
+    except psycopg2.DatabaseError as e:
+        msg = 'error %s encountered in GetSequencesTaxonomy' % e
+        debug(7, msg)
+        return msg, []
+    return '', [found.get(cseq, 'NA') for cseq in cseqs]
 
-    # ctaxinfo = {'taxonomy': taxStr}
-    # return '', ctaxinfo
-    return '', taxStr
+
+def GetSequencesIdsFromHashes(con, cur, hashes, idprimer=None):
+    """
+    Get the sequence ids for a list of sequence hashes (exact match)
+    The hash is the md5 hex string of the upper case sequence (same as the hashfull field in SequencesTable, i.e. hashlib.md5(sequence.upper().encode()).hexdigest())
+    so clients can send 32 characters per sequence instead of the full sequence
+
+    Parameters
+    ----------
+    con,cur :
+    hashes : list of str
+        the sequence hashes to get the ids for
+    idprimer : int (optional)
+        if supplied, verify the sequence is from this idPrimer
+
+    Returns
+    -------
+    errmsg : str
+        "" if ok, error msg if error encountered
+    sids : list of [list of int]
+        the id of the sequence matching each hash (empty list if not found or not a valid hash)
+    """
+    debug(1, 'GetSequencesIdsFromHashes for %d hashes', len(hashes))
+    sids = [[] for chash in hashes]
+    hash_pos = defaultdict(list)
+    for idx, chash in enumerate(hashes):
+        cdigest = hash_to_digest(chash)
+        if cdigest is None:
+            debug(2, 'bad sequence hash %s', chash)
+            continue
+        hash_pos[cdigest].append(idx)
+    digests = list(hash_pos.keys())
+    res = []
+    # get the sequences found in the sequence index (if enabled), and query only the rest
+    found = seqindex.lookup_sequence_digests(con, cur, digests)
+    if found is not None:
+        res = [(cdigest, cfound[0], cfound[1]) for cdigest, cfound in zip(digests, found) if cfound is not None]
+        digests = [cdigest for cdigest, cfound in zip(digests, found) if cfound is None]
+    try:
+        if len(digests) == 0:
+            pass
+        elif _test_digest_column(con, cur):
+            cur.execute('SELECT seqdigest, id, idprimer FROM SequencesTable WHERE seqdigest = ANY(%s)', [[psycopg2.Binary(cdigest) for cdigest in digests]])
+            res.extend([(bytes(cres[0]), cres[1], cres[2]) for cres in cur])
+        else:
+            cur.execute('SELECT hashfull, id, idprimer FROM SequencesTable WHERE hashfull = ANY(%s)', [[cdigest.hex() for cdigest in digests]])
+            res.extend([(bytes.fromhex(cres[0]), cres[1], cres[2]) for cres in cur])
+    except psycopg2.DatabaseError as e:
+        debug(7, 'error %s encountered in GetSequencesIdsFromHashes', e)
+        return 'error %s encountered in GetSequencesIdsFromHashes' % e, []
+    num_found = 0
+    for cdigest, cid, cprimer in res:
+        if idprimer is not None and cprimer != idprimer:
+            continue
+        for idx in hash_pos[cdigest]:
+            if len(sids[idx]) == 0:
+                sids[idx] = [cid]
+                num_found += 1
+    debug(2, 'found ids for %d out of %d hashes', num_found, len(hashes))
+    return '', sids
 
 
 def get_sequences_primer(con, cur, sequences):
@@ -1031,10 +1411,10 @@ def get_sequences_primer(con, cur, sequences):
     primername: str
         name of the region (i.e. 'v4' etc.)
     '''
-    debug(1, 'get_sequences_primer for %d sequences' % len(sequences))
+    debug(1, 'get_sequences_primer for %d sequences', len(sequences))
 
     # prepare queries for faster running
-    err = dbannotations._prepare_queries(con, cur)
+    err = db_access.prepare_statements(con, cur)
 
     primerid = None
     for cseq in sequences:
@@ -1110,7 +1490,7 @@ def get_species_seqs(con, cur, species, seq_translate_api):
     seqs: list of str
         the matching sequences
     '''
-    debug(2, 'get_species_seqs for %s' % species)
+    debug(2, 'get_species_seqs for %s', species)
     res = requests.post(seq_translate_api + '/get_species_seqs', json={'species': species})
     if not res.ok:
         msg = 'failed to get matching sequence translator sequences. error: %s' % res.content
@@ -1118,7 +1498,7 @@ def get_species_seqs(con, cur, species, seq_translate_api):
         return msg, [], []
 
     ids = res.json()['ids']
-    debug(2, 'found %d seqs' % len(ids))
+    debug(2, 'found %d seqs', len(ids))
     return '', ids, ids
 
 
@@ -1136,7 +1516,7 @@ def get_close_sequences(con, cur, sequence, max_mismatches=1, test_left_trim=Tru
     max_mismatches: int, optional
         the maximum number of mismatches allowed
     test_left_trim: bool, optional
-        if True, also return results of dbBact sequences for which the query sequence is a left trimmed version.
+        if True, also return results of dbBact sequences for which the query sequence is a left trimmed version (trimmed by up to seqindex.MAX_LEFT_TRIM bases).
         This is relevant for sequences that were left trimmed prior to query (i.e. like what people do in dada2)
     
     Returns
@@ -1145,24 +1525,89 @@ def get_close_sequences(con, cur, sequence, max_mismatches=1, test_left_trim=Tru
         the error encountered or empty string '' if ok
     similar_seqs: list of dict {'sequence': str, 'seq_id': int, 'num_mismatches': int}
     '''
-    debug(2, 'get_close_sequences for sequence %s' % sequence)
+    debug(2, 'get_close_sequences for sequence %s', sequence)
+    err, similar_seqs = get_close_sequences_list(con, cur, [sequence], max_mismatches=max_mismatches, test_left_trim=test_left_trim)
+    if err:
+        return err, []
+    return '', similar_seqs[0]
+
+
+def get_close_sequences_list(con, cur, sequences, max_mismatches=1, test_left_trim=True, best_only=False):
+    '''Get the sequences in dbbact that are close to each of the given sequences (see get_close_sequences())
+    Uses the close sequences index (if enabled, see seqindex.CloseSequencesIndex), and the database (pg_trgm similarity) for the sequences not searchable in the index
+
+    Parameters
+    ----------
+    con, cur
+    sequences: list of str ('ACGT')
+        the sequences to search for close enough matches.
+        at most MAX_CLOSE_DB_QUERIES sequences not searchable in the close sequences index (all the sequences if the index is not enabled)
+    max_mismatches: int, optional
+        the maximum number of mismatches allowed
+    test_left_trim: bool, optional
+        if True, also return results of dbBact sequences for which the query sequence is a left trimmed version (trimmed by up to seqindex.MAX_LEFT_TRIM bases).
+    best_only: bool, optional
+        if True, return only the closest dbBact sequence for each query (the lowest num_mismatches, and then the lowest seq_id)
+
+    Returns
+    -------
+    err: str
+        the error encountered or empty string '' if ok
+    similar_seqs: list of (list of dict {'sequence': str, 'seq_id': int, 'num_mismatches': int})
+        the close sequences for each query sequence (in the order of sequences)
+    '''
     if max_mismatches > 5:
         return 'max_mismatches must be <= 5', []
+    if max_mismatches < 0:
+        return 'max_mismatches must be >= 0', []
+    start_time = time.time()
+    sequences = [cseq.lower() for cseq in sequences]
+    similar_seqs = seqindex.lookup_close_sequences(con, cur, sequences, max_mismatches=max_mismatches, test_left_trim=test_left_trim)
+    if similar_seqs is None:
+        similar_seqs = [None] * len(sequences)
+    index_time = time.time() - start_time
+    num_db_queries = len([cres for cres in similar_seqs if cres is None])
+    if num_db_queries > MAX_CLOSE_DB_QUERIES:
+        err = 'too many sequences (%d) to search without the close sequences index. maximum is %d' % (num_db_queries, MAX_CLOSE_DB_QUERIES)
+        debug(4, err)
+        return err, []
+    num_db = 0
+    try:
+        for idx, cseq in enumerate(sequences):
+            if similar_seqs[idx] is not None:
+                continue
+            num_db += 1
+            similar_seqs[idx] = _get_close_sequences_db(con, cur, cseq, max_mismatches, test_left_trim)
+    except psycopg2.DatabaseError as e:
+        err = 'error %s encountered in get_close_sequences' % e
+        debug(7, err)
+        return err, []
+    if best_only:
+        similar_seqs = [cseqs[:1] for cseqs in similar_seqs]
+    debug(2, 'get_close_sequences for %d sequences (%d from the database) took %f sec (index %f sec)', len(sequences), num_db, time.time() - start_time, index_time)
+    return '', similar_seqs
 
-    sequence = sequence.lower()
 
+def _get_close_sequences_db(con, cur, sequence, max_mismatches, test_left_trim):
+    '''Get the close sequences to a (lowercase) sequence using the pg_trgm similarity of the sequences (see get_close_sequences())
+
+    Returns
+    -------
+    similar_seqs: list of dict {'sequence': str, 'seq_id': int, 'num_mismatches': int}
+    '''
     # set the similarity threshold for the results
-    sim_thresh = 1 - max_mismatches / len(sequence)
-    sim_thresh = 0.92
-    debug(2, 'sim_thresh: %f' % sim_thresh)
+    # each mismatch changes up to 3 trigrams, so with n trigrams the similarity (common / all trigrams) is >= (n - 3k) / (n + 3k)
+    num_trigrams = max(len(sequence) - 2, 1)
+    sim_thresh = min(0.92, max(0, (num_trigrams - 3 * max_mismatches) / (num_trigrams + 3 * max_mismatches)))
+    debug(2, 'sim_thresh: %f', sim_thresh)
 
     cur.execute('SET pg_trgm.similarity_threshold = %s', [sim_thresh])
     cur.execute('SELECT id, sequence FROM SequencesTable WHERE sequence %% %s', [sequence])
     res = cur.fetchall()
     if len(res) == 0:
         debug(2, 'no sequences found')
-        return '', []
-    debug(2, 'found %d sequences with similarity < %f' % (len(res), sim_thresh))
+        return []
+    debug(2, 'found %d sequences with similarity < %f', len(res), sim_thresh)
     similar_seqs = []
     for cres in res:
         cseq = cres['sequence']
@@ -1174,17 +1619,20 @@ def get_close_sequences(con, cur, sequence, max_mismatches=1, test_left_trim=Tru
         if mismatches > max_mismatches:
             # test also if it is a substring of the sequence (i.e. left trimmed)
             if test_left_trim:
-                debug(1, 'sequence %s has %d mismatches. testing for left trim subsequence')
-                if sequence not in cseq:
-                    debug(1, 'sequence %s is not substring of %s' % (sequence, cseq))
+                debug(1, 'sequence %s has %d mismatches. testing for left trim subsequence', cseq, mismatches)
+                # same as the close sequences index (seqindex.CloseSequencesIndex), only up to MAX_LEFT_TRIM bases are trimmed
+                pos = cseq.find(sequence)
+                if pos < 0 or pos > seqindex.MAX_LEFT_TRIM:
+                    debug(1, 'sequence %s is not substring of %s (up to position %d)', sequence, cseq, seqindex.MAX_LEFT_TRIM)
                     continue
                 else:
-                    debug(1, 'found subsequence %s is substring of %s' % (sequence, cseq))
+                    debug(1, 'found subsequence %s is substring of %s', sequence, cseq)
                     # set mismatches to the position where sequence appears in cseq
-                    mismatches = cseq.index(sequence)
+                    mismatches = pos
             else:
-                debug(1, 'sequence %s has %d mismatches. skipping' % (cseq, mismatches))
+                debug(1, 'sequence %s has %d mismatches. skipping', cseq, mismatches)
                 continue
         similar_seqs.append({'sequence': cseq, 'seq_id': cres['id'], 'num_mismatches': mismatches})
-    debug(2, 'out of which %d are close up to %d mismatches' % (len(similar_seqs), max_mismatches))
-    return '', similar_seqs
+    similar_seqs.sort(key=lambda x: (x['num_mismatches'], x['seq_id']))
+    debug(2, 'out of which %d are close up to %d mismatches', len(similar_seqs), max_mismatches)
+    return similar_seqs
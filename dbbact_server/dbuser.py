@@ -1,8 +1,27 @@
+import os
+import time
+import hmac
+import hashlib
+
 import psycopg2
 from .utils import debug
+from . import db_access
 
 maxfailedattempt = 3
 
+# the notification channel used to remove a user from the verified logins cache of all the workers (payload is 'id:<userid>' or 'user:<username>')
+USER_LOGIN_CHANNEL = 'dbbact_user_login'
+# cache of verified logins (per worker) so we don't need to run the (slow) crypt() for each request
+# (username, password digest) -> (userid, isadmin, expiration time)
+# used only if we get the invalidation notifications from the other workers (i.e. on password change)
+_login_cache = {}
+# time (seconds) to keep a verified login in the cache
+login_cache_ttl = 300
+# maximal number of logins in the cache
+login_cache_max_size = 10000
+# the key used to digest the passwords in the cache (so the plain passwords are not kept in memory)
+_login_cache_key = os.urandom(16)
+
 
 def user_name_from_email(con, cur, email):
     '''Get the user name from the email address
@@ -95,6 +114,99 @@ def getUserId(con, cur, user, password):
     return "", userId
 
 
+def _login_cache_notification(payload):
+    '''Called by db_access.poll_notifications() for each notification on the USER_LOGIN_CHANNEL (or with None if notifications were lost)'''
+    if payload is None or payload == '':
+        _login_cache.clear()
+        return
+    ctype, _, cval = payload.partition(':')
+    if ctype == 'id':
+        _remove_cached_logins(userid=int(cval))
+    else:
+        _remove_cached_logins(user=cval)
+
+
+db_access.listen(USER_LOGIN_CHANNEL, _login_cache_notification)
+
+
+def _password_digest(password):
+    if password is None:
+        password = ''
+    return hmac.new(_login_cache_key, password.encode('utf8'), hashlib.sha256).digest()
+
+
+def get_user_login(con, cur, user, password):
+    """
+    Get the user id and admin status after authentication, using the verified logins cache if possible
+
+    input:
+    con,cur : database connection and cursor
+    user : user name
+    pasword: user password
+
+    output:
+    errmsg : str
+        "" if ok, error msg if error encountered
+    id : int
+        user id  >= 0 if the user exist and the password is correct, otherwise the getUserId() error code
+    isadmin : int
+        1 if the user is admin, 0 if not
+    """
+    # without the notifications we would not know about password changes in the other workers
+    use_cache = db_access.is_listening()
+    if not use_cache:
+        _login_cache.clear()
+    key = (user, _password_digest(password))
+    cached = _login_cache.get(key)
+    if cached is not None:
+        if cached[2] > time.time():
+            debug(1, 'user %s found in login cache' % user)
+            return '', cached[0], cached[1]
+        del _login_cache[key]
+    err, userid = getUserId(con, cur, user, password)
+    if userid < 0:
+        return err, userid, 0
+    err, isadmin = isAdmin(con, cur, user)
+    if isadmin != 1:
+        isadmin = 0
+    if not use_cache:
+        return '', userid, isadmin
+    if len(_login_cache) >= login_cache_max_size:
+        # remove the expired logins, and if still full, start over
+        now = time.time()
+        for ckey in [ckey for ckey, cval in _login_cache.items() if cval[2] <= now]:
+            del _login_cache[ckey]
+        if len(_login_cache) >= login_cache_max_size:
+            _login_cache.clear()
+    _login_cache[key] = (userid, isadmin, time.time() + login_cache_ttl)
+    return '', userid, isadmin
+
+
+def invalidate_user_login(cur, user=None, userid=None):
+    """
+    Remove a user from the verified logins cache of all the workers (i.e. when the password is changed).
+    Should be called before the commit (the other workers are notified when the transaction is committed)
+
+    input:
+    cur : database cursor
+    user : str or None
+        the user name to remove
+    userid : int or None
+        the user id to remove
+    """
+    _remove_cached_logins(user=user, userid=userid)
+    if userid is not None:
+        db_access.notify(cur, USER_LOGIN_CHANNEL, 'id:%d' % userid)
+    if user is not None:
+        db_access.notify(cur, USER_LOGIN_CHANNEL, 'user:%s' % user)
+
+
+def _remove_cached_logins(user=None, userid=None):
+    '''Remove the logins of the user (by name or id) from the verified logins cache of this worker'''
+    for ckey in [ckey for ckey, cval in _login_cache.items() if ckey[0] == user or cval[0] == userid]:
+        del _login_cache[ckey]
+
+
 def getUserIdRecover(con, cur, user, recoverycode):
     """
     Get the user id using recover code
@@ -126,7 +238,7 @@ def getUserIdRecover(con, cur, user, recoverycode):
             tempUserId = row[0]
 
             # user exist and not locked , try to log in
-            debug(3, 'SELECT id FROM UsersPrivateTable WHERE (username=%s and tempcodehash = crypt(%s, tempcodehash))' % (user, recoverycode))
+            debug(3, 'checking recovery code for user %s' % user)
             cur.execute('SELECT id FROM UsersPrivateTable WHERE (username=%s and tempcodehash = crypt(%s, tempcodehash))', [user, recoverycode])
             if cur.rowcount == 0:
                 # increase the failure attempt counter
@@ -226,6 +338,9 @@ def setUserLoginAttempts(con, cur, usrid, val):
     """
     debug(3, 'update UsersPrivateTable set attemptscounter=%s WHERE id=%s' % (val, usrid))
     cur.execute('update UsersPrivateTable set attemptscounter=%s WHERE id=%s', [val, usrid])
+    if val >= maxfailedattempt:
+        # user is locked, so cached logins are not valid anymore
+        invalidate_user_login(cur, userid=usrid)
     con.commit()
 
 
@@ -242,6 +357,9 @@ def setUserLoginAttemptsByName(con, cur, username, val):
     """
     debug(3, 'update UsersPrivateTable set attemptscounter=%s WHERE username=%s' % (val, username))
     cur.execute('update UsersPrivateTable set attemptscounter=%s WHERE username=%s', [val, username])
+    if val >= maxfailedattempt:
+        # user is locked, so cached logins are not valid anymore
+        invalidate_user_login(cur, user=username)
     con.commit()
 
 
@@ -379,7 +497,7 @@ def addUser(con, cur, user, pwd, name, description, mail, publish):
         cur.execute("SELECT id FROM UsersTable WHERE username=%s", [user])
         cid = cur.fetchone()[0]
         # add private data to UsersPrivateTalbe
-        debug(3, "insert into UsersPrivateTable (username, passwordhash,name,description,isactive,shareemail,email,attemptscounter) values (%s, crypt(%s, gen_salt('bf')), %s, %s , %s, %s, %s, %s)" % (user, pwd, name, description, isactive, publish, mail, attemptscounter))
+        debug(3, 'adding user %s (id %s) to UsersPrivateTable', user, cid)
         cur.execute("insert into UsersPrivateTable (id, username, passwordhash,name,description,isactive,shareemail,email,attemptscounter) values (%s, %s, crypt(%s, gen_salt('bf')), %s, %s , %s, %s, %s, %s)", [cid, user, pwd, name, description, isactive, publish, mail, attemptscounter])
         con.commit()
         return "", 1
@@ -420,8 +538,9 @@ def updateNewPassword(con, cur, user, newpwd):
 
     # default values
     try:
-        debug(3, "update UsersPrivateTable set passwordhash = crypt(%s, gen_salt('bf')) where username=%s" % (newpwd, user))
+        debug(3, 'updating password for user %s', user)
         cur.execute("update UsersPrivateTable set passwordhash = crypt(%s, gen_salt('bf')) where username=%s", [newpwd, user])
+        invalidate_user_login(cur, user=user)
         con.commit()
         return "", 1
     except psycopg2.DatabaseError as e:
@@ -461,7 +580,7 @@ def updateNewTempcode(con, cur, user, tempcode):
 
     # default values
     try:
-        debug(3, "update UsersPrivateTable set tempcodehash = crypt(%s, gen_salt('bf')) where username=%s" % (tempcode, user))
+        debug(3, 'updating tempcode for user %s' % user)
         cur.execute("update UsersPrivateTable set tempcodehash = crypt(%s, gen_salt('bf')) where username=%s", [tempcode, user])
         debug(3, 'update password completed')
         con.commit()
@@ -0,0 +1,323 @@
+'''The ontology transitive closure table (OntologyClosureTable, created by database/ontology_closure.psql)
+
+Holds a row (termid, ancestorid, depth, ontologynameid) for each term and each of its ancestors in OntologyTreeStructureTable:
+ontologynameid is the ontology if the ancestor is reached through edges of this ontology only (one row for each such ontology),
+or NULL if the ancestor is reached only through paths mixing ontologies. depth is the length of the shortest such path.
+So all the ancestors/descendants of a term are one indexed query.
+
+The table is filled by dbbact_jobs/update_ontology_closure.py (using build_closure() with numpy),
+and updated by update_closure() when the parents of terms change (i.e. in AddTreeTerm()).
+'''
+
+import time
+from collections import defaultdict, deque
+
+import psycopg2
+
+from .utils import debug
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# the minimal time (seconds) between tests if the OntologyClosureTable exists, when it was not found (or was empty)
+RETEST_INTERVAL = 60
+
+# True if the OntologyClosureTable exists and is filled (only a positive result is kept)
+_has_closure_table = False
+# the time of the last test
+_last_test = 0
+
+
+def _test_closure_table(con, cur, force=False):
+    '''Test if the OntologyClosureTable exists in the database and was filled (by update_ontology_closure.py)
+    Once found, it is not tested again. If not found, it is tested again after RETEST_INTERVAL seconds (or if force is True)
+
+    Returns
+    -------
+    err: str
+        empty ('') if ok, otherwise the error encountered (the transaction is rolled back)
+    exists: bool
+    '''
+    global _has_closure_table, _last_test
+
+    if _has_closure_table:
+        return '', True
+    if not force and time.time() - _last_test < RETEST_INTERVAL:
+        return '', False
+    _last_test = time.time()
+    try:
+        cur.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'ontologyclosuretable'")
+        exists = cur.fetchone()[0] > 0
+        if exists:
+            cur.execute('SELECT 1 FROM OntologyClosureTable LIMIT 1')
+            exists = cur.rowcount > 0
+    except psycopg2.DatabaseError as e:
+        err = 'error %s encountered when testing the OntologyClosureTable' % e
+        debug(7, err)
+        con.rollback()
+        return err, False
+    if not exists:
+        debug(5, 'OntologyClosureTable not found or empty. Please run database/ontology_closure.psql and dbbact_jobs/update_ontology_closure.py')
+    _has_closure_table = exists
+    return '', exists
+
+
+def _bfs_depths(edges, term_id, ontology_id=None):
+    '''Get the depth of each ancestor of the term (following only edges of ontology_id if not None)
+
+    Parameters
+    ----------
+    edges: dict of {term id: list of (parent id, ontologynameid)}
+    term_id: int
+    ontology_id: int or None
+
+    Returns
+    -------
+    dict of {ancestor id: depth}
+    '''
+    depths = {}
+    queue = deque([(term_id, 0)])
+    visited = set([term_id])
+    while len(queue) > 0:
+        cid, cdepth = queue.popleft()
+        for cparent, conto in edges.get(cid, []):
+            if ontology_id is not None and conto != ontology_id:
+                continue
+            if cparent in visited:
+                continue
+            visited.add(cparent)
+            depths[cparent] = cdepth + 1
+            queue.append((cparent, cdepth + 1))
+    return depths
+
+
+def closure_rows(edges, term_ids):
+    '''Get the closure rows of the terms
+
+    Parameters
+    ----------
+    edges: dict of {term id: list of (parent id, ontologynameid)}
+        the parent edges of the terms and all their ancestors
+    term_ids: iterable of int
+        the terms to get the rows for
+
+    Returns
+    -------
+    list of (int, int, int, int or None)
+        the (termid, ancestorid, depth, ontologynameid) rows
+    '''
+    rows = []
+    for cid in term_ids:
+        pure_ancestors = set()
+        for contology in set(conto for cparent, conto in edges.get(cid, []) if conto is not None):
+            for cancestor, cdepth in _bfs_depths(edges, cid, contology).items():
+                rows.append((cid, cancestor, cdepth, contology))
+                pure_ancestors.add(cancestor)
+        for cancestor, cdepth in _bfs_depths(edges, cid).items():
+            if cancestor not in pure_ancestors:
+                rows.append((cid, cancestor, cdepth, None))
+    return rows
+
+
+def update_closure(con, cur, term_ids):
+    '''Update the closure rows of terms whose parents changed (and of all their descendants). Does not commit.
+
+    Parameters
+    ----------
+    con, cur
+    term_ids: list of int
+        the terms with added/removed parent edges
+
+    Returns
+    -------
+    err: str
+        empty ('') if ok (or if the OntologyClosureTable does not exist), otherwise the error encountered
+    '''
+    # always test if the table was created/filled since the last test, so we do not miss updates the other processes read
+    err, exists = _test_closure_table(con, cur, force=True)
+    if err or not exists:
+        return err
+    try:
+        # the descendants of the terms are not changed by changing the terms parents, so we can get them from the table
+        cur.execute('SELECT DISTINCT termid FROM OntologyClosureTable WHERE ancestorid = ANY(%s)', [list(term_ids)])
+        affected = set(term_ids).union(cres[0] for cres in cur)
+        # all the edges above the affected terms
+        cur.execute('WITH RECURSIVE anc(id) AS (SELECT unnest(%s::integer[]) UNION SELECT t.ontologyParentId FROM OntologyTreeStructureTable t JOIN anc ON t.ontologyId = anc.id) '
+                    'SELECT t.ontologyId, t.ontologyParentId, t.ontologyNameId FROM OntologyTreeStructureTable t JOIN anc ON t.ontologyId = anc.id',
+                    [list(affected)])
+        edges = defaultdict(list)
+        for cres in cur:
+            edges[cres[0]].append((cres[1], cres[2]))
+        rows = closure_rows(edges, affected)
+        cur.execute('DELETE FROM OntologyClosureTable WHERE termid = ANY(%s)', [list(affected)])
+        if len(rows) > 0:
+            cur.execute('INSERT INTO OntologyClosureTable (termid, ancestorid, depth, ontologynameid) '
+                        'SELECT unnest(%s::integer[]), unnest(%s::integer[]), unnest(%s::integer[]), unnest(%s::integer[])',
+                        [list(x) for x in zip(*rows)])
+        debug(2, 'updated %d closure rows for %d terms', len(rows), len(affected))
+        return ''
+    except psycopg2.DatabaseError as e:
+        err = 'error %s encountered in update_closure' % e
+        debug(7, err)
+        return err
+
+
+def get_ancestors(con, cur, term_ids, ontology_id=None):
+    '''Get all the ancestors of the terms using the OntologyClosureTable
+
+    Parameters
+    ----------
+    con, cur
+    term_ids: list of int
+        the terms to get the ancestors for
+    ontology_id: int or None, optional
+        if not None, get only the ancestors reached through edges of this ontology (OntologyNamesTable id)
+
+    Returns
+    -------
+    err: str
+        empty ('') if ok, otherwise the error encountered
+    ancestors: set of int or None
+        the ancestor term ids (including term_ids). None if the OntologyClosureTable does not exist
+    '''
+    return _get_related(con, cur, term_ids, 'ancestorid', 'termid', ontology_id)
+
+
+def get_descendants(con, cur, term_ids, ontology_id=None):
+    '''Get all the descendants of the terms using the OntologyClosureTable
+
+    Parameters
+    ----------
+    con, cur
+    term_ids: list of int
+        the terms to get the descendants for
+    ontology_id: int or None, optional
+        if not None, get only the descendants reached through edges of this ontology (OntologyNamesTable id)
+
+    Returns
+    -------
+    err: str
+        empty ('') if ok, otherwise the error encountered
+    descendants: set of int or None
+        the descendant term ids (including term_ids). None if the OntologyClosureTable does not exist
+    '''
+    return _get_related(con, cur, term_ids, 'termid', 'ancestorid', ontology_id)
+
+
+def _get_related(con, cur, term_ids, get_field, by_field, ontology_id):
+    err, exists = _test_closure_table(con, cur)
+    if err:
+        return err, None
+    if not exists:
+        return '', None
+    try:
+        if ontology_id is None:
+            cur.execute('SELECT DISTINCT %s FROM OntologyClosureTable WHERE %s = ANY(%%s)' % (get_field, by_field), [list(term_ids)])
+        else:
+            cur.execute('SELECT DISTINCT %s FROM OntologyClosureTable WHERE %s = ANY(%%s) AND ontologynameid = %%s' % (get_field, by_field), [list(term_ids), ontology_id])
+        related = set(term_ids).union(cres[0] for cres in cur)
+    except psycopg2.DatabaseError as e:
+        err = 'error %s encountered when getting the term closure' % e
+        debug(7, err)
+        return err, None
+    debug(2, 'found %d related terms for %d terms in the closure table', len(related), len(term_ids))
+    return '', related
+
+
+def _closure_keys(children, parents, num_terms):
+    '''Get the transitive closure of the edges (numpy arrays) by expanding all the paths one level at a time
+
+    Parameters
+    ----------
+    children, parents: numpy array of int64
+        the child and parent term id of each edge
+    num_terms: int
+        max term id + 1
+
+    Returns
+    -------
+    keys: numpy array of int64
+        the (term id * num_terms + ancestor id) of each closure row, sorted
+    depths: numpy array of int64
+        the depth (shortest path length) of each row
+    '''
+    order = np.argsort(children, kind='stable')
+    sorted_parents = parents[order]
+    offsets = np.searchsorted(children[order], np.arange(num_terms + 1))
+    seen = np.unique(children * num_terms + parents)
+    seen = seen[seen // num_terms != seen % num_terms]
+    frontier = seen
+    all_keys = [seen]
+    all_depths = [np.ones(len(seen), dtype=np.int64)]
+    depth = 1
+    while len(frontier) > 0:
+        depth += 1
+        terms = frontier // num_terms
+        ancestors = frontier % num_terms
+        counts = offsets[ancestors + 1] - offsets[ancestors]
+        total = counts.sum()
+        if total == 0:
+            break
+        # the parents of each ancestor in the frontier
+        starts = np.repeat(offsets[ancestors] - (np.cumsum(counts) - counts), counts)
+        new_parents = sorted_parents[starts + np.arange(total)]
+        new_keys = np.unique(np.repeat(terms, counts) * num_terms + new_parents)
+        new_keys = new_keys[(new_keys // num_terms != new_keys % num_terms) & ~np.isin(new_keys, seen, assume_unique=True)]
+        all_keys.append(new_keys)
+        all_depths.append(np.full(len(new_keys), depth, dtype=np.int64))
+        seen = np.union1d(seen, new_keys)
+        frontier = new_keys
+        debug(2, 'closure depth %d: %d new rows', depth, len(new_keys))
+    keys = np.concatenate(all_keys)
+    depths = np.concatenate(all_depths)
+    order = np.argsort(keys)
+    return keys[order], depths[order]
+
+
+def build_closure(children, parents, ontologies):
+    '''Build all the closure rows (same as closure_rows() for all the terms) using numpy
+
+    Parameters
+    ----------
+    children, parents: list of int
+        the child and parent term id of each edge (OntologyTreeStructureTable ontologyId, ontologyParentId)
+    ontologies: list of int or None
+        the ontologyNameId of each edge
+
+    Returns
+    -------
+    termids, ancestorids, depths: numpy array of int64
+    ontologyids: numpy array of int64
+        the ontologynameid of each row (-1 for NULL)
+    '''
+    children = np.array(children, dtype=np.int64)
+    parents = np.array(parents, dtype=np.int64)
+    ontologies = np.array([-1 if conto is None else conto for conto in ontologies], dtype=np.int64)
+    num_terms = int(max(children.max(initial=0), parents.max(initial=0))) + 1
+    all_keys = []
+    all_depths = []
+    all_ontologies = []
+    # the ancestors through the edges of each ontology
+    for contology in np.unique(ontologies):
+        if contology < 0:
+            continue
+        cedges = ontologies == contology
+        ckeys, cdepths = _closure_keys(children[cedges], parents[cedges], num_terms)
+        all_keys.append(ckeys)
+        all_depths.append(cdepths)
+        all_ontologies.append(np.full(len(ckeys), contology, dtype=np.int64))
+        debug(3, 'ontology %d: %d closure rows', contology, len(ckeys))
+    # and the ancestors reached only through mixed paths
+    ckeys, cdepths = _closure_keys(children, parents, num_terms)
+    if len(all_keys) > 0:
+        mixed = ~np.isin(ckeys, np.concatenate(all_keys))
+        ckeys = ckeys[mixed]
+        cdepths = cdepths[mixed]
+    all_keys.append(ckeys)
+    all_depths.append(cdepths)
+    all_ontologies.append(np.full(len(ckeys), -1, dtype=np.int64))
+    debug(3, 'mixed ontologies: %d closure rows', len(ckeys))
+    keys = np.concatenate(all_keys)
+    return keys // num_terms, keys % num_terms, np.concatenate(all_depths), np.concatenate(all_ontologies)
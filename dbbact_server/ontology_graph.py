@@ -0,0 +1,381 @@
+'''In-memory ontology graph (the OntologyTreeStructureTable edges), used to get the parents/children of the ontology terms without a query per term
+
+The edges are stored in CSR (compressed sparse row) arrays for each direction: for term id t, the parents are
+parent_ids[parent_offsets[t]:parent_offsets[t + 1]] (with the ontologyNameId of each edge in parent_ontologies), and the same for the children.
+The graph is loaded once per worker (on first use), and updated using the ChangeLogTable (see dbchanges.py):
+terms with changed parents (AddTreeTerm() records the child term id) are re-read and stored in override dicts,
+and changes to an unknown set of terms (bulk updates) cause a reload.
+
+NOTE: if the data version is not available (DataVersionTable not created), the graph is not used and the functions fall back to the database queries.
+'''
+
+import time
+import threading
+from array import array
+from collections import deque
+
+import psycopg2
+
+from .utils import debug
+from . import dbchanges
+
+# the maximal number of terms in the override dicts before reloading the whole graph
+MAX_OVERRIDES = 10000
+# the minimal time (seconds) between load attempts if the graph could not be loaded
+RELOAD_INTERVAL = 60
+
+# the graph of this worker (created on first use, see get_ontology_graph())
+_graph = None
+_enabled = True
+
+
+def _build_csr(sources, targets, ontologies, size):
+    '''Build the CSR arrays of the edges (keeping the order of the edges for each source)
+
+    Parameters
+    ----------
+    sources, targets, ontologies: list of int
+        the source term id, target term id and ontologyNameId of each edge
+    size: int
+        the number of rows (max term id + 1)
+
+    Returns
+    -------
+    offsets: array of int (size + 1)
+    ids: array of int
+        the target ids, ordered by the source
+    onto: array of int
+        the ontologyNameId of each edge in ids
+    '''
+    counts = [0] * (size + 1)
+    for csource in sources:
+        counts[csource + 1] += 1
+    for idx in range(size):
+        counts[idx + 1] += counts[idx]
+    offsets = array('l', counts)
+    pos = counts[:size]
+    ids = array('l', [0]) * len(sources)
+    onto = array('l', [0]) * len(sources)
+    for csource, ctarget, conto in zip(sources, targets, ontologies):
+        cpos = pos[csource]
+        ids[cpos] = ctarget
+        onto[cpos] = conto
+        pos[csource] = cpos + 1
+    return offsets, ids, onto
+
+
+class OntologyGraph:
+    '''The ontology term parent/child relations (from OntologyTreeStructureTable)'''
+    def __init__(self):
+        self.version = None
+        self.valid = False
+        self.num_edges = 0
+        self.build_time = 0
+        self._last_load = 0
+        self._size = 0
+        self._parent_offsets = self._child_offsets = array('l', [0])
+        self._parent_ids = self._parent_onto = self._child_ids = self._child_onto = array('l')
+        # the edges of the terms changed since the graph was loaded: {term id: list of (term id, ontologyNameId)}
+        self._parents_override = {}
+        self._children_override = {}
+        self._lock = threading.RLock()
+        self.lookups = 0
+
+    def load(self, con, cur):
+        '''Load all the edges from OntologyTreeStructureTable
+
+        Returns
+        -------
+        err: str
+            empty ('') if ok, otherwise the error encountered
+        '''
+        start_time = time.time()
+        self._last_load = start_time
+        # get the version before reading the edges, so we will not miss changes during the load
+        err, version = dbchanges.get_data_version(con, cur, use_cached=False)
+        if err:
+            return err
+        if not version:
+            self.valid = False
+            return 'data version not available. ontology graph disabled'
+        children = []
+        parents = []
+        ontologies = []
+        try:
+            cur.execute('SELECT ontologyId, ontologyParentId, ontologyNameId FROM OntologyTreeStructureTable ORDER BY uniqueId')
+            for cres in cur:
+                children.append(cres[0])
+                parents.append(cres[1])
+                ontologies.append(cres[2] or 0)
+        except psycopg2.DatabaseError as e:
+            debug(7, 'error %s encountered when loading the ontology graph', e)
+            self.valid = False
+            return 'error %s encountered when loading the ontology graph' % e
+        size = max(max(children, default=0), max(parents, default=0)) + 1
+        parent_offsets, parent_ids, parent_onto = _build_csr(children, parents, ontologies, size)
+        child_offsets, child_ids, child_onto = _build_csr(parents, children, ontologies, size)
+        with self._lock:
+            self._size = size
+            self._parent_offsets, self._parent_ids, self._parent_onto = parent_offsets, parent_ids, parent_onto
+            self._child_offsets, self._child_ids, self._child_onto = child_offsets, child_ids, child_onto
+            self._parents_override = {}
+            self._children_override = {}
+            self.num_edges = len(children)
+            self.version = version
+            self.valid = True
+            self.build_time = time.time() - start_time
+        debug(3, 'ontology graph loaded with %d edges (version %d) in %f sec', self.num_edges, version, self.build_time)
+        return ''
+
+    def refresh(self, con, cur):
+        '''Update the graph with the term changes since it was loaded (using the ChangeLogTable), or load it if needed
+
+        Returns
+        -------
+        err: str
+            empty ('') if ok, otherwise the error encountered
+        '''
+        if not self.valid:
+            if time.time() - self._last_load < RELOAD_INTERVAL:
+                return 'ontology graph not loaded'
+            return self.load(con, cur)
+        err, version = dbchanges.get_data_version(con, cur)
+        if err:
+            return err
+        if version <= self.version:
+            return ''
+        with self._lock:
+            changed_ids = set()
+            since = self.version
+            while True:
+                # only the committed changes (our own uncommitted changes may be rolled back)
+                err, changes = dbchanges.get_changes(con, cur, since, entity='term', until_version=version)
+                if err:
+                    self.valid = False
+                    return err
+                if len(changes) == 0:
+                    break
+                for cchange in changes:
+                    if cchange['id'] is None:
+                        debug(3, 'bulk term change in version %d. reloading the ontology graph', cchange['version'])
+                        return self.load(con, cur)
+                    changed_ids.add(cchange['id'])
+                since = changes[-1]['version']
+            if len(changed_ids) > 0:
+                try:
+                    cur.execute('SELECT ontologyId, ontologyParentId, ontologyNameId FROM OntologyTreeStructureTable WHERE ontologyId = ANY(%s) ORDER BY uniqueId', [list(changed_ids)])
+                    res = cur.fetchall()
+                except psycopg2.DatabaseError as e:
+                    debug(7, 'error %s encountered when refreshing the ontology graph', e)
+                    self.valid = False
+                    return 'error %s encountered when refreshing the ontology graph' % e
+                new_parents = {cid: [] for cid in changed_ids}
+                for cres in res:
+                    new_parents[cres[0]].append((cres[1], cres[2] or 0))
+                for cid, cparents in new_parents.items():
+                    old_parents = self.parent_edges(cid)
+                    if old_parents == cparents:
+                        continue
+                    self._parents_override[cid] = cparents
+                    # update the children of the removed/added parents
+                    for cparent, conto in set(old_parents) - set(cparents):
+                        self._children_override[cparent] = [cedge for cedge in self.child_edges(cparent) if cedge != (cid, conto)]
+                    for cparent, conto in set(cparents) - set(old_parents):
+                        self._children_override[cparent] = self.child_edges(cparent) + [(cid, conto)]
+                if len(self._parents_override) + len(self._children_override) > MAX_OVERRIDES:
+                    debug(3, 'too many changed terms in the ontology graph. reloading')
+                    return self.load(con, cur)
+            self.version = version
+            debug(2, 'ontology graph refreshed to version %d (%d changed terms)', self.version, len(changed_ids))
+        return ''
+
+    def parent_edges(self, term_id):
+        '''Get the parents of a term
+
+        Parameters
+        ----------
+        term_id: int
+            the term id (from OntologyTable)
+
+        Returns
+        -------
+        list of (int, int)
+            the (parent term id, ontologyNameId) of each parent edge (in the order they were added)
+        '''
+        edges = self._parents_override.get(term_id)
+        if edges is not None:
+            return list(edges)
+        if term_id < 0 or term_id >= self._size:
+            return []
+        start = self._parent_offsets[term_id]
+        end = self._parent_offsets[term_id + 1]
+        return list(zip(self._parent_ids[start:end], self._parent_onto[start:end]))
+
+    def child_edges(self, term_id):
+        '''Get the children of a term
+
+        Parameters
+        ----------
+        term_id: int
+            the term id (from OntologyTable)
+
+        Returns
+        -------
+        list of (int, int)
+            the (child term id, ontologyNameId) of each child edge
+        '''
+        edges = self._children_override.get(term_id)
+        if edges is not None:
+            return list(edges)
+        if term_id < 0 or term_id >= self._size:
+            return []
+        start = self._child_offsets[term_id]
+        end = self._child_offsets[term_id + 1]
+        return list(zip(self._child_ids[start:end], self._child_onto[start:end]))
+
+    def parents(self, term_id, ontology_id=None):
+        '''Get the immediate parent ids of a term (optionally only through edges of the ontology ontology_id)'''
+        if ontology_id is None:
+            return [cid for cid, conto in self.parent_edges(term_id)]
+        return [cid for cid, conto in self.parent_edges(term_id) if conto == ontology_id]
+
+    def children(self, term_id, ontology_id=None):
+        '''Get the immediate child ids of a term (optionally only through edges of the ontology ontology_id)'''
+        if ontology_id is None:
+            return [cid for cid, conto in self.child_edges(term_id)]
+        return [cid for cid, conto in self.child_edges(term_id) if conto == ontology_id]
+
+    def ancestors(self, term_ids, ontology_id=None):
+        '''Get all the ancestors of the terms
+
+        Parameters
+        ----------
+        term_ids: list of int
+            the terms to get the ancestors for
+        ontology_id: int or None, optional
+            if not None, follow only edges of this ontology (ontologyNameId)
+
+        Returns
+        -------
+        list of int
+            the ancestor term ids (including term_ids), in BFS order
+        '''
+        return self._traverse(term_ids, self.parents, ontology_id)
+
+    def descendants(self, term_ids, ontology_id=None, max_terms=None):
+        '''Get all the descendants of the terms
+
+        Parameters
+        ----------
+        term_ids: list of int
+            the terms to get the descendants for
+        ontology_id: int or None, optional
+            if not None, follow only edges of this ontology (ontologyNameId)
+        max_terms: int or None, optional
+            if not None, stop after max_terms terms
+
+        Returns
+        -------
+        list of int
+            the descendant term ids (including term_ids), in BFS order
+        '''
+        return self._traverse(term_ids, self.children, ontology_id, max_terms)
+
+    def _traverse(self, term_ids, get_next, ontology_id=None, max_terms=None):
+        self.lookups += 1
+        found = []
+        visited = set()
+        queue = deque(term_ids)
+        while len(queue) > 0:
+            cid = queue.popleft()
+            if cid in visited:
+                continue
+            visited.add(cid)
+            found.append(cid)
+            if max_terms is not None and len(found) >= max_terms:
+                break
+            queue.extend(get_next(cid, ontology_id))
+        return found
+
+    def root_paths(self, term_ids, max_paths=20):
+        '''Get paths from the terms to the roots of the ontology graph (at most max_paths paths)
+        Each path follows the first parent of each term, and the other parents start new paths (same as dbontology.get_parents_trees())
+
+        Parameters
+        ----------
+        term_ids: list of int
+            the terms to start the paths from
+        max_paths: int, optional
+            the maximal number of paths to return
+
+        Returns
+        -------
+        list of (list of int)
+            the term ids of each path, from the term to the root
+        '''
+        self.lookups += 1
+        all_paths = []
+        open_paths = [[x] for x in term_ids]
+        while len(open_paths) > 0 and len(all_paths) < max_paths:
+            cpath = open_paths.pop()
+            cpath_set = set(cpath)
+            while True:
+                # skip parents already in the path (loops)
+                ids = [x for x in self.parents(cpath[-1]) if x not in cpath_set]
+                if len(ids) == 0:
+                    break
+                for cid in ids[1:]:
+                    open_paths.append(cpath + [cid])
+                cpath.append(ids[0])
+                cpath_set.add(ids[0])
+            all_paths.append(cpath)
+        return all_paths
+
+    def get_stats(self):
+        '''Get the graph statistics (for /stats/cache)'''
+        return {'edges': self.num_edges, 'changed': len(self._parents_override), 'valid': self.valid,
+                'version': self.version, 'load_time': self.build_time, 'lookups': self.lookups}
+
+
+def get_ontology_graph(con, cur):
+    '''Get the ontology graph of this worker (loaded on first use and refreshed with the latest changes)
+
+    Parameters
+    ----------
+    con, cur
+
+    Returns
+    -------
+    OntologyGraph or None
+        None if the graph is disabled or cannot be used (i.e. the data version is not available), so the database should be queried instead
+    '''
+    global _graph
+
+    if not _enabled:
+        return None
+    if _graph is None:
+        _graph = OntologyGraph()
+    err = _graph.refresh(con, cur)
+    if err or not _graph.valid:
+        return None
+    return _graph
+
+
+def set_ontology_graph_enabled(enabled):
+    '''Enable/disable the ontology graph for this worker (called on server start)
+
+    Parameters
+    ----------
+    enabled: bool
+        False to always query the database for the ontology term parents/children
+    '''
+    global _enabled
+
+    _enabled = enabled
+
+
+def get_graph_stats():
+    '''Get the ontology graph statistics, or None if not loaded'''
+    if _graph is None:
+        return None
+    return _graph.get_stats()
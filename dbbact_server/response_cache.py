@@ -0,0 +1,161 @@
+import json
+import gzip
+import hashlib
+
+from flask import g, request, Response
+
+from .utils import debug
+from .cache import LRUCache
+from . import dbchanges
+
+# optional compression libraries (used if installed and accepted by the client)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the cached responses of the large rarely changing endpoints (i.e. /ontology/get_all_terms)
+# key is (name, params, data version), value is dict {'etag': str, 'identity': bytes, 'gzip'/'br'/'zstd': bytes (compressed on first use)}
+# limited by the total size of the responses (including the compressed copies), since per user responses (i.e. /experiments/get_experiments_list) can be several MB each
+MAX_RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+_response_cache = LRUCache('responses', max_size=32, max_bytes=MAX_RESPONSE_CACHE_BYTES)
+
+# the encodings we can send, in order of preference
+_ENCODINGS = ['br', 'zstd', 'gzip']
+
+
+def _compress(data, encoding):
+    '''Compress the data (bytes) using the encoding ('gzip', 'br' or 'zstd')'''
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if encoding == 'br':
+        return brotli.compress(data, quality=9)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    raise ValueError('unknown encoding %s' % encoding)
+
+
+def _entry_bytes(centry):
+    '''The total size of the cached response dict (the uncompressed and all the compressed copies)'''
+    return sum(len(cval) for cval in centry.values() if isinstance(cval, bytes))
+
+
+def _select_encoding():
+    '''Select the best compression accepted by the client (from the Accept-Encoding header)
+
+    Returns
+    -------
+    str: 'br', 'zstd', 'gzip' or 'identity' (no compression)
+    '''
+    for cencoding in _ENCODINGS:
+        if cencoding == 'br' and brotli is None:
+            continue
+        if cencoding == 'zstd' and zstandard is None:
+            continue
+        if request.accept_encodings[cencoding] > 0:
+            return cencoding
+    return 'identity'
+
+
+def cached_json_response(name, params, get_data, ensure_ascii=True):
+    '''Return a json response that is cached (per worker) until the database data version changes.
+    Used for large responses that rarely change (i.e. /ontology/get_all_terms).
+    The response has an ETag (based on the data version), so clients sending a matching If-None-Match get a 304 response without any database access.
+    The json is stored pre-serialized and compressed using the best encoding accepted by the client (gzip, and brotli/zstd if the libraries are installed)
+
+    Parameters
+    ----------
+    name: str
+        the name of the response (for the cache key and the ETag)
+    params: json serializable object
+        the request parameters affecting the result (including the userid if the result depends on it)
+    get_data: function()
+        called to get the data (if not cached). should return (err(str), data(json serializable object))
+    ensure_ascii: bool, optional
+        passed to json.dumps()
+
+    Returns
+    -------
+    flask.Response or (str, 400) if error encountered
+    '''
+    err, version = dbchanges.get_data_version(g.con, g.cur)
+    if err or not version:
+        # the data version is not available (i.e. DataVersionTable not created), so we cannot cache
+        err, data = get_data()
+        if err:
+            debug(6, err)
+            return (err, 400)
+        return json.dumps(data, ensure_ascii=ensure_ascii)
+
+    params_str = json.dumps(params, sort_keys=True)
+    params_hash = hashlib.md5(params_str.encode('utf8')).hexdigest()[:16]
+    etag = '%s-%d-%s' % (name, version, params_hash)
+    if request.if_none_match.contains_weak(etag):
+        debug(2, 'response %s not modified (version %d)', name, version)
+        res = Response(status=304)
+        res.set_etag(etag, weak=True)
+        return res
+
+    key = (name, params_str, version)
+    generation = _response_cache.generation
+    centry = _response_cache.get(key)
+    if centry is None:
+        err, data = get_data()
+        if err:
+            debug(6, err)
+            return (err, 400)
+        centry = {'etag': etag, 'identity': json.dumps(data, ensure_ascii=ensure_ascii).encode('utf8')}
+        _response_cache.set(key, centry, generation=generation, nbytes=_entry_bytes(centry))
+        debug(2, 'response %s cached for version %d (%d bytes)', name, version, len(centry['identity']))
+
+    encoding = _select_encoding()
+    if encoding not in centry:
+        # compressed once per cached response (the dict is shared, so other requests will use it)
+        centry[encoding] = _compress(centry['identity'], encoding)
+        # update the cached size (may evict this or other responses if over the size limit)
+        _response_cache.set(key, centry, generation=generation, nbytes=_entry_bytes(centry))
+    res = Response(centry[encoding], mimetype='application/json')
+    if encoding != 'identity':
+        res.headers['Content-Encoding'] = encoding
+    res.headers['Vary'] = 'Accept-Encoding'
+    res.headers['Cache-Control'] = 'no-cache'
+    res.set_etag(etag, weak=True)
+    return res
+
+
+def streamed_json_response(data, chunk_size=65536, ensure_ascii=True):
+    '''Return a json response that is encoded while it is sent (in chunks of about chunk_size characters), instead of building the whole json string in memory.
+    Used for large responses that are not cached (i.e. /ontology/get_term_sequences)
+    NOTE: data should not need the database or the request (the response is sent after the request teardown)
+
+    Parameters
+    ----------
+    data: json serializable object
+    chunk_size: int, optional
+        the minimal size of each chunk sent
+    ensure_ascii: bool, optional
+        passed to the json encoder
+
+    Returns
+    -------
+    flask.Response
+    '''
+    def generate():
+        chunk = []
+        chunk_len = 0
+        for cpart in json.JSONEncoder(ensure_ascii=ensure_ascii).iterencode(data):
+            chunk.append(cpart)
+            chunk_len += len(cpart)
+            if chunk_len >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                chunk_len = 0
+        yield ''.join(chunk)
+
+    # NOTE: not using stream_with_context(), since the generator does not need the request context.
+    # so the request teardown (returning the database connection to the pool) is not delayed until the client downloads the whole response
+    return Response(generate(), mimetype='application/json')
@@ -0,0 +1,923 @@
+'''In-memory indexes of the sequences in SequencesTable, used to skip the database queries when looking up sequence ids
+
+SequenceIndex: exact sequence -> (id, idprimer). Used by GetSequenceId() and GetSequencesIds() for exact matches.
+    Holds the md5 digest of each sequence (split into two uint64 arrays, sorted) with the sequence id and primer id.
+PrefixIndex: all the sequences that are prefixes of / extended by the query sequence. Used for the non-exact matches.
+    Holds all the sequences sorted (in one bytes buffer with the start offset of each sequence), searched using binary search.
+CloseSequencesIndex: the sequences with up to 5 mismatches to the query sequence. Used by get_close_sequences().
+    Holds the 2 bit packed sequences, and the sequences sorted by each of 6 blocks, for finding the candidates using the pigeonhole principle.
+
+Each index can be loaded from a snapshot file (created by dbbact_jobs/update_sequence_index.py) which is memory mapped,
+so all the workers on the server share one copy.
+Sequences added/changed after the index was built are picked up using the ChangeLogTable (see dbchanges.py).
+If sequences were changed in bulk (or the data version is not available), the index is not used until it is rebuilt/reloaded.
+
+NOTE: requires numpy. If numpy is not installed, the indexes are disabled and all lookups go to the database.
+'''
+
+import os
+import time
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left, bisect_right
+
+import psycopg2
+
+from .utils import debug
+from . import dbchanges
+from . import seqpack
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# minimal time (seconds) between rebuilds of an index that became invalid
+REBUILD_INTERVAL = 3600
+
+# the enabled indexes of this worker ({index_type: index}, see init_sequence_index())
+_indexes = {}
+
+# the process pool for large close sequences lookups (created on first use, see set_close_pool_size())
+_close_pool = None
+_close_pool_size = 0
+# the minimal number of query sequences for using the process pool
+CLOSE_POOL_MIN_QUERIES = 200
+
+
+def sequence_digest(sequence):
+    '''Get the md5 digest of the sequence (as used in the sequence index)
+    NOTE: the digest is of the upper case sequence (same as the hashfull field (hex) and the seqdigest field (binary) in SequencesTable)
+
+    Parameters
+    ----------
+    sequence: str
+        the ACGT sequence
+
+    Returns
+    -------
+    bytes (16 bytes)
+    '''
+    return hashlib.md5(sequence.upper().encode('utf8')).digest()
+
+
+def _split_digests(digests):
+    '''Split a list of 16 byte digests into the high and low uint64 numpy arrays'''
+    buf = np.frombuffer(b''.join(digests), dtype='>u8').astype(np.uint64)
+    return buf[0::2], buf[1::2]
+
+
+class _BaseIndex:
+    '''The common part of the sequence indexes: building from the database, snapshot files, and the incremental refresh.
+    Sequences added/changed after the index was built are stored in self._changed ({id: (sequence, idprimer)}), and ignored in the index arrays.
+
+    Subclasses set SNAPSHOT_MAGIC and implement:
+    _set_sequences(ids, primers, sequences) - set the index arrays from the sequences
+    _get_arrays() - the index arrays (list of numpy arrays) to save in the snapshot
+    _set_arrays(arrays) - set the index arrays from the snapshot (list of uint8 numpy arrays, in the order returned by _get_arrays())
+    _set_changed() - update the lookup structure of the changed sequences (from self._changed)
+    '''
+    SNAPSHOT_MAGIC = None
+
+    def __init__(self, filename=None):
+        '''
+        Parameters
+        ----------
+        filename: str or None, optional
+            the snapshot file to load the index from (reloaded when the file changes).
+            None to build the index from the database
+        '''
+        self.filename = filename
+        self._mtime = None
+        # the number of sequences in the index arrays
+        self.size = 0
+        # the data version the index is up to date with
+        self.version = None
+        # the highest sequence id in the index arrays
+        self.max_id = 0
+        # False if the index cannot be used (i.e. sequences changed in bulk since it was built)
+        self.valid = False
+        # sequences added/changed after the index was built: {id: (sequence, idprimer)} (deleted sequences are only in _changed_ids)
+        self._changed = {}
+        self._changed_ids = set()
+        self._last_build = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _set_data(self, version, max_id):
+        self.version = version
+        self.max_id = max_id
+        self._changed = {}
+        self._changed_ids = set()
+        self._set_changed()
+        self.valid = True
+
+    def build(self, con, cur):
+        '''Build the index from all the sequences in SequencesTable
+
+        Returns
+        -------
+        err: str
+            empty ('') if ok, otherwise the error encountered
+        '''
+        start_time = time.time()
+        self._last_build = start_time
+        # get the version before reading the sequences, so we will not miss changes during the build
+        err, version = dbchanges.get_data_version(con, cur, use_cached=False)
+        if err:
+            return err
+        if not version:
+            self.valid = False
+            return 'data version not available. sequence index disabled'
+        ids = []
+        primers = []
+        sequences = []
+        try:
+            # use a server side cursor so we do not fetch all the rows at once
+            scur = con.cursor(name='dbbact_sequence_index')
+            scur.itersize = 50000
+            scur.execute('SELECT id, idprimer, sequence FROM SequencesTable')
+            for cres in scur:
+                ids.append(cres[0])
+                primers.append(cres[1] or 0)
+                sequences.append(cres[2].lower())
+            scur.close()
+        except psycopg2.DatabaseError as e:
+            debug(7, 'error %s encountered when building the sequence index', e)
+            self.valid = False
+            return 'error %s encountered when building the sequence index' % e
+        with self._lock:
+            self._set_sequences(ids, primers, sequences)
+            self.size = len(ids)
+            self._set_data(version, max(ids) if len(ids) > 0 else 0)
+        debug(3, '%s built for %d sequences (version %d) in %f sec', type(self).__name__, len(ids), version, time.time() - start_time)
+        return ''
+
+    def save(self, filename):
+        '''Save the index to a snapshot file (replacing the file atomically)
+        The snapshot is one uint8 numpy array: header (magic, version, max_id, size, number of arrays, size of each array) followed by the index arrays
+
+        Parameters
+        ----------
+        filename: str
+            the snapshot file name (.npy)
+        '''
+        arrays = [np.ascontiguousarray(carr).view(np.uint8) for carr in self._get_arrays()]
+        header = np.array([self.SNAPSHOT_MAGIC, self.version, self.max_id, self.size, len(arrays)] + [len(carr) for carr in arrays], dtype=np.uint64)
+        parts = [header.view(np.uint8)]
+        for carr in arrays:
+            parts.append(carr)
+            # keep the arrays aligned to 8 bytes so they can be viewed as uint64 without copying
+            parts.append(np.zeros((-len(carr)) % 8, dtype=np.uint8))
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as fl:
+            np.save(fl, np.concatenate(parts))
+        os.replace(tmp_filename, filename)
+        debug(3, 'saved %s (%d sequences, version %d) to %s', type(self).__name__, self.size, self.version, filename)
+
+    def load(self):
+        '''Load (memory map) the index from the snapshot file
+
+        Returns
+        -------
+        err: str
+            empty ('') if ok, otherwise the error encountered
+        '''
+        try:
+            mtime = os.stat(self.filename).st_mtime
+            alldata = np.load(self.filename, mmap_mode='r')
+            if alldata.ndim != 1 or alldata.dtype != np.uint8 or len(alldata) < 40:
+                raise ValueError('not a sequence index snapshot')
+            header = alldata[:40].view(np.uint64)
+            if header[0] != self.SNAPSHOT_MAGIC:
+                raise ValueError('wrong snapshot type')
+            num_arrays = int(header[4])
+            sizes = alldata[40:40 + 8 * num_arrays].view(np.uint64)
+            arrays = []
+            pos = 40 + 8 * num_arrays
+            for csize in sizes:
+                csize = int(csize)
+                arrays.append(alldata[pos:pos + csize])
+                pos += csize + (-csize) % 8
+            if pos > len(alldata):
+                raise ValueError('snapshot file truncated')
+        except (OSError, ValueError) as e:
+            debug(6, 'cannot load sequence index from %s: %s', self.filename, e)
+            return 'cannot load sequence index from %s' % self.filename
+        with self._lock:
+            self._mtime = mtime
+            self._set_arrays(arrays)
+            self.size = int(header[3])
+            self._set_data(int(header[1]), int(header[2]))
+        debug(3, 'loaded %s from %s (%d sequences, version %d)', type(self).__name__, self.filename, self.size, self.version)
+        return ''
+
+    def refresh(self, con, cur):
+        '''Update the index with the sequence changes since it was built (using the ChangeLogTable)
+        Reloads the snapshot file if it changed, and rebuilds the index if it is not valid (at most once every REBUILD_INTERVAL seconds)
+        '''
+        if self.filename is not None:
+            try:
+                mtime = os.stat(self.filename).st_mtime
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime != self._mtime:
+                self.load()
+        if not self.valid:
+            if time.time() - self._last_build < REBUILD_INTERVAL:
+                return
+            self.build(con, cur)
+            if not self.valid:
+                return
+        err, version = dbchanges.get_data_version(con, cur)
+        if err or version <= self.version:
+            return
+        with self._lock:
+            changed_ids = set()
+            since = self.version
+            while True:
+                # only the committed changes (our own uncommitted changes may be rolled back)
+                err, changes = dbchanges.get_changes(con, cur, since, entity='sequence', until_version=version)
+                if err:
+                    self.valid = False
+                    return
+                if len(changes) == 0:
+                    break
+                for cchange in changes:
+                    if cchange['id'] is None:
+                        debug(3, 'bulk sequence change in version %d. %s needs rebuild', cchange['version'], type(self).__name__)
+                        self.valid = False
+                        return
+                    changed_ids.add(cchange['id'])
+                since = changes[-1]['version']
+            if len(changed_ids) > 0:
+                try:
+                    cur.execute('SELECT id, idprimer, sequence FROM SequencesTable WHERE id = ANY(%s)', [list(changed_ids)])
+                    res = cur.fetchall()
+                except psycopg2.DatabaseError as e:
+                    debug(7, 'error %s encountered when refreshing the sequence index', e)
+                    self.valid = False
+                    return
+                # deleted sequences stay only in _changed_ids
+                for cid in changed_ids:
+                    self._changed.pop(cid, None)
+                for cres in res:
+                    self._changed[cres['id']] = (cres['sequence'].lower(), cres['idprimer'] or 0)
+                self._changed_ids.update(changed_ids)
+                self._set_changed()
+            self.version = version
+            debug(2, '%s refreshed to version %d (%d changed sequences)', type(self).__name__, self.version, len(self._changed_ids))
+
+    def get_stats(self):
+        '''Get the index statistics (for /stats/cache)'''
+        return {'size': self.size, 'changed': len(self._changed_ids), 'valid': self.valid,
+                'version': self.version, 'hits': self.hits, 'misses': self.misses, 'filename': self.filename}
+
+
+class SequenceIndex(_BaseIndex):
+    '''Exact sequence -> (id, idprimer) index (using the sequence md5 digest)'''
+    SNAPSHOT_MAGIC = 0xdbbac7
+
+    def __init__(self, filename=None):
+        super().__init__(filename=filename)
+        # the digest high, digest low, sequence id, primer id uint64 arrays. sorted by the digest
+        self._hi = self._lo = self._ids = self._primers = np.zeros(0, dtype=np.uint64)
+        # the changed sequences {(hi, lo): (id, idprimer)}
+        self._new = {}
+
+    def _set_sequences(self, ids, primers, sequences):
+        if len(ids) == 0:
+            self._hi = self._lo = self._ids = self._primers = np.zeros(0, dtype=np.uint64)
+            return
+        hi, lo = _split_digests([sequence_digest(cseq) for cseq in sequences])
+        order = np.lexsort((lo, hi))
+        self._hi = hi[order]
+        self._lo = lo[order]
+        self._ids = np.array(ids, dtype=np.uint64)[order]
+        self._primers = np.array(primers, dtype=np.uint64)[order]
+
+    def _get_arrays(self):
+        return [self._hi, self._lo, self._ids, self._primers]
+
+    def _set_arrays(self, arrays):
+        self._hi, self._lo, self._ids, self._primers = [carr.view(np.uint64) for carr in arrays]
+
+    def _set_changed(self):
+        self._new = {}
+        for cid, (cseq, cprimer) in self._changed.items():
+            chi, clo = _split_digests([sequence_digest(cseq)])
+            self._new[(int(chi[0]), int(clo[0]))] = (cid, cprimer)
+
+    def lookup(self, sequences):
+        '''Get the (id, idprimer) of the exact sequences
+
+        Parameters
+        ----------
+        sequences: list of str
+            the ACGT sequences to look up
+
+        Returns
+        -------
+        list of (int, int) or None
+            the (sequence id, primer id) for each sequence, or None if not in the index
+            (None means the sequence may still be in the database, i.e. if it was added after the index was refreshed)
+        '''
+        return self.lookup_digests([sequence_digest(cseq) for cseq in sequences])
+
+    def lookup_digests(self, digests):
+        '''Get the (id, idprimer) of the sequences with the given digests
+
+        Parameters
+        ----------
+        digests: list of bytes
+            the sequence digests (see sequence_digest()) to look up
+
+        Returns
+        -------
+        list of (int, int) or None
+            the (sequence id, primer id) for each digest, or None if not in the index
+        '''
+        if len(digests) == 0:
+            return []
+        qhi, qlo = _split_digests(digests)
+        with self._lock:
+            found = [None] * len(digests)
+            nseqs = len(self._hi)
+            if nseqs > 0:
+                pos = np.searchsorted(self._hi, qhi)
+                pos_ok = np.minimum(pos, nseqs - 1)
+                match = (pos < nseqs) & (self._hi[pos_ok] == qhi) & (self._lo[pos_ok] == qlo)
+                match_ids = self._ids[pos_ok]
+                match_primers = self._primers[pos_ok]
+                for idx in np.nonzero(match)[0]:
+                    cid = int(match_ids[idx])
+                    if cid in self._changed_ids:
+                        continue
+                    found[idx] = (cid, int(match_primers[idx]))
+            if len(self._new) > 0:
+                for idx in range(len(digests)):
+                    if found[idx] is None:
+                        found[idx] = self._new.get((int(qhi[idx]), int(qlo[idx])))
+        nfound = len(digests) - found.count(None)
+        self.hits += nfound
+        self.misses += len(digests) - nfound
+        return found
+
+
+class _SortedSequences:
+    '''The sorted sequences of the PrefixIndex as a list of bytes (for bisect)'''
+    def __init__(self, seqs, offsets):
+        self._seqs = seqs
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        return self._seqs[self._offsets[idx]:self._offsets[idx + 1]].tobytes()
+
+
+def _find_longer(keys, query):
+    '''Get the range of the sorted keys starting with query (i.e. query is a prefix of them)'''
+    return bisect_left(keys, query), bisect_left(keys, query + b'\xff')
+
+
+def _find_shorter(keys, query, min_length):
+    '''Get the positions of the sorted keys which are prefixes of query (and are at least min_length long)
+
+    All the keys between a prefix of the query and the query start with that prefix, so the key preceding the query shares it.
+    We therefore look at the key preceding the query, and continue with the prefix of the query common with it.
+    '''
+    pos = []
+    while len(query) >= min_length and len(query) > 0:
+        cpos = bisect_right(keys, query) - 1
+        if cpos < 0:
+            break
+        ckey = keys[cpos]
+        common_len = len(os.path.commonprefix([ckey, query]))
+        if common_len == len(ckey):
+            if common_len < min_length:
+                break
+            # the key is a prefix of the query (can appear more than once)
+            start = bisect_left(keys, ckey, 0, cpos)
+            pos.extend(range(start, cpos + 1))
+            common_len -= 1
+        query = query[:common_len]
+    return pos
+
+
+class PrefixIndex(_BaseIndex):
+    '''Index of all the sequences for finding the sequences that are prefixes of / extended by a query sequence'''
+    SNAPSHOT_MAGIC = 0xdbbac8
+
+    def __init__(self, filename=None):
+        super().__init__(filename=filename)
+        # all the sequences (sorted) concatenated, the start position of each sequence (and the end of the last sequence), and the sequence id and primer id
+        self._seqs = np.zeros(0, dtype=np.uint8)
+        self._offsets = np.zeros(1, dtype=np.uint64)
+        self._ids = self._primers = np.zeros(0, dtype=np.uint64)
+        self._keys = _SortedSequences(self._seqs, self._offsets)
+        # the changed sequences (sorted), and their (id, idprimer)
+        self._new_keys = []
+        self._new_values = []
+
+    def _set_sequences(self, ids, primers, sequences):
+        order = sorted(range(len(sequences)), key=sequences.__getitem__)
+        lengths = np.array([len(sequences[idx]) for idx in order], dtype=np.uint64)
+        offsets = np.zeros(len(order) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum(lengths)
+        self._set_arrays([np.frombuffer(''.join(sequences[idx] for idx in order).encode('ascii'), dtype=np.uint8), offsets,
+                          np.array(ids, dtype=np.uint64)[order], np.array(primers, dtype=np.uint64)[order]])
+
+    def _get_arrays(self):
+        return [self._seqs, self._offsets, self._ids, self._primers]
+
+    def _set_arrays(self, arrays):
+        # use plain ndarray views of the memory mapped arrays (much faster slicing than numpy.memmap)
+        self._seqs = arrays[0].view(np.ndarray)
+        self._offsets, self._ids, self._primers = [carr.view(np.ndarray).view(np.uint64) for carr in arrays[1:]]
+        self._keys = _SortedSequences(self._seqs, self._offsets)
+
+    def _set_changed(self):
+        new = sorted((cseq.encode('ascii'), (cid, cprimer)) for cid, (cseq, cprimer) in self._changed.items())
+        self._new_keys = [cnew[0] for cnew in new]
+        self._new_values = [cnew[1] for cnew in new]
+
+    def lookup(self, sequences, no_shorter=False, no_longer=False, min_length=0):
+        '''Get the sequences that are prefixes of / extended by each query sequence
+
+        Parameters
+        ----------
+        sequences: list of str
+            the ACGT sequences to look up
+        no_shorter: bool, optional
+            False (default) to include database sequences that are prefixes of the query sequence
+        no_longer: bool, optional
+            False (default) to include database sequences that the query sequence is a prefix of
+        min_length: int, optional
+            ignore database sequences shorter than min_length
+
+        Returns
+        -------
+        list of list of (int, int)
+            the (sequence id, primer id) of the matching database sequences for each query sequence
+            (the exact match is always included)
+        '''
+        found = []
+        with self._lock:
+            for cseq in sequences:
+                query = cseq.lower().encode('ascii', errors='replace')
+                cfound = []
+                for ckeys, get_value, skip_changed in ((self._keys, self._get_value, True), (self._new_keys, self._new_values.__getitem__, False)):
+                    if not no_longer:
+                        start, end = _find_longer(ckeys, query)
+                    else:
+                        # only the exact matches
+                        start, end = bisect_left(ckeys, query), bisect_right(ckeys, query)
+                    positions = list(range(start, end))
+                    if len(query) < min_length:
+                        positions = [cpos for cpos in positions if len(ckeys[cpos]) >= min_length]
+                    if not no_shorter:
+                        # the exact matches are already included
+                        positions.extend(_find_shorter(ckeys, query[:-1], min_length))
+                    for cpos in positions:
+                        cid, cprimer = get_value(cpos)
+                        if skip_changed and cid in self._changed_ids:
+                            continue
+                        cfound.append((cid, cprimer))
+                found.append(cfound)
+        nfound = len([cfound for cfound in found if len(cfound) > 0])
+        self.hits += nfound
+        self.misses += len(sequences) - nfound
+        return found
+
+    def _get_value(self, pos):
+        return int(self._ids[pos]), int(self._primers[pos])
+
+
+# the close sequences index: the first CLOSE_NUM_BLOCKS * CLOSE_BLOCK_LEN bases of each sequence are split into blocks.
+# a sequence with up to CLOSE_NUM_BLOCKS - 1 mismatches to the query has at least one identical block (pigeonhole), so the search is exact up to MAX_CLOSE_MISMATCHES
+CLOSE_BLOCK_LEN = 16
+CLOSE_NUM_BLOCKS = 6
+CLOSE_MIN_LENGTH = CLOSE_BLOCK_LEN * CLOSE_NUM_BLOCKS
+MAX_CLOSE_MISMATCHES = CLOSE_NUM_BLOCKS - 1
+# the maximal left trim (number of bases removed from the start of the dbBact sequence) tested in the close sequences search
+MAX_LEFT_TRIM = 32
+
+
+def _close_str(query, sequence, max_mismatches, test_left_trim):
+    '''Get the number of mismatches between the query and a dbBact sequence (same as CloseSequencesIndex.lookup() for sequences not in the index arrays)
+
+    Returns
+    -------
+    int or None
+        the number of mismatches (on the length of the shorter sequence), or the left trim position if the query is contained in the sequence. None if not close
+    '''
+    mismatches = sum(1 for cquery, cseq in zip(query, sequence) if cquery != cseq)
+    if mismatches <= max_mismatches:
+        return mismatches
+    if test_left_trim:
+        pos = sequence.find(query)
+        if pos >= 0 and pos <= MAX_LEFT_TRIM:
+            return pos
+    return None
+
+
+class CloseSequencesIndex(_BaseIndex):
+    '''Index for finding the sequences with up to MAX_CLOSE_MISMATCHES mismatches to a query sequence (or containing it, i.e. left trimmed queries)
+    The sequences are stored 2 bit packed (32 bases per uint64 word). For each of the CLOSE_NUM_BLOCKS blocks (of CLOSE_BLOCK_LEN bases)
+    we keep the sequences sorted by the block, so the candidates sharing a block with the query are found using binary search,
+    and the mismatches are counted for all the candidates at once (xor and popcount of the packed words).
+    Sequences with non ACGT characters or shorter than CLOSE_MIN_LENGTH are kept as strings and compared one by one.
+    '''
+    SNAPSHOT_MAGIC = 0xdbbac9
+
+    def __init__(self, filename=None):
+        super().__init__(filename=filename)
+        # the packed sequences (concatenated), the start word of each sequence (and the end of the last), the sequence lengths and ids
+        self._words = np.zeros(0, dtype=np.uint64)
+        self._word_offsets = np.zeros(1, dtype=np.uint64)
+        self._lengths = self._ids = np.zeros(0, dtype=np.uint64)
+        # for each block - the sequence positions sorted by the block, and the sorted block values
+        self._block_order = self._block_keys = np.zeros([CLOSE_NUM_BLOCKS, 0], dtype=np.uint32)
+        # the sequences not in the packed arrays (concatenated), their start offsets and ids
+        self._other_seqs = np.zeros(0, dtype=np.uint8)
+        self._other_offsets = np.zeros(1, dtype=np.uint64)
+        self._other_ids = np.zeros(0, dtype=np.uint64)
+        # the sequences compared one by one (the other sequences and the changed sequences): list of (id, sequence)
+        self._brute = []
+        self.candidates = 0
+        self.query_time = 0
+
+    def _set_sequences(self, ids, primers, sequences):
+        packed = []
+        lengths = []
+        packed_ids = []
+        other = []
+        for cid, cseq in zip(ids, sequences):
+            codes = seqpack.encode(cseq)
+            if len(cseq) < CLOSE_MIN_LENGTH or not seqpack.is_acgt(codes):
+                other.append((cid, cseq))
+                continue
+            packed.append(seqpack.pack_codes(codes))
+            lengths.append(len(cseq))
+            packed_ids.append(cid)
+        word_offsets = np.zeros(len(packed) + 1, dtype=np.uint64)
+        word_offsets[1:] = np.cumsum([len(cwords) for cwords in packed])
+        words = np.concatenate(packed) if len(packed) > 0 else np.zeros(0, dtype=np.uint64)
+        block_order = np.zeros([CLOSE_NUM_BLOCKS, len(packed)], dtype=np.uint32)
+        block_keys = np.zeros([CLOSE_NUM_BLOCKS, len(packed)], dtype=np.uint32)
+        for cblock in range(CLOSE_NUM_BLOCKS):
+            keys = self._get_block(words, word_offsets[:-1], cblock)
+            block_order[cblock] = np.argsort(keys, kind='stable')
+            block_keys[cblock] = keys[block_order[cblock]]
+        other_offsets = np.zeros(len(other) + 1, dtype=np.uint64)
+        other_offsets[1:] = np.cumsum([len(cseq) for cid, cseq in other])
+        self._set_arrays([words, word_offsets, np.array(lengths, dtype=np.uint64), np.array(packed_ids, dtype=np.uint64), block_order, block_keys,
+                          np.frombuffer(''.join(cseq for cid, cseq in other).encode('ascii', errors='replace'), dtype=np.uint8), other_offsets,
+                          np.array([cid for cid, cseq in other], dtype=np.uint64)])
+
+    def _get_arrays(self):
+        return [self._words, self._word_offsets, self._lengths, self._ids, self._block_order.ravel(), self._block_keys.ravel(), self._other_seqs, self._other_offsets, self._other_ids]
+
+    def _set_arrays(self, arrays):
+        arrays = [carr.view(np.ndarray) for carr in arrays]
+        self._words, self._word_offsets, self._lengths, self._ids = [carr.view(np.uint64).ravel() for carr in arrays[:4]]
+        self._block_order, self._block_keys = [carr.view(np.uint32).reshape(CLOSE_NUM_BLOCKS, -1) for carr in arrays[4:6]]
+        self._other_seqs = arrays[6].view(np.uint8)
+        self._other_offsets, self._other_ids = [carr.view(np.uint64).ravel() for carr in arrays[7:]]
+
+    def _set_changed(self):
+        self._brute = []
+        for idx in range(len(self._other_ids)):
+            cid = int(self._other_ids[idx])
+            if cid not in self._changed_ids:
+                self._brute.append((cid, self._other_seqs[self._other_offsets[idx]:self._other_offsets[idx + 1]].tobytes().decode('ascii')))
+        for cid, (cseq, cprimer) in self._changed.items():
+            self._brute.append((cid, cseq))
+
+    @staticmethod
+    def _get_block(words, word_offsets, block):
+        '''Get the value (uint32) of the block for the sequences starting at word_offsets'''
+        cwords = words[word_offsets.astype(np.int64) + (block * CLOSE_BLOCK_LEN) // 32]
+        return ((cwords >> np.uint64(((block * CLOSE_BLOCK_LEN) % 32) * 2)) & np.uint64(0xffffffff)).astype(np.uint32)
+
+    def _find_block(self, block, key):
+        '''Get the positions of the sequences with the given block value'''
+        start = np.searchsorted(self._block_keys[block], key, side='left')
+        end = np.searchsorted(self._block_keys[block], key, side='right')
+        return self._block_order[block][start:end]
+
+    def _get_codes(self, pos):
+        '''Get the 2 bit codes of the sequence at position pos of the packed arrays'''
+        return seqpack.unpack_codes(self._words[int(self._word_offsets[pos]):int(self._word_offsets[pos + 1])], int(self._lengths[pos]))
+
+    def lookup(self, sequences, max_mismatches=1, test_left_trim=True):
+        '''Get the dbBact sequences close to each query sequence
+
+        Parameters
+        ----------
+        sequences: list of str
+            the ACGT sequences to look up
+        max_mismatches: int, optional
+            the maximal number of mismatches (on the length of the shorter sequence). must be <= MAX_CLOSE_MISMATCHES
+        test_left_trim: bool, optional
+            True to also return dbBact sequences containing the query starting at position <= MAX_LEFT_TRIM (the query was left trimmed)
+
+        Returns
+        -------
+        list of (list of dict {'sequence': str, 'seq_id': int, 'num_mismatches': int}) or None
+            the close sequences for each query (ordered by the number of mismatches), or None if the query cannot be searched in the index
+            (shorter than CLOSE_MIN_LENGTH or containing non ACGT characters)
+            for left trimmed matches, num_mismatches is the position of the query in the dbBact sequence
+        '''
+        start_time = time.time()
+        groups = np.array_split(np.arange(CLOSE_NUM_BLOCKS), max_mismatches + 1)
+        all_found = []
+        num_candidates = 0
+        with self._lock:
+            for cseq in sequences:
+                cseq = cseq.lower()
+                query_codes = seqpack.encode(cseq)
+                if len(cseq) < CLOSE_MIN_LENGTH or not seqpack.is_acgt(query_codes):
+                    all_found.append(None)
+                    continue
+                query_words = seqpack.pack_codes(query_codes)
+                # the value of each CLOSE_BLOCK_LEN window of the query (for the left trim search)
+                window_keys = seqpack.kmer_keys(query_codes, CLOSE_BLOCK_LEN)[0].astype(np.uint32)
+                found = {}
+                # candidates with up to max_mismatches mismatches have all the blocks of at least one group identical to the query
+                candidates = []
+                for cgroup in groups:
+                    matches = [self._find_block(cblock, window_keys[cblock * CLOSE_BLOCK_LEN]) for cblock in cgroup]
+                    best = int(np.argmin([len(cmatch) for cmatch in matches]))
+                    ccand = matches[best]
+                    for cblock in cgroup:
+                        if len(ccand) == 0:
+                            break
+                        if cblock != cgroup[best]:
+                            ccand = ccand[self._get_block(self._words, self._word_offsets[ccand], cblock) == window_keys[cblock * CLOSE_BLOCK_LEN]]
+                    candidates.append(ccand)
+                candidates = np.unique(np.concatenate(candidates)).astype(np.int64)
+                num_candidates += len(candidates)
+                if len(candidates) > 0:
+                    mismatches = seqpack.hamming_distance(self._words, self._word_offsets[candidates], self._lengths[candidates], query_words, len(cseq))
+                    for cpos, cmismatches in zip(candidates[mismatches <= max_mismatches], mismatches[mismatches <= max_mismatches]):
+                        found[int(cpos)] = int(cmismatches)
+                if test_left_trim:
+                    for ctrim in range(1, MAX_LEFT_TRIM + 1):
+                        # the blocks of the dbBact sequence fully covered by the query (if it starts at position ctrim)
+                        blocks = [cblock for cblock in range(CLOSE_NUM_BLOCKS) if cblock * CLOSE_BLOCK_LEN >= ctrim and (cblock + 1) * CLOSE_BLOCK_LEN - ctrim <= len(cseq)]
+                        if len(blocks) == 0:
+                            continue
+                        matches = [self._find_block(cblock, window_keys[cblock * CLOSE_BLOCK_LEN - ctrim]) for cblock in blocks]
+                        ccand = min(matches, key=len)
+                        ccand = ccand[self._lengths[ccand] >= len(cseq) + ctrim]
+                        num_candidates += len(ccand)
+                        for cpos in ccand:
+                            cpos = int(cpos)
+                            if cpos not in found and seqpack.find(self._get_codes(cpos), query_codes, ctrim, ctrim) == ctrim:
+                                found[cpos] = ctrim
+                cres = []
+                for cpos, cmismatches in found.items():
+                    cid = int(self._ids[cpos])
+                    if cid in self._changed_ids:
+                        continue
+                    cres.append({'sequence': seqpack.decode(self._get_codes(cpos)), 'seq_id': cid, 'num_mismatches': cmismatches})
+                for cid, cdbseq in self._brute:
+                    cmismatches = _close_str(cseq, cdbseq, max_mismatches, test_left_trim)
+                    if cmismatches is not None:
+                        cres.append({'sequence': cdbseq, 'seq_id': cid, 'num_mismatches': cmismatches})
+                cres.sort(key=lambda x: (x['num_mismatches'], x['seq_id']))
+                all_found.append(cres)
+        query_time = time.time() - start_time
+        nfound = len([cfound for cfound in all_found if cfound])
+        self.hits += nfound
+        self.misses += len(sequences) - nfound
+        self.candidates += num_candidates
+        self.query_time += query_time
+        debug(2, 'close sequences for %d queries: %d candidates, %d queries with matches. time %f sec', len(sequences), num_candidates, nfound, query_time)
+        return all_found
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['candidates'] = self.candidates
+        stats['query_time'] = self.query_time
+        return stats
+
+
+def _get_index(index_type, con, cur):
+    '''Refresh the index of the given type and return it if it is enabled and valid (otherwise None)'''
+    index = _indexes.get(index_type)
+    if index is None:
+        return None
+    index.refresh(con, cur)
+    if not index.valid:
+        return None
+    return index
+
+
+def init_sequence_index(filename=None, index_type='exact'):
+    '''Enable a sequence index for this process (called on server start)
+    The index is built/loaded on first use
+
+    Parameters
+    ----------
+    filename: str or None, optional
+        the snapshot file to load the index from (created by dbbact_jobs/update_sequence_index.py)
+        None to build the index from the database in each worker
+    index_type: str, optional
+        the index to enable (see INDEX_TYPES):
+        'exact' (default) - the exact sequence index (SequenceIndex)
+        'prefix' - the prefix index (PrefixIndex)
+        'close' - the close sequences index (CloseSequencesIndex)
+    '''
+    if np is None:
+        debug(6, 'numpy not installed. sequence index disabled')
+        return
+    index = INDEX_TYPES[index_type](filename=filename)
+    _indexes[index_type] = index
+    if filename is not None:
+        index.load()
+
+
+def lookup_sequences(con, cur, sequences):
+    '''Look up exact sequences in the sequence index of the worker (if enabled)
+
+    Parameters
+    ----------
+    con, cur
+    sequences: list of str
+        the ACGT sequences to look up
+
+    Returns
+    -------
+    list of (int, int) or None, or None if the index is not enabled/valid
+        the (sequence id, primer id) for each sequence, or None for sequences not in the index (should be looked up in the database)
+    '''
+    index = _get_index('exact', con, cur)
+    if index is None:
+        return None
+    return index.lookup(sequences)
+
+
+def lookup_sequence_digests(con, cur, digests):
+    '''Look up sequence digests (see sequence_digest()) in the sequence index of the worker (if enabled)
+
+    Parameters
+    ----------
+    con, cur
+    digests: list of bytes
+        the 16 byte sequence digests to look up
+
+    Returns
+    -------
+    list of (int, int) or None, or None if the index is not enabled/valid
+        the (sequence id, primer id) for each digest, or None for digests not in the index (should be looked up in the database)
+    '''
+    index = _get_index('exact', con, cur)
+    if index is None:
+        return None
+    return index.lookup_digests(digests)
+
+
+def lookup_prefix_sequences(con, cur, sequences, no_shorter=False, no_longer=False, min_length=0):
+    '''Look up the sequences that are prefixes of / extended by the query sequences in the prefix index of the worker (if enabled)
+
+    Parameters
+    ----------
+    con, cur
+    sequences: list of str
+        the ACGT sequences to look up
+    no_shorter: bool, optional
+        False (default) to include database sequences that are prefixes of the query sequence
+    no_longer: bool, optional
+        False (default) to include database sequences that the query sequence is a prefix of
+    min_length: int, optional
+        ignore database sequences shorter than min_length
+
+    Returns
+    -------
+    list of list of (int, int), or None if the index is not enabled/valid
+        the (sequence id, primer id) of the matching database sequences for each query sequence
+    '''
+    index = _get_index('prefix', con, cur)
+    if index is None:
+        return None
+    return index.lookup(sequences, no_shorter=no_shorter, no_longer=no_longer, min_length=min_length)
+
+
+def lookup_close_sequences(con, cur, sequences, max_mismatches=1, test_left_trim=True):
+    '''Look up the sequences close to the query sequences in the close sequences index of the worker (if enabled)
+
+    Parameters
+    ----------
+    con, cur
+    sequences: list of str
+        the ACGT sequences to look up
+    max_mismatches: int, optional
+        the maximal number of mismatches (<= MAX_CLOSE_MISMATCHES)
+    test_left_trim: bool, optional
+        True to also return dbBact sequences containing the query (starting at position <= MAX_LEFT_TRIM)
+
+    Returns
+    -------
+    list of (list of dict {'sequence': str, 'seq_id': int, 'num_mismatches': int} or None), or None if the index is not enabled/valid
+        the close sequences for each query, or None for queries that cannot be searched in the index (should be searched in the database)
+    '''
+    index = _get_index('close', con, cur)
+    if index is None:
+        return None
+    if _close_pool_size > 1 and index.filename is not None and len(sequences) >= CLOSE_POOL_MIN_QUERIES:
+        return _lookup_close_parallel(index, sequences, max_mismatches, test_left_trim)
+    return index.lookup(sequences, max_mismatches=max_mismatches, test_left_trim=test_left_trim)
+
+
+def set_close_pool_size(size):
+    '''Set the number of processes used for large close sequences lookups (called on server start)
+    The pool processes memory map the close index snapshot file, so the pool is used only if the index is loaded from a snapshot (DBBACT_CLOSE_INDEX is a file name)
+
+    Parameters
+    ----------
+    size: int
+        the number of processes in the pool (created on first use). 0 or 1 to look up in the worker process
+    '''
+    global _close_pool_size
+
+    _close_pool_size = size
+
+
+def _close_lookup_task(filename, mtime, version, changed, sequences, max_mismatches, test_left_trim):
+    '''Look up close sequences in a pool process (called by _lookup_close_parallel())
+    The pool process loads the snapshot once, and updates the changed sequences from the calling worker when the version changes
+
+    Returns
+    -------
+    list of (list of dict or None), or None if the snapshot file changed (so the calling worker should look up the sequences)
+    '''
+    index = _indexes.get('close')
+    if index is None or index._mtime != mtime:
+        index = CloseSequencesIndex(filename=filename)
+        if index.load() or index._mtime != mtime:
+            return None
+        _indexes['close'] = index
+    if index.version != version:
+        index._changed, index._changed_ids = changed
+        index._set_changed()
+        index.version = version
+    return index.lookup(sequences, max_mismatches=max_mismatches, test_left_trim=test_left_trim)
+
+
+def _lookup_close_parallel(index, sequences, max_mismatches, test_left_trim):
+    '''Look up close sequences in the process pool, splitting the queries between the pool processes
+
+    Returns
+    -------
+    list of (list of dict or None), same as CloseSequencesIndex.lookup()
+    '''
+    global _close_pool
+
+    start_time = time.time()
+    if _close_pool is None:
+        # spawn (and not fork) since the worker has open database connections and threads
+        _close_pool = ProcessPoolExecutor(max_workers=_close_pool_size, mp_context=multiprocessing.get_context('spawn'))
+    with index._lock:
+        mtime = index._mtime
+        version = index.version
+        changed = (dict(index._changed), set(index._changed_ids))
+    chunk_size = (len(sequences) + _close_pool_size - 1) // _close_pool_size
+    chunks = [sequences[pos:pos + chunk_size] for pos in range(0, len(sequences), chunk_size)]
+    futures = [_close_pool.submit(_close_lookup_task, index.filename, mtime, version, changed, cchunk, max_mismatches, test_left_trim) for cchunk in chunks]
+    all_found = []
+    for cchunk, cfuture in zip(chunks, futures):
+        cfound = cfuture.result()
+        if cfound is None:
+            debug(3, 'close index snapshot changed. looking up %d sequences in the worker', len(cchunk))
+            cfound = index.lookup(cchunk, max_mismatches=max_mismatches, test_left_trim=test_left_trim)
+        else:
+            nfound = len([cres for cres in cfound if cres])
+            index.hits += nfound
+            index.misses += len(cchunk) - nfound
+        all_found.extend(cfound)
+    index.query_time += time.time() - start_time
+    debug(2, 'close sequences for %d queries using %d processes took %f sec', len(sequences), len(chunks), time.time() - start_time)
+    return all_found
+
+
+def get_index_stats():
+    '''Get the statistics of the sequence indexes of the worker
+
+    Returns
+    -------
+    dict of {index_type: dict} for the enabled indexes, or None if no index is enabled
+    '''
+    if len(_indexes) == 0:
+        return None
+    return {cindex_type: cindex.get_stats() for cindex_type, cindex in _indexes.items()}
+
+
+# the index classes by index type (used in init_sequence_index())
+INDEX_TYPES = {'exact': SequenceIndex, 'prefix': PrefixIndex, 'close': CloseSequencesIndex}
@@ -0,0 +1,218 @@
+'''2 bit packed sequences and vectorized comparison functions (requires numpy)
+
+Each base is encoded to 2 bits (a=0, c=1, g=2, t=3), 32 bases per uint64 word (the first base in the lowest bits, the last word padded with 'a').
+Non ACGT characters (N and the other IUPAC codes) are escaped: packed as 'a', marked in the escape mask (same layout as the packed words,
+both bits of an escaped base are set), and their characters are stored separately so the sequence can be unpacked.
+
+The comparison functions work on many packed sequences at once (the words of all sequences concatenated, with the start word of each sequence),
+and on ACGT sequences (escaped bases are compared as 'a'; sequences with escaped bases should be compared as strings).
+'''
+
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# code for the non ACGT characters in encode()
+ESCAPE_CODE = 255
+
+# a packed sequence: the 2 bit words, the escape mask words, the sequence length, and the escaped characters (bytes, in order)
+PackedSequence = namedtuple('PackedSequence', ['words', 'mask', 'length', 'escapes'])
+
+if np is not None:
+    # the 2 bit code of each character (ESCAPE_CODE for non ACGT)
+    _BASE_CODES = np.full(256, ESCAPE_CODE, dtype=np.uint8)
+    for _code, _base in enumerate(b'acgt'):
+        _BASE_CODES[_base] = _code
+        _BASE_CODES[ord(chr(_base).upper())] = _code
+    _BASES = np.frombuffer(b'acgt', dtype=np.uint8)
+    # the shift of each base in the word
+    _SHIFTS = np.arange(0, 64, 2, dtype=np.uint64)
+    _POPCOUNT8 = np.array([bin(cval).count('1') for cval in range(256)], dtype=np.uint8)
+    _ODD_BITS = np.uint64(0x5555555555555555)
+    _ALL_BITS = np.uint64(0xffffffffffffffff)
+
+
+def encode(sequence):
+    '''Get the 2 bit codes of a sequence
+
+    Parameters
+    ----------
+    sequence: str
+        the sequence (upper or lower case)
+
+    Returns
+    -------
+    numpy array of uint8
+        the code (0-3) of each base, ESCAPE_CODE for non ACGT characters
+    '''
+    return _BASE_CODES[np.frombuffer(sequence.encode('ascii', errors='replace'), dtype=np.uint8)]
+
+
+def is_acgt(codes):
+    '''True if the codes (from encode()) contain only ACGT bases'''
+    return len(codes) == 0 or codes.max() != ESCAPE_CODE
+
+
+def pack_codes(codes):
+    '''Pack 2 bit codes into uint64 words (escaped bases are packed as 'a')
+
+    Parameters
+    ----------
+    codes: numpy array of uint8
+        the base codes (from encode())
+
+    Returns
+    -------
+    numpy array of uint64
+        the packed words (ceil(len(codes) / 32) words)
+    '''
+    padded = np.zeros((len(codes) + 31) // 32 * 32, dtype=np.uint64)
+    padded[:len(codes)] = np.where(codes == ESCAPE_CODE, 0, codes)
+    return np.bitwise_or.reduce(padded.reshape(-1, 32) << _SHIFTS, axis=1)
+
+
+def unpack_codes(words, length):
+    '''Get the 2 bit codes (numpy array of uint8) of the first length bases of the packed words'''
+    return ((words[:, None] >> _SHIFTS) & np.uint64(3)).astype(np.uint8).ravel()[:length]
+
+
+def decode(codes):
+    '''Get the (lowercase) ACGT sequence (str) of the 2 bit codes'''
+    return _BASES[codes].tobytes().decode('ascii')
+
+
+def pack(sequence):
+    '''Pack a sequence (see PackedSequence)
+
+    Parameters
+    ----------
+    sequence: str
+        the sequence (upper or lower case, can contain non ACGT characters)
+
+    Returns
+    -------
+    PackedSequence
+    '''
+    codes = encode(sequence)
+    escaped = codes == ESCAPE_CODE
+    escapes = np.frombuffer(sequence.encode('ascii', errors='replace'), dtype=np.uint8)[escaped].tobytes()
+    return PackedSequence(pack_codes(codes), pack_codes(np.where(escaped, 3, 0).astype(np.uint8)), len(codes), escapes.lower())
+
+
+def unpack(packed):
+    '''Get the (lowercase) sequence (str) of a PackedSequence'''
+    chars = _BASES[unpack_codes(packed.words, packed.length)]
+    if len(packed.escapes) > 0:
+        chars[unpack_codes(packed.mask, packed.length) == 3] = np.frombuffer(packed.escapes, dtype=np.uint8)
+    return chars.tobytes().decode('ascii')
+
+
+def popcount(words):
+    '''Count the set bits in each uint64 of the array'''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    words = np.ascontiguousarray(words)
+    return _POPCOUNT8[words.view(np.uint8)].reshape(words.shape + (8, )).sum(axis=-1)
+
+
+def kmer_keys(codes, k):
+    '''Get the packed value of each k-mer (window of k bases) of a sequence
+
+    Parameters
+    ----------
+    codes: numpy array of uint8
+        the base codes (from encode())
+    k: int
+        the k-mer length (<= 32)
+
+    Returns
+    -------
+    keys: numpy array of uint64
+        the value of the k-mer starting at each position (the first base in the lowest bits)
+    valid: numpy array of bool
+        False for k-mers containing escaped bases
+    '''
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    num_kmers = len(codes) - k + 1
+    escaped = codes == ESCAPE_CODE
+    codes = np.where(escaped, 0, codes).astype(np.uint64)
+    # add the bases one by one (k vector operations instead of a num_kmers x k matrix)
+    keys = codes[:num_kmers].copy()
+    for cpos in range(1, k):
+        keys |= codes[cpos:cpos + num_kmers] << _SHIFTS[cpos]
+    num_escaped = np.concatenate([[0], np.cumsum(escaped)])
+    valid = num_escaped[k:] == num_escaped[:num_kmers]
+    return keys, valid
+
+
+def hamming_distance(words, offsets, lengths, query_words, query_len):
+    '''Count the mismatches between a query and many packed sequences, on the length of the shorter of each pair
+
+    Parameters
+    ----------
+    words: numpy array of uint64
+        the packed words of all the sequences (concatenated)
+    offsets: numpy array of int
+        the start word (in words) of each sequence to compare
+    lengths: numpy array of int
+        the length of each sequence to compare
+    query_words: numpy array of uint64
+        the packed query
+    query_len: int
+        the query length
+
+    Returns
+    -------
+    numpy array of int
+        the number of mismatches for each sequence
+    '''
+    if len(offsets) == 0:
+        return np.zeros(0, dtype=np.int64)
+    compare_len = np.minimum(np.asarray(lengths, dtype=np.int64), query_len)
+    word_pos = np.arange(len(query_words))
+    # the words to compare for each sequence (repeating the last word of sequences shorter than the query. masked below)
+    cand_words = words[np.asarray(offsets, dtype=np.int64)[:, None] + np.minimum(word_pos[None, :], np.maximum((compare_len[:, None] + 31) // 32 - 1, 0))]
+    diff = cand_words ^ query_words[None, :]
+    # one bit per different base
+    diff = (diff | (diff >> np.uint64(1))) & _ODD_BITS
+    # mask the bases after the compared length
+    num_valid = np.clip(compare_len[:, None] - 32 * word_pos[None, :], 0, 32).astype(np.uint64)
+    mask = np.where(num_valid == 32, _ALL_BITS, (np.uint64(1) << (np.uint64(2) * np.minimum(num_valid, np.uint64(31)))) - np.uint64(1))
+    return popcount(diff & mask).sum(axis=1).astype(np.int64)
+
+
+def prefix_equal(words, offsets, lengths, query_words, query_len):
+    '''Test for many packed sequences if the shorter of the sequence and the query is a prefix of the other (see hamming_distance() for the parameters)
+
+    Returns
+    -------
+    numpy array of bool
+    '''
+    return hamming_distance(words, offsets, lengths, query_words, query_len) == 0
+
+
+def find(codes, query_codes, start=0, end=None):
+    '''Find the first position of a query in a sequence (like str.find(), on the 2 bit codes)
+
+    Parameters
+    ----------
+    codes: numpy array of uint8
+        the codes of the sequence (from encode() or unpack_codes())
+    query_codes: numpy array of uint8
+        the codes of the query
+    start, end: int, optional
+        find only occurrences starting at positions start to end (inclusive). None for any position
+    NOTE: escaped bases match any escaped base (compare the strings to test the escaped characters)
+
+    Returns
+    -------
+    int
+        the position of the query in the sequence, or -1 if not found
+    '''
+    if end is not None:
+        codes = codes[:end + len(query_codes)]
+    return codes.tobytes().find(query_codes.tobytes(), start)
@@ -0,0 +1,333 @@
+'''In-memory ontology term dictionary (OntologyTable and OntologySynonymTable), used to convert between the term descriptions, dbbact ids,
+ontology term_ids and synonyms without a query per term
+
+The terms are stored sorted by id: ids is an array of the dbbact ids, and descriptions/term_ids are lists (of interned strings) of the same order,
+with dicts from the description/term_id to the id (or tuple of ids if not unique), and a dict from each synonym to the term id.
+The dictionary is loaded once per worker (on first use), and updated using the ChangeLogTable (see dbchanges.py), like the ontology graph (ontology_graph.py):
+changed terms (add_ontology_term() and AddSynonym() record the term id) are re-read and stored in an override dict,
+and changes to an unknown set of terms (bulk updates) cause a reload.
+Terms changed by the current (not yet committed) transaction are invalidated using invalidate_terms(), so they are read from the database.
+The descriptions/term_ids/synonyms of the invalidated terms are also invalidated (new terms are not in the dictionary, so their ids are not enough),
+so they are looked up in the database until the term change is read by refresh().
+
+NOTE: terms not found in the dictionary (i.e. added in the current transaction) are always looked up in the database,
+so the dictionary is used only to save queries, and not to decide a term does not exist.
+'''
+
+import sys
+import time
+import threading
+from array import array
+from bisect import bisect_left
+
+import psycopg2
+
+from .utils import debug
+from . import dbchanges
+
+# the maximal number of terms in the override dict before reloading the whole dictionary
+MAX_OVERRIDES = 10000
+# the minimal time (seconds) between load attempts if the dictionary could not be loaded
+RELOAD_INTERVAL = 60
+
+# the term dictionary of this worker (created on first use, see get_term_dict())
+_term_dict = None
+_enabled = True
+
+
+def _intern(value):
+    '''Intern a string (so descriptions repeated as term_ids/synonyms are stored once)'''
+    if value is None:
+        return None
+    return sys.intern(value)
+
+
+def _add_key(mapping, key, term_id):
+    '''Add the term id to the key in a dict of {key: id or tuple of ids}'''
+    cval = mapping.get(key)
+    if cval is None:
+        mapping[key] = term_id
+    elif isinstance(cval, tuple):
+        if term_id not in cval:
+            mapping[key] = cval + (term_id, )
+    elif cval != term_id:
+        mapping[key] = (cval, term_id)
+
+
+def _remove_key(mapping, key, term_id):
+    '''Remove the term id from the key in a dict of {key: id or tuple of ids}'''
+    cval = mapping.get(key)
+    if cval is None:
+        return
+    if isinstance(cval, tuple):
+        cval = tuple(cid for cid in cval if cid != term_id)
+        if len(cval) == 1:
+            cval = cval[0]
+        mapping[key] = cval
+    elif cval == term_id:
+        del mapping[key]
+
+
+def _key_ids(mapping, key):
+    '''Get the (sorted) list of ids of the key in a dict of {key: id or tuple of ids}'''
+    cval = mapping.get(key)
+    if cval is None:
+        return []
+    if isinstance(cval, tuple):
+        return sorted(cval)
+    return [cval]
+
+
+class TermDictionary:
+    '''The ontology term descriptions, term_ids and synonyms (from OntologyTable and OntologySynonymTable)'''
+    def __init__(self):
+        self.version = None
+        self.valid = False
+        self.build_time = 0
+        self._last_load = 0
+        self._ids = array('l')
+        self._descriptions = []
+        self._term_ids = []
+        self._by_description = {}
+        self._by_term_id = {}
+        self._synonyms = {}
+        # the terms changed since the dictionary was loaded: {id: (description, term_id)}, or None if should be read from the database
+        self._overrides = {}
+        # the descriptions/term_ids/synonyms (lower case) of the invalidated terms, which should be looked up in the database: {key: term id}
+        self._invalid_keys = {}
+        self._lock = threading.RLock()
+        self.lookups = 0
+        self.misses = 0
+
+    def load(self, con, cur):
+        '''Load all the terms and synonyms
+
+        Returns
+        -------
+        err: str
+            empty ('') if ok, otherwise the error encountered
+        '''
+        start_time = time.time()
+        self._last_load = start_time
+        # get the version before reading the terms, so we will not miss changes during the load
+        err, version = dbchanges.get_data_version(con, cur, use_cached=False)
+        if err:
+            return err
+        if not version:
+            self.valid = False
+            return 'data version not available. term dictionary disabled'
+        ids = array('l')
+        descriptions = []
+        term_ids = []
+        by_description = {}
+        by_term_id = {}
+        synonyms = {}
+        try:
+            cur.execute('SELECT id, description, term_id FROM OntologyTable ORDER BY id')
+            for cres in cur:
+                ids.append(cres[0])
+                descriptions.append(_intern(cres[1]))
+                term_ids.append(_intern(cres[2]))
+                _add_key(by_description, descriptions[-1], cres[0])
+                _add_key(by_term_id, term_ids[-1], cres[0])
+            cur.execute('SELECT synonym, idOntology FROM OntologySynonymTable ORDER BY uniqueId')
+            for cres in cur:
+                # same as GetSynonymTermId(), use the first term with this synonym
+                synonyms.setdefault(_intern(cres[0]), cres[1])
+        except psycopg2.DatabaseError as e:
+            debug(7, 'error %s encountered when loading the term dictionary', e)
+            self.valid = False
+            return 'error %s encountered when loading the term dictionary' % e
+        with self._lock:
+            self._ids, self._descriptions, self._term_ids = ids, descriptions, term_ids
+            self._by_description, self._by_term_id, self._synonyms = by_description, by_term_id, synonyms
+            self._overrides = {}
+            # the invalidated terms we read are committed (or changed by this transaction), so no need to look up their keys in the database
+            self._invalid_keys = {ckey: cid for ckey, cid in self._invalid_keys.items() if not self._has_id(cid)}
+            self.version = version
+            self.valid = True
+            self.build_time = time.time() - start_time
+        debug(3, 'term dictionary loaded with %d terms, %d synonyms (version %d) in %f sec', len(ids), len(synonyms), version, self.build_time)
+        return ''
+
+    def refresh(self, con, cur):
+        '''Update the dictionary with the term changes since it was loaded (using the ChangeLogTable), or load it if needed
+
+        Returns
+        -------
+        err: str
+            empty ('') if ok, otherwise the error encountered
+        '''
+        if not self.valid:
+            if time.time() - self._last_load < RELOAD_INTERVAL:
+                return 'term dictionary not loaded'
+            return self.load(con, cur)
+        err, version = dbchanges.get_data_version(con, cur)
+        if err:
+            return err
+        if version <= self.version:
+            return ''
+        with self._lock:
+            changed_ids = set()
+            since = self.version
+            while True:
+                # only the committed changes (our own uncommitted changes may be rolled back)
+                err, changes = dbchanges.get_changes(con, cur, since, entity='term', until_version=version)
+                if err:
+                    self.valid = False
+                    return err
+                if len(changes) == 0:
+                    break
+                for cchange in changes:
+                    if cchange['id'] is None:
+                        debug(3, 'bulk term change in version %d. reloading the term dictionary', cchange['version'])
+                        return self.load(con, cur)
+                    changed_ids.add(cchange['id'])
+                since = changes[-1]['version']
+            if len(changed_ids) > 0:
+                try:
+                    cur.execute('SELECT id, description, term_id FROM OntologyTable WHERE id = ANY(%s)', [list(changed_ids)])
+                    terms = {cres[0]: (_intern(cres[1]), _intern(cres[2])) for cres in cur}
+                    cur.execute('SELECT synonym, idOntology FROM OntologySynonymTable WHERE idOntology = ANY(%s) ORDER BY uniqueId', [list(changed_ids)])
+                    new_synonyms = [(_intern(cres[0]), cres[1]) for cres in cur]
+                except psycopg2.DatabaseError as e:
+                    debug(7, 'error %s encountered when refreshing the term dictionary', e)
+                    self.valid = False
+                    return 'error %s encountered when refreshing the term dictionary' % e
+                for cid in changed_ids:
+                    self._set_term(cid, terms.get(cid))
+                for ckey in [ckey for ckey, cid in self._invalid_keys.items() if cid in changed_ids]:
+                    del self._invalid_keys[ckey]
+                for csynonym, cid in new_synonyms:
+                    self._synonyms.setdefault(csynonym, cid)
+                if len(self._overrides) > MAX_OVERRIDES:
+                    debug(3, 'too many changed terms in the term dictionary. reloading')
+                    return self.load(con, cur)
+            self.version = version
+            debug(2, 'term dictionary refreshed to version %d (%d changed terms)', self.version, len(changed_ids))
+        return ''
+
+    def _set_term(self, term_id, info):
+        '''Replace the description and term_id of a term (info is (description, term_id), or None to read the term from the database)'''
+        old_info = self.get(term_id)
+        if old_info is not None:
+            _remove_key(self._by_description, old_info[0], term_id)
+            _remove_key(self._by_term_id, old_info[1], term_id)
+        self._overrides[term_id] = info
+        if info is not None:
+            _add_key(self._by_description, info[0], term_id)
+            _add_key(self._by_term_id, info[1], term_id)
+
+    def invalidate(self, term_ids, keys=()):
+        '''Read the terms from the database until the next change (i.e. terms changed in the current transaction)
+
+        Parameters
+        ----------
+        term_ids: list of int
+        keys: list of str, optional
+            the descriptions/term_ids/synonyms of the terms, to look up in the database until the term change is read
+        '''
+        with self._lock:
+            for cid in term_ids:
+                self._set_term(cid, None)
+                for ckey in keys:
+                    self._invalid_keys[ckey.lower()] = cid
+
+    def is_valid_key(self, key):
+        '''False if the description/term_id/synonym (lower case) was invalidated, so should be looked up in the database'''
+        return key not in self._invalid_keys
+
+    def _has_id(self, term_id):
+        pos = bisect_left(self._ids, term_id)
+        return pos < len(self._ids) and self._ids[pos] == term_id
+
+    def get(self, term_id):
+        '''Get the (description, term_id) of a dbbact term id, or None if not in the dictionary'''
+        if term_id in self._overrides:
+            return self._overrides[term_id]
+        pos = bisect_left(self._ids, term_id)
+        if pos < len(self._ids) and self._ids[pos] == term_id:
+            return self._descriptions[pos], self._term_ids[pos]
+        return None
+
+    def ids_from_description(self, description):
+        '''Get the list of dbbact ids of the terms with the description (i.e. 'feces')'''
+        return _key_ids(self._by_description, description)
+
+    def ids_from_term_id(self, term_id):
+        '''Get the list of dbbact ids of the terms with the ontology term_id (i.e. 'envo:00000001')'''
+        return _key_ids(self._by_term_id, term_id)
+
+    def synonym_id(self, synonym):
+        '''Get the dbbact id of the term for the synonym, or None if not in the dictionary'''
+        if not self.is_valid_key(synonym):
+            return None
+        cid = self._synonyms.get(synonym)
+        if cid is not None and cid in self._overrides and self._overrides[cid] is None:
+            # the term was invalidated
+            return None
+        return cid
+
+    def get_stats(self):
+        '''Get the dictionary statistics (for /stats/cache)'''
+        return {'terms': len(self._ids), 'synonyms': len(self._synonyms), 'changed': len(self._overrides), 'invalid_keys': len(self._invalid_keys), 'valid': self.valid,
+                'version': self.version, 'load_time': self.build_time, 'lookups': self.lookups, 'misses': self.misses}
+
+
+def get_term_dict(con, cur):
+    '''Get the term dictionary of this worker (loaded on first use and refreshed with the latest changes)
+
+    Parameters
+    ----------
+    con, cur
+
+    Returns
+    -------
+    TermDictionary or None
+        None if the dictionary is disabled or cannot be used (i.e. the data version is not available), so the database should be queried instead
+    '''
+    global _term_dict
+
+    if not _enabled:
+        return None
+    if _term_dict is None:
+        _term_dict = TermDictionary()
+    err = _term_dict.refresh(con, cur)
+    if err or not _term_dict.valid:
+        return None
+    return _term_dict
+
+
+def invalidate_terms(term_ids, keys=()):
+    '''Invalidate terms changed (not yet committed) by this worker, so they are read from the database
+
+    Parameters
+    ----------
+    term_ids: list of int
+        the dbbact ids of the changed terms
+    keys: list of str, optional
+        the descriptions/term_ids/synonyms added/changed for the terms (i.e. of a new term), so the lookups of these are done in the database
+    '''
+    if _term_dict is None or not _term_dict.valid:
+        return
+    _term_dict.invalidate(term_ids, keys)
+
+
+def set_term_dict_enabled(enabled):
+    '''Enable/disable the term dictionary for this worker (called on server start)
+
+    Parameters
+    ----------
+    enabled: bool
+        False to always query the database for the term descriptions/ids/synonyms
+    '''
+    global _enabled
+
+    _enabled = enabled
+
+
+def get_term_dict_stats():
+    '''Get the term dictionary statistics, or None if not loaded'''
+    if _term_dict is None:
+        return None
+    return _term_dict.get_stats()
@@ -1,14 +1,30 @@
+import os
 import sys
+import time
+import json
+import hmac
+import base64
+import hashlib
 import smtplib
 import random
 import string
 import datetime
-import inspect
+import collections
 
 debuglevel = 6
+# per-module debug levels (module name, i.e. 'dbbact_server.dbsequences' -> level). overrides debuglevel for these modules
+_module_levels = {}
+# minimal level of debug records kept in the recent records ring buffer (None to keep only the printed records)
+ringlevel = None
+# the recent debug records. each record is (time, level, file, function, line, msg, source), msg is formatted and truncated to MAX_RECORD_LEN
+_recent_records = collections.deque(maxlen=1000)
+# the maximal message length kept in the recent records ring buffer
+MAX_RECORD_LEN = 1000
+# the lowest level that can be printed or kept (for quick filtering of the debug() calls)
+_min_level = debuglevel
 
 
-def debug(level, msg, request=None):
+def debug(level, msg, *args, request=None):
     """
     print a debug message
 
@@ -16,42 +32,134 @@ def debug(level, msg, request=None):
     level : int
         error level (0=debug, 4=info, 7=warning,...10=critical)
     msg : str
-        the debug message
+        the debug message. if args are supplied, the message is formatted using msg % args only if it is printed
+        (so expensive formatting can be skipped using debug(1, 'sequence %s', sequence))
+    args :
+        the arguments for formatting msg
     request: requests.Request or None, optional
         not None to write the source address of the request
-    ofile: str or None, optional
-        name of file to write the debug info into, or None to print to stderr
     """
-    global debuglevel
-
-    if level >= debuglevel:
+    if level < _min_level:
+        return
+    try:
+        frame = sys._getframe(1)
+        module = frame.f_globals.get('__name__')
+        code = frame.f_code
+        cfile = code.co_filename.split('/')[-1]
+        cfunction = code.co_name
+        cline = frame.f_lineno
+    except:
+        module = None
+        cfile = 'NA'
+        cline = 'NA'
+        cfunction = 'NA'
+    emit = level >= _module_levels.get(module, debuglevel)
+    if not emit and (ringlevel is None or level < ringlevel):
+        return
+    source = None
+    if request is not None:
         try:
-            cf = inspect.stack()[1]
-            cfile = cf.filename.split('/')[-1]
-            cline = cf.lineno
-            cfunction = cf.function
+            if request.environ.get('HTTP_X_FORWARDED_FOR') is None:
+                source = request.environ['REMOTE_ADDR']
+            else:
+                source = request.environ['HTTP_X_FORWARDED_FOR']
         except:
-            cfile = 'NA'
-            cline = 'NA'
-            cfunction = 'NA'
-        omsg = '[%s] [%d] [%s:%s:%s] ' % (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), level, cfile, cfunction, cline)
-        if request is not None:
-            try:
-                if request.environ.get('HTTP_X_FORWARDED_FOR') is None:
-                    source = request.environ['REMOTE_ADDR']
-                else:
-                    source = request.environ['HTTP_X_FORWARDED_FOR']
-            except:
-                source = 'Failed'
-            omsg += '[IP: %s] ' % source
-        omsg += '%s' % msg
-        print(omsg, file=sys.stderr, flush=True)
-
-
-def SetDebugLevel(level):
+            source = 'Failed'
+    if args:
+        try:
+            msg = msg % args
+        except Exception as e:
+            msg = '%s %s (formatting failed: %s)' % (msg, args, e)
+    else:
+        msg = '%s' % msg
+    record = (time.time(), level, cfile, cfunction, cline, msg, source)
+    # keep only the formatted (and truncated) message, so the args are not kept alive by the ring buffer
+    if len(msg) > MAX_RECORD_LEN:
+        _recent_records.append(record[:5] + (msg[:MAX_RECORD_LEN] + '...', source))
+    else:
+        _recent_records.append(record)
+    if emit:
+        print(_format_record(record), file=sys.stderr, flush=True)
+
+
+def _format_record(record):
+    '''format a debug record (from debug()) as a log line'''
+    ctime, level, cfile, cfunction, cline, msg, source = record
+    omsg = '[%s] [%d] [%s:%s:%s] ' % (datetime.datetime.fromtimestamp(ctime).strftime('%Y-%m-%d %H:%M:%S'), level, cfile, cfunction, cline)
+    if source is not None:
+        omsg += '[IP: %s] ' % source
+    omsg += msg
+    return omsg
+
+
+def _update_min_level():
+    global _min_level
+
+    levels = [debuglevel] + list(_module_levels.values())
+    if ringlevel is not None:
+        levels.append(ringlevel)
+    _min_level = min(levels)
+
+
+def SetDebugLevel(level, module=None):
+    """
+    set the minimal level of the debug messages to print
+
+    input:
+    level : int or None
+        the minimal level. None to remove the module level (when module is not None)
+    module : str or None, optional
+        None to set the default level, or the module name (i.e. 'dbbact_server.dbsequences') to set the level only for this module
+    """
     global debuglevel
 
-    debuglevel = level
+    if module is None:
+        debuglevel = level
+    elif level is None:
+        _module_levels.pop(module, None)
+    else:
+        _module_levels[module] = level
+    _update_min_level()
+
+
+def SetDebugRingLevel(level, size=None):
+    """
+    set the minimal level of the debug records kept in the recent records ring buffer (see get_recent_debug())
+
+    input:
+    level : int or None
+        keep records with level >= level, even if they are not printed. None to keep only the printed records
+    size : int or None, optional
+        if not None, the number of records kept in the ring buffer
+    """
+    global ringlevel, _recent_records
+
+    ringlevel = level
+    if size is not None:
+        _recent_records = collections.deque(_recent_records, maxlen=size)
+    _update_min_level()
+
+
+def get_recent_debug(num=None, min_level=None):
+    """
+    get the recent debug records from the ring buffer
+
+    input:
+    num : int or None, optional
+        the maximal number of records to return (the most recent ones). None to return all
+    min_level : int or None, optional
+        return only records with level >= min_level
+
+    output:
+    records : list of str
+        the formatted records (oldest first)
+    """
+    records = list(_recent_records)
+    if min_level is not None:
+        records = [crec for crec in records if crec[1] >= min_level]
+    if num is not None:
+        records = records[-num:]
+    return [_format_record(crec) for crec in records]
 
 
 def getdoc(func):
@@ -134,3 +242,98 @@ def random_str(size=6, chars=string.ascii_uppercase + string.digits):
     random str : string of 6 characters
     """
     return ''.join(random.choice(chars) for _ in range(size))
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def create_token(secret, data, ttl):
+    """
+    create a signed token (HMAC-SHA256) containing the data and an expiration time
+
+    input:
+    secret : bytes
+        the key used to sign the token
+    data : dict
+        the data to store in the token (must be json serializable)
+    ttl : int
+        the token validity time (seconds)
+
+    output:
+    token : str
+        the signed token ("payload.signature", base64 encoded)
+    expires : int
+        the token expiration time (seconds since epoch)
+    """
+    expires = int(time.time() + ttl)
+    payload = dict(data)
+    payload['exp'] = expires
+    payload = _b64encode(json.dumps(payload, separators=(',', ':')).encode('utf8'))
+    signature = _b64encode(hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest())
+    return '%s.%s' % (payload, signature), expires
+
+
+def verify_token(secret, token):
+    """
+    verify a token created by create_token() and return its data
+
+    input:
+    secret : bytes
+        the key used to sign the token
+    token : str
+        the token to verify
+
+    output:
+    err : str
+        empty ('') if the token is valid, otherwise the reason it is not
+    data : dict or None
+        the data stored in the token (including the 'exp' expiration time)
+    """
+    try:
+        payload, signature = token.split('.')
+        expected = hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            return 'invalid token signature', None
+        data = json.loads(_b64decode(payload).decode('utf8'))
+    except Exception as e:
+        return 'malformed token: %s' % e, None
+    if data.get('exp', 0) < time.time():
+        return 'token expired', None
+    return '', data
+
+
+def get_token_secret(filename='dbbact-token-secret.key'):
+    """
+    get the key used to sign the login tokens. the key is created (randomly) if the file does not exist,
+    so all the workers of the server (and server restarts) use the same key
+
+    input:
+    filename : str, optional
+        name of the file containing the key
+
+    output:
+    secret : bytes
+    """
+    if not os.path.exists(filename):
+        # write to a temporary file and link it, so other workers never see a partial key
+        tmpname = '%s.%d' % (filename, os.getpid())
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fl:
+            fl.write(_b64encode(os.urandom(32)))
+        try:
+            os.link(tmpname, filename)
+            debug(5, 'created new token key file %s' % filename)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmpname)
+    with open(filename) as fl:
+        secret = fl.read().strip()
+    if len(secret) == 0:
+        raise ValueError('token key file %s is empty' % filename)
+    return secret.encode('ascii')
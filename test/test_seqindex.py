@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import random
+import sys
+
+from dbbact_server import seqindex
+
+__version__ = "0.9"
+
+'''Tests for the worker sequence indexes (dbbact_server/seqindex.py), comparing the PrefixIndex and CloseSequencesIndex lookups to brute force
+The indexes are built from random sequences (no database needed)
+Run using pytest, or directly (./test_seqindex.py)
+'''
+
+
+def random_seq(length, rand=random):
+	return ''.join(rand.choice('acgt') for _ in range(length))
+
+
+def mutate(seq, num_mismatches, rand=random):
+	seq = list(seq)
+	for cpos in rand.sample(range(len(seq)), num_mismatches):
+		seq[cpos] = rand.choice([cbase for cbase in 'acgt' if cbase != seq[cpos]])
+	return ''.join(seq)
+
+
+def make_index(index_class, seqs, changed=None):
+	'''build the index from a dict of {id: sequence}, and add the changed sequences ({id: sequence or None for deleted}) like refresh()'''
+	index = index_class()
+	ids = sorted(seqs.keys())
+	index._set_sequences(ids, [0] * len(ids), [seqs[cid] for cid in ids])
+	index.size = len(ids)
+	index._set_data(1, max(ids))
+	if changed:
+		for cid, cseq in changed.items():
+			if cseq is not None:
+				index._changed[cid] = (cseq, 0)
+		index._changed_ids.update(changed.keys())
+		index._set_changed()
+	return index
+
+
+def current_seqs(seqs, changed=None):
+	'''the database sequences after applying the changes'''
+	seqs = dict(seqs)
+	for cid, cseq in (changed or {}).items():
+		if cseq is None:
+			seqs.pop(cid, None)
+		else:
+			seqs[cid] = cseq
+	return seqs
+
+
+def prefix_brute(query, seqs, no_shorter=False, no_longer=False, min_length=0):
+	found = set()
+	for cid, cseq in seqs.items():
+		if len(cseq) < min_length:
+			continue
+		if cseq == query or (not no_longer and cseq.startswith(query)) or (not no_shorter and query.startswith(cseq)):
+			found.add(cid)
+	return found
+
+
+def close_brute(query, seqs, max_mismatches, test_left_trim):
+	found = []
+	for cid, cseq in seqs.items():
+		mismatches = sum(1 for cbase1, cbase2 in zip(query, cseq) if cbase1 != cbase2)
+		if mismatches > max_mismatches:
+			if not test_left_trim:
+				continue
+			mismatches = cseq.find(query)
+			if mismatches < 0 or mismatches > seqindex.MAX_LEFT_TRIM:
+				continue
+		found.append((mismatches, cid))
+	return sorted(found)
+
+
+def prefix_data(rand):
+	base = [random_seq(150, rand) for _ in range(20)]
+	seqs = {}
+	for cbase in base:
+		for clen in (100, 120, 150):
+			seqs[len(seqs) + 1] = cbase[:clen]
+		seqs[len(seqs) + 1] = cbase + random_seq(10, rand)
+		seqs[len(seqs) + 1] = mutate(cbase, 1, rand)
+	queries = [cbase[:clen] for cbase in base for clen in (90, 110, 120, 150, 160)] + [random_seq(150, rand) for _ in range(5)]
+	queries += [seqs[1] + 'acgt', seqs[2][:40]]
+	return seqs, queries
+
+
+def test_prefix_index():
+	rand = random.Random(1)
+	seqs, queries = prefix_data(rand)
+	index = make_index(seqindex.PrefixIndex, seqs)
+	for no_shorter, no_longer, min_length in [(False, False, 0), (True, False, 0), (False, True, 0), (True, True, 0), (False, False, 110), (False, False, 155)]:
+		res = index.lookup(queries, no_shorter=no_shorter, no_longer=no_longer, min_length=min_length)
+		for cquery, cres in zip(queries, res):
+			assert len(cres) == len(set(cres))
+			assert set(cid for cid, cprimer in cres) == prefix_brute(cquery, seqs, no_shorter, no_longer, min_length)
+
+
+def test_prefix_index_changed():
+	rand = random.Random(2)
+	seqs, queries = prefix_data(rand)
+	changed = {1: None, 2: seqs[7][:130], 3: mutate(seqs[3], 2, rand), len(seqs) + 1: seqs[12][:110], len(seqs) + 2: queries[0]}
+	index = make_index(seqindex.PrefixIndex, seqs, changed)
+	res = index.lookup(queries)
+	for cquery, cres in zip(queries, res):
+		assert sorted(cid for cid, cprimer in cres) == sorted(prefix_brute(cquery, current_seqs(seqs, changed)))
+
+
+def close_data(rand):
+	base = [random_seq(160, rand) for _ in range(30)]
+	seqs = {}
+	for cbase in base:
+		seqs[len(seqs) + 1] = cbase
+		for cnum in range(1, 7):
+			seqs[len(seqs) + 1] = mutate(cbase, cnum, rand)
+		seqs[len(seqs) + 1] = random_seq(20, rand) + cbase[:140]
+		seqs[len(seqs) + 1] = random_seq(40, rand) + cbase[:120]
+	# sequences not in the packed arrays (short or non ACGT)
+	seqs[len(seqs) + 1] = base[0][:80]
+	seqs[len(seqs) + 1] = base[1][:50] + 'n' + base[1][51:]
+	queries = []
+	for cbase in base[:10]:
+		queries += [cbase, mutate(cbase, 2, rand), cbase[:100], cbase[10:130], cbase[32:150], cbase[33:150]]
+	queries += [random_seq(150, rand), base[0][:80], base[1][:100], base[2][:50]]
+	return seqs, queries
+
+
+def test_close_index():
+	rand = random.Random(3)
+	seqs, queries = close_data(rand)
+	index = make_index(seqindex.CloseSequencesIndex, seqs)
+	for max_mismatches in range(seqindex.MAX_CLOSE_MISMATCHES + 1):
+		for test_left_trim in (False, True):
+			res = index.lookup(queries, max_mismatches=max_mismatches, test_left_trim=test_left_trim)
+			for cquery, cres in zip(queries, res):
+				if len(cquery) < seqindex.CLOSE_MIN_LENGTH:
+					assert cres is None
+					continue
+				assert [(cfound['num_mismatches'], cfound['seq_id']) for cfound in cres] == close_brute(cquery, seqs, max_mismatches, test_left_trim)
+				for cfound in cres:
+					assert cfound['sequence'] == seqs[cfound['seq_id']]
+
+
+def test_close_index_changed():
+	rand = random.Random(4)
+	seqs, queries = close_data(rand)
+	changed = {1: None, 2: mutate(seqs[2], 3, rand), len(seqs) + 1: mutate(queries[1], 1, rand), len(seqs) + 2: random_seq(10, rand) + queries[3]}
+	index = make_index(seqindex.CloseSequencesIndex, seqs, changed)
+	res = index.lookup(queries, max_mismatches=2)
+	for cquery, cres in zip(queries, res):
+		if cres is None:
+			continue
+		assert [(cfound['num_mismatches'], cfound['seq_id']) for cfound in cres] == close_brute(cquery, current_seqs(seqs, changed), 2, True)
+
+
+def main(argv):
+	for ctest in [test_prefix_index, test_prefix_index_changed, test_close_index, test_close_index_changed]:
+		ctest()
+		print('%s ok' % ctest.__name__)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
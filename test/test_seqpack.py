@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import argparse
+import random
+import sys
+import timeit
+
+import numpy as np
+
+from dbbact_server import seqpack
+
+__version__ = "0.9"
+
+'''Tests for the 2 bit packed sequences (dbbact_server/seqpack.py)
+Run using pytest, or directly (./test_seqpack.py) to also run the microbenchmarks comparing to the string versions
+'''
+
+
+def random_seq(length, rand=random):
+	return ''.join(rand.choice('acgt') for _ in range(length))
+
+
+def mutate(seq, num_mismatches, rand=random):
+	seq = list(seq)
+	for cpos in rand.sample(range(len(seq)), num_mismatches):
+		seq[cpos] = rand.choice([cbase for cbase in 'acgt' if cbase != seq[cpos]])
+	return ''.join(seq)
+
+
+def str_hamming(seq1, seq2):
+	return sum(1 for cbase1, cbase2 in zip(seq1, seq2) if cbase1 != cbase2)
+
+
+def concat_packed(seqs):
+	'''pack the sequences into one words array (like seqindex.CloseSequencesIndex)'''
+	packed = [seqpack.pack_codes(seqpack.encode(cseq)) for cseq in seqs]
+	offsets = np.zeros(len(seqs), dtype=np.int64)
+	offsets[1:] = np.cumsum([len(cwords) for cwords in packed])[:-1]
+	return np.concatenate(packed), offsets, np.array([len(cseq) for cseq in seqs])
+
+
+def test_round_trip():
+	rand = random.Random(1)
+	for clen in [0, 1, 31, 32, 33, 64, 150, 253]:
+		cseq = random_seq(clen, rand)
+		packed = seqpack.pack(cseq)
+		assert len(packed.words) == (clen + 31) // 32
+		assert seqpack.unpack(packed) == cseq
+		assert seqpack.unpack(seqpack.pack(cseq.upper())) == cseq
+		assert seqpack.decode(seqpack.unpack_codes(packed.words, clen)) == cseq
+
+
+def test_round_trip_escaped():
+	rand = random.Random(2)
+	cseq = random_seq(150, rand)
+	for cpos, cchar in [(0, 'n'), (31, 'r'), (32, 'y'), (100, 'n'), (149, 'k')]:
+		cseq = cseq[:cpos] + cchar + cseq[cpos + 1:]
+	packed = seqpack.pack(cseq)
+	assert packed.escapes == b'nrynk'
+	assert seqpack.unpack(packed) == cseq
+	assert seqpack.unpack(seqpack.pack(cseq.upper())) == cseq
+	assert not seqpack.is_acgt(seqpack.encode(cseq))
+	assert seqpack.is_acgt(seqpack.encode('acgtACGT'))
+
+
+def test_hamming_distance():
+	rand = random.Random(3)
+	query = random_seq(150, rand)
+	seqs = [mutate(query, cnum, rand) for cnum in range(6)]
+	# different lengths are compared on the shorter length
+	seqs += [mutate(query, 2, rand)[:100], mutate(query, 1, rand) + random_seq(50, rand), random_seq(64, rand), random_seq(150, rand)]
+	words, offsets, lengths = concat_packed(seqs)
+	for cquery in [query, query[:96], query[:33], query + 'acgt']:
+		res = seqpack.hamming_distance(words, offsets, lengths, seqpack.pack_codes(seqpack.encode(cquery)), len(cquery))
+		assert list(res) == [str_hamming(cquery, cseq) for cseq in seqs]
+	# subset of the sequences
+	res = seqpack.hamming_distance(words, offsets[[3, 0]], lengths[[3, 0]], seqpack.pack_codes(seqpack.encode(query)), len(query))
+	assert list(res) == [3, 0]
+
+
+def test_prefix_equal():
+	rand = random.Random(4)
+	query = random_seq(150, rand)
+	seqs = [query, query[:100], query + 'acg', mutate(query, 1, rand), query[:120] + random_seq(30, rand)]
+	words, offsets, lengths = concat_packed(seqs)
+	res = seqpack.prefix_equal(words, offsets, lengths, seqpack.pack_codes(seqpack.encode(query)), len(query))
+	assert list(res) == [cseq.startswith(query) or query.startswith(cseq) for cseq in seqs]
+
+
+def test_kmer_keys():
+	rand = random.Random(5)
+	cseq = random_seq(100, rand)
+	cseq = cseq[:50] + 'n' + cseq[51:]
+	codes = seqpack.encode(cseq)
+	keys, valid = seqpack.kmer_keys(codes, 16)
+	assert len(keys) == 85
+	for cpos in range(len(keys)):
+		ckmer = cseq[cpos:cpos + 16]
+		assert valid[cpos] == ('n' not in ckmer)
+		if valid[cpos]:
+			assert keys[cpos] == seqpack.pack_codes(seqpack.encode(ckmer))[0]
+	assert len(seqpack.kmer_keys(codes[:10], 16)[0]) == 0
+
+
+def test_find():
+	rand = random.Random(6)
+	cseq = random_seq(200, rand)
+	codes = seqpack.encode(cseq)
+	for cstart in [0, 1, 17, 32, 60]:
+		query = cseq[cstart:cstart + 120]
+		assert seqpack.find(codes, seqpack.encode(query)) == cseq.find(query)
+		assert seqpack.find(codes, seqpack.encode(query), cstart, cstart) == cstart
+	assert seqpack.find(codes, seqpack.encode(cseq[10:130]), 0, 5) == -1
+	assert seqpack.find(codes, seqpack.encode(random_seq(120, rand))) == -1
+
+
+def benchmark(num_seqs=10000, seq_len=150):
+	'''compare the packed functions to the string versions'''
+	rand = random.Random(7)
+	query = random_seq(seq_len, rand)
+	seqs = [mutate(query, rand.randint(0, 10), rand) for _ in range(num_seqs)]
+	words, offsets, lengths = concat_packed(seqs)
+	query_words = seqpack.pack_codes(seqpack.encode(query))
+	results = []
+
+	def bench(name, str_func, packed_func, number=3):
+		str_time = min(timeit.repeat(str_func, number=1, repeat=number))
+		packed_time = min(timeit.repeat(packed_func, number=1, repeat=number))
+		results.append((name, str_time, packed_time))
+
+	bench('hamming', lambda: [str_hamming(query, cseq) for cseq in seqs], lambda: seqpack.hamming_distance(words, offsets, lengths, query_words, seq_len))
+	bench('prefix', lambda: [cseq.startswith(query) or query.startswith(cseq) for cseq in seqs], lambda: seqpack.prefix_equal(words, offsets, lengths, query_words, seq_len))
+	whole_seq = random_seq(1500, rand)
+	short_seqs = set(random_seq(seq_len, rand) for _ in range(1000))
+	bench('kmer scan', lambda: [cpos for cpos in range(len(whole_seq) - seq_len) if whole_seq[cpos:cpos + seq_len] in short_seqs],
+		lambda: seqpack.kmer_keys(seqpack.encode(whole_seq), 32))
+	print('%d sequences of length %d' % (num_seqs, seq_len))
+	print('%-12s %12s %12s %8s' % ('test', 'str (sec)', 'packed (sec)', 'speedup'))
+	for cname, cstr_time, cpacked_time in results:
+		print('%-12s %12.5f %12.5f %8.1f' % (cname, cstr_time, cpacked_time, cstr_time / cpacked_time))
+	# memory per sequence
+	print('memory per sequence: str %d bytes, packed %d bytes' % (sys.getsizeof(query), seqpack.pack(query).words.nbytes))
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='seqpack tests and microbenchmarks. version ' + __version__)
+	parser.add_argument('--num-seqs', help='number of sequences in the benchmark', default=10000, type=int)
+	parser.add_argument('--seq-len', help='sequence length in the benchmark', default=150, type=int)
+	parser.add_argument('--no-benchmark', help='only run the tests', action='store_true')
+	args = parser.parse_args(argv)
+
+	for ctest in [test_round_trip, test_round_trip_escaped, test_hamming_distance, test_prefix_equal, test_kmer_keys, test_find]:
+		ctest()
+		print('%s ok' % ctest.__name__)
+	if not args.no_benchmark:
+		benchmark(num_seqs=args.num_seqs, seq_len=args.seq_len)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -12,7 +12,7 @@ from collections import defaultdict
 
 import psycopg2
 
-from dbbact_server import db_access
+from dbbact_server import db_access, dbchanges
 from dbbact_server.utils import debug, SetDebugLevel
 
 __version__ = "0.1"
@@ -30,6 +30,9 @@ def add_dbbact_ids(con, cur):
 		cid = cres['id']
 		new_id_ontology = 'dbbact:%s' % cid
 		cur.execute('UPDATE ontologytable SET term_id=%s WHERE id=%s', [new_id_ontology, cid])
+	err = dbchanges.add_change(con, cur, 'term', [cres['id'] for cres in res])
+	if err:
+		raise ValueError(err)
 	debug(3, 'committing')
 	con.commit()
 	debug(3, 'done')
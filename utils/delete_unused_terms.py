@@ -9,7 +9,7 @@ import sys
 import argparse
 import setproctitle
 
-from dbbact_server import db_access
+from dbbact_server import db_access, dbchanges
 from dbbact_server.utils import debug, SetDebugLevel
 
 __version__ = "0.1"
@@ -26,7 +26,7 @@ def delete_unused_terms(con, cur, commit=True):
 	True to commit the changes to the database. False to run without changing
 	'''
 	debug(3, 'deleting unused terms')
-	num_deleted = 0
+	deleted_ids = []
 	cur.execute('SELECT id, description FROM OntologyTable')
 	res = cur.fetchall()
 	debug(3, 'found %d terms' % len(res))
@@ -49,9 +49,12 @@ def delete_unused_terms(con, cur, commit=True):
 		# first delete from synonymstable
 		cur.execute('DELETE FROM OntologySynonymTable WHERE idontology=%s', [cid])
 		cur.execute('DELETE FROM OntologyTable WHERE id=%s', [cid])
-		num_deleted += 1
-	debug(3, 'found %d unused terms to delete' % num_deleted)
+		deleted_ids.append(cid)
+	debug(3, 'found %d unused terms to delete' % len(deleted_ids))
 	if commit:
+		err = dbchanges.add_change(con, cur, 'term', deleted_ids)
+		if err:
+			raise ValueError(err)
 		con.commit()
 		debug(3, 'committed')
 	else:
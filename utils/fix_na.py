@@ -12,7 +12,7 @@ from collections import defaultdict
 import oboparse
 import psycopg2
 
-from dbbact_server import db_access
+from dbbact_server import db_access, dbchanges, ontology_closure
 from dbbact_server.utils import debug, SetDebugLevel
 
 __version__ = "0.1"
@@ -45,6 +45,7 @@ def fix_na(con, cur, commit=False):
 	debug(3, 'Found %d dbbact terms' % cur.rowcount)
 	res = cur.fetchall()
 	num_na_parents = 0
+	changed_ids = set()
 	for cres in res:
 		cur.execute('SELECT * FROM OntologyTreeStructureTable WHERE ontologyid=%s', [cres['id']])
 		tres = cur.fetchall()
@@ -56,7 +57,15 @@ def fix_na(con, cur, commit=False):
 			if ttres['description'] == 'na':
 				cur.execute('UPDATE OntologyTreeStructureTable SET ontologyparentid=%s, ontologynameid=%s WHERE uniqueid=%s', [root_id, ontologynameid, ctres['uniqueid']])
 				num_na_parents += 1
+				changed_ids.add(cres['id'])
 	debug(4, 'updating %d dbbact terms roots' % num_na_parents)
+	err = ontology_closure.update_closure(con, cur, list(changed_ids))
+	if err:
+		raise ValueError(err)
+	# the term parents changed
+	err = dbchanges.add_change(con, cur, 'term')
+	if err:
+		raise ValueError(err)
 	if commit:
 		con.commit()
 		debug(3, 'commited')
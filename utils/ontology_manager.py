@@ -11,7 +11,7 @@ from collections import defaultdict
 
 import psycopg2
 
-from dbbact_server import db_access
+from dbbact_server import db_access, dbannotations, dbchanges, ontology_closure
 from dbbact_server.utils import debug, SetDebugLevel
 
 __version__ = "1.0"
@@ -114,6 +114,7 @@ def add_term(ctx, term):
 	term = term.lower()
 	debug(3, 'add-term for term %s' % term)
 	term_id = _add_dbbact_term(con, cur, term)
+	dbchanges.add_change(con, cur, 'term', term_id)
 	con.commit()
 	_write_log(log_file, 'add_term for term: %s (id: %s)' % (term, term_id))
 
@@ -157,6 +158,12 @@ def delete_term(ctx, term, delete_from_annotations):
 	cur.execute('DELETE FROM ontologytreestructuretable WHERE ontologyid=%s', [term_id])
 	# and delete the term itself
 	cur.execute('DELETE FROM ontologytable WHERE id=%s', [term_id])
+	err = ontology_closure.update_closure(con, cur, [term_id])
+	if err:
+		raise ValueError(err)
+	# the annotation details/parents shown by the server may have changed
+	dbannotations.invalidate_annotation_cache(con, cur)
+	dbchanges.add_change(con, cur, 'term')
 	con.commit()
 	_write_log(log_file, 'delete_term for term: %s (id: %s)' % (term, term_id))
 
@@ -294,6 +301,10 @@ def add_parent(ctx, term, parent, add_if_not_exist, old_parent, only_dbbact):
 	# add to the OntologyTreeStructureTable
 	cur.execute('INSERT INTO ontologytreestructuretable (ontologyid, ontologyparentid, ontologynameid) VALUES (%s, %s, %s)', [term_id, parent_term_id, ontology_database_id])
 	debug(3, 'Inserted into ontologytreestructuretable')
+	err = ontology_closure.update_closure(con, cur, [term_id])
+	if err:
+		raise ValueError(err)
+	dbchanges.add_change(con, cur, 'term', term_id)
 	if commit:
 		_write_log(log_file, 'add_parent for term: %s (id: %s) parent: %s (id: %s)' % (term, term_id, parent, parent_term_id))
 		con.commit()
@@ -344,6 +355,9 @@ def rename_term(ctx, old_term, new_term, experiments, add_if_not_exist, ignore_n
 			raise ValueError('new term %s already exists as term_id' % new_term)
 		cur.execute('UPDATE OntologyTable SET description=%s WHERE id=%s', [new_term, old_term_id])
 		_write_log(log_file, 'rename_term for old_term: %s (id: %s) to new_term: %s in place' % (old_term, old_term_id, new_term))
+		# the annotation details/parents shown by the server may have changed
+		dbannotations.invalidate_annotation_cache(con, cur)
+		dbchanges.add_change(con, cur, 'term')
 		con.commit()
 		debug(3, 'done')
 		return
@@ -391,8 +405,14 @@ def rename_term(ctx, old_term, new_term, experiments, add_if_not_exist, ignore_n
 			res = cur.fetchall()
 			for cres in res:
 				cur.execute('UPDATE OntologyTreeStructureTable SET ontologyparentid=%s WHERE uniqueid=%s', [new_term_id, cres['uniqueid']])
+			err = ontology_closure.update_closure(con, cur, [cres['ontologyid'] for cres in res])
+			if err:
+				raise ValueError(err)
 
 	_write_log(log_file, 'rename_term for old_term: %s (id: %s) to new_term: %s (id: %s)' % (old_term, old_term_id, new_term, new_term_id))
+	# the annotation details/parents shown by the server may have changed
+	dbannotations.invalidate_annotation_cache(con, cur)
+	dbchanges.add_change(con, cur, 'term')
 	con.commit()
 	debug(3, 'done')
 
@@ -451,6 +471,9 @@ def add_term_to_annotation(ctx, old_term, new_term, experiments, add_if_not_exis
 		num_added += 1
 	debug(3, 'added new term to %d annotations (%d annotations skipped)' % (num_added, num_non_match))
 	_write_log(log_file, 'add_term_to_annotation for old_term: %s (id: %s) to new_term: %s (id: %s)' % (old_term, old_term_id, new_term, new_term_id))
+	# the annotation details/parents shown by the server may have changed
+	dbannotations.invalidate_annotation_cache(con, cur)
+	dbchanges.add_change(con, cur, 'term')
 	con.commit()
 	debug(3, 'done')
 
@@ -504,6 +527,9 @@ def combine_terms(ctx, term1, term2):
 
 	debug(3, 'added new term to %d annotations (%d annotations skipped)' % (num_added, num_non_match))
 	_write_log(log_file, 'combine_terms for term: %s (id: %s) and term: %s (id: %s)' % (term1, term1_id, term2, term2_id))
+	# the annotation details/parents shown by the server may have changed
+	dbannotations.invalidate_annotation_cache(con, cur)
+	dbchanges.add_change(con, cur, 'term')
 	con.commit()
 	debug(3, 'done')
 
@@ -12,7 +12,7 @@ import argparse
 import psycopg2
 import psycopg2.extras
 
-from dbbact_server import db_access
+from dbbact_server import db_access, dbannotations
 from dbbact_server.utils import debug, SetDebugLevel
 
 __version__ = "0.9"
@@ -34,6 +34,10 @@ def add_annotation_seq_count(con, cur):
 		cur2.execute('UPDATE annotationstable SET seqcount=%s WHERE id=%s', [num_seqs, cid])
 		num_anno += 1
 	debug(2, 'scanned %d annotations.' % num_anno)
+	# the annotation seqcount is cached by the server workers
+	err = dbannotations.invalidate_annotation_cache(con, cur)
+	if err:
+		raise ValueError(err)
 	debug(2, 'committing')
 	con.commit()
 	debug(3, 'done')
@@ -14,7 +14,7 @@ from collections import defaultdict
 import oboparse
 import psycopg2
 
-from dbbact_server import db_access
+from dbbact_server import db_access, dbannotations
 from dbbact_server.utils import debug, SetDebugLevel
 
 __version__ = "0.1"
@@ -115,6 +115,8 @@ def update_obsolete_terms(con, cur, ontofilename, ontology_name=None, commit=Tru
 					debug(5, 'entry already exists for annotation %d' % cidannotation)
 				cur.execute('DELETE FROM AnnotationListTable WHERE idannotation=%s AND idannotationdetail=%s AND idontology=%s', [cidannotation, cidannotationdetail, cobsolete_id])
 			debug(3, 'did it for term %s replace with term %s' % (cobsolete_term, cname))
+	# the annotation details shown by the server workers changed
+	dbannotations.invalidate_annotation_cache(con, cur)
 	if commit:
 		con.commit()
 	debug(3, 'done')